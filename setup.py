@@ -29,7 +29,6 @@ setup(
         'Click',
         'fastapi',
         'hiredis',
-        'python-consul',
         'python-dateutil',
         'psycopg2',
         'requests',
@@ -39,6 +38,7 @@ setup(
         'uvicorn',
         'email-validator',
     ],
+    extras_require={'msgpack': ['msgpack']},
     packages=find_packages(),
     include_package_data=True,
     classifiers=[
@@ -6,9 +6,13 @@ from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 
 from .auth import setup_auth
+from .changes import setup_changes
 from .consul import setup_consul
 from .database import setup_database, setup_aiopg_database, upgrade_database
+from .middleware import setup_middleware
 from .redis import setup_redis
+from .routing_table import setup_routing_table
+from .services.password import setup_password_hasher
 from .routers import carriers
 from .routers import carrier_trunks
 from .routers import cdr
@@ -21,6 +25,7 @@ from .routers import routing_rules
 from .routers import routing_group
 from .routers import status
 from .routers import tenants
+from .warmup import setup_warmup
 
 
 def get_app(config: dict):
@@ -37,6 +42,10 @@ def get_app(config: dict):
     if config.get('database_upgrade'):
         upgrade_database(app, config)
     app = setup_redis(app, config)
+    app = setup_routing_table(app, config)
+    app = setup_changes(app, config)
+    app = setup_warmup(app, config)
+    app = setup_password_hasher(app, config)
     app.include_router(status.router, tags=['status'])
 
     app.include_router(carriers.router, prefix="/1.0", tags=['carriers'])
@@ -52,6 +61,7 @@ def get_app(config: dict):
     app.include_router(tenants.router, prefix="/1.0", tags=['tenants'])
 
     app = setup_auth(app, config)
+    app = setup_middleware(app)
 
     app.add_middleware(
         CORSMiddleware,
@@ -1,12 +1,8 @@
 from dataclasses import dataclass
 from typing import Optional, List
 
-from aiohttp import ClientSession
-from aiohttp import TCPConnector  # type: ignore
-
 from fastapi import FastAPI
 from starlette.requests import Request
-from starlette.responses import Response
 
 
 X_AUTH_TOKEN_HEADER = 'X-Auth-Token'
@@ -28,6 +24,10 @@ class AuthClient(object):
         self._cert = cert
 
     async def get_token_data(self, token: str, tenant_uuid: str) -> Optional[Principal]:
+        # only loaded when the authentication is enabled
+        from aiohttp import ClientSession
+        from aiohttp import TCPConnector  # type: ignore
+
         verify_ssl = bool(self._cert)
         connector = TCPConnector(verify_ssl=verify_ssl)
         async with ClientSession(connector=connector) as session:
@@ -79,21 +79,6 @@ def setup_auth(app: FastAPI, config: dict) -> FastAPI:
         auth_client = AuthClient(
             url=config['wazo_auth_url'], cert=bool(config['wazo_auth_cert'])
         )
-
-        # pylint: disable= unused-variable
-        @app.middleware("http")
-        async def auth_middleware(request: Request, call_next):
-            header = request.headers.get(X_AUTH_TOKEN_HEADER)
-            if header is None:
-                return Response(
-                    "Missing %s header" % X_AUTH_TOKEN_HEADER, status_code=401
-                )
-            tenant_uuid = request.headers.get(WAZO_TENANT)
-            principal = await auth_client.get_token_data(header, tenant_uuid)
-            if principal is None:
-                return Response("The provided token is not valid", status_code=401)
-            request.state.principal = principal
-            response = await call_next(request)
-            return response
+        setattr(app, 'auth_client', auth_client)
 
     return app
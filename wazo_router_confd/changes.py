@@ -0,0 +1,358 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import logging
+
+from collections import deque
+from itertools import islice
+from json import dumps, loads
+from time import monotonic
+from typing import Any, AsyncIterator, Callable, Deque, List, Optional, Set
+
+import aiopg  # type: ignore
+
+from fastapi import FastAPI, HTTPException
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from wazo_router_confd.auth import Principal
+from wazo_router_confd.database import from_database_uri_to_dsn
+from wazo_router_confd.models.changes import CHANGES_CHANNEL, CHANGES_REVISION_SEQUENCE
+
+
+logger = logging.getLogger(__name__)
+
+ChangeHandler = Callable[[Optional[List[dict]]], Any]
+
+
+class ChangeListener(object):
+    """Dispatch the changes of the configuration tables notified by Postgres.
+
+    The triggers of the tables notify every change, including the ones made
+    outside of the API by migrations or scripts. The listener holds its own
+    connection, the notifications received together are dispatched as one
+    batch, and the handlers are called with None when some changes may have
+    been missed while disconnected. Postgres delivers the notifications in
+    the commit order of their transactions, the changes are dispatched in
+    this order.
+    """
+
+    dsn: str
+    check_interval: float
+    retry_interval: float
+    handlers: List[ChangeHandler]
+    connected: bool
+    since: Optional[int]
+    revision: Optional[int]
+    task: Optional[asyncio.Future]
+
+    def __init__(
+        self, dsn: str, check_interval: float = 30.0, retry_interval: float = 5.0
+    ):
+        self.dsn = dsn
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.handlers = []
+        self.connected = False
+        self.since = None
+        self.revision = None
+        self.task = None
+
+    def add_handler(self, handler: ChangeHandler):
+        """Call `handler` with each batch of changes, awaited if a coroutine."""
+        self.handlers.append(handler)
+
+    async def dispatch(self, changes: Optional[List[dict]]):
+        for handler in self.handlers:
+            try:
+                result = handler(changes)
+                if asyncio.iscoroutine(result):
+                    await result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Configuration change handler failed: %s", e)
+
+    async def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        disconnected = False
+        while True:
+            try:
+                async with aiopg.connect(self.dsn) as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute('LISTEN %s' % CHANGES_CHANNEL)
+                        # the changes notified from now on follow this revision
+                        await cur.execute(
+                            'SELECT CASE WHEN is_called THEN last_value ELSE 0 END '
+                            'FROM %s' % CHANGES_REVISION_SEQUENCE
+                        )
+                        (since,) = await cur.fetchone()
+                    self.connected = True
+                    self.since = self.revision = since
+                    if disconnected:
+                        await self.dispatch(None)
+                    await self.listen(conn)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Configuration changes listener failed: %s", e)
+            if self.connected:
+                self.connected = False
+                disconnected = True
+            await asyncio.sleep(self.retry_interval)
+
+    async def listen(self, conn: Any):
+        while True:
+            try:
+                notify = await asyncio.wait_for(
+                    conn.notifies.get(), self.check_interval
+                )
+            except asyncio.TimeoutError:
+                # a lost connection is only noticed when using it
+                async with conn.cursor() as cur:
+                    await cur.execute('SELECT 1')
+                continue
+            notifies = [notify]
+            while not conn.notifies.empty():
+                notifies.append(await conn.notifies.get())
+            changes = []
+            for notify in notifies:
+                try:
+                    changes.append(loads(notify.payload))
+                except ValueError:
+                    logger.warning("Invalid configuration change %s", notify.payload)
+            if changes:
+                self.revision = changes[-1]['revision']
+                await self.dispatch(changes)
+
+
+class ChangeFeed(object):
+    """The recent configuration changes, streamed to the edge nodes.
+
+    The changes are kept from the revision the listener connected at, a
+    stream resuming after a known revision gets the changes notified after
+    it, and a reset when they are no longer known, telling the client to
+    reload the whole configuration.
+    """
+
+    listener: ChangeListener
+    size: int
+    queue_size: int
+    changes: Deque[dict]
+    evicted: Optional[int]
+    queues: List[asyncio.Queue]
+
+    def __init__(
+        self, listener: ChangeListener, size: int = 10000, queue_size: int = 1000
+    ):
+        self.listener = listener
+        self.size = size
+        self.queue_size = queue_size
+        self.changes = deque()
+        self.evicted = None
+        self.queues = []
+        listener.add_handler(self.publish)
+
+    def get_floor(self) -> Optional[int]:
+        """The revision after which every change is known."""
+        if self.evicted is not None:
+            return self.evicted
+        return self.listener.since
+
+    def publish(self, changes: Optional[List[dict]]):
+        if changes is None:
+            # reconnected, the changes since the last connection are unknown
+            self.changes.clear()
+            self.evicted = None
+        else:
+            self.changes.extend(changes)
+            while len(self.changes) > self.size:
+                self.evicted = self.changes.popleft()['revision']
+        for queue in self.queues:
+            if changes is not None and queue.qsize() < self.queue_size:
+                queue.put_nowait(changes)
+                continue
+            # a stream which does not keep up is reset
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+    def replay(self, after: int) -> Optional[List[dict]]:
+        """The changes notified after the revision `after`, None if unknown."""
+        floor = self.get_floor()
+        if floor is None:
+            return None
+        if after == floor:
+            return list(self.changes)
+        # the revisions are not ordered, the changes are
+        for index, change in enumerate(self.changes):
+            if change['revision'] == after:
+                return list(islice(self.changes, index + 1, None))
+        return None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        self.queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.queues.remove(queue)
+
+
+def format_event(event: str, data: dict, event_id: Optional[int] = None) -> str:
+    lines = ['event: %s' % event, 'data: %s' % dumps(data)]
+    if event_id is not None:
+        lines.insert(0, 'id: %d' % event_id)
+    return '\n'.join(lines) + '\n\n'
+
+
+def get_stream_tenants(
+    principal: Optional[Principal], tenant_uuid: Optional[str] = None
+) -> Optional[Set[str]]:
+    """The tenants whose changes are streamed to the client, None for all."""
+    tenant_uuids = None
+    if principal is not None and principal.tenant_uuids:
+        tenant_uuids = set(principal.tenant_uuids)
+    if tenant_uuid is None:
+        return tenant_uuids
+    if tenant_uuids is not None and tenant_uuid not in tenant_uuids:
+        raise HTTPException(
+            status_code=403, detail="Token not valid for tenant_uuid %s" % tenant_uuid
+        )
+    return {tenant_uuid}
+
+
+async def stream_changes(
+    feed: ChangeFeed,
+    tenant_uuids: Optional[Set[str]] = None,
+    after: Optional[int] = None,
+    timeout: float = 300.0,
+    keepalive_interval: float = 15.0,
+) -> AsyncIterator[str]:
+    """Server-sent events of the changes of `tenant_uuids`, of every tenant
+    if None.
+
+    Each change is sent with its revision as event id, so that a client
+    reconnecting with Last-Event-ID resumes where it stopped. The queue is
+    subscribed to before the replay, without await in between, so that no
+    change is missed or sent twice.
+    """
+
+    def is_visible(change: dict) -> bool:
+        # a truncation is not related to a tenant
+        return (
+            tenant_uuids is None
+            or change['tenant'] is None
+            or change['tenant'] in tenant_uuids
+        )
+
+    def reset() -> str:
+        return format_event('reset', dict(revision=feed.listener.revision))
+
+    queue = feed.subscribe()
+    try:
+        if after is not None:
+            changes = feed.replay(after)
+            if changes is None:
+                yield reset()
+            for change in changes or []:
+                if is_visible(change):
+                    yield format_event('change', change, change['revision'])
+        deadline = monotonic() + timeout
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                changes = await asyncio.wait_for(
+                    queue.get(), min(keepalive_interval, remaining)
+                )
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            if changes is None:
+                yield reset()
+                continue
+            for change in changes:
+                if is_visible(change):
+                    yield format_event('change', change, change['revision'])
+    finally:
+        feed.unsubscribe(queue)
+
+
+class EventStreamResponse(StreamingResponse):
+    """Stream events until the client disconnects."""
+
+    media_type = 'text/event-stream'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        async def wait_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        stream = asyncio.ensure_future(super().__call__(scope, receive, send))
+        disconnect = asyncio.ensure_future(wait_for_disconnect())
+        done, _ = await asyncio.wait(
+            [stream, disconnect], return_when=asyncio.FIRST_COMPLETED
+        )
+        disconnect.cancel()
+        if stream not in done:
+            stream.cancel()
+        await asyncio.gather(stream, disconnect, return_exceptions=True)
+        if stream in done:
+            stream.result()
+
+
+def get_change_feed(request: Request) -> Optional[ChangeFeed]:
+    return getattr(request.state, 'change_feed', None)
+
+
+def get_changed_tables(changes: Optional[List[dict]]) -> Optional[List[str]]:
+    if changes is None:
+        return None
+    return sorted({change['table'] for change in changes})
+
+
+async def flush_changes(redis: Any, changes: Optional[List[dict]]):
+    """Flush the Redis cache once for a batch of changes.
+
+    Every process listens to the changes, the batch is flushed by the first
+    of them, as told by its last revision.
+    """
+    if changes is None:
+        # the missed changes have no revision
+        await redis.flushdb()
+        return
+    revision = max(change['revision'] for change in changes)
+    await redis.flushdb_once('revision-%d' % revision)
+
+
+def setup_changes(app: FastAPI, config: dict) -> FastAPI:
+    if not config.get('database_change_listener'):
+        return app
+    listener = ChangeListener(from_database_uri_to_dsn(config['database_uri']))
+    setattr(app, 'change_listener', listener)
+    # the changes made through the API are also invalidated by the requests,
+    # these handlers catch the others
+    redis = getattr(app, 'redis')
+    listener.add_handler(lambda changes: flush_changes(redis, changes))
+    bus = getattr(app, 'invalidation_bus')
+    listener.add_handler(lambda changes: bus.invalidate(get_changed_tables(changes)))
+    setattr(
+        app,
+        'change_feed',
+        ChangeFeed(listener, size=int(config.get('change_feed_size') or 10000)),
+    )
+    app.add_event_handler("startup", listener.start)
+    app.add_event_handler("shutdown", listener.stop)
+    return app
@@ -0,0 +1,122 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import re
+
+from hashlib import sha1
+from json import dumps
+from typing import Any, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import Text, cast, column
+from starlette.requests import Request
+from starlette.responses import Response
+
+
+ROW_VERSION = 'row_version'
+
+re_etags = re.compile(r'\*|(?:W/)?"[^"]*"')
+
+
+def get_row_version(table: Any) -> Any:
+    """The version of the rows of `table`.
+
+    The xmin system column of Postgres, the transaction which wrote the row,
+    changes with each update of the row and needs no upkeep.
+    """
+    return cast(column('xmin', _selectable=table), Text)
+
+
+def format_etag(version: str, weak: bool = False) -> str:
+    return '%s"%s"' % ('W/' if weak else '', version)
+
+
+def get_page_etag(versions: List[Any]) -> str:
+    digest = sha1(dumps(versions, default=str).encode('utf-8')).hexdigest()
+    return format_etag(digest, weak=True)
+
+
+def parse_etags(header: Optional[str]) -> Optional[List[str]]:
+    if header is None:
+        return None
+    return re_etags.findall(header)
+
+
+def strip_weak(etag: str) -> str:
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+class Conditional(object):
+    """The validators of a conditional request.
+
+    The reads are not modified when the ETag of the resource is one of
+    If-None-Match, by weak comparison. The writes are made when the ETag is
+    one of If-Match, by strong comparison, and fail with 412 otherwise.
+    """
+
+    if_match: Optional[List[str]]
+    if_none_match: Optional[List[str]]
+    response: Optional[Response]
+    etag: Optional[str]
+
+    def __init__(
+        self,
+        if_match: Optional[List[str]] = None,
+        if_none_match: Optional[List[str]] = None,
+        response: Optional[Response] = None,
+    ):
+        self.if_match = if_match
+        self.if_none_match = if_none_match
+        self.response = response
+        self.etag = None
+
+    def set_etag(self, etag: str):
+        self.etag = etag
+        if self.response is not None:
+            self.response.headers['ETag'] = etag
+
+    @property
+    def not_modified(self) -> bool:
+        if self.etag is None or self.if_none_match is None:
+            return False
+        return '*' in self.if_none_match or strip_weak(self.etag) in {
+            strip_weak(etag) for etag in self.if_none_match
+        }
+
+    def get_not_modified_response(self) -> Response:
+        return Response(status_code=304, headers={'ETag': self.etag or ''})
+
+    def precondition_failed(self):
+        raise HTTPException(status_code=412, detail="Precondition failed")
+
+    def guard(self, statement: Any, table: Any, row: Any) -> Any:
+        """The write `statement` of `row`, made only if its version is the
+        one of If-Match.
+
+        The version is also checked by the statement, as the row may be
+        changed by another transaction meanwhile; the statement then returns
+        no row.
+        """
+        if self.if_match is None or '*' in self.if_match:
+            return statement
+        if format_etag(row[ROW_VERSION]) not in self.if_match:
+            self.precondition_failed()
+        return statement.where(get_row_version(table) == row[ROW_VERSION])
+
+    def written(self, row: Any) -> Any:
+        """The row returned by a guarded statement, None if changed meanwhile."""
+        if row is None:
+            if self.if_match is not None:
+                self.precondition_failed()
+            return None
+        if ROW_VERSION in row.keys():
+            self.set_etag(format_etag(row[ROW_VERSION]))
+        return row
+
+
+def get_conditional(request: Request, response: Response) -> Conditional:
+    return Conditional(
+        if_match=parse_etags(request.headers.get('if-match')),
+        if_none_match=parse_etags(request.headers.get('if-none-match')),
+        response=response,
+    )
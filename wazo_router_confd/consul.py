@@ -1,90 +1,419 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from typing import Optional
+import asyncio
+import logging
 
-from urllib.parse import urlparse
+from base64 import b64decode
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import quote, urlparse
 from uuid import uuid4
-from typing import Tuple
 
-from consul import Consul  # type: ignore
 from fastapi import FastAPI
 from pydantic import NoneBytes
 
+from wazo_router_confd.database import get_worker_pool_size
+
+if TYPE_CHECKING:  # pragma: no cover
+    import aiohttp  # noqa
+
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_PREFIX = 'wazo-router-confd.'
+
+CONSUL_SETTINGS = (
+    'database_uri',
+    'database_pool_min_size',
+    'database_pool_max_size',
+    'database_pool_acquire_timeout',
+    'database_pool_max_lifetime',
+    'database_statement_timeout',
+    'database_replica_uris',
+    'database_replica_max_lag',
+    'database_replica_check_interval',
+    'redis_timeout',
+    'redis_failure_threshold',
+    'redis_reset_timeout',
+    'redis_local_cache_size',
+    'redis_invalidation_poll_interval',
+    'routing_table_check_interval',
+)
+
+
+def run_sync(coroutine: Awaitable) -> Any:
+    """Run a Consul call outside of the event loop of the server."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
 
 class ConsulService(object):
-    def __init__(self, consul_uri: str):
+    """Client of the HTTP API of the Consul agent.
+
+    The calls do not block the event loop; the KV reads can be blocking
+    queries, returning once the data changed past a given index.
+    """
+
+    url: str
+    timeout: float
+    session: Optional['aiohttp.ClientSession']
+
+    def __init__(self, consul_uri: str, timeout: float = 10.0):
         uri = urlparse(consul_uri)
-        self._consul_uri = consul_uri
-        self._consul = Consul(host=uri.hostname, port=uri.port)
+        self.url = '%s://%s:%d/v1' % (
+            uri.scheme if uri.scheme in ('http', 'https') else 'http',
+            uri.hostname or 'localhost',
+            uri.port or 8500,
+        )
+        self.timeout = timeout
+        self.session = None
+
+    async def connect(self):
+        # only loaded when Consul is configured
+        from aiohttp import ClientSession
+
+        self.session = ClientSession()
+
+    async def disconnect(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request(
+        self, method: str, path: str, timeout: Optional[float] = None, **kwargs
+    ) -> Tuple[int, Any, Any]:
+        if self.session is None:
+            from aiohttp import ClientSession
 
-    def register(
+            # one-shot calls, made before the server is started
+            async with ClientSession() as session:
+                return await self.send(session, method, path, timeout, **kwargs)
+        return await self.send(self.session, method, path, timeout, **kwargs)
+
+    async def send(
+        self,
+        session: 'aiohttp.ClientSession',
+        method: str,
+        path: str,
+        timeout: Optional[float] = None,
+        **kwargs
+    ) -> Tuple[int, Any, Any]:
+        from aiohttp.client import ClientTimeout
+
+        async with session.request(
+            method,
+            self.url + path,
+            timeout=ClientTimeout(total=timeout or self.timeout),
+            **kwargs
+        ) as response:
+            if response.status == 404:
+                return response.status, response.headers, None
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+            return response.status, response.headers, data
+
+    async def register(
         self,
         service_id: str,
         name: str,
         address: Optional[str] = None,
         port: Optional[int] = None,
-        tags: Tuple[str] = None,
+        tags: Tuple[str, ...] = None,
         check: Optional[dict] = None,
     ):
-        self._consul.agent.service.register(
-            name,
-            service_id=service_id,
-            address=address,
-            port=port,
-            tags=tags,
-            check=check,
+        service: Dict[str, Any] = dict(ID=service_id, Name=name)
+        if address is not None:
+            service['Address'] = address
+        if port is not None:
+            service['Port'] = port
+        if tags is not None:
+            service['Tags'] = list(tags)
+        if check is not None:
+            service['Check'] = check
+        await self.request('PUT', '/agent/service/register', json=service)
+
+    async def deregister(self, service_id: str):
+        await self.request('PUT', '/agent/service/deregister/%s' % quote(service_id))
+
+    async def get(self, key: str) -> NoneBytes:
+        _, _, data = await self.request('GET', '/kv/%s' % quote(key))
+        return b64decode(data[0]['Value']) if data and data[0]['Value'] else None
+
+    async def put(self, key: str, value: str) -> bool:
+        _, _, data = await self.request(
+            'PUT', '/kv/%s' % quote(key), data=value.encode('utf-8')
         )
+        return bool(data)
+
+    async def get_prefix(
+        self, prefix: str, index: Optional[int] = None, wait: Optional[float] = None
+    ) -> Tuple[int, Dict[str, bytes]]:
+        """The keys under `prefix` and the index of the KV store.
+
+        With an index, the call returns when the keys changed past it or
+        after `wait` seconds.
+        """
+        params = dict(recurse='true')
+        timeout = None
+        if index is not None:
+            params['index'] = str(index)
+            if wait is not None:
+                params['wait'] = '%ds' % wait
+                # the agent adds up to wait / 16 to the wait time
+                timeout = wait * 1.1 + self.timeout
+        _, headers, data = await self.request(
+            'GET', '/kv/%s' % quote(prefix), timeout=timeout, params=params
+        )
+        return (
+            int(headers.get('X-Consul-Index') or 0),
+            {
+                entry['Key']: b64decode(entry['Value']) if entry['Value'] else b''
+                for entry in data or []
+            },
+        )
+
+
+def get_settings(values: Dict[str, bytes]) -> Dict[str, str]:
+    settings = {}
+    for key, value in values.items():
+        name = key[len(SETTINGS_PREFIX) :]
+        if key.startswith(SETTINGS_PREFIX) and name in CONSUL_SETTINGS:
+            settings[name] = value.decode('utf-8')
+    return settings
+
+
+def load_settings(consul: ConsulService, config: dict) -> int:
+    """Override the configuration with the settings stored in Consul.
 
-    def deregister(self, service_id: str):
-        self._consul.agent.service.deregister(service_id)
+    Return the index of the KV store the settings were read at.
+    """
+    index, values = run_sync(consul.get_prefix(SETTINGS_PREFIX))
+    config.update(get_settings(values))
+    return index
 
-    def get(self, key: str) -> NoneBytes:
-        _, data = self._consul.kv.get(key)
-        return data['Value'] if data else None
 
-    def put(self, key: str, value: str) -> bool:
-        return self._consul.kv.put(key, value)
+def get_databases(app: FastAPI) -> list:
+    replica_set = getattr(app, 'replica_set')
+    return [replica_set.primary] + list(replica_set.replicas)
+
+
+async def resize_database_pools(app: FastAPI, config: dict, name: str):
+    # the sizes are the totals of the service, shared between its workers
+    size = get_worker_pool_size(int(config[name]), int(config.get('workers') or 1))
+    for database in get_databases(app):
+        if name == 'database_pool_min_size':
+            await database.reconfigure(min_size=size)
+        else:
+            await database.reconfigure(max_size=size)
+
+
+async def set_acquire_timeout(app: FastAPI, config: dict, name: str):
+    for database in get_databases(app):
+        await database.reconfigure(acquire_timeout=float(config[name]))
+
+
+def set_attribute(
+    app_attribute: str, attribute: str
+) -> Callable[[FastAPI, dict, str], Awaitable]:
+    path = app_attribute.split('.')
+
+    async def apply(app: FastAPI, config: dict, name: str):
+        obj: Any = app
+        for attribute_name in path:
+            obj = getattr(obj, attribute_name, None)
+            if obj is None:
+                return
+        setattr(obj, attribute, float(config[name]))
+
+    return apply
+
+
+async def resize_local_cache(app: FastAPI, config: dict, name: str):
+    local_cache = getattr(app, 'redis').local_cache
+    local_cache.max_size = int(config[name])
+    while len(local_cache.values) > max(local_cache.max_size, 0):
+        local_cache.values.popitem(last=False)
+
+
+# the settings applied to a running service, the others need a restart
+HOT_SETTINGS: Dict[str, Callable[[FastAPI, dict, str], Awaitable]] = {
+    'database_pool_min_size': resize_database_pools,
+    'database_pool_max_size': resize_database_pools,
+    'database_pool_acquire_timeout': set_acquire_timeout,
+    'database_replica_max_lag': set_attribute('replica_set', 'max_lag'),
+    'database_replica_check_interval': set_attribute('replica_set', 'check_interval'),
+    'redis_timeout': set_attribute('redis.breaker', 'timeout'),
+    'redis_failure_threshold': set_attribute('redis.breaker', 'failure_threshold'),
+    'redis_reset_timeout': set_attribute('redis.breaker', 'reset_timeout'),
+    'redis_local_cache_size': resize_local_cache,
+    'redis_invalidation_poll_interval': set_attribute(
+        'invalidation_bus', 'poll_interval'
+    ),
+    'routing_table_check_interval': set_attribute(
+        'routing_table_manager', 'check_interval'
+    ),
+}
+
+
+class SettingsWatch(object):
+    """Apply the settings changed in Consul to the running service.
+
+    The `wazo-router-confd.` keys are watched with blocking queries, the
+    changed tunables are applied in place (pool sizes, timeouts, intervals)
+    and a restart is required for the others.
+    """
+
+    app: FastAPI
+    consul: ConsulService
+    config: dict
+    wait: float
+    retry_interval: float
+    index: Optional[int]
+    settings: Dict[str, str]
+    task: Optional[asyncio.Future]
+
+    def __init__(
+        self,
+        app: FastAPI,
+        consul: ConsulService,
+        config: dict,
+        wait: float = 300.0,
+        retry_interval: float = 5.0,
+    ):
+        self.app = app
+        self.consul = consul
+        self.config = config
+        self.wait = wait
+        self.retry_interval = retry_interval
+        self.index = None
+        self.settings = {}
+        self.task = None
+
+    def load(self):
+        self.index = load_settings(self.consul, self.config)
+        self.settings = {
+            name: self.config[name] for name in CONSUL_SETTINGS if name in self.config
+        }
+
+    async def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                index, values = await self.consul.get_prefix(
+                    SETTINGS_PREFIX, index=self.index, wait=self.wait
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Consul settings can not be watched: %s", e)
+                await asyncio.sleep(self.retry_interval)
+                continue
+            settings = get_settings(values)
+            if self.index is None:
+                # first read of a worker, the settings were loaded by its parent
+                self.settings = settings
+            else:
+                await self.apply(
+                    {
+                        name: value
+                        for name, value in settings.items()
+                        if self.settings.get(name) != value
+                    }
+                )
+                self.settings.update(settings)
+            # the index is reset when it goes backwards
+            self.index = index if self.index is None or index >= self.index else 0
+
+    async def apply(self, changed: Dict[str, str]):
+        self.config.update(changed)
+        for name, value in sorted(changed.items()):
+            applier = HOT_SETTINGS.get(name)
+            if applier is None:
+                logger.warning(
+                    "Setting %s changed in Consul, it is applied at the next restart",
+                    name,
+                )
+                continue
+            logger.info("Setting %s changed in Consul to %s", name, value)
+            try:
+                await applier(self.app, self.config, name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Setting %s can not be applied: %s", name, e)
+
+
+async def register_service(consul: ConsulService, config: dict) -> str:
+    """Register the API HTTP service on Consul and return its service id."""
+    service_id = 'wazo-router-confd-%s' % uuid4()
+    await consul.register(
+        service_id,
+        'wazo-router-confd',
+        address=config.get('advertise_host'),
+        port=config.get('advertise_port'),
+        tags=('wazo-router-confd', 'wazo-router', 'wazo-api', 'wazo'),
+        check={
+            "id": "api",
+            "name": "HTTP API on port 5000",
+            "http": "http://%(advertise_host)s:%(advertise_port)d/status" % config,
+            "method": "GET",
+            "interval": "10s",
+            "timeout": "1s",
+        }
+        if (config.get('advertise_host') and config.get('advertise_port'))
+        else None,
+    )
+    return service_id
 
 
 def setup_consul(app: FastAPI, config: dict):
     consul = ConsulService(config['consul_uri'])
     setattr(app, 'consul', consul)
+    watch = SettingsWatch(
+        app, consul, config, wait=float(config.get('consul_watch_wait') or 300.0)
+    )
+    setattr(app, 'consul_settings_watch', watch)
 
-    # configuration settings from consul
-    database_uri = consul.get('wazo-router-confd.database_uri')
-    if database_uri is not None:
-        config['database_uri'] = database_uri.decode('utf-8')
+    # configuration settings from consul, already loaded by the parent of the
+    # workers
+    if not config.get('consul_settings_loaded'):
+        watch.load()
 
-    # register the API HTTP service on consul
-    service_id = 'wazo-router-confd-%s' % uuid4()
+    app.add_event_handler("startup", consul.connect)
+    app.add_event_handler("startup", watch.start)
+    app.add_event_handler("shutdown", watch.stop)
 
-    # pylint: disable= unused-variable
-    @app.on_event("startup")
-    def startup_event():
-        consul = getattr(app, 'consul')
-        consul.register(
-            service_id,
-            'wazo-router-confd',
-            address=config.get('advertise_host'),
-            port=config.get('advertise_port'),
-            tags=('wazo-router-confd', 'wazo-router', 'wazo-api', 'wazo'),
-            check={
-                "id": "api",
-                "name": "HTTP API on port 5000",
-                "http": "http://%(advertise_host)s:%(advertise_port)d/status" % config,
-                "method": "GET",
-                "interval": "10s",
-                "timeout": "1s",
-            }
-            if (config.get('advertise_host') and config.get('advertise_port'))
-            else None,
-        )
+    if config.get('consul_register', True):
+        service_ids = []
+
+        # pylint: disable= unused-variable
+        @app.on_event("startup")
+        async def startup_event():
+            service_ids.append(await register_service(consul, config))
+
+        # pylint: disable= unused-variable
+        @app.on_event("shutdown")
+        async def shutdown_event():
+            while service_ids:
+                service_id = service_ids.pop()
+                try:
+                    await consul.deregister(service_id)
+                except Exception as e:
+                    logger.warning(
+                        "Service %s can not be deregistered: %s", service_id, e
+                    )
 
-    # pylint: disable= unused-variable
-    @app.on_event("shutdown")
-    def shutdown_event():
-        consul = getattr(app, 'consul')
-        consul.deregister(service_id)
+    app.add_event_handler("shutdown", consul.disconnect)
 
     return app
@@ -1,24 +1,45 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import asyncio
 import logging
 import os
+import re
 
 import aiopg  # type: ignore
-
-import alembic.config  # type: ignore
-import alembic.command  # type: ignore
-
-from alembic import migration
-
+import aiopg.sa  # type: ignore
+import psycopg2  # type: ignore
+
+from aiopg.sa.engine import get_dialect  # type: ignore
+from psycopg2.errorcodes import INVALID_SQL_STATEMENT_NAME  # type: ignore
+
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import wraps
+from time import monotonic
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
 from urllib.parse import urlparse
+from weakref import WeakKeyDictionary
 
 from fastapi import FastAPI
 from starlette.requests import Request
-from starlette.responses import Response
 
-from sqlalchemy import create_engine
+from sqlalchemy import Table, create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.dml import Delete, Insert, Update
 from tenacity import (  # type: ignore
     after_log,
     before_log,
@@ -29,52 +50,531 @@ from tenacity import (  # type: ignore
 
 from wazo_router_confd.models.base import Base
 
+# pylint: disable= unused-import
+# the triggers notifying the changes are created along with the tables
+import wazo_router_confd.models.changes  # noqa
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False)
 logger = logging.getLogger(__name__)
 
+F = TypeVar('F', bound=Callable[..., Awaitable[Any]])
+
+
+def get_aiopg_pool(request: Request) -> 'AiopgConnectionPool':
+    return request.state.async_db.connection_pool
+
+
+def get_aiopg_read_pool(request: Request) -> 'AiopgConnectionPool':
+    return request.state.replica_set.choose().connection_pool
 
-def get_db(request: Request):
-    return request.state.db
 
+def get_async_db(request: Request) -> 'AsyncDatabase':
+    return request.state.async_db
 
-def get_aiopg_pool(request: Request) -> aiopg.Pool:
-    return request.state.aiopg_pool
+
+def get_async_read_db(request: Request) -> 'AsyncDatabase':
+    return request.state.replica_set.choose()
+
+
+def get_pool_settings(config: dict) -> dict:
+    return dict(
+        min_size=int(config.get('database_pool_min_size') or 1),
+        max_size=int(config.get('database_pool_max_size') or 10),
+        acquire_timeout=float(config.get('database_pool_acquire_timeout') or 60.0),
+        max_lifetime=float(config.get('database_pool_max_lifetime') or -1),
+        statement_timeout=int(config.get('database_statement_timeout') or 0),
+    )
+
+
+def get_worker_pool_size(total: int, workers: int) -> int:
+    """The share of a pool size of the service given to one of its workers."""
+    return max(total // max(workers, 1), 1)
+
+
+def get_statement_timeout_options(statement_timeout: int) -> dict:
+    if statement_timeout <= 0:
+        return {}
+    return dict(options='-c statement_timeout=%d' % statement_timeout)
 
 
 def setup_database(app: FastAPI, config: dict):
+    # the API runs on aiopg, this engine is left to the migrations and to the
+    # bulk imports, which run in threads
     database_uri = config['database_uri']
-    connect_args = (
-        {"check_same_thread": False} if database_uri.startswith('sqlite:') else {}
-    )
-    engine = create_engine(database_uri, connect_args=connect_args)
+    if database_uri.startswith('sqlite:'):
+        engine = create_engine(database_uri, connect_args={"check_same_thread": False})
+    else:
+        settings = get_pool_settings(config)
+        engine = create_engine(
+            database_uri,
+            connect_args=get_statement_timeout_options(settings['statement_timeout']),
+            pool_size=settings['min_size'],
+            max_overflow=max(settings['max_size'] - settings['min_size'], 0),
+            pool_timeout=settings['acquire_timeout'],
+            pool_recycle=int(settings['max_lifetime']),
+        )
     setattr(app, 'engine', engine)
+    return app
+
+
+class PoolStatistics(object):
+    """Count the connection acquisitions of a pool and the time spent waiting."""
+
+    waiters: int
+    acquired: int
+    timeouts: int
+    acquire_time: float
+    max_acquire_time: float
+
+    def __init__(self):
+        self.waiters = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.acquire_time = 0.0
+        self.max_acquire_time = 0.0
 
-    # pylint: disable= unused-variable
-    @app.middleware("http")
-    async def db_session_middleware(request: Request, call_next):
-        response = Response("Internal server error", status_code=500)
+    async def measure(self, acquire: Awaitable[Any], timeout: float) -> Any:
+        """Time `acquire`, which fails after `timeout` seconds of waiting."""
+        start = monotonic()
+        self.waiters += 1
         try:
-            request.state.db = SessionLocal(bind=engine)
-            response = await call_next(request)
+            conn = await asyncio.wait_for(acquire, timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
         finally:
-            request.state.db.close()
-        return response
-
-    return app
+            self.waiters -= 1
+        elapsed = monotonic() - start
+        self.acquired += 1
+        self.acquire_time += elapsed
+        self.max_acquire_time = max(self.max_acquire_time, elapsed)
+        return conn
+
+
+class PreparedStatement(object):
+    """A statement prepared once per connection, then executed by name.
+
+    The SQL uses the server side `$1 ... $n` placeholders. Connections are
+    tracked weakly, so a recycled or replaced connection prepares it again.
+    """
+
+    name: str
+    sql: str
+    types: Tuple[str, ...]
+    connections: 'WeakKeyDictionary[Any, bool]'
+
+    def __init__(self, name: str, sql: str, types: Tuple[str, ...] = ()):
+        self.name = name
+        self.sql = sql
+        self.types = types
+        self.connections = WeakKeyDictionary()
+
+    def get_prepare_sql(self) -> str:
+        types = "(%s) " % ", ".join(self.types) if self.types else ""
+        return "PREPARE %s %sAS %s" % (self.name, types, self.sql)
+
+    def get_execute_sql(self, args: Sequence[Any]) -> str:
+        if not args:
+            return "EXECUTE %s" % self.name
+        return "EXECUTE %s (%s)" % (self.name, ", ".join(["%s"] * len(args)))
+
+    async def prepare(self, cur: Any):
+        await cur.execute(self.get_prepare_sql())
+        self.connections[cur.raw.connection] = True
+
+    async def execute(self, cur: Any, args: Sequence[Any] = ()):
+        if cur.raw.connection not in self.connections:
+            await self.prepare(cur)
+        try:
+            await cur.execute(self.get_execute_sql(args), list(args))
+        except psycopg2.Error as e:
+            # the session lost its prepared statements (e.g. DISCARD ALL)
+            if e.pgcode != INVALID_SQL_STATEMENT_NAME:
+                raise
+            await self.prepare(cur)
+            await cur.execute(self.get_execute_sql(args), list(args))
 
 
 class AiopgConnectionPool(object):
+    """An aiopg pool which can be resized, with the statistics of its acquisitions.
+
+    The connections are acquired by `acquire`, timed and bounded by the acquire
+    timeout; the timeout of aiopg also bounds each operation, it is left to its
+    default and the queries are bounded by the statement timeout.
+    """
+
     dsn: str
+    min_size: int
+    max_size: int
+    acquire_timeout: float
+    max_lifetime: float
+    statement_timeout: int
+    statistics: PoolStatistics
     pool: aiopg.Pool
-
-    def __init__(self, dsn):
+    retired: List[aiopg.Pool]
+
+    def __init__(
+        self,
+        dsn,
+        min_size=1,
+        max_size=10,
+        acquire_timeout=60.0,
+        max_lifetime=-1,
+        statement_timeout=0,
+    ):
         self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.max_lifetime = max_lifetime
+        self.statement_timeout = statement_timeout
+        self.statistics = PoolStatistics()
+        self.retired = []
 
     async def connect(self):
-        self.pool = await aiopg.create_pool(self.dsn)
+        self.pool = await aiopg.create_pool(
+            self.dsn,
+            minsize=self.min_size,
+            maxsize=self.max_size,
+            pool_recycle=self.max_lifetime,
+            **get_statement_timeout_options(self.statement_timeout)
+        )
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Any]:
+        # released to the pool it comes from, which may be replaced meanwhile
+        pool = self.pool
+        conn = await self.statistics.measure(pool.acquire(), self.acquire_timeout)
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+
+    async def reconfigure(
+        self,
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        acquire_timeout: Optional[float] = None,
+    ):
+        """Replace the pool by one with the new settings.
+
+        The requests which already hold the previous pool may still acquire
+        from it, it is closed after one acquire timeout.
+        """
+        if min_size is not None:
+            self.min_size = min_size
+        if max_size is not None:
+            self.max_size = max_size
+        if acquire_timeout is not None:
+            self.acquire_timeout = acquire_timeout
+        self.min_size = min(self.min_size, self.max_size)
+        previous = getattr(self, 'pool', None)
+        if previous is None:
+            return
+        await self.connect()
+        self.retired.append(previous)
+        asyncio.get_event_loop().call_later(
+            self.acquire_timeout, lambda: asyncio.ensure_future(self.retire(previous))
+        )
+
+    async def retire(self, pool: aiopg.Pool):
+        if pool in self.retired:
+            self.retired.remove(pool)
+            pool.close()
+            await pool.wait_closed()
+
+    def get_status(self) -> dict:
+        statistics = self.statistics
+        return dict(
+            min_size=self.min_size,
+            max_size=self.max_size,
+            size=self.pool.size,
+            in_use=self.pool.size - self.pool.freesize,
+            idle=self.pool.freesize,
+            waiters=statistics.waiters,
+            acquired=statistics.acquired,
+            timeouts=statistics.timeouts,
+            acquire_time_avg=(
+                statistics.acquire_time / statistics.acquired
+                if statistics.acquired
+                else 0.0
+            ),
+            acquire_time_max=statistics.max_acquire_time,
+        )
 
     async def clear(self):
         await self.pool.clear()
+        for pool in list(self.retired):
+            await self.retire(pool)
+
+
+class Transaction(object):
+    """The connection of a transaction and the tables changed so far."""
+
+    database: 'AsyncDatabase'
+    connection: Any
+    tables: Set[str]
+
+    def __init__(self, database: 'AsyncDatabase', connection: Any):
+        self.database = database
+        self.connection = connection
+        self.tables = set()
+
+
+current_transaction: ContextVar[Optional[Transaction]] = ContextVar(
+    'current_transaction', default=None
+)
+
+
+def transactional(func: F) -> F:
+    """Run a service function in a transaction of the database it is given first."""
+
+    @wraps(func)
+    async def wrapper(db: 'AsyncDatabase', *args, **kwargs):
+        async with db.transaction():
+            return await func(db, *args, **kwargs)
+
+    return cast(F, wrapper)
+
+
+class AsyncDatabase(object):
+    """Run SQLAlchemy Core statements on the aiopg pool used by the kamailio API.
+
+    Outside of a transaction each statement runs on its own connection, in
+    autocommit mode.
+    """
+
+    connection_pool: AiopgConnectionPool
+    engine: Optional[aiopg.sa.Engine]
+    listeners: List[Callable[[str], None]]
+
+    def __init__(self, connection_pool: AiopgConnectionPool):
+        self.connection_pool = connection_pool
+        self.engine = None
+        self.listeners = []
+
+    async def connect(self):
+        self.engine = aiopg.sa.Engine(
+            get_dialect(), self.connection_pool.pool, self.connection_pool.dsn
+        )
+
+    async def reconfigure(self, **settings):
+        await self.connection_pool.reconfigure(**settings)
+        if self.engine is not None:
+            await self.connect()
+
+    def add_listener(self, listener: Callable[[str], None]):
+        """Call `listener` with the name of each table changed by a statement."""
+        self.listeners.append(listener)
+
+    def get_transaction(self) -> Optional[Transaction]:
+        transaction = current_transaction.get()
+        if transaction is not None and transaction.database is self:
+            return transaction
+        return None
+
+    def notify(self, query: Any):
+        if isinstance(query, (Insert, Update, Delete)):
+            table = cast(Table, query.table).name
+            transaction = self.get_transaction()
+            if transaction is not None:
+                # the changes are not visible before the commit
+                transaction.tables.add(table)
+            else:
+                self.notify_table(table)
+
+    def notify_table(self, table: str):
+        for listener in self.listeners:
+            listener(table)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Any]:
+        """A SQLAlchemy connection on a connection of the pool.
+
+        Within a transaction, this is the connection of the transaction.
+        """
+        transaction = self.get_transaction()
+        if transaction is not None:
+            yield transaction.connection
+            return
+        async with self.connection_pool.acquire() as raw:
+            yield aiopg.sa.SAConnection(raw, self.engine)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Any]:
+        """Run the statements of the block on one connection, in one transaction.
+
+        A nested block joins the enclosing transaction. The listeners are
+        called with the changed tables once it has been committed.
+        """
+        if self.get_transaction() is not None:
+            async with self.acquire() as conn:
+                yield conn
+            return
+        async with self.acquire() as conn:
+            transaction = Transaction(self, conn)
+            token = current_transaction.set(transaction)
+            try:
+                async with conn.begin():
+                    yield conn
+            finally:
+                current_transaction.reset(token)
+        for table in sorted(transaction.tables):
+            self.notify_table(table)
+
+    async def fetch_all(self, query: Any) -> List[Any]:
+        async with self.acquire() as conn:
+            result = await conn.execute(query)
+            rows = await result.fetchall() if result.returns_rows else []
+        self.notify(query)
+        return rows
+
+    async def fetch_all_batches(self, queries: List[Any]) -> List[Any]:
+        """Run the statements in one transaction and return all their rows."""
+        rows: List[Any] = []
+        async with self.acquire() as conn:
+            async with conn.begin():
+                for query in queries:
+                    result = await conn.execute(query)
+                    if result.returns_rows:
+                        rows.extend(await result.fetchall())
+        for query in queries:
+            self.notify(query)
+        return rows
+
+    async def fetch_one(self, query: Any) -> Optional[Any]:
+        async with self.acquire() as conn:
+            result = await conn.execute(query)
+            row = await result.first() if result.returns_rows else None
+        self.notify(query)
+        return row
+
+    async def fetch_value(self, query: Any) -> Any:
+        async with self.acquire() as conn:
+            value = await conn.scalar(query)
+        self.notify(query)
+        return value
+
+    async def execute(self, query: Any) -> int:
+        async with self.acquire() as conn:
+            result = await conn.execute(query)
+            rowcount = result.rowcount
+            result.close()
+        self.notify(query)
+        return rowcount
+
+
+REPLICA_LAG_QUERY = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() "
+    "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class ReplicaSet(object):
+    """Route read-only queries to the replicas lagging less than `max_lag` seconds.
+
+    Queries go to the primary when no replica is healthy, and also for
+    `max_lag` seconds after a write, so that clients read their own writes.
+    """
+
+    primary: AsyncDatabase
+    replicas: List[AsyncDatabase]
+    max_lag: float
+    check_interval: float
+    healthy: List[AsyncDatabase]
+    lags: List[Optional[float]]
+    last_write: Optional[float]
+    index: int
+    task: Optional[asyncio.Future]
+
+    def __init__(
+        self,
+        primary: AsyncDatabase,
+        replicas: List[AsyncDatabase],
+        max_lag: float = 10.0,
+        check_interval: float = 5.0,
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.healthy = []
+        self.lags = [None] * len(replicas)
+        self.last_write = None
+        self.index = 0
+        self.task = None
+        primary.add_listener(lambda table: self.mark_write())
+
+    def mark_write(self):
+        self.last_write = monotonic()
+
+    async def connect(self):
+        if self.replicas:
+            await self.check()
+            self.task = asyncio.ensure_future(self.run())
+
+    async def disconnect(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        for replica in self.replicas:
+            if replica.engine is not None:
+                await replica.connection_pool.clear()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.check()
+
+    async def get_lag(self, replica: AsyncDatabase) -> float:
+        if replica.engine is None:
+            await replica.connection_pool.connect()
+            await replica.connect()
+        return float(await replica.fetch_value(REPLICA_LAG_QUERY))
+
+    async def check(self):
+        healthy = []
+        for i, replica in enumerate(self.replicas):
+            try:
+                self.lags[i] = await asyncio.wait_for(
+                    self.get_lag(replica), self.check_interval
+                )
+            except Exception as e:
+                logger.warning("Database replica %d is not available: %s", i, repr(e))
+                self.lags[i] = None
+                continue
+            if self.lags[i] <= self.max_lag:
+                healthy.append(replica)
+        self.healthy = healthy
+
+    def choose(self) -> AsyncDatabase:
+        if not self.healthy or (
+            self.last_write is not None and monotonic() - self.last_write < self.max_lag
+        ):
+            return self.primary
+        self.index = (self.index + 1) % len(self.healthy)
+        return self.healthy[self.index]
+
+
+def get_replica_uris(config: dict) -> List[str]:
+    replica_uris: Union[str, List[str]] = config.get('database_replica_uris') or []
+    if isinstance(replica_uris, str):
+        replica_uris = replica_uris.split(',')
+    return [uri.strip() for uri in replica_uris if uri.strip()]
+
+
+def get_engine_pool_status(engine) -> dict:
+    pool = engine.pool
+    if not hasattr(pool, 'checkedout'):
+        return {}
+    return dict(
+        size=pool.size(),
+        in_use=pool.checkedout(),
+        idle=pool.checkedin(),
+        overflow=max(pool.overflow(), 0),
+    )
 
 
 def from_database_uri_to_dsn(database_uri: str) -> str:
@@ -92,30 +592,88 @@ def from_database_uri_to_dsn(database_uri: str) -> str:
 def setup_aiopg_database(app: FastAPI, config: dict):
     database_uri = config['database_uri']
     dsn = from_database_uri_to_dsn(database_uri)
-    connection_pool = AiopgConnectionPool(dsn)
+    connection_pool = AiopgConnectionPool(dsn, **get_pool_settings(config))
+    async_db = AsyncDatabase(connection_pool)
+    setattr(app, 'async_db', async_db)
+    replica_set = ReplicaSet(
+        async_db,
+        [
+            AsyncDatabase(
+                AiopgConnectionPool(
+                    from_database_uri_to_dsn(replica_uri), **get_pool_settings(config)
+                )
+            )
+            for replica_uri in get_replica_uris(config)
+        ],
+        max_lag=float(config.get('database_replica_max_lag') or 10.0),
+        check_interval=float(config.get('database_replica_check_interval') or 5.0),
+    )
+    setattr(app, 'replica_set', replica_set)
 
     app.add_event_handler("startup", connection_pool.connect)
+    app.add_event_handler("startup", async_db.connect)
+    app.add_event_handler("startup", replica_set.connect)
+    app.add_event_handler("shutdown", replica_set.disconnect)
     app.add_event_handler("shutdown", connection_pool.clear)
 
-    # pylint: disable= unused-variable
-    @app.middleware("http")
-    async def db_aiopg_database_middleware(request: Request, call_next):
-        response = Response("Internal server error", status_code=500)
-        request.state.aiopg_pool = connection_pool.pool
-        response = await call_next(request)
-        return response
-
     return app
 
 
+re_migration_revision = re.compile(r"^revision = '(\w+)'", re.MULTILINE)
+re_migration_down_revision = re.compile(r"^down_revision = (.*)$", re.MULTILINE)
+re_quoted_revision = re.compile(r"'(\w+)'")
+
+
+def get_migration_heads(versions_dir: str) -> Set[str]:
+    """Read the head revisions of the migration scripts, without loading Alembic."""
+    revisions = set()
+    down_revisions = set()
+    for name in os.listdir(versions_dir):
+        if not name.endswith('.py'):
+            continue
+        with open(os.path.join(versions_dir, name)) as f:
+            source = f.read()
+        m = re_migration_revision.search(source)
+        if m is None:
+            continue
+        revisions.add(m.group(1))
+        m = re_migration_down_revision.search(source)
+        if m is not None:
+            down_revisions.update(re_quoted_revision.findall(m.group(1)))
+    return revisions - down_revisions
+
+
+def get_database_heads(connection: Any) -> Set[str]:
+    if connection.execute("SELECT to_regclass('alembic_version')").scalar() is None:
+        return set()
+    return {
+        row[0] for row in connection.execute("SELECT version_num FROM alembic_version")
+    }
+
+
 def upgrade_database(app: FastAPI, config: dict, force_migration: bool = False):
     cur_dir = os.path.dirname(__file__)
+    engine = getattr(app, "engine")
+    wait_for_database(engine)
+    with engine.connect() as connection:
+        database_heads = get_database_heads(connection)
+    # a restart usually finds the database up to date, Alembic is not needed
+    if database_heads and database_heads == get_migration_heads(
+        "{}/migrations/alembic/versions".format(cur_dir)
+    ):
+        engine.dispose()
+        logger.info("Database is up to date")
+        return
+
+    import alembic.config  # type: ignore
+    import alembic.command  # type: ignore
+
+    from alembic import migration
+
     cfg = alembic.config.Config("{}/migrations/alembic.ini".format(cur_dir))
     cfg.set_main_option("script_location", "{}/migrations/alembic".format(cur_dir))
     cfg.set_main_option("sqlalchemy.url", config['database_uri'])
 
-    engine = getattr(app, "engine")
-    wait_for_database(engine)
     with engine.begin() as connection:
         ctxt = migration.MigrationContext.configure(connection)
         current_version = ctxt.get_current_revision()
@@ -0,0 +1,204 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from sqlalchemy import select
+from sqlalchemy.sql.schema import Column, Table
+from starlette.responses import JSONResponse, Response
+
+from wazo_router_confd.conditional import (
+    ROW_VERSION,
+    format_etag,
+    get_page_etag,
+    get_row_version,
+)
+
+
+# the relations of a resource which can be expanded: the foreign key column of
+# its table and the schema of the related resource
+Relations = Dict[str, Tuple[Column, Type[BaseModel]]]
+
+
+def get_related_key(column: Column) -> Column:
+    """The primary key referenced by the foreign key `column`."""
+    (key,) = [fk.column for fk in column.foreign_keys if fk.column.primary_key]
+    return key
+
+
+def split_names(names: Optional[str]) -> List[str]:
+    return [name.strip() for name in (names or '').split(',') if name.strip()]
+
+
+class Fieldset(object):
+    """The fields and the expanded relations of the resources to return.
+
+    A field of an expanded relation is prefixed by the name of the relation,
+    as `domain.domain`, which expands it.
+    """
+
+    fields: Optional[List[str]]
+    expand: List[str]
+    response: Optional[Response]
+
+    def __init__(
+        self,
+        fields: Optional[List[str]] = None,
+        expand: List[str] = None,
+        response: Optional[Response] = None,
+    ):
+        self.fields = fields or None
+        self.expand = list(expand or [])
+        self.response = response
+        for field in self.fields or []:
+            relation = field.split('.', 1)[0]
+            if '.' in field and relation not in self.expand:
+                self.expand.append(relation)
+
+    def __bool__(self) -> bool:
+        return self.fields is not None or bool(self.expand)
+
+
+def get_fieldset(
+    response: Response, fields: str = None, expand: str = None
+) -> Fieldset:
+    return Fieldset(
+        fields=split_names(fields), expand=split_names(expand), response=response
+    )
+
+
+def get_fieldset_response(fieldset: Optional[Fieldset], content: Any) -> Any:
+    """The response of a partial resource, not validated by the response model.
+
+    The headers set by the dependencies are kept.
+    """
+    if not fieldset:
+        return content
+    headers = None
+    if fieldset.response is not None:
+        headers = dict(fieldset.response.headers)
+    return JSONResponse(content=jsonable_encoder(content), headers=headers)
+
+
+class Projection(object):
+    """The query of the fields of a fieldset.
+
+    Only the requested columns are selected, and the expanded relations are
+    joined to the table in the same query. The versions of the rows are
+    selected along, for their ETags.
+    """
+
+    table: Table
+    fieldset: Optional[Fieldset]
+    names: List[str]
+    relations: Dict[str, Tuple[Any, Column, List[str]]]
+
+    def __init__(
+        self,
+        table: Table,
+        schema: Type[BaseModel],
+        fieldset: Optional[Fieldset] = None,
+        relations: Optional[Relations] = None,
+    ):
+        self.table = table
+        self.fieldset = fieldset
+        self.relations = {}
+        fieldset = fieldset or Fieldset()
+        relations = relations or {}
+        for name in fieldset.expand:
+            if name not in relations:
+                raise HTTPException(
+                    status_code=400,
+                    detail="expand must be among %s"
+                    % (', '.join(sorted(relations)) or 'no relation'),
+                )
+            column, related_schema = relations[name]
+            self.relations[name] = (
+                get_related_key(column).table.alias(name),
+                column,
+                list(related_schema.__fields__),
+            )
+        if fieldset.fields is None:
+            self.names = list(schema.__fields__)
+            return
+        self.names = []
+        related_names: Dict[str, List[str]] = {}
+        for field in fieldset.fields:
+            relation, _, name = field.partition('.')
+            if not name:
+                relation, name = '', relation
+            if relation:
+                allowed = self.relations[relation][2]
+            else:
+                allowed = list(schema.__fields__)
+            if name not in allowed:
+                raise HTTPException(
+                    status_code=400,
+                    detail="Invalid field %s, must be among %s"
+                    % (field, ', '.join(allowed)),
+                )
+            if relation:
+                related_names.setdefault(relation, []).append(name)
+            elif name not in self.names:
+                self.names.append(name)
+        for relation, names in related_names.items():
+            alias, column, _ = self.relations[relation]
+            self.relations[relation] = (alias, column, names)
+
+    def select(self) -> Any:
+        version = get_row_version(self.table).label(ROW_VERSION)
+        if not self.fieldset:
+            return select([self.table, version])
+        columns = [self.table.c[name] for name in self.names] + [version]
+        # a join of the table when there are relations
+        from_: Any = self.table
+        for relation, (alias, column, names) in self.relations.items():
+            key = alias.c[get_related_key(column).name]
+            from_ = from_.outerjoin(alias, key == column)
+            # the key tells whether there is a related row
+            columns.append(key.label('%s__' % relation))
+            columns.append(
+                get_row_version(alias).label('%s__%s' % (relation, ROW_VERSION))
+            )
+            columns.extend(
+                alias.c[name].label('%s__%s' % (relation, name)) for name in names
+            )
+        return select(columns).select_from(from_)
+
+    def get_item(self, row: Any) -> Optional[dict]:
+        if row is None or not self.fieldset:
+            return row
+        item = {name: row[name] for name in self.names}
+        for relation, (_, _, names) in self.relations.items():
+            item[relation] = None
+            if row['%s__' % relation] is not None:
+                item[relation] = {
+                    name: row['%s__%s' % (relation, name)] for name in names
+                }
+        return item
+
+    def get_items(self, rows: List[Any]) -> List[Any]:
+        return [self.get_item(row) for row in rows]
+
+    def get_version(self, row: Any) -> str:
+        """The version of the row and of its expanded relations."""
+        return '.'.join(
+            [row[ROW_VERSION]]
+            + [
+                row['%s__%s' % (relation, ROW_VERSION)] or '0'
+                for relation in self.relations
+            ]
+        )
+
+    def get_etag(self, row: Any) -> str:
+        # the partial resources are weak, they can not be written
+        return format_etag(self.get_version(row), weak=bool(self.fieldset))
+
+    def get_page_etag(self, page: dict, key: Column) -> str:
+        return get_page_etag(
+            [[row[key.name], self.get_version(row)] for row in page['items']]
+            + [page['total'], page['next']]
+        )
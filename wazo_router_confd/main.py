@@ -2,12 +2,13 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from configparser import ConfigParser, Error as ConfigParserError
-from typing import Optional
+from typing import Any, Dict, Optional, Tuple
 
 import click
 import uvicorn  # type: ignore
 
 from .app import get_app
+from .server import run_workers
 
 
 @click.command()
@@ -24,6 +25,27 @@ from .app import get_app
 @click.option(
     "--port", type=int, default=9600, help="Bind socket to this port", show_default=True
 )
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of worker processes, the database pool sizes are shared between them",
+    show_default=True,
+)
+@click.option(
+    "--loop",
+    type=click.Choice(["auto", "asyncio", "uvloop"]),
+    default="auto",
+    help="Event loop implementation, auto uses uvloop when installed",
+    show_default=True,
+)
+@click.option(
+    "--http",
+    type=click.Choice(["auto", "h11", "httptools"]),
+    default="auto",
+    help="HTTP protocol implementation, auto uses httptools when installed",
+    show_default=True,
+)
 @click.option(
     "--advertise-host",
     type=str,
@@ -59,6 +81,68 @@ from .app import get_app
     help="Run database migrations at startup",
     show_default=True,
 )
+@click.option(
+    "--database-pool-min-size",
+    type=int,
+    default=1,
+    help="Number of database connections opened at startup and kept in the pools",
+    show_default=True,
+)
+@click.option(
+    "--database-pool-max-size",
+    type=int,
+    default=10,
+    help="Maximum number of database connections of each pool",
+    show_default=True,
+)
+@click.option(
+    "--database-pool-acquire-timeout",
+    type=float,
+    default=60.0,
+    help="Seconds to wait for a free database connection",
+    show_default=True,
+)
+@click.option(
+    "--database-pool-max-lifetime",
+    type=float,
+    default=-1,
+    help="Seconds after which pooled database connections are replaced, -1 to disable",
+    show_default=True,
+)
+@click.option(
+    "--database-statement-timeout",
+    type=int,
+    default=0,
+    help="Database statement timeout in milliseconds, 0 to disable",
+    show_default=True,
+)
+@click.option(
+    "--database-change-listener/--no-database-change-listener",
+    default=False,
+    help="Listen to the changes of the configuration tables made outside of the API",
+    show_default=True,
+)
+@click.option(
+    "--database-replica-uri",
+    "database_replica_uris",
+    type=str,
+    multiple=True,
+    help="SQLAlchemy URI of a read replica, used for the kamailio lookups and listings",
+)
+@click.option(
+    "--database-replica-max-lag",
+    type=float,
+    default=10.0,
+    help="Replication lag in seconds above which a replica is not used",
+    show_default=True,
+)
+@click.option(
+    "--database-replica-check-interval",
+    type=float,
+    default=5.0,
+    help="Interval in seconds between replica health checks",
+    show_default=True,
+)
 @click.option(
     "--redis-uri",
     type=str,
@@ -66,6 +150,97 @@ from .app import get_app
     help="REDIS URI, overwrites the configuration obtained from the Consul agent",
     show_default=True,
 )
+@click.option(
+    "--redis-codec",
+    type=click.Choice(["json", "msgpack"]),
+    default="json",
+    help="Serialization format of the values cached in REDIS",
+    show_default=True,
+)
+@click.option(
+    "--redis-timeout",
+    type=float,
+    default=0.25,
+    help="Timeout in seconds of REDIS commands, REDIS is bypassed after repeated failures",
+    show_default=True,
+)
+@click.option(
+    "--redis-reset-timeout",
+    type=float,
+    default=5.0,
+    help="Delay in seconds before trying REDIS again after it was bypassed",
+    show_default=True,
+)
+@click.option(
+    "--redis-local-cache-size",
+    type=int,
+    default=10000,
+    help="Number of REDIS values also cached in memory, 0 to disable",
+    show_default=True,
+)
+@click.option(
+    "--redis-invalidation-poll-interval",
+    type=float,
+    default=5.0,
+    help="Interval in seconds between checks for missed cache invalidations",
+    show_default=True,
+)
+@click.option(
+    "--preload-kamailio-caches",
+    is_flag=True,
+    default=False,
+    help="Load the kamailio caches at startup, /status reports ready once done",
+    show_default=True,
+)
+@click.option(
+    "--warmup-kamailio-caches",
+    is_flag=True,
+    default=False,
+    help="Compute the kamailio auth and routing entries in the background at startup",
+    show_default=True,
+)
+@click.option(
+    "--warmup-concurrency",
+    type=int,
+    default=4,
+    help="Number of kamailio entries computed concurrently by the warmup",
+    show_default=True,
+)
+@click.option(
+    "--warmup-traffic-path",
+    type=click.Path(),
+    default=None,
+    help="Path of the file recording the most frequent kamailio requests, warmed up at startup",
+    show_default=True,
+)
+@click.option(
+    "--warmup-traffic-size",
+    type=int,
+    default=1000,
+    help="Number of kamailio requests recorded for the warmup",
+    show_default=True,
+)
+@click.option(
+    "--routing-table-path",
+    type=click.Path(),
+    default=None,
+    help="Path of the routing table file shared by the workers, disabled if not set",
+    show_default=True,
+)
+@click.option(
+    "--routing-table-check-interval",
+    type=float,
+    default=0.5,
+    help="Interval in seconds between checks for a republished routing table",
+    show_default=True,
+)
+@click.option(
+    "--password-hashing-processes",
+    type=int,
+    default=None,
+    help="Number of processes hashing the passwords of the bulk requests, started on first use, defaults to the number of CPUs",
+    show_default=True,
+)
 @click.option(
     "--wazo-auth/--no-wazo-auth",
     default=False,
@@ -92,27 +267,77 @@ def main(
     config_file: Optional[str] = None,
     host: Optional[str] = None,
     port: Optional[int] = None,
+    workers: int = 1,
+    loop: str = "auto",
+    http: str = "auto",
     advertise_host: Optional[str] = None,
     advertise_port: Optional[int] = None,
     consul_uri: Optional[str] = None,
     database_uri: Optional[str] = None,
     database_upgrade: bool = True,
+    database_pool_min_size: int = 1,
+    database_pool_max_size: int = 10,
+    database_pool_acquire_timeout: float = 60.0,
+    database_pool_max_lifetime: float = -1,
+    database_statement_timeout: int = 0,
+    database_change_listener: bool = False,
+    database_replica_uris: Tuple[str, ...] = (),
+    database_replica_max_lag: float = 10.0,
+    database_replica_check_interval: float = 5.0,
     redis_uri: Optional[str] = None,
+    redis_codec: Optional[str] = None,
+    redis_timeout: float = 0.25,
+    redis_reset_timeout: float = 5.0,
+    redis_local_cache_size: int = 10000,
+    redis_invalidation_poll_interval: float = 5.0,
+    preload_kamailio_caches: bool = False,
+    warmup_kamailio_caches: bool = False,
+    warmup_concurrency: int = 4,
+    warmup_traffic_path: Optional[str] = None,
+    warmup_traffic_size: int = 1000,
+    routing_table_path: Optional[str] = None,
+    routing_table_check_interval: float = 0.5,
+    password_hashing_processes: Optional[int] = None,
     wazo_auth: bool = False,
     wazo_auth_url: Optional[str] = None,
     wazo_auth_cert: Optional[str] = None,
     debug: bool = False,
     auto_envvar_prefix: Optional[str] = None,
 ):
-    config = dict(
+    config: Dict[str, Any] = dict(
         host=host,
         port=port,
+        workers=workers,
+        loop=loop,
+        http=http,
         advertise_host=advertise_host,
         advertise_port=advertise_port,
         consul_uri=consul_uri,
         database_uri=database_uri,
         database_upgrade=database_upgrade,
+        database_pool_min_size=database_pool_min_size,
+        database_pool_max_size=database_pool_max_size,
+        database_pool_acquire_timeout=database_pool_acquire_timeout,
+        database_pool_max_lifetime=database_pool_max_lifetime,
+        database_statement_timeout=database_statement_timeout,
+        database_change_listener=database_change_listener,
+        database_replica_uris=list(database_replica_uris),
+        database_replica_max_lag=database_replica_max_lag,
+        database_replica_check_interval=database_replica_check_interval,
         redis_uri=redis_uri,
+        redis_codec=redis_codec,
+        redis_timeout=redis_timeout,
+        redis_reset_timeout=redis_reset_timeout,
+        redis_local_cache_size=redis_local_cache_size,
+        redis_invalidation_poll_interval=redis_invalidation_poll_interval,
+        preload_kamailio_caches=preload_kamailio_caches,
+        warmup_kamailio_caches=warmup_kamailio_caches,
+        warmup_concurrency=warmup_concurrency,
+        warmup_traffic_path=warmup_traffic_path,
+        warmup_traffic_size=warmup_traffic_size,
+        routing_table_path=routing_table_path,
+        routing_table_check_interval=routing_table_check_interval,
+        password_hashing_processes=password_hashing_processes,
         wazo_auth=wazo_auth,
         wazo_auth_url=wazo_auth_url,
         wazo_auth_cert=wazo_auth_cert,
@@ -126,9 +351,16 @@ def main(
             raise click.UsageError("Invalid configuration file")
         for k, v in parser['DEFAULT'].items():
             config[k] = v
-    app = get_app(config)
     log_level = "info" if not config['debug'] else "debug"
-    uvicorn.run(app, host=config['host'], port=config['port'], log_level=log_level)
+    uvicorn_options = dict(
+        log_level=log_level, loop=config['loop'], http=config['http']
+    )
+    workers = int(config['workers'] or 1)
+    if workers > 1:
+        run_workers(config, workers, **uvicorn_options)
+    else:
+        app = get_app(config)
+        uvicorn.run(app, host=config['host'], port=config['port'], **uvicorn_options)
 
 
 def main_with_env():
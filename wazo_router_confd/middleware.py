@@ -0,0 +1,122 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from typing import Optional, Set
+
+from fastapi import FastAPI
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from wazo_router_confd.auth import X_AUTH_TOKEN_HEADER, WAZO_TENANT, AuthClient
+from wazo_router_confd.redis import (
+    InvalidationBus,
+    Redis,
+    deferred_tables,
+    re_read_only_path,
+)
+
+
+class RequestMiddleware(object):
+    """Prepare the request state, authenticate and invalidate the caches.
+
+    A plain ASGI middleware: the response goes through untouched, without the
+    tasks and queues of the `http` middlewares.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        request_state: dict,
+        auth_client: Optional[AuthClient] = None,
+        redis: Optional[Redis] = None,
+        invalidation_bus: Optional[InvalidationBus] = None,
+    ):
+        self.app = app
+        self.request_state = request_state
+        self.auth_client = auth_client
+        self.redis = redis
+        self.invalidation_bus = invalidation_bus
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        # Request.state reads and writes scope['state']
+        state = scope.setdefault('state', {})
+        state.update(self.request_state)
+        if self.auth_client is not None:
+            headers = Headers(scope=scope)
+            token = headers.get(X_AUTH_TOKEN_HEADER)
+            if token is None:
+                response = Response(
+                    "Missing %s header" % X_AUTH_TOKEN_HEADER, status_code=401
+                )
+                await response(scope, receive, send)
+                return
+            principal = await self.auth_client.get_token_data(
+                token, headers.get(WAZO_TENANT)
+            )
+            if principal is None:
+                response = Response("The provided token is not valid", status_code=401)
+                await response(scope, receive, send)
+                return
+            state['principal'] = principal
+        if (
+            self.redis is None
+            or scope['method'] in ('HEAD', 'GET')
+            or re_read_only_path(scope['path'])
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        redis = self.redis
+        bus = self.invalidation_bus
+        tables: Set[str] = set()
+        token = deferred_tables.set(tables) if bus is not None else None
+
+        async def publish():
+            if bus is not None and tables:
+                changed_tables = sorted(tables)
+                tables.clear()
+                await bus.publish(changed_tables)
+
+        async def send_after_flush(message: Message):
+            if message['type'] == 'http.response.start':
+                # the caches are flushed before the client sees a successful
+                # change, and before the other instances are told about it
+                if 200 <= message['status'] < 300:
+                    await redis.flushdb()
+                await publish()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_after_flush)
+        finally:
+            if token is not None:
+                deferred_tables.reset(token)
+            # the changes committed after the response started
+            await publish()
+
+
+def setup_middleware(app: FastAPI) -> FastAPI:
+    request_state = {
+        name: getattr(app, name)
+        for name in (
+            'async_db',
+            'replica_set',
+            'redis',
+            'routing_table_manager',
+            'traffic_recorder',
+            'change_feed',
+        )
+        if hasattr(app, name)
+    }
+    app.add_middleware(
+        RequestMiddleware,
+        request_state=request_state,
+        auth_client=getattr(app, 'auth_client', None),
+        redis=getattr(app, 'redis', None),
+        invalidation_bus=getattr(app, 'invalidation_bus', None),
+    )
+    return app
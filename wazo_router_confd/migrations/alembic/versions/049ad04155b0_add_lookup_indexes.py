@@ -0,0 +1,72 @@
+"""add indexes for the kamailio lookups
+
+Revision ID: 049ad04155b0
+Revises: 819e55cac7fd
+Create Date: 2020-03-02 10:12:31.482117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '049ad04155b0'
+down_revision = '819e55cac7fd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_domains_domain'), 'domains', ['domain'], unique=False)
+    op.create_index(op.f('ix_ipbx_domain_id'), 'ipbx', ['domain_id'], unique=False)
+    op.create_index(op.f('ix_ipbx_ip_fqdn'), 'ipbx', ['ip_fqdn'], unique=False)
+    op.create_index(op.f('ix_ipbx_ip_address'), 'ipbx', ['ip_address'], unique=False)
+    op.create_index(op.f('ix_ipbx_username'), 'ipbx', ['username'], unique=False)
+    op.create_index(
+        op.f('ix_carrier_trunks_carrier_id'),
+        'carrier_trunks',
+        ['carrier_id'],
+        unique=False,
+    )
+    op.create_index(
+        op.f('ix_carrier_trunks_ip_address'),
+        'carrier_trunks',
+        ['ip_address'],
+        unique=False,
+    )
+    op.create_index(
+        'ix_carrier_trunks_tenant_uuid_id',
+        'carrier_trunks',
+        ['tenant_uuid', 'id'],
+        unique=False,
+    )
+    op.create_index(
+        'ix_carrier_trunks_registered',
+        'carrier_trunks',
+        ['id'],
+        unique=False,
+        postgresql_where=sa.text('registered'),
+    )
+    op.drop_index('tenant_uuid', table_name='dids')
+    op.create_index(op.f('ix_dids_did_prefix'), 'dids', ['did_prefix'], unique=False)
+    op.create_index(
+        'ix_normalization_rules_lookup',
+        'normalization_rules',
+        ['profile_id', 'rule_type', 'match_prefix', 'priority'],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index('ix_normalization_rules_lookup', table_name='normalization_rules')
+    op.drop_index(op.f('ix_dids_did_prefix'), table_name='dids')
+    op.create_index('tenant_uuid', 'dids', ['did_prefix'], unique=False)
+    op.drop_index('ix_carrier_trunks_registered', table_name='carrier_trunks')
+    op.drop_index('ix_carrier_trunks_tenant_uuid_id', table_name='carrier_trunks')
+    op.drop_index(op.f('ix_carrier_trunks_ip_address'), table_name='carrier_trunks')
+    op.drop_index(op.f('ix_carrier_trunks_carrier_id'), table_name='carrier_trunks')
+    op.drop_index(op.f('ix_ipbx_username'), table_name='ipbx')
+    op.drop_index(op.f('ix_ipbx_ip_address'), table_name='ipbx')
+    op.drop_index(op.f('ix_ipbx_ip_fqdn'), table_name='ipbx')
+    op.drop_index(op.f('ix_ipbx_domain_id'), table_name='ipbx')
+    op.drop_index(op.f('ix_domains_domain'), table_name='domains')
@@ -0,0 +1,79 @@
+"""notify the changes of the configuration tables
+
+Revision ID: 5f1c2b7d9e41
+Revises: 049ad04155b0
+Create Date: 2020-03-16 09:41:12.308264
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5f1c2b7d9e41'
+down_revision = '049ad04155b0'
+branch_labels = None
+depends_on = None
+
+TABLES = (
+    'tenants',
+    'domains',
+    'ipbx',
+    'dids',
+    'carrier_trunks',
+    'normalization_profiles',
+    'normalization_rules',
+)
+
+
+def upgrade():
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION notify_configuration_change() RETURNS trigger AS $$
+        DECLARE
+            data jsonb;
+            tenant text;
+        BEGIN
+            IF TG_LEVEL = 'ROW' THEN
+                IF TG_OP = 'DELETE' THEN
+                    data := to_jsonb(OLD);
+                ELSE
+                    data := to_jsonb(NEW);
+                END IF;
+                IF TG_TABLE_NAME = 'tenants' THEN
+                    tenant := data->>'uuid';
+                ELSIF TG_TABLE_NAME = 'normalization_rules' THEN
+                    SELECT tenant_uuid::text INTO tenant FROM normalization_profiles
+                    WHERE id = (data->>'profile_id')::integer;
+                ELSE
+                    tenant := data->>'tenant_uuid';
+                END IF;
+            END IF;
+            PERFORM pg_notify('wazo_router_confd_changes', json_build_object(
+                'table', TG_TABLE_NAME,
+                'op', lower(TG_OP),
+                'id', COALESCE(data->'id', data->'uuid'),
+                'tenant', tenant
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    for table in TABLES:
+        op.execute(
+            "CREATE TRIGGER notify_configuration_change "
+            "AFTER INSERT OR UPDATE OR DELETE ON %s "
+            "FOR EACH ROW EXECUTE PROCEDURE notify_configuration_change()" % table
+        )
+        op.execute(
+            "CREATE TRIGGER notify_configuration_truncate "
+            "AFTER TRUNCATE ON %s "
+            "FOR EACH STATEMENT EXECUTE PROCEDURE notify_configuration_change()" % table
+        )
+
+
+def downgrade():
+    for table in TABLES:
+        op.execute("DROP TRIGGER notify_configuration_truncate ON %s" % table)
+        op.execute("DROP TRIGGER notify_configuration_change ON %s" % table)
+    op.execute("DROP FUNCTION notify_configuration_change()")
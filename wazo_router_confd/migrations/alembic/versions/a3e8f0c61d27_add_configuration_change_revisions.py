@@ -0,0 +1,60 @@
+"""number the changes of the configuration tables
+
+Revision ID: a3e8f0c61d27
+Revises: 5f1c2b7d9e41
+Create Date: 2020-03-18 14:22:05.761940
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3e8f0c61d27'
+down_revision = '5f1c2b7d9e41'
+branch_labels = None
+depends_on = None
+
+NOTIFY_FUNCTION = """
+    CREATE OR REPLACE FUNCTION notify_configuration_change() RETURNS trigger AS $$
+    DECLARE
+        data jsonb;
+        tenant text;
+    BEGIN
+        IF TG_LEVEL = 'ROW' THEN
+            IF TG_OP = 'DELETE' THEN
+                data := to_jsonb(OLD);
+            ELSE
+                data := to_jsonb(NEW);
+            END IF;
+            IF TG_TABLE_NAME = 'tenants' THEN
+                tenant := data->>'uuid';
+            ELSIF TG_TABLE_NAME = 'normalization_rules' THEN
+                SELECT tenant_uuid::text INTO tenant FROM normalization_profiles
+                WHERE id = (data->>'profile_id')::integer;
+            ELSE
+                tenant := data->>'tenant_uuid';
+            END IF;
+        END IF;
+        PERFORM pg_notify('wazo_router_confd_changes', json_build_object(
+            %s
+            'table', TG_TABLE_NAME,
+            'op', lower(TG_OP),
+            'id', COALESCE(data->'id', data->'uuid'),
+            'tenant', tenant
+        )::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    op.execute("CREATE SEQUENCE configuration_change_revision")
+    op.execute(
+        NOTIFY_FUNCTION % "'revision', nextval('configuration_change_revision'),"
+    )
+
+
+def downgrade():
+    op.execute(NOTIFY_FUNCTION % '')
+    op.execute("DROP SEQUENCE configuration_change_revision")
@@ -0,0 +1,65 @@
+"""notify the bulk changes of the configuration tables once
+
+Revision ID: d91b4e2a6c58
+Revises: a3e8f0c61d27
+Create Date: 2020-03-23 11:05:47.190324
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd91b4e2a6c58'
+down_revision = 'a3e8f0c61d27'
+branch_labels = None
+depends_on = None
+
+NOTIFY_FUNCTION = """
+    CREATE OR REPLACE FUNCTION notify_configuration_change() RETURNS trigger AS $$
+    DECLARE
+        data jsonb;
+        tenant text;
+    BEGIN
+        %s
+        IF TG_LEVEL = 'ROW' THEN
+            IF TG_OP = 'DELETE' THEN
+                data := to_jsonb(OLD);
+            ELSE
+                data := to_jsonb(NEW);
+            END IF;
+            IF TG_TABLE_NAME = 'tenants' THEN
+                tenant := data->>'uuid';
+            ELSIF TG_TABLE_NAME = 'normalization_rules' THEN
+                SELECT tenant_uuid::text INTO tenant FROM normalization_profiles
+                WHERE id = (data->>'profile_id')::integer;
+            ELSE
+                tenant := data->>'tenant_uuid';
+            END IF;
+        END IF;
+        PERFORM pg_notify('wazo_router_confd_changes', json_build_object(
+            'revision', nextval('configuration_change_revision'),
+            'table', TG_TABLE_NAME,
+            'op', lower(TG_OP),
+            'id', COALESCE(data->'id', data->'uuid'),
+            'tenant', tenant
+        )::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    op.execute(
+        NOTIFY_FUNCTION
+        % """
+        IF current_setting('wazo_router_confd.bulk_changes', true) = 'on' THEN
+            -- the bulk changes are notified once per table and tenant
+            RETURN NULL;
+        END IF;
+        """
+    )
+
+
+def downgrade():
+    op.execute(NOTIFY_FUNCTION % '')
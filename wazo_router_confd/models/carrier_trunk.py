@@ -9,8 +9,10 @@ from sqlalchemy import (
     String,
     ForeignKey,
     ForeignKeyConstraint,
+    Index,
     UniqueConstraint,
     Boolean,
+    text,
 )
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import UUIDType
@@ -37,6 +39,10 @@ class CarrierTrunk(Base):
             ondelete='SET NULL',
         ),
         UniqueConstraint('tenant_uuid', 'carrier_id', 'name'),
+        Index('ix_carrier_trunks_tenant_uuid_id', 'tenant_uuid', 'id'),
+        Index(
+            'ix_carrier_trunks_registered', 'id', postgresql_where=text('registered')
+        ),
     )
 
     id = Column(Integer, primary_key=True, index=True)
@@ -44,14 +50,14 @@ class CarrierTrunk(Base):
         UUIDType(), ForeignKey('tenants.uuid', ondelete='CASCADE'), nullable=False
     )
     tenant = relationship("Tenant")
-    carrier_id = Column(Integer, nullable=False)
+    carrier_id = Column(Integer, nullable=False, index=True)
     carrier = relationship('Carrier')
     normalization_profile_id = Column(Integer, nullable=True)
     normalization_profile = relationship("NormalizationProfile")
     name = Column(String(256), index=True)
     sip_proxy = Column(String(128), nullable=False)
     sip_proxy_port = Column(Integer, nullable=False, default=5060)
-    ip_address = Column(String(256), nullable=True)
+    ip_address = Column(String(256), nullable=True, index=True)
     registered = Column(Boolean, default=False)
     auth_username = Column(String(35), nullable=True)
     auth_password = Column(String(192), nullable=True)
@@ -0,0 +1,147 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from sqlalchemy import DDL, event
+
+from .base import Base
+
+
+CHANGES_CHANNEL = 'wazo_router_confd_changes'
+CHANGES_REVISION_SEQUENCE = 'configuration_change_revision'
+BULK_CHANGES_SETTING = 'wazo_router_confd.bulk_changes'
+
+CHANGE_TABLES = (
+    'tenants',
+    'domains',
+    'ipbx',
+    'dids',
+    'carrier_trunks',
+    'normalization_profiles',
+    'normalization_rules',
+)
+
+# each row change is notified as {"revision", "table", "op", "id", "tenant"}, a
+# truncation without id; the row changes of a bulk load are notified with the
+# "bulk" op, without id. The revisions identify the changes, they are not
+# ordered: Postgres delivers the notifications in the commit order of their
+# transactions, which is the order of the changes
+CREATE_CHANGE_FUNCTION = """
+CREATE SEQUENCE IF NOT EXISTS %(sequence)s;
+CREATE OR REPLACE FUNCTION notify_configuration_change() RETURNS trigger AS $$
+DECLARE
+    data jsonb;
+    tenant text;
+BEGIN
+    IF current_setting('%(bulk_setting)s', true) = 'on' THEN
+        -- the bulk changes are notified once per table and tenant
+        RETURN NULL;
+    END IF;
+    IF TG_LEVEL = 'ROW' THEN
+        IF TG_OP = 'DELETE' THEN
+            data := to_jsonb(OLD);
+        ELSE
+            data := to_jsonb(NEW);
+        END IF;
+        IF TG_TABLE_NAME = 'tenants' THEN
+            tenant := data->>'uuid';
+        ELSIF TG_TABLE_NAME = 'normalization_rules' THEN
+            SELECT tenant_uuid::text INTO tenant FROM normalization_profiles
+            WHERE id = (data->>'profile_id')::integer;
+        ELSE
+            tenant := data->>'tenant_uuid';
+        END IF;
+    END IF;
+    PERFORM pg_notify('%(channel)s', json_build_object(
+        'revision', nextval('%(sequence)s'),
+        'table', TG_TABLE_NAME,
+        'op', lower(TG_OP),
+        'id', COALESCE(data->'id', data->'uuid'),
+        'tenant', tenant
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+""" % dict(
+    channel=CHANGES_CHANNEL,
+    sequence=CHANGES_REVISION_SEQUENCE,
+    bulk_setting=BULK_CHANGES_SETTING,
+)
+
+CREATE_CHANGE_TRIGGERS = """
+CREATE TRIGGER notify_configuration_change
+AFTER INSERT OR UPDATE OR DELETE ON %(table)s
+FOR EACH ROW EXECUTE PROCEDURE notify_configuration_change();
+CREATE TRIGGER notify_configuration_truncate
+AFTER TRUNCATE ON %(table)s
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_configuration_change()
+"""
+
+DROP_CHANGE_TRIGGERS = """
+DROP TRIGGER IF EXISTS notify_configuration_truncate ON %(table)s;
+DROP TRIGGER IF EXISTS notify_configuration_change ON %(table)s
+"""
+
+DROP_CHANGE_FUNCTION = """
+DROP FUNCTION IF EXISTS notify_configuration_change();
+DROP SEQUENCE IF EXISTS %s
+""" % (
+    CHANGES_REVISION_SEQUENCE
+)
+
+
+NOTIFY_BULK_CHANGES = """
+SELECT pg_notify('%(channel)s', json_build_object(
+    'revision', nextval('%(sequence)s'),
+    'table', %%(table)s,
+    'op', 'bulk',
+    'id', NULL,
+    'tenant', tenant::text
+)::text) FROM unnest(%%(tenants)s::uuid[]) AS tenant
+""" % dict(
+    channel=CHANGES_CHANNEL, sequence=CHANGES_REVISION_SEQUENCE
+)
+
+
+def set_bulk_changes(cursor, enabled: bool):
+    """Skip the notification of each row changed in the current transaction."""
+    cursor.execute(
+        "SELECT set_config(%s, %s, true)",
+        (BULK_CHANGES_SETTING, 'on' if enabled else 'off'),
+    )
+
+
+def notify_bulk_changes(cursor, table: str, tenants: list):
+    cursor.execute(NOTIFY_BULK_CHANGES, dict(table=table, tenants=tenants))
+
+
+def get_change_triggers_ddl() -> str:
+    return ';\n'.join(
+        [CREATE_CHANGE_FUNCTION]
+        + [CREATE_CHANGE_TRIGGERS % dict(table=table) for table in CHANGE_TABLES]
+    )
+
+
+def execute_on_postgresql(ddl: DDL) -> DDL:
+    # the stubs only take a Dialect, SQLAlchemy takes its name as well
+    return ddl.execute_if(dialect='postgresql')  # type: ignore
+
+
+# the triggers are created along with the tables, migrations add them to the
+# existing databases
+event.listen(
+    Base.metadata,
+    'after_create',
+    execute_on_postgresql(DDL(get_change_triggers_ddl().replace('%', '%%'))),
+)
+event.listen(
+    Base.metadata,
+    'before_drop',
+    execute_on_postgresql(
+        DDL(
+            ';\n'.join(
+                [DROP_CHANGE_TRIGGERS % dict(table=table) for table in CHANGE_TABLES]
+                + [DROP_CHANGE_FUNCTION]
+            )
+        )
+    ),
+)
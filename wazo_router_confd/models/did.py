@@ -9,7 +9,6 @@ from sqlalchemy import (
     String,
     ForeignKey,
     ForeignKeyConstraint,
-    Index,
     UniqueConstraint,
 )
 from sqlalchemy.orm import relationship
@@ -26,7 +25,6 @@ if TYPE_CHECKING:  # pragma: no cover
 class DID(Base):
     __tablename__ = "dids"
     __table_args__ = (
-        Index('tenant_uuid', 'did_prefix'),
         UniqueConstraint('tenant_uuid', 'did_regex'),
         ForeignKeyConstraint(
             ['tenant_uuid', 'ipbx_id'],
@@ -47,4 +45,4 @@ class DID(Base):
     )
     carrier_trunk = relationship('CarrierTrunk')
     did_regex = Column(String(256))
-    did_prefix = Column(String(128))
+    did_prefix = Column(String(128), index=True)
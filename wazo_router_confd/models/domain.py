@@ -25,4 +25,4 @@ class Domain(Base):
         UUIDType(), ForeignKey('tenants.uuid', ondelete='CASCADE'), nullable=False
     )
     tenant = relationship('Tenant')
-    domain = Column(String(64))
+    domain = Column(String(64), index=True)
@@ -45,16 +45,16 @@ class IPBX(Base):
         UUIDType(), ForeignKey('tenants.uuid', ondelete='CASCADE'), nullable=False
     )
     tenant = relationship("Tenant")
-    domain_id = Column(Integer, nullable=False)
+    domain_id = Column(Integer, nullable=False, index=True)
     domain = relationship("Domain")
     normalization_profile_id = Column(Integer, nullable=True)
     normalization_profile = relationship("NormalizationProfile")
     customer = Column(Integer, nullable=True)
-    ip_fqdn = Column(String(256), nullable=False)
-    ip_address = Column(String(256), nullable=True)
+    ip_fqdn = Column(String(256), nullable=False, index=True)
+    ip_address = Column(String(256), nullable=True, index=True)
     port = Column(Integer, nullable=False, default=5060)
     registered = Column(Boolean, default=False, nullable=False)
-    username = Column(String(50), nullable=True)
+    username = Column(String(50), nullable=True, index=True)
     password = Column(String(192), nullable=True)
     password_ha1 = Column(String(64), nullable=True)
     realm = Column(String(64), nullable=True)
@@ -3,7 +3,15 @@
 
 from typing import TYPE_CHECKING
 
-from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, UniqueConstraint
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Integer,
+    String,
+    ForeignKey,
+    Index,
+    UniqueConstraint,
+)
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import UUIDType
 
@@ -36,7 +44,16 @@ class NormalizationProfile(Base):
 
 class NormalizationRule(Base):
     __tablename__ = "normalization_rules"
-    __table_args__ = (UniqueConstraint('profile_id', 'match_regex'),)
+    __table_args__ = (
+        UniqueConstraint('profile_id', 'match_regex'),
+        Index(
+            'ix_normalization_rules_lookup',
+            'profile_id',
+            'rule_type',
+            'match_prefix',
+            'priority',
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     profile_id = Column(
@@ -0,0 +1,214 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, datetime
+from json import dumps, loads
+from typing import Any, List, Optional, Sequence
+
+from fastapi import HTTPException
+from sqlalchemy import and_, bindparam, func, or_, select, tuple_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from starlette.datastructures import URL
+from starlette.requests import Request
+
+from wazo_router_confd.database import AsyncDatabase
+
+
+ORDER_DIRECTIONS = ('asc', 'desc')
+TOTAL_MODES = ('exact', 'estimated')
+
+
+class Pagination(object):
+    """A page of a list endpoint.
+
+    The first page starts at `offset`, the next ones after the `cursor` of
+    the previous page: the sort key of its last item, so that walking a large
+    list costs the same for each page.
+    """
+
+    offset: int
+    limit: int
+    cursor: Optional[str]
+    order: Optional[str]
+    direction: str
+    total: Optional[str]
+    url: Optional[URL]
+
+    def __init__(
+        self,
+        offset: int = 0,
+        limit: int = 100,
+        cursor: Optional[str] = None,
+        order: Optional[str] = None,
+        direction: str = 'asc',
+        total: Optional[str] = None,
+        url: Optional[URL] = None,
+    ):
+        self.offset = offset
+        self.limit = limit
+        self.cursor = cursor
+        self.order = order
+        self.direction = direction
+        self.total = total
+        self.url = url
+
+
+def get_pagination(
+    request: Request,
+    offset: int = 0,
+    limit: int = 100,
+    cursor: str = None,
+    order: str = None,
+    direction: str = 'asc',
+    total: str = None,
+) -> Pagination:
+    if offset < 0 or limit < 0:
+        raise HTTPException(status_code=400, detail="Invalid offset or limit")
+    if direction not in ORDER_DIRECTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail="direction must be one of %s" % ', '.join(ORDER_DIRECTIONS),
+        )
+    if total is not None and total not in TOTAL_MODES:
+        raise HTTPException(
+            status_code=400, detail="total must be one of %s" % ', '.join(TOTAL_MODES)
+        )
+    return Pagination(
+        offset=offset,
+        limit=limit,
+        cursor=cursor,
+        order=order,
+        direction=direction,
+        total=total,
+        url=request.url,
+    )
+
+
+class Explain(Executable, ClauseElement):
+    def __init__(self, statement: Any):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def compile_explain(element: Explain, compiler: Any, **kwargs) -> str:
+    return 'EXPLAIN (FORMAT JSON) %s' % compiler.process(element.statement, **kwargs)
+
+
+def encode_cursor(values: List[Any]) -> str:
+    def default(value: Any) -> str:
+        if isinstance(value, (date, datetime)):
+            return value.isoformat()
+        return str(value)
+
+    data = dumps(values, default=default, separators=(',', ':'))
+    return urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    try:
+        values = loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def get_keyset_condition(
+    columns: Sequence[Any], values: List[Any], descending: bool
+) -> Any:
+    """The rows after the sort key `values`, the last column being unique.
+
+    The NULL values of the sort column come last in ascending order and
+    first in descending order, as sorted by Postgres.
+    """
+    key = columns[-1]
+    key_value = bindparam('cursor_key', values[-1], type_=key.type, unique=True)
+    if len(columns) == 1:
+        return key < key_value if descending else key > key_value
+    column, value = columns[0], values[0]
+    if value is None:
+        if descending:
+            return or_(column.isnot(None), key < key_value)
+        return and_(column.is_(None), key > key_value)
+    keys = tuple_(column, key)
+    after = tuple_(
+        bindparam('cursor_value', value, type_=column.type, unique=True), key_value
+    )
+    condition = keys < after if descending else keys > after
+    if column.nullable and not descending:
+        condition = or_(condition, column.is_(None))
+    return condition
+
+
+async def get_total(db: AsyncDatabase, query: Any, mode: str) -> int:
+    if mode == 'estimated':
+        # the estimate of the planner, without scanning the rows
+        plan = await db.fetch_value(Explain(query))
+        if isinstance(plan, str):
+            plan = loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    return await db.fetch_value(select([func.count()]).select_from(query.alias()))
+
+
+async def paginate(
+    db: AsyncDatabase,
+    query: Any,
+    key: Any,
+    pagination: Optional[Pagination] = None,
+    order_columns: Sequence[str] = (),
+) -> dict:
+    """The fields of a list response for the page of `query`.
+
+    The rows are sorted by the `order` column, one of `order_columns` of the
+    table of `key`, then by `key`, a unique column, so that the pages are
+    deterministic.
+    """
+    pagination = pagination or Pagination()
+    columns = [key]
+    if pagination.order is not None and pagination.order != key.name:
+        if pagination.order not in order_columns:
+            raise HTTPException(
+                status_code=400,
+                detail="order must be one of %s"
+                % ', '.join([key.name] + list(order_columns)),
+            )
+        columns.insert(0, key.table.c[pagination.order])
+    descending = pagination.direction == 'desc'
+
+    total = None
+    if pagination.total is not None:
+        total = await get_total(db, query, pagination.total)
+
+    page = query
+    for column in columns:
+        # the cursor is read from the sort columns of the last row
+        if column.name not in page.c:
+            page = page.column(column)
+    page = page.order_by(
+        *[column.desc() if descending else column.asc() for column in columns]
+    )
+    if pagination.cursor is not None:
+        page = page.where(
+            get_keyset_condition(
+                columns, decode_cursor(pagination.cursor, len(columns)), descending
+            )
+        )
+    elif pagination.offset:
+        page = page.offset(pagination.offset)
+    # one more row tells whether there is a next page
+    rows = await db.fetch_all(page.limit(pagination.limit + 1))
+
+    next_url = None
+    if len(rows) > pagination.limit:
+        rows = rows[: pagination.limit]
+        if rows and pagination.url is not None:
+            cursor = encode_cursor([rows[-1][column.name] for column in columns])
+            next_url = str(
+                pagination.url.remove_query_params('offset').include_query_params(
+                    cursor=cursor
+                )
+            )
+    return dict(items=rows, total=total, next=next_url)
@@ -1,42 +1,512 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import asyncio
+import logging
+import re
+
 import aioredis  # type: ignore
 
+from collections import OrderedDict, deque
+from contextvars import ContextVar
 from json import loads, dumps
-from typing import Optional
+from time import monotonic
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Union
+
+try:
+    import msgpack  # type: ignore
+except ImportError:  # pragma: no cover
+    msgpack = None
 
 from fastapi import FastAPI
+from sqlalchemy import event
 from starlette.requests import Request
-from starlette.responses import Response
+
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'wazo-router-confd:invalidations'
+INVALIDATION_SEQUENCE_KEY = 'wazo-router-confd:invalidation-sequence'
+FLUSH_KEY = 'wazo-router-confd:flush:%s'
+
+# the tables changed by the request being served, published by the request
+# once the Redis cache is flushed: the other instances would otherwise refill
+# their local caches from the stale entries
+deferred_tables: ContextVar[Optional[Set[str]]] = ContextVar(
+    'deferred_tables', default=None
+)
+
+# flush the database unless it was already flushed for KEYS[1], the key is set
+# again after the flush, which removes it
+FLUSH_ONCE_SCRIPT = '''
+if redis.call('SET', KEYS[1], 1, 'NX', 'EX', ARGV[1]) then
+    redis.call('FLUSHDB')
+    redis.call('SET', KEYS[1], 1, 'EX', ARGV[1])
+    return 1
+end
+return 0
+'''
+
+
+# POST endpoints which do not change the configuration, and must not flush the cache
+re_read_only_path = re.compile(
+    r'^/1\.0/(kamailio/|normalization-profiles/[0-9]+/normalize$)'
+).match
+
+
+class JSONCodec(object):
+    name = 'json'
+    version = 'j1'
+
+    def encode(self, value: dict) -> bytes:
+        return dumps(value, default=str, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, value: bytes) -> dict:
+        return loads(value)
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    version = 'm1'
+
+    def encode(self, value: dict) -> bytes:
+        return msgpack.packb(value, default=str, use_bin_type=True)
+
+    def decode(self, value: bytes) -> dict:
+        return msgpack.unpackb(value, raw=False)
+
+
+Codec = Union[JSONCodec, MsgpackCodec]
+
+codecs: Dict[str, Callable[[], Codec]] = {
+    JSONCodec.name: JSONCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+
+def get_codec(name: Optional[str] = None) -> Codec:
+    name = name or JSONCodec.name
+    if name not in codecs:
+        raise ValueError("Unknown Redis codec %s" % name)
+    if name == MsgpackCodec.name and msgpack is None:
+        raise ValueError("The msgpack Redis codec requires the msgpack package")
+    return codecs[name]()
+
+
+class LocalCache(object):
+    """Process-local LRU cache of the values stored in Redis."""
+
+    max_size: int
+    values: 'OrderedDict[str, dict]'
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.values = OrderedDict()
+
+    def get(self, key: str) -> Optional[dict]:
+        value = self.values.get(key)
+        if value is not None:
+            self.values.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: dict):
+        if self.max_size <= 0:
+            return
+        self.values[key] = value
+        self.values.move_to_end(key)
+        while len(self.values) > self.max_size:
+            self.values.popitem(last=False)
+
+    def clear(self):
+        self.values.clear()
+
+
+class CircuitBreakerOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Stop calling Redis once too many of the recent calls failed or timed out.
+
+    While open every call fails immediately, after `reset_timeout` seconds a
+    single probe call is let through (half-open) and its outcome closes or
+    reopens the circuit.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    timeout: float
+    failure_threshold: float
+    window_size: int
+    reset_timeout: float
+    state: str
+    opened_at: float
+    outcomes: Deque[bool]
+    probing: bool
+
+    def __init__(
+        self,
+        timeout: float = 0.25,
+        failure_threshold: float = 0.5,
+        window_size: int = 20,
+        reset_timeout: float = 5.0,
+    ):
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.window_size = window_size
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.outcomes = deque(maxlen=window_size)
+        self.probing = False
+
+    def allow(self) -> bool:
+        if (
+            self.state == self.OPEN
+            and monotonic() - self.opened_at >= self.reset_timeout
+        ):
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+        return self.state != self.OPEN
+
+    def open(self):
+        if self.state != self.OPEN:
+            logger.warning("Redis circuit breaker opened")
+        self.state = self.OPEN
+        self.opened_at = monotonic()
+        self.probing = False
+
+    def record(self, success: bool):
+        if self.state == self.HALF_OPEN:
+            if success:
+                logger.warning("Redis circuit breaker closed")
+                self.state = self.CLOSED
+                self.outcomes.clear()
+                self.probing = False
+            else:
+                self.open()
+            return
+        self.outcomes.append(success)
+        failures = self.outcomes.count(False)
+        if len(
+            self.outcomes
+        ) >= self.window_size and failures >= self.failure_threshold * len(
+            self.outcomes
+        ):
+            self.open()
+
+    async def call(self, factory: Callable[[], Awaitable[Any]]) -> Any:
+        if not self.allow():
+            raise CircuitBreakerOpen()
+        try:
+            result = await asyncio.wait_for(factory(), self.timeout)
+        except asyncio.CancelledError:
+            self.probing = False
+            raise
+        except Exception:
+            self.record(False)
+            raise
+        self.record(True)
+        return result
 
 
 class Redis(object):
+    """Redis cache, a Redis outage only turns every lookup into a cache miss."""
+
     uri: str
     flush_on_connect: bool
-    pool: aioredis.ConnectionsPool
+    codec: Codec
+    local_cache: LocalCache
+    breaker: CircuitBreaker
+    flush_pending: bool
+    pool: Optional[aioredis.ConnectionsPool]
 
-    def __init__(self, uri, flush_on_connect=False):
+    def __init__(
+        self, uri, flush_on_connect=False, codec=None, local_cache_size=0, breaker=None
+    ):
         self.uri = uri
         self.flush_on_connect = flush_on_connect
+        self.codec = codec or JSONCodec()
+        self.local_cache = LocalCache(local_cache_size)
+        self.breaker = breaker or CircuitBreaker()
+        self.flush_pending = flush_on_connect
+        self.pool = None
 
     async def connect(self):
-        self.pool = await aioredis.create_redis_pool(self.uri)
-        if self.flush_on_connect:
-            await self.flushdb()
+        try:
+            await self.get_pool()
+        except Exception as e:
+            logger.warning("Redis is not available: %s", e)
+            self.breaker.open()
 
     def disconnect(self):
-        self.pool.close()
+        if self.pool is not None:
+            self.pool.close()
+
+    async def get_pool(self) -> aioredis.ConnectionsPool:
+        if self.pool is None:
+            self.pool = await aioredis.create_redis_pool(self.uri)
+        if self.flush_pending:
+            # entries written before an outage may be stale
+            await self.pool.flushdb()
+            self.flush_pending = False
+        return self.pool
+
+    async def execute(self, command: str, *args) -> Any:
+        async def call():
+            pool = await self.get_pool()
+            return await getattr(pool, command)(*args)
+
+        try:
+            return await self.breaker.call(call)
+        except CircuitBreakerOpen:
+            return None
+        except Exception as e:
+            logger.warning("Redis %s failed: %s", command, repr(e))
+            return None
+
+    def get_key(self, key: str) -> str:
+        # entries written by another codec, or codec version, are never read back
+        return '%s:%s' % (self.codec.version, key)
 
     async def get_value(self, key: str) -> Optional[dict]:
-        value = await self.pool.get(key)
-        return loads(value) if value is not None else None
+        value = self.local_cache.get(key)
+        if value is None:
+            data = await self.execute('get', self.get_key(key))
+            if data is not None:
+                value = self.codec.decode(data)
+                self.local_cache.set(key, value)
+        return value
 
     async def set_value(self, key: str, value: dict):
-        await self.pool.set(key, dumps(value, default=str))
+        await self.execute('set', self.get_key(key), self.codec.encode(value))
+        self.local_cache.set(key, value)
+
+    async def get_values(self, keys: List[str]) -> List[Optional[dict]]:
+        values = {key: self.local_cache.get(key) for key in keys}
+        missing_keys = [key for key, value in values.items() if value is None]
+        if missing_keys:
+            redis_values = await self.execute('mget', *map(self.get_key, missing_keys))
+            for key, data in zip(missing_keys, redis_values or []):
+                if data is not None:
+                    value = self.codec.decode(data)
+                    values[key] = value
+                    self.local_cache.set(key, value)
+        return [values[key] for key in keys]
+
+    async def set_values(self, values: Dict[str, dict]):
+        if not values:
+            return
+        pairs: List[Union[str, bytes]] = []
+        for key, value in values.items():
+            pairs.extend((self.get_key(key), self.codec.encode(value)))
+        await self.execute('mset', *pairs)
+        for key, value in values.items():
+            self.local_cache.set(key, value)
 
     async def flushdb(self):
-        await self.pool.flushdb()
+        self.local_cache.clear()
+        # retried on the next successful call if Redis is not reachable
+        self.flush_pending = True
+        await self.execute('ping')
+
+    async def flushdb_once(self, name: str, expire: int = 60):
+        """Flush the database once for `name`, among every process sharing it."""
+        self.local_cache.clear()
+        flushed = await self.execute(
+            'eval', FLUSH_ONCE_SCRIPT, [FLUSH_KEY % name], [expire]
+        )
+        if flushed is None:
+            # retried on the next successful call if Redis is not reachable
+            self.flush_pending = True
+
+
+class RedisBatch(object):
+    """Collect the reads and writes of a request, to send them with MGET and MSET."""
+
+    redis: Redis
+    values: Dict[str, Optional[dict]]
+    pending: Dict[str, dict]
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self.values = {}
+        self.pending = {}
+
+    async def get_values(self, keys: List[str]) -> List[Optional[dict]]:
+        missing_keys = [key for key in keys if key not in self.values]
+        if missing_keys:
+            self.values.update(
+                zip(missing_keys, await self.redis.get_values(missing_keys))
+            )
+        return [self.values[key] for key in keys]
+
+    def set_value(self, key: str, value: dict):
+        self.values[key] = value
+        self.pending[key] = value
+
+    async def commit(self):
+        pending, self.pending = self.pending, {}
+        await self.redis.set_values(pending)
+
+
+class InvalidationBus(object):
+    """Invalidate the process-local caches of every instance on configuration changes.
+
+    Each change is published on a Redis channel with a sequence number, and a
+    gap in the sequence, or a sequence which moved without a message, means
+    that some changes were missed: the handlers are then asked to invalidate
+    everything.
+    """
+
+    redis: Redis
+    poll_interval: float
+    handlers: List[Callable[[Optional[List[str]]], None]]
+    sequence: Optional[int]
+    loop: Optional[asyncio.AbstractEventLoop]
+    tasks: List[asyncio.Future]
+
+    def __init__(self, redis: Redis, poll_interval: float = 5.0):
+        self.redis = redis
+        self.poll_interval = poll_interval
+        self.handlers = []
+        self.sequence = None
+        self.loop = None
+        self.tasks = []
+
+    def add_handler(self, handler: Callable[[Optional[List[str]]], None]):
+        self.handlers.append(handler)
+
+    def invalidate(self, tables: Optional[List[str]] = None):
+        for handler in self.handlers:
+            handler(tables)
+
+    async def start(self):
+        self.loop = asyncio.get_event_loop()
+        try:
+            self.sequence = await self.get_sequence()
+        except Exception as e:
+            logger.warning("Cache invalidation sequence check failed: %s", e)
+        self.tasks = [
+            asyncio.ensure_future(self.listen()),
+            asyncio.ensure_future(self.poll()),
+        ]
+
+    async def stop(self):
+        self.loop = None
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def get_sequence(self) -> int:
+        pool = await self.redis.get_pool()
+        return int(await pool.get(INVALIDATION_SEQUENCE_KEY) or 0)
+
+    async def publish(self, tables: List[str]):
+        try:
+            pool = await self.redis.get_pool()
+            sequence = await pool.incr(INVALIDATION_SEQUENCE_KEY)
+            await pool.publish(
+                INVALIDATION_CHANNEL, dumps(dict(sequence=sequence, tables=tables))
+            )
+        except Exception as e:
+            # the other instances notice the missed change with the sequence
+            logger.warning("Cache invalidation publication failed: %s", e)
+
+    def publish_threadsafe(self, tables: List[str]):
+        # local caches are invalidated right away, other instances asynchronously
+        self.invalidate(tables)
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self.publish(tables), loop)
+
+    def publish_changes(self, tables: List[str]):
+        """Invalidate the caches of the changed `tables`.
+
+        Within a request, the other instances are told by the request once the
+        Redis cache is flushed.
+        """
+        deferred = deferred_tables.get()
+        if deferred is None:
+            self.publish_threadsafe(tables)
+            return
+        self.invalidate(tables)
+        deferred.update(tables)
+
+    def receive(self, message: dict):
+        sequence = message.get('sequence')
+        if self.sequence is not None and sequence != self.sequence + 1:
+            logger.warning(
+                "Missed cache invalidations (%s -> %s), invalidating everything",
+                self.sequence,
+                sequence,
+            )
+            self.invalidate(None)
+        else:
+            self.invalidate(message.get('tables'))
+        self.sequence = sequence
+
+    async def listen(self):
+        while True:
+            try:
+                pool = await self.redis.get_pool()
+                (channel,) = await pool.subscribe(INVALIDATION_CHANNEL)
+                while await channel.wait_message():
+                    self.receive(loads(await channel.get(encoding='utf-8')))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Cache invalidation subscription failed: %s", e)
+            # messages may have been lost while not subscribed
+            self.invalidate(None)
+            await asyncio.sleep(self.poll_interval)
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                sequence = await self.get_sequence()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Cache invalidation sequence check failed: %s", e)
+                continue
+            if sequence != self.sequence:
+                logger.warning(
+                    "Missed cache invalidations (%s -> %s), invalidating everything",
+                    self.sequence,
+                    sequence,
+                )
+                self.invalidate(None)
+                self.sequence = sequence
+
+
+def setup_invalidation(engine, bus: InvalidationBus):
+    # publish the tables changed by each transaction committed through the engine
+    # pylint: disable= unused-variable,unused-argument,too-many-arguments
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context.isinsert or context.isupdate or context.isdelete:
+            table = getattr(context.compiled.statement, 'table', None)
+            if table is not None:
+                changed_tables: Set[str] = conn.info.setdefault('changed_tables', set())
+                changed_tables.add(table.name)
+
+    @event.listens_for(engine, 'commit')
+    def commit(conn):
+        changed_tables = conn.info.pop('changed_tables', None)
+        if changed_tables:
+            bus.publish_changes(sorted(changed_tables))
+
+    @event.listens_for(engine, 'rollback')
+    def rollback(conn):
+        conn.info.pop('changed_tables', None)
 
 
 def get_redis(request: Request) -> Redis:
@@ -46,26 +516,38 @@ def get_redis(request: Request) -> Redis:
 def setup_redis(app: FastAPI, config: dict):
     redis_uri = config['redis_uri']
     redis = Redis(
-        redis_uri, flush_on_connect=bool(config.get('redis_flush_on_connect'))
+        redis_uri,
+        flush_on_connect=bool(config.get('redis_flush_on_connect')),
+        codec=get_codec(config.get('redis_codec')),
+        local_cache_size=int(config.get('redis_local_cache_size') or 0),
+        breaker=CircuitBreaker(
+            timeout=float(config.get('redis_timeout') or 0.25),
+            failure_threshold=float(config.get('redis_failure_threshold') or 0.5),
+            window_size=int(config.get('redis_failure_window') or 20),
+            reset_timeout=float(config.get('redis_reset_timeout') or 5.0),
+        ),
     )
     setattr(app, 'redis', redis)
+    bus = InvalidationBus(
+        redis,
+        poll_interval=float(config.get('redis_invalidation_poll_interval') or 5.0),
+    )
+    bus.add_handler(lambda tables: redis.local_cache.clear())
+    setattr(app, 'invalidation_bus', bus)
+    engine = getattr(app, 'engine', None)
+    if engine is not None:
+        setup_invalidation(engine, bus)
+    async_db = getattr(app, 'async_db', None)
+    if async_db is not None:
+        async_db.add_listener(lambda table: bus.publish_changes([table]))
+    replica_set = getattr(app, 'replica_set', None)
+    if replica_set is not None:
+        # changes made through other instances are not visible on lagging replicas
+        bus.add_handler(lambda tables: replica_set.mark_write())
 
     app.add_event_handler("startup", redis.connect)
+    app.add_event_handler("startup", bus.start)
+    app.add_event_handler("shutdown", bus.stop)
     app.add_event_handler("shutdown", redis.disconnect)
 
-    # pylint: disable= unused-variable
-    @app.middleware("http")
-    async def db_aioredis_database_middleware(request: Request, call_next):
-        response = Response("Internal server error", status_code=500)
-        request.state.redis = redis
-        response = await call_next(request)
-        if (
-            request.method not in ('HEAD', 'GET')
-            and not request.url.path.startswith('/kamailio')
-            and response.status_code >= 200
-            and response.status_code < 300
-        ):
-            await redis.flushdb()
-        return response
-
     return app
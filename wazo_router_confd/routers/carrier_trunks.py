@@ -2,26 +2,30 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from time import time
+from typing import List
 
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
 
 from wazo_router_confd.auth import Principal, get_principal
-from wazo_router_confd.database import get_db
+from wazo_router_confd.conditional import Conditional, get_conditional
+from wazo_router_confd.database import AsyncDatabase, get_async_db, get_async_read_db
+from wazo_router_confd.fieldsets import Fieldset, get_fieldset, get_fieldset_response
+from wazo_router_confd.pagination import Pagination, get_pagination
 from wazo_router_confd.schemas import carrier_trunk as schema
 from wazo_router_confd.services import carrier_trunk as service
+from wazo_router_confd.services.password import PasswordHasher, get_password_hasher
 
 
 router = APIRouter()
 
 
 @router.post("/carrier_trunks", response_model=schema.CarrierTrunkRead)
-def create_carrier_trunk(
+async def create_carrier_trunk(
     carrier_trunk: schema.CarrierTrunkCreate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_carrier_trunk = service.get_carrier_trunk_by_name(
+    db_carrier_trunk = await service.get_carrier_trunk_by_name(
         db, principal, name=carrier_trunk.name
     )
     if db_carrier_trunk:
@@ -43,49 +47,91 @@ def create_carrier_trunk(
                 },
             },
         )
-    return service.create_carrier_trunk(db, principal, carrier_trunk=carrier_trunk)
+    return await service.create_carrier_trunk(
+        db, principal, carrier_trunk=carrier_trunk
+    )
 
 
 @router.get("/carrier_trunks", response_model=schema.CarrierTrunkList)
-def read_carrier_trunks(
-    offset: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+async def read_carrier_trunks(
+    pagination: Pagination = Depends(get_pagination),
+    fieldset: Fieldset = Depends(get_fieldset),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_read_db),
+    principal: Principal = Depends(get_principal),
+):
+    carrier_trunks = await service.get_carrier_trunks(
+        db, principal, pagination=pagination, fieldset=fieldset, conditional=conditional
+    )
+    if conditional.not_modified:
+        return conditional.get_not_modified_response()
+    return get_fieldset_response(fieldset, carrier_trunks)
+
+
+@router.post("/carrier_trunks/bulk", response_model=schema.CarrierTrunkBulkResult)
+async def create_carrier_trunks(
+    carrier_trunks: List[schema.CarrierTrunkCreate],
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
+    hasher: PasswordHasher = Depends(get_password_hasher),
 ):
-    carrier_trunks = service.get_carrier_trunks(
-        db, principal, offset=offset, limit=limit
+    return await service.create_carrier_trunks(
+        db, principal, carrier_trunks=carrier_trunks, hasher=hasher
+    )
+
+
+@router.put("/carrier_trunks/bulk", response_model=schema.CarrierTrunkBulkResult)
+async def update_carrier_trunks(
+    carrier_trunks: List[schema.CarrierTrunkBulkUpdate],
+    db: AsyncDatabase = Depends(get_async_db),
+    principal: Principal = Depends(get_principal),
+    hasher: PasswordHasher = Depends(get_password_hasher),
+):
+    return await service.update_carrier_trunks(
+        db, principal, carrier_trunks=carrier_trunks, hasher=hasher
     )
-    return carrier_trunks
 
 
 @router.get(
     "/carrier_trunks/{carrier_trunk_id}", response_model=schema.CarrierTrunkRead
 )
-def read_carrier_trunk(
+async def read_carrier_trunk(
     carrier_trunk_id: int,
-    db: Session = Depends(get_db),
+    fieldset: Fieldset = Depends(get_fieldset),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_carrier_trunk = service.get_carrier_trunk(
-        db, principal, carrier_trunk_id=carrier_trunk_id
+    db_carrier_trunk = await service.get_carrier_trunk(
+        db,
+        principal,
+        carrier_trunk_id=carrier_trunk_id,
+        fieldset=fieldset,
+        conditional=conditional,
     )
     if db_carrier_trunk is None:
         raise HTTPException(status_code=404, detail="Carrier Trunk not found")
-    return db_carrier_trunk
+    if conditional.not_modified:
+        return conditional.get_not_modified_response()
+    return get_fieldset_response(fieldset, db_carrier_trunk)
 
 
 @router.put(
     "/carrier_trunks/{carrier_trunk_id}", response_model=schema.CarrierTrunkRead
 )
-def update_carrier_trunk(
+async def update_carrier_trunk(
     carrier_trunk_id: int,
     carrier_trunk: schema.CarrierTrunkUpdate,
-    db: Session = Depends(get_db),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_carrier_trunk = service.update_carrier_trunk(
-        db, principal, carrier_trunk=carrier_trunk, carrier_trunk_id=carrier_trunk_id
+    db_carrier_trunk = await service.update_carrier_trunk(
+        db,
+        principal,
+        carrier_trunk=carrier_trunk,
+        carrier_trunk_id=carrier_trunk_id,
+        conditional=conditional,
     )
     if db_carrier_trunk is None:
         raise HTTPException(status_code=404, detail="Carrier Trunk not found")
@@ -95,13 +141,14 @@ def update_carrier_trunk(
 @router.delete(
     "/carrier_trunks/{carrier_trunk_id}", response_model=schema.CarrierTrunkRead
 )
-def delete_carrier_trunk(
+async def delete_carrier_trunk(
     carrier_trunk_id: int,
-    db: Session = Depends(get_db),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_carrier_trunk = service.delete_carrier_trunk(
-        db, principal, carrier_trunk_id=carrier_trunk_id
+    db_carrier_trunk = await service.delete_carrier_trunk(
+        db, principal, carrier_trunk_id=carrier_trunk_id, conditional=conditional
     )
     if db_carrier_trunk is None:
         raise HTTPException(status_code=404, detail="Carrier Trunk not found")
@@ -4,10 +4,11 @@
 from time import time
 
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
 
 from wazo_router_confd.auth import Principal, get_principal
-from wazo_router_confd.database import get_db
+from wazo_router_confd.database import AsyncDatabase, get_async_db, get_async_read_db
+from wazo_router_confd.fieldsets import Fieldset, get_fieldset, get_fieldset_response
+from wazo_router_confd.pagination import Pagination, get_pagination
 from wazo_router_confd.schemas import carrier as schema
 from wazo_router_confd.services import carrier as service
 
@@ -16,12 +17,12 @@ router = APIRouter()
 
 
 @router.post("/carriers", response_model=schema.Carrier)
-def create_carrier(
+async def create_carrier(
     carrier: schema.CarrierCreate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_carrier = service.get_carrier_by_name(db, principal, name=carrier.name)
+    db_carrier = await service.get_carrier_by_name(db, principal, name=carrier.name)
     if db_carrier:
         raise HTTPException(
             status_code=409,
@@ -41,40 +42,45 @@ def create_carrier(
                 },
             },
         )
-    return service.create_carrier(db, principal, carrier=carrier)
+    return await service.create_carrier(db, principal, carrier=carrier)
 
 
 @router.get("/carriers", response_model=schema.CarrierList)
-def read_carriers(
-    offset: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+async def read_carriers(
+    pagination: Pagination = Depends(get_pagination),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_read_db),
     principal: Principal = Depends(get_principal),
 ):
-    carriers = service.get_carriers(db, principal, offset=offset, limit=limit)
-    return carriers
+    carriers = await service.get_carriers(
+        db, principal, pagination=pagination, fieldset=fieldset
+    )
+    return get_fieldset_response(fieldset, carriers)
 
 
 @router.get("/carriers/{carrier_id}", response_model=schema.Carrier)
-def read_carrier(
+async def read_carrier(
     carrier_id: int,
-    db: Session = Depends(get_db),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_carrier = service.get_carrier(db, principal, carrier_id=carrier_id)
+    db_carrier = await service.get_carrier(
+        db, principal, carrier_id=carrier_id, fieldset=fieldset
+    )
     if db_carrier is None:
         raise HTTPException(status_code=404, detail="Carrier not found")
-    return db_carrier
+    return get_fieldset_response(fieldset, db_carrier)
 
 
 @router.put("/carriers/{carrier_id}", response_model=schema.Carrier)
-def update_carrier(
+async def update_carrier(
     carrier_id: int,
     carrier: schema.CarrierUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_carrier = service.update_carrier(
+    db_carrier = await service.update_carrier(
         db, principal, carrier=carrier, carrier_id=carrier_id
     )
     if db_carrier is None:
@@ -83,12 +89,12 @@ def update_carrier(
 
 
 @router.delete("/carriers/{carrier_id}", response_model=schema.Carrier)
-def delete_carrier(
+async def delete_carrier(
     carrier_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_carrier = service.delete_carrier(db, principal, carrier_id=carrier_id)
+    db_carrier = await service.delete_carrier(db, principal, carrier_id=carrier_id)
     if db_carrier is None:
         raise HTTPException(status_code=404, detail="Carrier not found")
     return db_carrier
@@ -2,10 +2,11 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
 
 from wazo_router_confd.auth import Principal, get_principal
-from wazo_router_confd.database import get_db
+from wazo_router_confd.database import AsyncDatabase, get_async_db, get_async_read_db
+from wazo_router_confd.fieldsets import Fieldset, get_fieldset, get_fieldset_response
+from wazo_router_confd.pagination import Pagination, get_pagination
 from wazo_router_confd.schemas import cdr as schema
 from wazo_router_confd.services import cdr as service
 
@@ -14,57 +15,60 @@ router = APIRouter()
 
 
 @router.post("/cdrs", response_model=schema.CDR)
-def create_cdr(
+async def create_cdr(
     cdr: schema.CDRCreate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    return service.create_cdr(db, principal, cdr=cdr)
+    return await service.create_cdr(db, principal, cdr=cdr)
 
 
 @router.get("/cdrs", response_model=schema.CDRList)
-def read_cdrs(
-    offset: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+async def read_cdrs(
+    pagination: Pagination = Depends(get_pagination),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_read_db),
     principal: Principal = Depends(get_principal),
 ):
-    cdrs = service.get_cdrs(db, principal, offset=offset, limit=limit)
-    return cdrs
+    cdrs = await service.get_cdrs(
+        db, principal, pagination=pagination, fieldset=fieldset
+    )
+    return get_fieldset_response(fieldset, cdrs)
 
 
 @router.get("/cdrs/{cdr_id}", response_model=schema.CDR)
-def read_cdr(
+async def read_cdr(
     cdr_id: int,
-    db: Session = Depends(get_db),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_cdr = service.get_cdr(db, principal, cdr_id=cdr_id)
+    db_cdr = await service.get_cdr(db, principal, cdr_id=cdr_id, fieldset=fieldset)
     if db_cdr is None:
         raise HTTPException(status_code=404, detail="CDR not found")
-    return db_cdr
+    return get_fieldset_response(fieldset, db_cdr)
 
 
 @router.put("/cdrs/{cdr_id}", response_model=schema.CDR)
-def update_cdr(
+async def update_cdr(
     cdr_id: int,
     cdr: schema.CDRUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_cdr = service.update_cdr(db, principal, cdr=cdr, cdr_id=cdr_id)
+    db_cdr = await service.update_cdr(db, principal, cdr=cdr, cdr_id=cdr_id)
     if db_cdr is None:
         raise HTTPException(status_code=404, detail="CDR not found")
     return db_cdr
 
 
 @router.delete("/cdrs/{cdr_id}", response_model=schema.CDR)
-def delete_cdr(
+async def delete_cdr(
     cdr_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_cdr = service.delete_cdr(db, principal, cdr_id=cdr_id)
+    db_cdr = await service.delete_cdr(db, principal, cdr_id=cdr_id)
     if db_cdr is None:
         raise HTTPException(status_code=404, detail="CDR not found")
     return db_cdr
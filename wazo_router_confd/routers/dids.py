@@ -1,27 +1,35 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import csv
+
 from time import time
 
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
 
 from wazo_router_confd.auth import Principal, get_principal
-from wazo_router_confd.database import get_db
+from wazo_router_confd.database import AsyncDatabase, get_async_db, get_async_read_db
+from wazo_router_confd.fieldsets import Fieldset, get_fieldset, get_fieldset_response
+from wazo_router_confd.pagination import Pagination, get_pagination
 from wazo_router_confd.schemas import did as schema
 from wazo_router_confd.services import did as service
 
 
 router = APIRouter()
 
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
 
 @router.post("/dids", response_model=schema.DID)
-def create_did(
+async def create_did(
     did: schema.DIDCreate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_did = service.get_did_by_regex(db, principal, regex=did.did_regex)
+    db_did = await service.get_did_by_regex(db, principal, regex=did.did_regex)
     if db_did:
         raise HTTPException(
             status_code=409,
@@ -41,52 +49,101 @@ def create_did(
                 },
             },
         )
-    return service.create_did(db, principal, did=did)
+    return await service.create_did(db, principal, did=did)
 
 
 @router.get("/dids", response_model=schema.DIDList)
-def read_dids(
-    offset: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+async def read_dids(
+    pagination: Pagination = Depends(get_pagination),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_read_db),
+    principal: Principal = Depends(get_principal),
+):
+    dids = await service.get_dids(
+        db, principal, pagination=pagination, fieldset=fieldset
+    )
+    return get_fieldset_response(fieldset, dids)
+
+
+@router.post("/dids/bulk", response_model=schema.DIDBulkResult)
+async def import_dids(
+    request: Request,
+    on_conflict: str = 'skip',
+    dry_run: bool = False,
+    db: AsyncDatabase = Depends(get_async_db),
+    principal: Principal = Depends(get_principal),
+):
+    if on_conflict not in ('skip', 'update'):
+        raise HTTPException(
+            status_code=400, detail="on_conflict must be one of skip, update"
+        )
+    ndjson = request.headers.get('content-type', '').startswith(NDJSON_MEDIA_TYPE)
+    body = await request.body()
+    try:
+        result = await run_in_threadpool(
+            service.import_dids,
+            request.app.engine,
+            principal,
+            service.read_did_rows(body, ndjson=ndjson),
+            update=on_conflict == 'update',
+            dry_run=dry_run,
+        )
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(
+            status_code=400, detail="There was an error parsing the body: %s" % e
+        )
+    if not dry_run and (result.created or result.updated):
+        db.notify_table('dids')
+    return result
+
+
+@router.get("/dids/bulk")
+async def export_dids(
+    format: str = 'csv',
+    db: AsyncDatabase = Depends(get_async_read_db),
     principal: Principal = Depends(get_principal),
 ):
-    dids = service.get_dids(db, principal, offset=offset, limit=limit)
-    return dids
+    if format not in ('csv', 'ndjson'):
+        raise HTTPException(status_code=400, detail="format must be one of csv, ndjson")
+    return StreamingResponse(
+        service.export_dids(db, principal, ndjson=format == 'ndjson'),
+        media_type=NDJSON_MEDIA_TYPE if format == 'ndjson' else 'text/csv',
+    )
 
 
 @router.get("/dids/{did_id}", response_model=schema.DID)
-def read_did(
+async def read_did(
     did_id: int,
-    db: Session = Depends(get_db),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_did = service.get_did(db, principal, did_id=did_id)
+    db_did = await service.get_did(db, principal, did_id=did_id, fieldset=fieldset)
     if db_did is None:
         raise HTTPException(status_code=404, detail="DID not found")
-    return db_did
+    return get_fieldset_response(fieldset, db_did)
 
 
 @router.put("/dids/{did_id}", response_model=schema.DID)
-def update_did(
+async def update_did(
     did_id: int,
     did: schema.DIDUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_did = service.update_did(db, principal, did=did, did_id=did_id)
+    db_did = await service.update_did(db, principal, did=did, did_id=did_id)
     if db_did is None:
         raise HTTPException(status_code=404, detail="DID not found")
     return db_did
 
 
 @router.delete("/dids/{did_id}", response_model=schema.DID)
-def delete_did(
+async def delete_did(
     did_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_did = service.delete_did(db, principal, did_id=did_id)
+    db_did = await service.delete_did(db, principal, did_id=did_id)
     if db_did is None:
         raise HTTPException(status_code=404, detail="DID not found")
     return db_did
@@ -4,10 +4,12 @@
 from time import time
 
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
 
 from wazo_router_confd.auth import Principal, get_principal
-from wazo_router_confd.database import get_db
+from wazo_router_confd.conditional import Conditional, get_conditional
+from wazo_router_confd.database import AsyncDatabase, get_async_db, get_async_read_db
+from wazo_router_confd.fieldsets import Fieldset, get_fieldset, get_fieldset_response
+from wazo_router_confd.pagination import Pagination, get_pagination
 from wazo_router_confd.schemas import domain as schema
 from wazo_router_confd.services import domain as service
 
@@ -16,12 +18,12 @@ router = APIRouter()
 
 
 @router.post("/domains", response_model=schema.Domain)
-def create_domain(
+async def create_domain(
     domain: schema.DomainCreate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_domain = service.get_domain(db, principal, domain=domain.domain)
+    db_domain = await service.get_domain(db, principal, domain=domain.domain)
     if db_domain:
         raise HTTPException(
             status_code=409,
@@ -41,52 +43,69 @@ def create_domain(
                 },
             },
         )
-    return service.create_domain(db, principal, domain=domain)
+    return await service.create_domain(db, principal, domain=domain)
 
 
 @router.get("/domains", response_model=schema.DomainList)
-def read_domains(
-    offset: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+async def read_domains(
+    pagination: Pagination = Depends(get_pagination),
+    fieldset: Fieldset = Depends(get_fieldset),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_read_db),
     principal: Principal = Depends(get_principal),
 ):
-    domains = service.get_domains(db, principal, offset=offset, limit=limit)
-    return domains
+    domains = await service.get_domains(
+        db, principal, pagination=pagination, fieldset=fieldset, conditional=conditional
+    )
+    if conditional.not_modified:
+        return conditional.get_not_modified_response()
+    return get_fieldset_response(fieldset, domains)
 
 
 @router.get("/domains/{domain_id}", response_model=schema.Domain)
-def read_domain(
+async def read_domain(
     domain_id: int,
-    db: Session = Depends(get_db),
+    fieldset: Fieldset = Depends(get_fieldset),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_domain = service.get_domain_by_id(db, principal, domain_id=domain_id)
+    db_domain = await service.get_domain_by_id(
+        db, principal, domain_id=domain_id, fieldset=fieldset, conditional=conditional
+    )
     if db_domain is None:
         raise HTTPException(status_code=404, detail="Domain not found")
-    return db_domain
+    if conditional.not_modified:
+        return conditional.get_not_modified_response()
+    return get_fieldset_response(fieldset, db_domain)
 
 
 @router.put("/domains/{domain_id}", response_model=schema.Domain)
-def update_domain(
+async def update_domain(
     domain_id: int,
     domain: schema.DomainUpdate,
-    db: Session = Depends(get_db),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_domain = service.update_domain(db, principal, domain=domain, domain_id=domain_id)
+    db_domain = await service.update_domain(
+        db, principal, domain=domain, domain_id=domain_id, conditional=conditional
+    )
     if db_domain is None:
         raise HTTPException(status_code=404, detail="Domain not found")
     return db_domain
 
 
 @router.delete("/domains/{domain_id}", response_model=schema.Domain)
-def delete_domain(
+async def delete_domain(
     domain_id: int,
-    db: Session = Depends(get_db),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_domain = service.delete_domain(db, principal, domain_id=domain_id)
+    db_domain = await service.delete_domain(
+        db, principal, domain_id=domain_id, conditional=conditional
+    )
     if db_domain is None:
         raise HTTPException(status_code=404, detail="Domain not found")
     return db_domain
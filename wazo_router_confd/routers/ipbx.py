@@ -1,70 +1,112 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from typing import List
+
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
 
 from wazo_router_confd.auth import Principal, get_principal
-from wazo_router_confd.database import get_db
+from wazo_router_confd.conditional import Conditional, get_conditional
+from wazo_router_confd.database import AsyncDatabase, get_async_db, get_async_read_db
+from wazo_router_confd.fieldsets import Fieldset, get_fieldset, get_fieldset_response
+from wazo_router_confd.pagination import Pagination, get_pagination
 from wazo_router_confd.schemas import ipbx as schema
 from wazo_router_confd.services import ipbx as service
+from wazo_router_confd.services.password import PasswordHasher, get_password_hasher
 
 
 router = APIRouter()
 
 
 @router.post("/ipbxs", response_model=schema.IPBXRead)
-def create_ipbx(
+async def create_ipbx(
     ipbx: schema.IPBXCreate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    return service.create_ipbx(db, principal, ipbx=ipbx)
+    return await service.create_ipbx(db, principal, ipbx=ipbx)
 
 
 @router.get("/ipbxs", response_model=schema.IPBXList)
-def read_ipbxs(
-    offset: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+async def read_ipbxs(
+    pagination: Pagination = Depends(get_pagination),
+    fieldset: Fieldset = Depends(get_fieldset),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_read_db),
+    principal: Principal = Depends(get_principal),
+):
+    ipbxs = await service.get_ipbxs(
+        db, principal, pagination=pagination, fieldset=fieldset, conditional=conditional
+    )
+    if conditional.not_modified:
+        return conditional.get_not_modified_response()
+    return get_fieldset_response(fieldset, ipbxs)
+
+
+@router.post("/ipbxs/bulk", response_model=schema.IPBXBulkResult)
+async def create_ipbxs(
+    ipbxs: List[schema.IPBXCreate],
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
+    hasher: PasswordHasher = Depends(get_password_hasher),
 ):
-    ipbxs = service.get_ipbxs(db, principal, offset=offset, limit=limit)
-    return ipbxs
+    return await service.create_ipbxs(db, principal, ipbxs=ipbxs, hasher=hasher)
+
+
+@router.put("/ipbxs/bulk", response_model=schema.IPBXBulkResult)
+async def update_ipbxs(
+    ipbxs: List[schema.IPBXBulkUpdate],
+    db: AsyncDatabase = Depends(get_async_db),
+    principal: Principal = Depends(get_principal),
+    hasher: PasswordHasher = Depends(get_password_hasher),
+):
+    return await service.update_ipbxs(db, principal, ipbxs=ipbxs, hasher=hasher)
 
 
 @router.get("/ipbxs/{ipbx_id}", response_model=schema.IPBXRead)
-def read_ipbx(
+async def read_ipbx(
     ipbx_id: int,
-    db: Session = Depends(get_db),
+    fieldset: Fieldset = Depends(get_fieldset),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_ipbx = service.get_ipbx(db, principal, ipbx_id=ipbx_id)
+    db_ipbx = await service.get_ipbx(
+        db, principal, ipbx_id=ipbx_id, fieldset=fieldset, conditional=conditional
+    )
     if db_ipbx is None:
         raise HTTPException(status_code=404, detail="IPBX not found")
-    return db_ipbx
+    if conditional.not_modified:
+        return conditional.get_not_modified_response()
+    return get_fieldset_response(fieldset, db_ipbx)
 
 
 @router.put("/ipbxs/{ipbx_id}", response_model=schema.IPBXRead)
-def update_ipbx(
+async def update_ipbx(
     ipbx_id: int,
     ipbx: schema.IPBXUpdate,
-    db: Session = Depends(get_db),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_ipbx = service.update_ipbx(db, principal, ipbx=ipbx, ipbx_id=ipbx_id)
+    db_ipbx = await service.update_ipbx(
+        db, principal, ipbx=ipbx, ipbx_id=ipbx_id, conditional=conditional
+    )
     if db_ipbx is None:
         raise HTTPException(status_code=404, detail="IPBX not found")
     return db_ipbx
 
 
 @router.delete("/ipbxs/{ipbx_id}", response_model=schema.IPBXRead)
-def delete_ipbx(
+async def delete_ipbx(
     ipbx_id: int,
-    db: Session = Depends(get_db),
+    conditional: Conditional = Depends(get_conditional),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_ipbx = service.delete_ipbx(db, principal, ipbx_id=ipbx_id)
+    db_ipbx = await service.delete_ipbx(
+        db, principal, ipbx_id=ipbx_id, conditional=conditional
+    )
     if db_ipbx is None:
         raise HTTPException(status_code=404, detail="IPBX not found")
     return db_ipbx
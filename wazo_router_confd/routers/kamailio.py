@@ -1,14 +1,28 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import aiopg  # type: ignore
+from typing import Optional
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Header, HTTPException
 
-from wazo_router_confd.database import get_aiopg_pool
+from wazo_router_confd.auth import Principal, get_principal
+from wazo_router_confd.changes import (
+    ChangeFeed,
+    EventStreamResponse,
+    get_change_feed,
+    get_stream_tenants,
+    stream_changes,
+)
+from wazo_router_confd.database import (
+    AiopgConnectionPool,
+    get_aiopg_pool,
+    get_aiopg_read_pool,
+)
 from wazo_router_confd.redis import Redis, get_redis
+from wazo_router_confd.routing_table import RoutingTable, get_routing_table
 from wazo_router_confd.schemas import kamailio as schema
 from wazo_router_confd.services import kamailio as service
+from wazo_router_confd.warmup import TrafficRecorder, get_traffic_recorder
 
 
 router = APIRouter()
@@ -17,15 +31,19 @@ router = APIRouter()
 @router.post("/kamailio/routing")
 async def kamailio_routing(
     request: schema.RoutingRequest,
-    pool: aiopg.Pool = Depends(get_aiopg_pool),
+    pool: AiopgConnectionPool = Depends(get_aiopg_read_pool),
     redis: Redis = Depends(get_redis),
+    table: Optional[RoutingTable] = Depends(get_routing_table),
+    recorder: Optional[TrafficRecorder] = Depends(get_traffic_recorder),
 ):
-    return await service.routing(pool, redis, request=request)
+    if recorder is not None:
+        recorder.record(request)
+    return await service.routing(pool, redis, request=request, table=table)
 
 
 @router.post("/kamailio/cdr")
 async def kamailio_cdr(
-    request: schema.CDRRequest, pool: aiopg.Pool = Depends(get_aiopg_pool)
+    request: schema.CDRRequest, pool: AiopgConnectionPool = Depends(get_aiopg_pool)
 ):
     return await service.cdr(pool, request)
 
@@ -33,12 +51,43 @@ async def kamailio_cdr(
 @router.post("/kamailio/auth")
 async def kamailio_auth(
     request: schema.AuthRequest,
-    pool: aiopg.Pool = Depends(get_aiopg_pool),
+    pool: AiopgConnectionPool = Depends(get_aiopg_read_pool),
     redis: Redis = Depends(get_redis),
+    recorder: Optional[TrafficRecorder] = Depends(get_traffic_recorder),
 ):
+    if recorder is not None:
+        recorder.record(request)
     return await service.auth(pool, redis, request=request)
 
 
 @router.get("/kamailio/dbtext/uacreg")
-async def kamailio_dbtext_uacreg(pool: aiopg.Pool = Depends(get_aiopg_pool)):
+async def kamailio_dbtext_uacreg(
+    pool: AiopgConnectionPool = Depends(get_aiopg_read_pool)
+):
     return await service.dbtext_uacreg(pool)
+
+
+@router.get("/kamailio/changes/stream")
+async def kamailio_changes_stream(
+    tenant_uuid: Optional[str] = None,
+    since: Optional[int] = None,
+    timeout: float = 300.0,
+    last_event_id: Optional[int] = Header(None),
+    feed: Optional[ChangeFeed] = Depends(get_change_feed),
+    principal: Principal = Depends(get_principal),
+):
+    if feed is None:
+        raise HTTPException(
+            status_code=503, detail="Configuration changes are not listened to"
+        )
+    # checked before the stream starts, to fail with 403
+    tenant_uuids = get_stream_tenants(principal, tenant_uuid)
+    return EventStreamResponse(
+        stream_changes(
+            feed,
+            tenant_uuids,
+            after=last_event_id if last_event_id is not None else since,
+            timeout=timeout,
+        ),
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
@@ -4,24 +4,30 @@
 from time import time
 
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from pydantic import ValidationError
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
 
 from wazo_router_confd.auth import Principal, get_principal
-from wazo_router_confd.database import get_db
+from wazo_router_confd.database import AsyncDatabase, get_async_db, get_async_read_db
+from wazo_router_confd.fieldsets import Fieldset, get_fieldset, get_fieldset_response
+from wazo_router_confd.pagination import Pagination, get_pagination
 from wazo_router_confd.schemas import normalization as schema
 from wazo_router_confd.services import normalization as service
 
 
 router = APIRouter()
 
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
 
 @router.post("/normalization-profiles", response_model=schema.NormalizationProfile)
-def create_normalization_profile(
+async def create_normalization_profile(
     normalization_profile: schema.NormalizationProfileCreate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_normalization_profile = service.get_normalization_profile_by_name(
+    db_normalization_profile = await service.get_normalization_profile_by_name(
         db, principal, name=normalization_profile.name
     )
     if db_normalization_profile:
@@ -43,52 +49,56 @@ def create_normalization_profile(
                 },
             },
         )
-    return service.create_normalization_profile(
+    return await service.create_normalization_profile(
         db, principal, normalization_profile=normalization_profile
     )
 
 
 @router.get("/normalization-profiles", response_model=schema.NormalizationProfileList)
-def read_normalization_profiles(
-    offset: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+async def read_normalization_profiles(
+    pagination: Pagination = Depends(get_pagination),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_read_db),
     principal: Principal = Depends(get_principal),
 ):
-    normalization_profiles = service.get_normalization_profiles(
-        db, principal, offset=offset, limit=limit
+    normalization_profiles = await service.get_normalization_profiles(
+        db, principal, pagination=pagination, fieldset=fieldset
     )
-    return normalization_profiles
+    return get_fieldset_response(fieldset, normalization_profiles)
 
 
 @router.get(
     "/normalization-profiles/{normalization_profile_id}",
     response_model=schema.NormalizationProfile,
 )
-def read_normalization_profile(
+async def read_normalization_profile(
     normalization_profile_id: int,
-    db: Session = Depends(get_db),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_normalization_profile = service.get_normalization_profile(
-        db, principal, normalization_profile_id=normalization_profile_id
+    db_normalization_profile = await service.get_normalization_profile(
+        db,
+        principal,
+        normalization_profile_id=normalization_profile_id,
+        fieldset=fieldset,
     )
     if db_normalization_profile is None:
         raise HTTPException(status_code=404, detail="Normalization profile not found")
-    return db_normalization_profile
+    return get_fieldset_response(fieldset, db_normalization_profile)
 
 
 @router.put(
     "/normalization-profiles/{normalization_profile_id}",
     response_model=schema.NormalizationProfile,
 )
-def update_normalization_profile(
+async def update_normalization_profile(
     normalization_profile_id: int,
     normalization_profile: schema.NormalizationProfileUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_normalization_profile = service.update_normalization_profile(
+    db_normalization_profile = await service.update_normalization_profile(
         db,
         principal,
         normalization_profile=normalization_profile,
@@ -103,12 +113,12 @@ def update_normalization_profile(
     "/normalization-profiles/{normalization_profile_id}",
     response_model=schema.NormalizationProfile,
 )
-def delete_normalization_profile(
+async def delete_normalization_profile(
     normalization_profile_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_normalization_profile = service.delete_normalization_profile(
+    db_normalization_profile = await service.delete_normalization_profile(
         db, principal, normalization_profile_id=normalization_profile_id
     )
     if db_normalization_profile is None:
@@ -116,13 +126,60 @@ def delete_normalization_profile(
     return db_normalization_profile
 
 
+@router.post(
+    "/normalization-profiles/{normalization_profile_id}/normalize",
+    response_model=schema.NormalizationResponse,
+)
+async def normalize_numbers(
+    normalization_profile_id: int,
+    request: Request,
+    direction: schema.NormalizationDirection = None,
+    db: AsyncDatabase = Depends(get_async_db),
+    principal: Principal = Depends(get_principal),
+):
+    profile = await service.get_compiled_normalization_profile_by_id(
+        db, principal, normalization_profile_id=normalization_profile_id
+    )
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Normalization profile not found")
+    # NDJSON: one number per line, the direction is given as query parameter
+    if request.headers.get('content-type', '').startswith(NDJSON_MEDIA_TYPE):
+        if direction is None:
+            raise HTTPException(status_code=400, detail="Missing direction")
+        return StreamingResponse(
+            service.normalize_ndjson_numbers(profile, direction, request.stream()),
+            media_type=NDJSON_MEDIA_TYPE,
+        )
+    try:
+        normalization_request = schema.NormalizationRequest(**await request.json())
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=400, detail="There was an error parsing the body"
+        )
+    # large batches: skip the per item response model validation
+    return JSONResponse(
+        dict(
+            items=[
+                dict(number=number, normalized=normalized)
+                for number, normalized in service.normalize_numbers(
+                    profile,
+                    normalization_request.direction,
+                    normalization_request.numbers,
+                )
+            ]
+        )
+    )
+
+
 @router.post("/normalization-rules", response_model=schema.NormalizationRule)
-def create_normalization_rule(
+async def create_normalization_rule(
     normalization_rule: schema.NormalizationRuleCreate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_normalization_rule = service.get_normalization_rule_by_match_regex(
+    db_normalization_rule = await service.get_normalization_rule_by_match_regex(
         db, principal, match_regex=normalization_rule.match_regex
     )
     if db_normalization_rule:
@@ -144,52 +201,53 @@ def create_normalization_rule(
                 },
             },
         )
-    return service.create_normalization_rule(
+    return await service.create_normalization_rule(
         db, principal, normalization_rule=normalization_rule
     )
 
 
 @router.get("/normalization-rules", response_model=schema.NormalizationRuleList)
-def read_normalization_rules(
-    offset: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+async def read_normalization_rules(
+    pagination: Pagination = Depends(get_pagination),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_read_db),
     principal: Principal = Depends(get_principal),
 ):
-    normalization_rules = service.get_normalization_rules(
-        db, principal, offset=offset, limit=limit
+    normalization_rules = await service.get_normalization_rules(
+        db, principal, pagination=pagination, fieldset=fieldset
     )
-    return normalization_rules
+    return get_fieldset_response(fieldset, normalization_rules)
 
 
 @router.get(
     "/normalization-rules/{normalization_rule_id}",
     response_model=schema.NormalizationRule,
 )
-def read_normalization_rule(
+async def read_normalization_rule(
     normalization_rule_id: int,
-    db: Session = Depends(get_db),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_normalization_rule = service.get_normalization_rule(
-        db, principal, normalization_rule_id=normalization_rule_id
+    db_normalization_rule = await service.get_normalization_rule(
+        db, principal, normalization_rule_id=normalization_rule_id, fieldset=fieldset
     )
     if db_normalization_rule is None:
         raise HTTPException(status_code=404, detail="Normalization rule not found")
-    return db_normalization_rule
+    return get_fieldset_response(fieldset, db_normalization_rule)
 
 
 @router.put(
     "/normalization-rules/{normalization_rule_id}",
     response_model=schema.NormalizationRule,
 )
-def update_normalization_rule(
+async def update_normalization_rule(
     normalization_rule_id: int,
     normalization_rule: schema.NormalizationRuleUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_normalization_rule = service.update_normalization_rule(
+    db_normalization_rule = await service.update_normalization_rule(
         db,
         principal,
         normalization_rule=normalization_rule,
@@ -204,12 +262,12 @@ def update_normalization_rule(
     "/normalization-rules/{normalization_rule_id}",
     response_model=schema.NormalizationRule,
 )
-def delete_normalization_rule(
+async def delete_normalization_rule(
     normalization_rule_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_normalization_rule = service.delete_normalization_rule(
+    db_normalization_rule = await service.delete_normalization_rule(
         db, principal, normalization_rule_id=normalization_rule_id
     )
     if db_normalization_rule is None:
@@ -2,10 +2,11 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
 
 from wazo_router_confd.auth import Principal, get_principal
-from wazo_router_confd.database import get_db
+from wazo_router_confd.database import AsyncDatabase, get_async_db, get_async_read_db
+from wazo_router_confd.fieldsets import Fieldset, get_fieldset, get_fieldset_response
+from wazo_router_confd.pagination import Pagination, get_pagination
 from wazo_router_confd.schemas import routing_group as schema
 from wazo_router_confd.services import routing_group as service
 
@@ -14,49 +15,52 @@ router = APIRouter()
 
 
 @router.post("/routing-groups", response_model=schema.RoutingGroup)
-def create_routing_group(
+async def create_routing_group(
     routing_group: schema.RoutingGroupCreate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    return service.create_routing_group(db, principal, routing_group=routing_group)
+    return await service.create_routing_group(
+        db, principal, routing_group=routing_group
+    )
 
 
 @router.get("/routing-groups", response_model=schema.RoutingGroupList)
-def read_routing_groups(
-    offset: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+async def read_routing_groups(
+    pagination: Pagination = Depends(get_pagination),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_read_db),
     principal: Principal = Depends(get_principal),
 ):
-    routing_groups = service.get_routing_groups(
-        db, principal, offset=offset, limit=limit
+    routing_groups = await service.get_routing_groups(
+        db, principal, pagination=pagination, fieldset=fieldset
     )
-    return routing_groups
+    return get_fieldset_response(fieldset, routing_groups)
 
 
 @router.get("/routing-groups/{routing_group_id}", response_model=schema.RoutingGroup)
-def read_routing_group(
+async def read_routing_group(
     routing_group_id: int,
-    db: Session = Depends(get_db),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_routing_group = service.get_routing_group(
-        db, principal, routing_group_id=routing_group_id
+    db_routing_group = await service.get_routing_group(
+        db, principal, routing_group_id=routing_group_id, fieldset=fieldset
     )
     if db_routing_group is None:
         raise HTTPException(status_code=404, detail="RoutingGroup not found")
-    return db_routing_group
+    return get_fieldset_response(fieldset, db_routing_group)
 
 
 @router.put("/routing-groups/{routing_group_id}", response_model=schema.RoutingGroup)
-def update_routing_group(
+async def update_routing_group(
     routing_group_id: int,
     routing_group: schema.RoutingGroupUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_routing_group = service.update_routing_group(
+    db_routing_group = await service.update_routing_group(
         db, principal, routing_group=routing_group, routing_group_id=routing_group_id
     )
     if db_routing_group is None:
@@ -65,12 +69,12 @@ def update_routing_group(
 
 
 @router.delete("/routing-groups/{routing_group_id}", response_model=schema.RoutingGroup)
-def delete_routing_group(
+async def delete_routing_group(
     routing_group_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_routing_group = service.delete_routing_group(
+    db_routing_group = await service.delete_routing_group(
         db, principal, routing_group_id=routing_group_id
     )
     if db_routing_group is None:
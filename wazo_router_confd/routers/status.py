@@ -1,12 +1,38 @@
 from fastapi import APIRouter
 
+from starlette.requests import Request
 from starlette.responses import Response
-from starlette.status import HTTP_204_NO_CONTENT
+from starlette.status import HTTP_204_NO_CONTENT, HTTP_503_SERVICE_UNAVAILABLE
+
+from wazo_router_confd.database import get_engine_pool_status
+from wazo_router_confd.schemas import status as schema
 
 
 router = APIRouter()
 
 
 @router.get("/status")
-async def status():
+async def status(request: Request):
+    warmup = getattr(request.app, 'warmup', None)
+    if warmup is not None and not warmup.ready:
+        return Response(status_code=HTTP_503_SERVICE_UNAVAILABLE)
     return Response(status_code=HTTP_204_NO_CONTENT)
+
+
+@router.get("/status/pools", response_model=schema.PoolsStatus)
+async def pools_status(request: Request):
+    app = request.app
+    return schema.PoolsStatus(
+        aiopg=app.async_db.connection_pool.get_status(),
+        sqlalchemy=get_engine_pool_status(app.engine) or None,
+    )
+
+
+@router.get("/status/warmup", response_model=schema.WarmupStatus)
+async def warmup_status(request: Request):
+    warmup = getattr(request.app, 'warmup', None)
+    if warmup is None:
+        return schema.WarmupStatus(
+            ready=True, state='disabled', total=0, done=0, failed=0
+        )
+    return schema.WarmupStatus(**warmup.get_status())
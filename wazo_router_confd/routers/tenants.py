@@ -5,10 +5,11 @@ from time import time
 
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import UUID4
-from sqlalchemy.orm import Session
 
 from wazo_router_confd.auth import Principal, get_principal
-from wazo_router_confd.database import get_db
+from wazo_router_confd.database import AsyncDatabase, get_async_db, get_async_read_db
+from wazo_router_confd.fieldsets import Fieldset, get_fieldset, get_fieldset_response
+from wazo_router_confd.pagination import Pagination, get_pagination
 from wazo_router_confd.schemas import tenant as schema
 from wazo_router_confd.services import tenant as service
 
@@ -17,12 +18,12 @@ router = APIRouter()
 
 
 @router.post("/tenants", response_model=schema.Tenant)
-def create_tenant(
+async def create_tenant(
     tenant: schema.TenantCreate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_tenant = service.get_tenant_by_name(db, principal, name=tenant.name)
+    db_tenant = await service.get_tenant_by_name(db, principal, name=tenant.name)
     if db_tenant:
         raise HTTPException(
             status_code=409,
@@ -42,40 +43,45 @@ def create_tenant(
                 },
             },
         )
-    return service.create_tenant(db, principal, tenant=tenant)
+    return await service.create_tenant(db, principal, tenant=tenant)
 
 
 @router.get("/tenants", response_model=schema.TenantList)
-def read_tenants(
-    offset: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+async def read_tenants(
+    pagination: Pagination = Depends(get_pagination),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_read_db),
     principal: Principal = Depends(get_principal),
 ):
-    tenants = service.get_tenants(db, principal, offset=offset, limit=limit)
-    return tenants
+    tenants = await service.get_tenants(
+        db, principal, pagination=pagination, fieldset=fieldset
+    )
+    return get_fieldset_response(fieldset, tenants)
 
 
 @router.get("/tenants/{tenant_uuid}", response_model=schema.Tenant)
-def read_tenant(
+async def read_tenant(
     tenant_uuid: UUID4,
-    db: Session = Depends(get_db),
+    fieldset: Fieldset = Depends(get_fieldset),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_tenant = service.get_tenant(db, principal, tenant_uuid=tenant_uuid)
+    db_tenant = await service.get_tenant(
+        db, principal, tenant_uuid=tenant_uuid, fieldset=fieldset
+    )
     if db_tenant is None:
         raise HTTPException(status_code=404, detail="Tenant not found")
-    return db_tenant
+    return get_fieldset_response(fieldset, db_tenant)
 
 
 @router.put("/tenants/{tenant_uuid}", response_model=schema.Tenant)
-def update_tenant(
+async def update_tenant(
     tenant_uuid: UUID4,
     tenant: schema.TenantUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_tenant = service.update_tenant(
+    db_tenant = await service.update_tenant(
         db, principal, tenant_uuid=tenant_uuid, tenant=tenant
     )
     if db_tenant is None:
@@ -84,12 +90,12 @@ def update_tenant(
 
 
 @router.delete("/tenants/{tenant_uuid}", response_model=schema.Tenant)
-def delete_tenant(
+async def delete_tenant(
     tenant_uuid: UUID4,
-    db: Session = Depends(get_db),
+    db: AsyncDatabase = Depends(get_async_db),
     principal: Principal = Depends(get_principal),
 ):
-    db_tenant = service.delete_tenant(db, principal, tenant_uuid=tenant_uuid)
+    db_tenant = await service.delete_tenant(db, principal, tenant_uuid=tenant_uuid)
     if db_tenant is None:
         raise HTTPException(status_code=404, detail="Tenant not found")
     return db_tenant
@@ -0,0 +1,410 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import fcntl
+import logging
+import mmap
+import os
+import struct
+
+from json import dumps, loads
+from time import time
+from typing import Any, Dict, Iterable, List, Optional
+from uuid import uuid4
+
+from fastapi import FastAPI
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from wazo_router_confd.redis import InvalidationBus
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'WZRTABLE'
+FORMAT_VERSION = 1
+# magic, format version, revision, build id, number of entries
+HEADER = struct.Struct('<8sIQ16sI')
+# key offset, key length, value offset, value length
+ENTRY = struct.Struct('<IIII')
+
+ROUTING_TABLES = frozenset(
+    [
+        'carrier_trunks',
+        'carriers',
+        'dids',
+        'domains',
+        'ipbx',
+        'normalization_profiles',
+        'normalization_rules',
+        'tenants',
+    ]
+)
+
+
+class RoutingTable(object):
+    """Read-only view of a routing table file, mapped in memory.
+
+    The file is a sorted index of fixed size entries followed by the keys and
+    the JSON encoded values: a lookup is a binary search on the mapping and
+    only the value found is decoded, so the workers mapping the same file
+    share its pages.
+    """
+
+    path: str
+    revision: int
+    build_id: str
+    count: int
+    inode: int
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, revision, build_id, count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.mm.close()
+            raise ValueError("%s is not a routing table file" % path)
+        self.revision = revision
+        self.build_id = build_id.hex()
+        self.count = count
+
+    def close(self):
+        self.mm.close()
+
+    def get_key(self, index: int) -> bytes:
+        key_offset, key_length, _, _ = ENTRY.unpack_from(
+            self.mm, HEADER.size + index * ENTRY.size
+        )
+        return self.mm[key_offset : key_offset + key_length]
+
+    def get(self, key: str) -> Optional[Any]:
+        encoded_key = key.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_key(middle) < encoded_key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count or self.get_key(low) != encoded_key:
+            return None
+        _, _, value_offset, value_length = ENTRY.unpack_from(
+            self.mm, HEADER.size + low * ENTRY.size
+        )
+        return loads(self.mm[value_offset : value_offset + value_length])
+
+
+def write_routing_table(path: str, entries: Dict[str, Any], revision: int):
+    """Write the entries to a new file, then atomically replace `path` with it."""
+    items = sorted(
+        (key.encode('utf-8'), dumps(value, separators=(',', ':')).encode('utf-8'))
+        for key, value in entries.items()
+    )
+    index = []
+    data = []
+    offset = HEADER.size + len(items) * ENTRY.size
+    for key, value in items:
+        index.append(ENTRY.pack(offset, len(key), offset + len(key), len(value)))
+        data.append(key)
+        data.append(value)
+        offset += len(key) + len(value)
+    tmp_path = '%s.%s.tmp' % (path, uuid4().hex)
+    # the table contains the credentials of the ipbxs
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(
+                HEADER.pack(MAGIC, FORMAT_VERSION, revision, uuid4().bytes, len(items))
+            )
+            f.write(b''.join(index))
+            f.write(b''.join(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def get_ipbx_record(row: Any) -> dict:
+    return dict(
+        id=row['id'],
+        tenant_uuid=str(row['tenant_uuid']),
+        normalization_profile_id=row['normalization_profile_id'],
+        ip_fqdn=row['ip_fqdn'],
+        port=row['port'],
+        username=row['username'],
+        password=row['password'],
+        realm=row['realm'],
+    )
+
+
+def get_carrier_trunk_record(row: Any) -> dict:
+    return dict(
+        id=row['id'],
+        tenant_uuid=str(row['tenant_uuid']),
+        normalization_profile_id=row['normalization_profile_id'],
+        sip_proxy=row['sip_proxy'],
+        sip_proxy_port=row['sip_proxy_port'],
+        auth_username=row['auth_username'],
+        auth_password=row['auth_password'],
+        realm=row['realm'],
+    )
+
+
+def append_to(entries: Dict[str, Any], key: str, value: Any):
+    entries.setdefault(key, []).append(value)
+
+
+def get_routing_entries(connection: Any) -> Dict[str, Any]:
+    """Read the routing configuration into the entries of a routing table.
+
+    Keys:
+    - ipbx:<id> and carrier_trunk:<id>, the route of an ipbx or a carrier trunk
+    - domain:<domain>, [ipbx id, tenant uuid] ordered by ipbx id
+    - did:<prefix>, [ipbx id, tenant uuid, did regex] ordered by ipbx id
+    - source:<ip or fqdn>, [tenant uuid, first carrier trunk id] of the
+      tenants owning an ipbx with this address
+    - normalization_profile:<id>, the profile and its ordered rules
+    """
+    entries: Dict[str, Any] = {}
+    for row in connection.execute(
+        text(
+            "SELECT id, tenant_uuid, normalization_profile_id, ip_fqdn, port, "
+            "username, password, realm FROM ipbx"
+        )
+    ):
+        entries['ipbx:%d' % row['id']] = get_ipbx_record(row)
+    for row in connection.execute(
+        text(
+            "SELECT id, tenant_uuid, normalization_profile_id, sip_proxy, "
+            "sip_proxy_port, auth_username, auth_password, realm FROM carrier_trunks"
+        )
+    ):
+        entries['carrier_trunk:%d' % row['id']] = get_carrier_trunk_record(row)
+    for row in connection.execute(
+        text(
+            "SELECT domains.domain, ipbx.id, ipbx.tenant_uuid "
+            "FROM ipbx JOIN domains ON (ipbx.domain_id = domains.id) ORDER BY ipbx.id"
+        )
+    ):
+        append_to(
+            entries, 'domain:%s' % row['domain'], [row['id'], str(row['tenant_uuid'])]
+        )
+    for row in connection.execute(
+        text(
+            "SELECT dids.did_prefix, ipbx.id, ipbx.tenant_uuid, dids.did_regex "
+            "FROM ipbx JOIN dids ON (dids.ipbx_id = ipbx.id) ORDER BY ipbx.id"
+        )
+    ):
+        append_to(
+            entries,
+            'did:%s' % row['did_prefix'],
+            [row['id'], str(row['tenant_uuid']), row['did_regex']],
+        )
+    for row in connection.execute(
+        text(
+            "SELECT DISTINCT ipbx.ip_fqdn, ipbx.tenant_uuid, carrier_trunk.id "
+            "FROM ipbx JOIN (SELECT DISTINCT ON (tenant_uuid) tenant_uuid, id "
+            "FROM carrier_trunks ORDER BY tenant_uuid, id) AS carrier_trunk "
+            "ON (carrier_trunk.tenant_uuid = ipbx.tenant_uuid) "
+            "ORDER BY carrier_trunk.id"
+        )
+    ):
+        append_to(
+            entries, 'source:%s' % row['ip_fqdn'], [str(row['tenant_uuid']), row['id']]
+        )
+    for row in connection.execute(
+        text(
+            "SELECT id, name, country_code, area_code, intl_prefix, ld_prefix, "
+            "always_intl_prefix_plus, always_ld FROM normalization_profiles"
+        )
+    ):
+        entries['normalization_profile:%d' % row['id']] = dict(row, rules=[])
+    for row in connection.execute(
+        text(
+            "SELECT profile_id, id, rule_type, priority, match_regex, match_prefix, "
+            "replace_regex FROM normalization_rules ORDER BY priority, id"
+        )
+    ):
+        profile = entries.get('normalization_profile:%d' % row['profile_id'])
+        if profile is not None:
+            rule = dict(row)
+            del rule['profile_id']
+            profile['rules'].append(rule)
+    return entries
+
+
+def get_revision(timestamp: Optional[float] = None) -> int:
+    # microseconds since the epoch, comparable between the processes of a host
+    return int((timestamp if timestamp is not None else time()) * 1000000)
+
+
+def build_routing_table(engine: Any, path: str):
+    # the snapshot is taken by the first query, after this revision
+    revision = get_revision()
+    with engine.connect() as connection:
+        # a consistent snapshot of all the tables
+        with connection.begin():
+            connection.execute(
+                text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            )
+            entries = get_routing_entries(connection)
+    write_routing_table(path, entries, revision)
+    logger.info(
+        "Routing table %s published, revision %d, %d entries",
+        path,
+        revision,
+        len(entries),
+    )
+
+
+class RoutingTableManager(object):
+    """Keep the routing table of a worker current.
+
+    A table is only used when its snapshot was taken after the last change
+    notified to the worker, the lookups go to the database otherwise. The
+    first worker needing a newer table rebuilds and republishes it, holding a
+    lock next to the file, and the others remap it.
+    """
+
+    path: str
+    engine: Any
+    check_interval: float
+    table: Optional[RoutingTable]
+    required_revision: int
+    prepared: bool
+    loop: Optional[asyncio.AbstractEventLoop]
+    tasks: List[asyncio.Future]
+    rebuild: Optional[asyncio.Event]
+
+    def __init__(
+        self, path: str, engine: Any, bus: InvalidationBus, check_interval: float = 0.5
+    ):
+        self.path = path
+        self.engine = engine
+        self.check_interval = check_interval
+        self.table = None
+        self.required_revision = 0
+        self.prepared = False
+        self.loop = None
+        self.tasks = []
+        self.rebuild = None
+        bus.add_handler(self.invalidate)
+
+    def current(self) -> Optional[RoutingTable]:
+        table = self.table
+        if table is None or table.revision <= self.required_revision:
+            return None
+        return table
+
+    def invalidate(self, tables: Optional[Iterable[str]]):
+        if tables is not None and not ROUTING_TABLES.intersection(tables):
+            return
+        # local changes are notified right before their commit, a table is
+        # only trusted if its snapshot was taken a check interval later
+        self.required_revision = max(
+            self.required_revision, get_revision(time() + self.check_interval)
+        )
+        loop, rebuild = self.loop, self.rebuild
+        if loop is not None and rebuild is not None and not loop.is_closed():
+            # called from the threads running the synchronous sessions too
+            loop.call_soon_threadsafe(rebuild.set)
+
+    def remap(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return
+        if self.table is not None and self.table.inode == inode:
+            return
+        try:
+            table = RoutingTable(self.path)
+        except (OSError, ValueError) as e:
+            logger.warning("Routing table %s can not be loaded: %s", self.path, e)
+            return
+        # lookups in progress keep a reference to the previous table
+        self.table = table
+
+    def refresh(self):
+        with open(self.path + '.lock', 'a') as lock:
+            # wait for the build in progress in another worker, if any
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            self.remap()
+            if self.current() is None:
+                build_routing_table(self.engine, self.path)
+                self.remap()
+
+    def prepare(self):
+        """Publish the table in the parent process, before starting the workers."""
+        self.refresh()
+        self.prepared = True
+
+    async def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.rebuild = asyncio.Event()
+        if not self.prepared:
+            # the file may have been left by an instance which is not running
+            self.required_revision = get_revision()
+        try:
+            # serve the first calls from the table
+            await run_in_threadpool(self.refresh)
+        except Exception as e:
+            logger.warning("Routing table build failed: %s", e)
+        self.tasks = [
+            asyncio.ensure_future(self.watch()),
+            asyncio.ensure_future(self.republish()),
+        ]
+
+    async def stop(self):
+        self.loop = None
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            self.remap()
+
+    async def republish(self):
+        while True:
+            await self.rebuild.wait()
+            # coalesce the changes made in a burst
+            await asyncio.sleep(self.check_interval)
+            self.rebuild.clear()
+            self.remap()
+            if self.current() is not None:
+                continue
+            try:
+                await run_in_threadpool(self.refresh)
+            except Exception as e:
+                logger.warning("Routing table build failed: %s", e)
+                self.rebuild.set()
+
+
+def get_routing_table(request: Request) -> Optional[RoutingTable]:
+    manager = getattr(request.state, 'routing_table_manager', None)
+    return manager.current() if manager is not None else None
+
+
+def setup_routing_table(app: FastAPI, config: dict) -> FastAPI:
+    path = config.get('routing_table_path')
+    if not path:
+        return app
+    manager = RoutingTableManager(
+        path,
+        getattr(app, 'engine'),
+        getattr(app, 'invalidation_bus'),
+        check_interval=float(config.get('routing_table_check_interval') or 0.5),
+    )
+    setattr(app, 'routing_table_manager', manager)
+    app.add_event_handler("startup", manager.start)
+    app.add_event_handler("shutdown", manager.stop)
+    return app
@@ -27,3 +27,5 @@ class CarrierUpdate(BaseModel):
 
 class CarrierList(BaseModel):
     items: List[Carrier]
+    total: Optional[int] = None
+    next: Optional[str] = None
@@ -82,5 +82,21 @@ class CarrierTrunkUpdate(BaseModel):
     retry_seconds: int = 30
 
 
+class CarrierTrunkBulkUpdate(CarrierTrunkUpdate):
+    id: int
+
+
 class CarrierTrunkList(BaseModel):
     items: List[CarrierTrunkRead]
+    total: Optional[int] = None
+    next: Optional[str] = None
+
+
+class CarrierTrunkBulkError(BaseModel):
+    index: int
+    message: str
+
+
+class CarrierTrunkBulkResult(BaseModel):
+    items: List[CarrierTrunkRead]
+    errors: List[CarrierTrunkBulkError]
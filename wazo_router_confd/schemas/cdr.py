@@ -47,3 +47,5 @@ class CDRUpdate(BaseModel):
 
 class CDRList(BaseModel):
     items: List[CDR]
+    total: Optional[int] = None
+    next: Optional[str] = None
@@ -33,3 +33,18 @@ class DIDUpdate(BaseModel):
 
 class DIDList(BaseModel):
     items: List[DID]
+    total: Optional[int] = None
+    next: Optional[str] = None
+
+
+class DIDBulkError(BaseModel):
+    line: int
+    did_regex: Optional[str]
+    message: str
+
+
+class DIDBulkResult(BaseModel):
+    created: int
+    updated: int
+    error_count: int
+    errors: List[DIDBulkError]
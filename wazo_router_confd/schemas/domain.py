@@ -27,3 +27,5 @@ class DomainUpdate(BaseModel):
 
 class DomainList(BaseModel):
     items: List[Domain]
+    total: Optional[int] = None
+    next: Optional[str] = None
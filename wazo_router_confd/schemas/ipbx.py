@@ -72,5 +72,21 @@ class IPBXUpdate(BaseModel):
     realm: Optional[constr(max_length=50)] = None  # type: ignore
 
 
+class IPBXBulkUpdate(IPBXUpdate):
+    id: int
+
+
 class IPBXList(BaseModel):
     items: List[IPBXRead]
+    total: Optional[int] = None
+    next: Optional[str] = None
+
+
+class IPBXBulkError(BaseModel):
+    index: int
+    message: str
+
+
+class IPBXBulkResult(BaseModel):
+    items: List[IPBXRead]
+    errors: List[IPBXBulkError]
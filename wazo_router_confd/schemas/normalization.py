@@ -1,6 +1,7 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from enum import Enum
 from typing import Optional, List
 
 from pydantic import BaseModel, constr, UUID4
@@ -45,6 +46,8 @@ class NormalizationProfileUpdate(BaseModel):
 
 class NormalizationProfileList(BaseModel):
     items: List[NormalizationProfile]
+    total: Optional[int] = None
+    next: Optional[str] = None
 
 
 class NormalizationRule(BaseModel):
@@ -77,3 +80,24 @@ class NormalizationRuleUpdate(BaseModel):
 
 class NormalizationRuleList(BaseModel):
     items: List[NormalizationRule]
+    total: Optional[int] = None
+    next: Optional[str] = None
+
+
+class NormalizationDirection(str, Enum):
+    local_to_e164 = 'local_to_e164'
+    e164_to_local = 'e164_to_local'
+
+
+class NormalizationRequest(BaseModel):
+    direction: NormalizationDirection
+    numbers: List[str]
+
+
+class NormalizedNumber(BaseModel):
+    number: str
+    normalized: str
+
+
+class NormalizationResponse(BaseModel):
+    items: List[NormalizedNumber]
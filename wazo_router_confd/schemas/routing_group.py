@@ -27,3 +27,5 @@ class RoutingGroupUpdate(BaseModel):
 
 class RoutingGroupList(BaseModel):
     items: List[RoutingGroup]
+    total: Optional[int] = None
+    next: Optional[str] = None
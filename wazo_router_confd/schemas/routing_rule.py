@@ -36,3 +36,5 @@ class RoutingRuleUpdate(BaseModel):
 
 class RoutingRuleList(BaseModel):
     items: List[RoutingRule]
+    total: Optional[int] = None
+    next: Optional[str] = None
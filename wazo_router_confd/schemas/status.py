@@ -0,0 +1,41 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class AiopgPoolStatus(BaseModel):
+    min_size: int
+    max_size: int
+    size: int
+    in_use: int
+    idle: int
+    waiters: int
+    acquired: int
+    timeouts: int
+    acquire_time_avg: float
+    acquire_time_max: float
+
+
+class EnginePoolStatus(BaseModel):
+    size: int
+    in_use: int
+    idle: int
+    overflow: int
+
+
+class PoolsStatus(BaseModel):
+    aiopg: AiopgPoolStatus
+    sqlalchemy: Optional[EnginePoolStatus] = None
+
+
+class WarmupStatus(BaseModel):
+    ready: bool
+    state: str
+    total: int
+    done: int
+    failed: int
+    duration: Optional[float] = None
+    error: Optional[str] = None
@@ -0,0 +1,219 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from typing import Any, Dict, List, Optional
+
+import uvicorn  # type: ignore
+
+from .app import get_app
+from .consul import ConsulService, load_settings, register_service, run_sync
+from .database import get_worker_pool_size
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_worker_config(config: dict, workers: int) -> dict:
+    """Split the database connection budget between the workers.
+
+    The pool sizes of the configuration are the totals for the whole service,
+    each worker gets its share (at least one connection).
+    """
+    worker_config = dict(config)
+    for key, default in (('database_pool_min_size', 1), ('database_pool_max_size', 10)):
+        worker_config[key] = get_worker_pool_size(
+            int(config.get(key) or default), workers
+        )
+    return worker_config
+
+
+class Worker(uvicorn.Server):
+    """A server of the supervisor, draining its connections on SIGTERM.
+
+    The worker stops accepting connections first, leaving the shared socket to
+    the other workers, and exits once the connections it accepted are closed,
+    or after the keep-alive timeout, when only idle connections can be left.
+    """
+
+    ready: Any
+    drain_deadline: Optional[float]
+
+    def __init__(self, config: uvicorn.Config, ready: Any):
+        super().__init__(config=config)
+        self.ready = ready
+        self.drain_deadline = None
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        if self.started:
+            self.ready.set()
+
+    def install_signal_handlers(self):
+        super().install_signal_handlers()
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGTERM, self.handle_drain, signal.SIGTERM, None)
+
+    def handle_drain(self, sig, frame):
+        if not self.started or self.should_exit or self.drain_deadline is not None:
+            self.handle_exit(sig, frame)
+            return
+        for server in self.servers:
+            server.close()
+        self.drain_deadline = time.monotonic() + self.config.timeout_keep_alive
+
+    async def on_tick(self, counter) -> bool:
+        if self.drain_deadline is not None and (
+            not self.server_state.connections or time.monotonic() >= self.drain_deadline
+        ):
+            self.should_exit = True
+        return await super().on_tick(counter)
+
+
+class Supervisor(object):
+    """Serve an application with pre-forked workers sharing one socket.
+
+    SIGHUP starts a new generation of workers, then stops the previous one
+    gracefully once the new one is serving; SIGINT and SIGTERM stop all the
+    workers. Workers exiting unexpectedly are replaced.
+    """
+
+    config: uvicorn.Config
+    workers: int
+    processes: List[Any]
+    replaced: List[Any]
+    retiring: List[Any]
+    ready: Dict[int, Any]
+    should_exit: bool
+    should_reload: bool
+    context: Any
+
+    def __init__(self, config: uvicorn.Config, workers: int):
+        self.config = config
+        self.workers = workers
+        self.processes = []
+        self.replaced = []
+        self.retiring = []
+        self.ready = {}
+        self.should_exit = False
+        self.should_reload = False
+        self.context = multiprocessing.get_context('fork')
+
+    def handle_exit(self, sig, frame):
+        self.should_exit = True
+
+    def handle_reload(self, sig, frame):
+        self.should_reload = True
+
+    def serve(self, sock: socket.socket, ready: Any):
+        server = Worker(config=self.config, ready=ready)
+        server.run(sockets=[sock])
+
+    def spawn(self, sock: socket.socket):
+        ready = self.context.Event()
+        process = self.context.Process(target=self.serve, args=(sock, ready))
+        process.start()
+        self.ready[process.pid] = ready
+        return process
+
+    def is_serving(self) -> bool:
+        return all(self.ready[process.pid].is_set() for process in self.processes)
+
+    def reload(self, sock: socket.socket):
+        logger.info("Reloading %d workers", self.workers)
+        # the previous generation is stopped once the new one is serving
+        self.replaced.extend(self.processes)
+        self.processes = [self.spawn(sock) for _ in range(self.workers)]
+
+    def retire(self):
+        for process in self.replaced:
+            # the worker drains its connections before exiting
+            process.terminate()
+        self.retiring.extend(self.replaced)
+        self.replaced = []
+
+    def run(self, sock: Optional[socket.socket] = None):
+        sock = sock if sock is not None else self.config.bind_socket()
+        signal.signal(signal.SIGINT, self.handle_exit)
+        signal.signal(signal.SIGTERM, self.handle_exit)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        logger.info(
+            "Started parent process [%d] with %d workers", os.getpid(), self.workers
+        )
+        self.processes = [self.spawn(sock) for _ in range(self.workers)]
+        while not self.should_exit:
+            if self.should_reload:
+                self.should_reload = False
+                self.reload(sock)
+            if self.replaced and self.is_serving():
+                self.retire()
+            for process in self.retiring:
+                if not process.is_alive():
+                    self.ready.pop(process.pid, None)
+            self.retiring = [p for p in self.retiring if p.is_alive()]
+            for i, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.warning(
+                        "Worker [%d] exited with code %s, restarting",
+                        process.pid,
+                        process.exitcode,
+                    )
+                    self.ready.pop(process.pid, None)
+                    self.processes[i] = self.spawn(sock)
+            time.sleep(0.1)
+        logger.info("Stopping parent process [%d]", os.getpid())
+        for process in self.processes + self.replaced + self.retiring:
+            process.terminate()
+        for process in self.processes + self.replaced + self.retiring:
+            process.join()
+        sock.close()
+
+
+def run_workers(config: dict, workers: int, **uvicorn_options):
+    """Prepare the application once, then serve it from `workers` processes.
+
+    The parent reads the Consul settings, runs the migrations, builds the
+    application, publishes the routing table and registers the service; the
+    workers inherit the prepared application and only open their own
+    connections at startup.
+    """
+    consul = None
+    if config.get('consul_uri') is not None:
+        consul = ConsulService(config['consul_uri'])
+        load_settings(consul, config)
+    worker_config = get_worker_config(config, workers)
+    # the workers only watch the settings, registration is done below, once
+    # for all the workers
+    worker_config['consul_settings_loaded'] = True
+    worker_config['consul_register'] = False
+    app = get_app(worker_config)
+    routing_table_manager = getattr(app, 'routing_table_manager', None)
+    if routing_table_manager is not None:
+        # the workers map the table at startup, before serving their first call
+        try:
+            routing_table_manager.prepare()
+        except Exception as e:
+            logger.warning("Routing table build failed: %s", e)
+    # the connections opened by the migrations can not be shared with children
+    app.engine.dispose()
+    service_id = (
+        run_sync(register_service(consul, config)) if consul is not None else None
+    )
+    try:
+        supervisor = Supervisor(
+            uvicorn.Config(
+                app, host=config['host'], port=config['port'], **uvicorn_options
+            ),
+            workers,
+        )
+        supervisor.run()
+    finally:
+        if consul is not None:
+            run_sync(consul.deregister(service_id))
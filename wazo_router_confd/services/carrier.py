@@ -1,68 +1,117 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from sqlalchemy.orm import Session
+from typing import Any, Dict, Iterable, Optional, Union
+
+from sqlalchemy import select
 
 from wazo_router_confd.auth import Principal
+from wazo_router_confd.database import AsyncDatabase, transactional
+from wazo_router_confd.fieldsets import Fieldset, Projection, Relations
 from wazo_router_confd.models.carrier import Carrier
+from wazo_router_confd.pagination import Pagination, paginate
 from wazo_router_confd.schemas import carrier as schema
+from wazo_router_confd.schemas import tenant as tenant_schema
 from wazo_router_confd.services import tenant as tenant_service
 
 
-def get_carrier(db: Session, principal: Principal, carrier_id: int) -> Carrier:
-    db_carrier = db.query(Carrier).filter(Carrier.id == carrier_id)
+RELATIONS: Relations = dict(
+    tenant=(Carrier.__table__.c.tenant_uuid, tenant_schema.Tenant)
+)
+
+
+async def get_carrier(
+    db: AsyncDatabase,
+    principal: Principal,
+    carrier_id: int,
+    fieldset: Optional[Fieldset] = None,
+) -> Optional[Any]:
+    projection = Projection(Carrier.__table__, schema.Carrier, fieldset, RELATIONS)
+    db_carrier = projection.select().where(Carrier.id == carrier_id)
     if principal is not None and principal.tenant_uuids:
-        db_carrier = db_carrier.filter(Carrier.tenant_uuid.in_(principal.tenant_uuids))
-    return db_carrier.first()
+        db_carrier = db_carrier.where(Carrier.tenant_uuid.in_(principal.tenant_uuids))
+    return projection.get_item(await db.fetch_one(db_carrier.limit(1)))
+
 
+async def get_carriers_by_ids(db: AsyncDatabase, ids: Iterable[int]) -> Dict[int, Any]:
+    ids = set(ids)
+    if not ids:
+        return {}
+    rows = await db.fetch_all(select([Carrier.__table__]).where(Carrier.id.in_(ids)))
+    return {row.id: row for row in rows}
 
-def get_carrier_by_name(db: Session, principal: Principal, name: str) -> Carrier:
-    db_carrier = db.query(Carrier).filter(Carrier.name == name)
+
+async def get_carrier_by_name(
+    db: AsyncDatabase, principal: Principal, name: str
+) -> Optional[Any]:
+    db_carrier = select([Carrier.__table__]).where(Carrier.name == name)
     if principal is not None and principal.tenant_uuids:
-        db_carrier = db_carrier.filter(Carrier.tenant_uuid.in_(principal.tenant_uuids))
-    return db_carrier.first()
+        db_carrier = db_carrier.where(Carrier.tenant_uuid.in_(principal.tenant_uuids))
+    return await db.fetch_one(db_carrier.limit(1))
 
 
-def get_carriers(
-    db: Session, principal: Principal, offset: int = 0, limit: int = 100
-) -> schema.CarrierList:
-    items = db.query(Carrier)
+async def get_carriers(
+    db: AsyncDatabase,
+    principal: Principal,
+    pagination: Optional[Pagination] = None,
+    fieldset: Optional[Fieldset] = None,
+) -> Union[schema.CarrierList, dict]:
+    projection = Projection(Carrier.__table__, schema.Carrier, fieldset, RELATIONS)
+    items = projection.select()
     if principal is not None and principal.tenant_uuid:
-        items = items.filter(Carrier.tenant_uuid == principal.tenant_uuid)
-    items = items.offset(offset).limit(limit).all()
-    return schema.CarrierList(items=items)
-
-
-def create_carrier(
-    db: Session, principal: Principal, carrier: schema.CarrierCreate
-) -> Carrier:
-    carrier.tenant_uuid = tenant_service.get_uuid(principal, db, carrier.tenant_uuid)
-    db_carrier = Carrier(name=carrier.name, tenant_uuid=carrier.tenant_uuid)
-    db.add(db_carrier)
-    db.commit()
-    db.refresh(db_carrier)
-    return db_carrier
+        items = items.where(Carrier.tenant_uuid == principal.tenant_uuid)
+    page = await paginate(
+        db, items, Carrier.__table__.c.id, pagination, order_columns=('name',)
+    )
+    if fieldset:
+        return dict(page, items=projection.get_items(page['items']))
+    return schema.CarrierList(**page)
+
+
+@transactional
+async def create_carrier(
+    db: AsyncDatabase, principal: Principal, carrier: schema.CarrierCreate
+) -> Any:
+    carrier.tenant_uuid = await tenant_service.get_uuid(
+        principal, db, carrier.tenant_uuid
+    )
+    return await db.fetch_one(
+        Carrier.__table__.insert()
+        .values(name=carrier.name, tenant_uuid=carrier.tenant_uuid)
+        .returning(*Carrier.__table__.c)
+    )
 
 
-def update_carrier(
-    db: Session, principal: Principal, carrier_id: int, carrier: schema.CarrierUpdate
-) -> Carrier:
-    db_carrier = get_carrier(db, principal, carrier_id)
+@transactional
+async def update_carrier(
+    db: AsyncDatabase,
+    principal: Principal,
+    carrier_id: int,
+    carrier: schema.CarrierUpdate,
+) -> Optional[Any]:
+    db_carrier = await get_carrier(db, principal, carrier_id)
     if db_carrier is not None:
-        db_carrier.name = carrier.name if carrier.name is not None else db_carrier.name
-        db_carrier.tenant_uuid = (
-            carrier.tenant_uuid
-            if carrier.tenant_uuid is not None
-            else db_carrier.tenant_uuid
+        db_carrier = await db.fetch_one(
+            Carrier.__table__.update()
+            .where(Carrier.id == db_carrier.id)
+            .values(
+                name=carrier.name if carrier.name is not None else db_carrier.name,
+                tenant_uuid=(
+                    carrier.tenant_uuid
+                    if carrier.tenant_uuid is not None
+                    else db_carrier.tenant_uuid
+                ),
+            )
+            .returning(*Carrier.__table__.c)
         )
-        db.commit()
-        db.refresh(db_carrier)
     return db_carrier
 
 
-def delete_carrier(db: Session, principal: Principal, carrier_id: int) -> Carrier:
-    db_carrier = get_carrier(db, principal, carrier_id)
+@transactional
+async def delete_carrier(
+    db: AsyncDatabase, principal: Principal, carrier_id: int
+) -> Optional[Any]:
+    db_carrier = await get_carrier(db, principal, carrier_id)
     if db_carrier is not None:
-        db.delete(db_carrier)
-        db.commit()
+        await db.execute(Carrier.__table__.delete().where(Carrier.id == db_carrier.id))
     return db_carrier
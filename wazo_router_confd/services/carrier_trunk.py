@@ -1,155 +1,467 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from sqlalchemy.orm import Session
+from typing import Any, Dict, List, Optional, Set, Union
+
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
 
 from wazo_router_confd.auth import Principal
+from wazo_router_confd.conditional import ROW_VERSION, Conditional, get_row_version
+from wazo_router_confd.database import AsyncDatabase, transactional
+from wazo_router_confd.fieldsets import Fieldset, Projection, Relations
 from wazo_router_confd.models.carrier_trunk import CarrierTrunk
+from wazo_router_confd.pagination import Pagination, paginate
+from wazo_router_confd.schemas import carrier as carrier_schema
 from wazo_router_confd.schemas import carrier_trunk as schema
+from wazo_router_confd.schemas import normalization as normalization_schema
+from wazo_router_confd.schemas import tenant as tenant_schema
+from wazo_router_confd.services import carrier as carrier_service
+from wazo_router_confd.services import normalization as normalization_service
 from wazo_router_confd.services import password as password_service
 from wazo_router_confd.services import tenant as tenant_service
 
 
-def get_carrier_trunk(
-    db: Session, principal: Principal, carrier_trunk_id: int
-) -> CarrierTrunk:
-    db_carrier_trunk = db.query(CarrierTrunk).filter(
-        CarrierTrunk.id == carrier_trunk_id
+RELATIONS: Relations = dict(
+    tenant=(CarrierTrunk.__table__.c.tenant_uuid, tenant_schema.Tenant),
+    carrier=(CarrierTrunk.__table__.c.carrier_id, carrier_schema.Carrier),
+    normalization_profile=(
+        CarrierTrunk.__table__.c.normalization_profile_id,
+        normalization_schema.NormalizationProfile,
+    ),
+)
+
+
+async def get_carrier_trunk(
+    db: AsyncDatabase,
+    principal: Principal,
+    carrier_trunk_id: int,
+    fieldset: Optional[Fieldset] = None,
+    conditional: Optional[Conditional] = None,
+) -> Optional[Any]:
+    projection = Projection(
+        CarrierTrunk.__table__, schema.CarrierTrunkRead, fieldset, RELATIONS
     )
+    db_carrier_trunk = projection.select().where(CarrierTrunk.id == carrier_trunk_id)
     if principal is not None and principal.tenant_uuids:
-        db_carrier_trunk = db_carrier_trunk.filter(
+        db_carrier_trunk = db_carrier_trunk.where(
             CarrierTrunk.tenant_uuid.in_(principal.tenant_uuids)
         )
-    return db_carrier_trunk.first()
+    row = await db.fetch_one(db_carrier_trunk.limit(1))
+    if row is not None and conditional is not None:
+        conditional.set_etag(projection.get_etag(row))
+    return projection.get_item(row)
 
 
-def get_carrier_trunk_by_name(
-    db: Session, principal: Principal, name: str
-) -> CarrierTrunk:
-    return db.query(CarrierTrunk).filter(CarrierTrunk.name == name).first()
+async def get_carrier_trunk_by_name(
+    db: AsyncDatabase, principal: Principal, name: str
+) -> Optional[Any]:
+    return await db.fetch_one(
+        select([CarrierTrunk.__table__]).where(CarrierTrunk.name == name).limit(1)
+    )
 
 
-def get_carrier_trunks(
-    db: Session, principal: Principal, offset: int = 0, limit: int = 100
-) -> schema.CarrierTrunkList:
-    items = db.query(CarrierTrunk)
+async def get_carrier_trunks(
+    db: AsyncDatabase,
+    principal: Principal,
+    pagination: Optional[Pagination] = None,
+    fieldset: Optional[Fieldset] = None,
+    conditional: Optional[Conditional] = None,
+) -> Union[schema.CarrierTrunkList, dict]:
+    projection = Projection(
+        CarrierTrunk.__table__, schema.CarrierTrunkRead, fieldset, RELATIONS
+    )
+    items = projection.select()
     if principal is not None and principal.tenant_uuid:
-        items = items.filter(CarrierTrunk.tenant_uuid == principal.tenant_uuid)
-    items = items.offset(offset).limit(limit).all()
-    return schema.CarrierTrunkList(items=items)
+        items = items.where(CarrierTrunk.tenant_uuid == principal.tenant_uuid)
+    page = await paginate(
+        db,
+        items,
+        CarrierTrunk.__table__.c.id,
+        pagination,
+        order_columns=('name', 'carrier_id', 'sip_proxy', 'ip_address'),
+    )
+    if conditional is not None:
+        conditional.set_etag(
+            projection.get_page_etag(page, CarrierTrunk.__table__.c.id)
+        )
+        if conditional.not_modified:
+            # not serialized, the client has it
+            return page
+    if fieldset:
+        return dict(page, items=projection.get_items(page['items']))
+    return schema.CarrierTrunkList(**page)
 
 
-def create_carrier_trunk(
-    db: Session, principal: Principal, carrier_trunk: schema.CarrierTrunkCreate
-) -> CarrierTrunk:
-    carrier_trunk.tenant_uuid = tenant_service.get_uuid(
-        principal, db, carrier_trunk.tenant_uuid
+async def create_carrier_trunk(
+    db: AsyncDatabase, principal: Principal, carrier_trunk: schema.CarrierTrunkCreate
+) -> Any:
+    # key stretching is CPU bound, keep it off the event loop and out of the
+    # transaction
+    auth_password = await run_in_threadpool(
+        password_service.hash, carrier_trunk.auth_password
     )
-    db_carrier_trunk = CarrierTrunk(
-        tenant_uuid=carrier_trunk.tenant_uuid,
-        carrier_id=carrier_trunk.carrier_id,
-        name=carrier_trunk.name,
-        normalization_profile_id=carrier_trunk.normalization_profile_id,
-        sip_proxy=carrier_trunk.sip_proxy,
-        sip_proxy_port=carrier_trunk.sip_proxy_port,
-        ip_address=carrier_trunk.ip_address,
-        registered=carrier_trunk.registered,
-        auth_username=carrier_trunk.auth_username,
-        auth_password=password_service.hash(carrier_trunk.auth_password),
-        realm=carrier_trunk.realm,
-        registrar_proxy=carrier_trunk.registrar_proxy,
-        from_domain=carrier_trunk.from_domain,
-        expire_seconds=carrier_trunk.expire_seconds,
-        retry_seconds=carrier_trunk.retry_seconds,
-    )
-    db.add(db_carrier_trunk)
-    db.commit()
-    db.refresh(db_carrier_trunk)
-    return db_carrier_trunk
+    async with db.transaction():
+        carrier_trunk.tenant_uuid = await tenant_service.get_uuid(
+            principal, db, carrier_trunk.tenant_uuid
+        )
+        return await db.fetch_one(
+            CarrierTrunk.__table__.insert()
+            .values(
+                tenant_uuid=carrier_trunk.tenant_uuid,
+                carrier_id=carrier_trunk.carrier_id,
+                name=carrier_trunk.name,
+                normalization_profile_id=carrier_trunk.normalization_profile_id,
+                sip_proxy=carrier_trunk.sip_proxy,
+                sip_proxy_port=carrier_trunk.sip_proxy_port,
+                ip_address=carrier_trunk.ip_address,
+                registered=carrier_trunk.registered,
+                auth_username=carrier_trunk.auth_username,
+                auth_password=auth_password,
+                realm=carrier_trunk.realm,
+                registrar_proxy=carrier_trunk.registrar_proxy,
+                from_domain=carrier_trunk.from_domain,
+                expire_seconds=carrier_trunk.expire_seconds,
+                retry_seconds=carrier_trunk.retry_seconds,
+            )
+            .returning(*CarrierTrunk.__table__.c)
+        )
 
 
-def update_carrier_trunk(
-    db: Session,
-    principal: Principal,
-    carrier_trunk_id: int,
-    carrier_trunk: schema.CarrierTrunkUpdate,
-) -> CarrierTrunk:
-    db_carrier_trunk = get_carrier_trunk(db, principal, carrier_trunk_id)
-    if db_carrier_trunk is not None:
-        db_carrier_trunk.name = (
+def get_carrier_trunk_update_values(
+    db_carrier_trunk: CarrierTrunk, carrier_trunk: schema.CarrierTrunkUpdate
+) -> dict:
+    return dict(
+        name=(
             carrier_trunk.name
             if carrier_trunk.name is not None
             else db_carrier_trunk.name
-        )
-        db_carrier_trunk.normalization_profile_id = (
+        ),
+        normalization_profile_id=(
             carrier_trunk.normalization_profile_id
             if carrier_trunk.normalization_profile_id is not None
             else db_carrier_trunk.normalization_profile_id
-        )
-        db_carrier_trunk.sip_proxy = (
+        ),
+        sip_proxy=(
             carrier_trunk.sip_proxy
             if carrier_trunk.sip_proxy is not None
             else db_carrier_trunk.sip_proxy
-        )
-        db_carrier_trunk.sip_proxy_port = (
+        ),
+        sip_proxy_port=(
             carrier_trunk.sip_proxy_port
             if carrier_trunk.sip_proxy_port is not None
             else db_carrier_trunk.sip_proxy_port
-        )
-        db_carrier_trunk.ip_address = (
+        ),
+        ip_address=(
             carrier_trunk.ip_address
             if carrier_trunk.ip_address is not None
             else db_carrier_trunk.ip_address
-        )
-        db_carrier_trunk.registered = (
+        ),
+        registered=(
             carrier_trunk.registered
             if carrier_trunk.registered is not None
             else db_carrier_trunk.registered
-        )
-        db_carrier_trunk.auth_username = (
+        ),
+        auth_username=(
             carrier_trunk.auth_username
             if carrier_trunk.auth_username is not None
             else db_carrier_trunk.auth_username
-        )
-        if carrier_trunk.auth_password is not None:
-            db_carrier_trunk.auth_password = password_service.hash(
-                carrier_trunk.auth_password
-            )
-        db_carrier_trunk.realm = (
+        ),
+        realm=(
             carrier_trunk.realm
             if carrier_trunk.realm is not None
             else db_carrier_trunk.realm
-        )
-        db_carrier_trunk.registrar_proxy = (
+        ),
+        registrar_proxy=(
             carrier_trunk.registrar_proxy
             if carrier_trunk.registrar_proxy is not None
             else db_carrier_trunk.registrar_proxy
-        )
-        db_carrier_trunk.from_domain = (
+        ),
+        from_domain=(
             carrier_trunk.from_domain
             if carrier_trunk.from_domain is not None
             else db_carrier_trunk.from_domain
-        )
-        db_carrier_trunk.expire_seconds = (
+        ),
+        expire_seconds=(
             carrier_trunk.expire_seconds
             if carrier_trunk.expire_seconds is not None
             else db_carrier_trunk.expire_seconds
-        )
-        db_carrier_trunk.retry_seconds = (
+        ),
+        retry_seconds=(
             carrier_trunk.retry_seconds
             if carrier_trunk.retry_seconds is not None
             else db_carrier_trunk.retry_seconds
+        ),
+    )
+
+
+async def update_carrier_trunk(
+    db: AsyncDatabase,
+    principal: Principal,
+    carrier_trunk_id: int,
+    carrier_trunk: schema.CarrierTrunkUpdate,
+    conditional: Optional[Conditional] = None,
+) -> Optional[Any]:
+    auth_password = None
+    if carrier_trunk.auth_password is not None:
+        auth_password = await run_in_threadpool(
+            password_service.hash, carrier_trunk.auth_password
         )
-        db.commit()
-        db.refresh(db_carrier_trunk)
-    return db_carrier_trunk
+    async with db.transaction():
+        db_carrier_trunk = await get_carrier_trunk(db, principal, carrier_trunk_id)
+        conditional = conditional or Conditional()
+        if db_carrier_trunk is not None:
+            values = get_carrier_trunk_update_values(db_carrier_trunk, carrier_trunk)
+            if carrier_trunk.auth_password is not None:
+                values['auth_password'] = auth_password
+            db_carrier_trunk = conditional.written(
+                await db.fetch_one(
+                    conditional.guard(
+                        CarrierTrunk.__table__.update().where(
+                            CarrierTrunk.id == db_carrier_trunk.id
+                        ),
+                        CarrierTrunk.__table__,
+                        db_carrier_trunk,
+                    )
+                    .values(**values)
+                    .returning(
+                        *CarrierTrunk.__table__.c,
+                        get_row_version(CarrierTrunk.__table__).label(ROW_VERSION)
+                    )
+                )
+            )
+        return db_carrier_trunk
 
 
-def delete_carrier_trunk(
-    db: Session, principal: Principal, carrier_trunk_id: int
-) -> CarrierTrunk:
-    db_carrier_trunk = get_carrier_trunk(db, principal, carrier_trunk_id)
+@transactional
+async def delete_carrier_trunk(
+    db: AsyncDatabase,
+    principal: Principal,
+    carrier_trunk_id: int,
+    conditional: Optional[Conditional] = None,
+) -> Optional[Any]:
+    db_carrier_trunk = await get_carrier_trunk(db, principal, carrier_trunk_id)
+    conditional = conditional or Conditional()
     if db_carrier_trunk is not None:
-        db.delete(db_carrier_trunk)
-        db.commit()
+        conditional.written(
+            await db.fetch_one(
+                conditional.guard(
+                    CarrierTrunk.__table__.delete().where(
+                        CarrierTrunk.id == db_carrier_trunk.id
+                    ),
+                    CarrierTrunk.__table__,
+                    db_carrier_trunk,
+                ).returning(CarrierTrunk.id)
+            )
+        )
     return db_carrier_trunk
+
+
+BULK_BATCH_SIZE = 1000
+
+
+async def check_bulk_carrier_trunks(
+    db: AsyncDatabase, values: Dict[int, dict], errors: Dict[int, str]
+):
+    """Move the carrier trunks which can not be saved from `values` to `errors`.
+
+    The references of the whole request are resolved with one query by table.
+    """
+    carriers = await carrier_service.get_carriers_by_ids(
+        db,
+        [
+            carrier_trunk['carrier_id']
+            for carrier_trunk in values.values()
+            if 'carrier_id' in carrier_trunk
+        ],
+    )
+    normalization_profiles = await normalization_service.get_normalization_profiles_by_ids(
+        db,
+        [
+            carrier_trunk['normalization_profile_id']
+            for carrier_trunk in values.values()
+            if carrier_trunk['normalization_profile_id'] is not None
+        ],
+    )
+    # the owner of each name: the id of an existing carrier trunk, or the index
+    # of a carrier trunk of the request
+    names = {carrier_trunk['name'] for carrier_trunk in values.values()}
+    owners: Dict[str, Any] = {}
+    if names:
+        for row in await db.fetch_all(
+            select([CarrierTrunk.id, CarrierTrunk.name]).where(
+                CarrierTrunk.name.in_(names)
+            )
+        ):
+            owners[row.name] = row.id
+    for index, carrier_trunk in values.items():
+        carrier = (
+            carriers.get(carrier_trunk['carrier_id'])
+            if 'carrier_id' in carrier_trunk
+            else None
+        )
+        normalization_profile = normalization_profiles.get(
+            carrier_trunk['normalization_profile_id']
+        )
+        name = carrier_trunk['name']
+        if 'carrier_id' in carrier_trunk and (
+            carrier is None or carrier.tenant_uuid != carrier_trunk['tenant_uuid']
+        ):
+            errors[index] = "Carrier not found"
+        elif carrier_trunk['normalization_profile_id'] is not None and (
+            normalization_profile is None
+            or normalization_profile.tenant_uuid != carrier_trunk['tenant_uuid']
+        ):
+            errors[index] = "Normalization profile not found"
+        elif name in owners and owners[name] != carrier_trunk.get('id'):
+            errors[index] = "Duplicated name"
+        else:
+            owners[name] = ('index', index)
+    for index in errors:
+        values.pop(index, None)
+
+
+async def hash_bulk_passwords(
+    hasher: password_service.PasswordHasher,
+    values: Dict[int, dict],
+    passwords: Dict[int, Optional[str]],
+):
+    indexes = [index for index in values if passwords.get(index) is not None]
+    hashed = await hasher.hash_all([passwords[index] for index in indexes])
+    for index, password in zip(indexes, hashed):
+        values[index]['auth_password'] = password
+
+
+def get_bulk_result(
+    rows: List[Any], errors: Dict[int, str]
+) -> schema.CarrierTrunkBulkResult:
+    return schema.CarrierTrunkBulkResult(
+        items=rows,
+        errors=[
+            schema.CarrierTrunkBulkError(index=index, message=message)
+            for index, message in sorted(errors.items())
+        ],
+    )
+
+
+async def create_carrier_trunks(
+    db: AsyncDatabase,
+    principal: Principal,
+    carrier_trunks: List[schema.CarrierTrunkCreate],
+    hasher: password_service.PasswordHasher,
+) -> schema.CarrierTrunkBulkResult:
+    """Create the carrier trunks, reporting the ones which can not be created.
+
+    The passwords are hashed on the process pool of `hasher`, and the rows
+    inserted by batches in one transaction.
+    """
+    errors: Dict[int, str] = {}
+    values: Dict[int, dict] = {}
+    for index, carrier_trunk in enumerate(carrier_trunks):
+        tenant_uuid, error = tenant_service.get_bulk_uuid(
+            principal, carrier_trunk.tenant_uuid
+        )
+        if error is not None:
+            errors[index] = error
+            continue
+        values[index] = dict(
+            tenant_uuid=tenant_uuid,
+            carrier_id=carrier_trunk.carrier_id,
+            name=carrier_trunk.name,
+            normalization_profile_id=carrier_trunk.normalization_profile_id,
+            sip_proxy=carrier_trunk.sip_proxy,
+            sip_proxy_port=carrier_trunk.sip_proxy_port,
+            ip_address=carrier_trunk.ip_address,
+            registered=carrier_trunk.registered,
+            auth_username=carrier_trunk.auth_username,
+            auth_password=None,
+            realm=carrier_trunk.realm,
+            registrar_proxy=carrier_trunk.registrar_proxy,
+            from_domain=carrier_trunk.from_domain,
+            expire_seconds=carrier_trunk.expire_seconds,
+            retry_seconds=carrier_trunk.retry_seconds,
+        )
+    await check_bulk_carrier_trunks(db, values, errors)
+    await hash_bulk_passwords(
+        hasher,
+        values,
+        {
+            index: carrier_trunk.auth_password
+            for index, carrier_trunk in enumerate(carrier_trunks)
+        },
+    )
+    rows = list(values.values())
+    async with db.transaction():
+        await tenant_service.create_missing_tenants(
+            db, [carrier_trunk['tenant_uuid'] for carrier_trunk in rows]
+        )
+        rows = await db.fetch_all_batches(
+            [
+                CarrierTrunk.__table__.insert()
+                .values(rows[start : start + BULK_BATCH_SIZE])
+                .returning(*CarrierTrunk.__table__.c)
+                for start in range(0, len(rows), BULK_BATCH_SIZE)
+            ]
+        )
+    return get_bulk_result(rows, errors)
+
+
+async def update_carrier_trunks(
+    db: AsyncDatabase,
+    principal: Principal,
+    carrier_trunks: List[schema.CarrierTrunkBulkUpdate],
+    hasher: password_service.PasswordHasher,
+) -> schema.CarrierTrunkBulkResult:
+    """Update the carrier trunks, reporting the ones which can not be updated."""
+    db_carrier_trunks: Dict[int, Any] = {}
+    if carrier_trunks:
+        query = select([CarrierTrunk.__table__]).where(
+            CarrierTrunk.id.in_({carrier_trunk.id for carrier_trunk in carrier_trunks})
+        )
+        if principal is not None and principal.tenant_uuids:
+            query = query.where(CarrierTrunk.tenant_uuid.in_(principal.tenant_uuids))
+        db_carrier_trunks = {row.id: row for row in await db.fetch_all(query)}
+    errors: Dict[int, str] = {}
+    values: Dict[int, dict] = {}
+    updated: Set[int] = set()
+    for index, carrier_trunk in enumerate(carrier_trunks):
+        if carrier_trunk.id not in db_carrier_trunks:
+            errors[index] = "Carrier Trunk not found"
+        elif carrier_trunk.id in updated:
+            errors[index] = "Duplicated id"
+        else:
+            updated.add(carrier_trunk.id)
+            db_carrier_trunk = db_carrier_trunks[carrier_trunk.id]
+            values[index] = get_carrier_trunk_update_values(
+                db_carrier_trunk, carrier_trunk
+            )
+            values[index].update(
+                id=carrier_trunk.id, tenant_uuid=db_carrier_trunk.tenant_uuid
+            )
+    await check_bulk_carrier_trunks(db, values, errors)
+    await hash_bulk_passwords(
+        hasher,
+        values,
+        {
+            index: carrier_trunk.auth_password
+            for index, carrier_trunk in enumerate(carrier_trunks)
+        },
+    )
+    return get_bulk_result(
+        await db.fetch_all_batches(
+            [
+                CarrierTrunk.__table__.update()
+                .where(CarrierTrunk.id == carrier_trunk['id'])
+                .values(
+                    {
+                        name: value
+                        for name, value in carrier_trunk.items()
+                        if name not in ('id', 'tenant_uuid')
+                    }
+                )
+                .returning(*CarrierTrunk.__table__.c)
+                for carrier_trunk in values.values()
+            ]
+        ),
+        errors,
+    )
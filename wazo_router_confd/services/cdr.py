@@ -1,70 +1,115 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from sqlalchemy.orm import Session
+from typing import Any, Optional, Union
 
 from wazo_router_confd.auth import Principal
+from wazo_router_confd.database import AsyncDatabase, transactional
+from wazo_router_confd.fieldsets import Fieldset, Projection, Relations
 from wazo_router_confd.models.cdr import CDR
+from wazo_router_confd.pagination import Pagination, paginate
+from wazo_router_confd.schemas import carrier_trunk as carrier_trunk_schema
 from wazo_router_confd.schemas import cdr as schema
+from wazo_router_confd.schemas import ipbx as ipbx_schema
+from wazo_router_confd.schemas import tenant as tenant_schema
 from wazo_router_confd.services import tenant as tenant_service
 
 
-def get_cdr(db: Session, principal: Principal, cdr_id: int) -> CDR:
-    db_cdr = db.query(CDR).filter(CDR.id == cdr_id)
+RELATIONS: Relations = dict(
+    tenant=(CDR.__table__.c.tenant_uuid, tenant_schema.Tenant),
+    ipbx=(CDR.__table__.c.ipbx_id, ipbx_schema.IPBXRead),
+    carrier_trunk=(
+        CDR.__table__.c.carrier_trunk_id,
+        carrier_trunk_schema.CarrierTrunkRead,
+    ),
+)
+
+
+async def get_cdr(
+    db: AsyncDatabase,
+    principal: Principal,
+    cdr_id: int,
+    fieldset: Optional[Fieldset] = None,
+) -> Optional[Any]:
+    projection = Projection(CDR.__table__, schema.CDR, fieldset, RELATIONS)
+    db_cdr = projection.select().where(CDR.id == cdr_id)
     if principal is not None and principal.tenant_uuids:
-        db_cdr = db_cdr.filter(CDR.tenant_uuid.in_(principal.tenant_uuids))
-    return db_cdr.first()
+        db_cdr = db_cdr.where(CDR.tenant_uuid.in_(principal.tenant_uuids))
+    return projection.get_item(await db.fetch_one(db_cdr.limit(1)))
 
 
-def get_cdrs(
-    db: Session, principal: Principal, offset: int = 0, limit: int = 100
-) -> schema.CDRList:
-    items = db.query(CDR)
+async def get_cdrs(
+    db: AsyncDatabase,
+    principal: Principal,
+    pagination: Optional[Pagination] = None,
+    fieldset: Optional[Fieldset] = None,
+) -> Union[schema.CDRList, dict]:
+    projection = Projection(CDR.__table__, schema.CDR, fieldset, RELATIONS)
+    items = projection.select()
     if principal is not None and principal.tenant_uuid:
-        items = items.filter(CDR.tenant_uuid == principal.tenant_uuid)
-    items = items.offset(offset).limit(limit).all()
-    return schema.CDRList(items=items)
+        items = items.where(CDR.tenant_uuid == principal.tenant_uuid)
+    page = await paginate(
+        db,
+        items,
+        CDR.__table__.c.id,
+        pagination,
+        order_columns=('call_start', 'duration', 'source_ip'),
+    )
+    if fieldset:
+        return dict(page, items=projection.get_items(page['items']))
+    return schema.CDRList(**page)
 
 
-def create_cdr(db: Session, principal: Principal, cdr: schema.CDRCreate) -> CDR:
-    cdr.tenant_uuid = tenant_service.get_uuid(principal, db, cdr.tenant_uuid)
-    db_cdr = CDR(
-        tenant_uuid=cdr.tenant_uuid,
-        source_ip=cdr.source_ip,
-        source_port=cdr.source_port,
-        from_uri=cdr.from_uri,
-        to_uri=cdr.to_uri,
-        call_id=cdr.call_id,
-        call_start=cdr.call_start,
-        duration=cdr.duration,
+@transactional
+async def create_cdr(
+    db: AsyncDatabase, principal: Principal, cdr: schema.CDRCreate
+) -> Any:
+    cdr.tenant_uuid = await tenant_service.get_uuid(principal, db, cdr.tenant_uuid)
+    return await db.fetch_one(
+        CDR.__table__.insert()
+        .values(
+            tenant_uuid=cdr.tenant_uuid,
+            source_ip=cdr.source_ip,
+            source_port=cdr.source_port,
+            from_uri=cdr.from_uri,
+            to_uri=cdr.to_uri,
+            call_id=cdr.call_id,
+            call_start=cdr.call_start,
+            duration=cdr.duration,
+        )
+        .returning(*CDR.__table__.c)
     )
-    db.add(db_cdr)
-    db.commit()
-    db.refresh(db_cdr)
-    return db_cdr
 
 
-def update_cdr(
-    db: Session, principal: Principal, cdr_id: int, cdr: schema.CDRUpdate
-) -> CDR:
-    db_cdr = get_cdr(db, principal, cdr_id)
+@transactional
+async def update_cdr(
+    db: AsyncDatabase, principal: Principal, cdr_id: int, cdr: schema.CDRUpdate
+) -> Optional[Any]:
+    db_cdr = await get_cdr(db, principal, cdr_id)
     if db_cdr is not None:
-        db_cdr.tenant_uuid = cdr.tenant_uuid if cdr.tenant_uuid else db_cdr.tenant_uuid
-        db_cdr.source_ip = cdr.source_ip if cdr.source_ip else db_cdr.source_ip
-        db_cdr.source_port = cdr.source_port if cdr.source_port else db_cdr.source_port
-        db_cdr.from_uri = cdr.from_uri if cdr.from_uri else db_cdr.from_uri
-        db_cdr.to_uri = cdr.to_uri if cdr.to_uri else db_cdr.to_uri
-        db_cdr.call_id = cdr.call_id if cdr.call_id else db_cdr.call_id
-        db_cdr.call_start = cdr.call_start if cdr.call_start else db_cdr.call_start
-        db_cdr.duration = cdr.duration if cdr.duration else db_cdr.duration
-        db.commit()
-        db.refresh(db_cdr)
+        db_cdr = await db.fetch_one(
+            CDR.__table__.update()
+            .where(CDR.id == db_cdr.id)
+            .values(
+                tenant_uuid=cdr.tenant_uuid if cdr.tenant_uuid else db_cdr.tenant_uuid,
+                source_ip=cdr.source_ip if cdr.source_ip else db_cdr.source_ip,
+                source_port=cdr.source_port if cdr.source_port else db_cdr.source_port,
+                from_uri=cdr.from_uri if cdr.from_uri else db_cdr.from_uri,
+                to_uri=cdr.to_uri if cdr.to_uri else db_cdr.to_uri,
+                call_id=cdr.call_id if cdr.call_id else db_cdr.call_id,
+                call_start=cdr.call_start if cdr.call_start else db_cdr.call_start,
+                duration=cdr.duration if cdr.duration else db_cdr.duration,
+            )
+            .returning(*CDR.__table__.c)
+        )
     return db_cdr
 
 
-def delete_cdr(db: Session, principal: Principal, cdr_id: int) -> CDR:
-    db_cdr = get_cdr(db, principal, cdr_id)
+@transactional
+async def delete_cdr(
+    db: AsyncDatabase, principal: Principal, cdr_id: int
+) -> Optional[Any]:
+    db_cdr = await get_cdr(db, principal, cdr_id)
     if db_cdr is not None:
-        db.delete(db_cdr)
-        db.commit()
+        await db.execute(CDR.__table__.delete().where(CDR.id == db_cdr.id))
     return db_cdr
@@ -1,43 +1,84 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import csv
+import io
 import re
 
-from typing import Optional
+from json import dumps, loads
+from typing import Any, AsyncIterator, Iterator, List, Optional, Tuple, Union
+from uuid import UUID
 
-from sqlalchemy.orm import Session
+from sqlalchemy import select
 
 from wazo_router_confd.auth import Principal
+from wazo_router_confd.database import AsyncDatabase, transactional
+from wazo_router_confd.fieldsets import Fieldset, Projection, Relations
+from wazo_router_confd.models.changes import notify_bulk_changes, set_bulk_changes
 from wazo_router_confd.models.did import DID
+from wazo_router_confd.pagination import Pagination, paginate
+from wazo_router_confd.schemas import carrier_trunk as carrier_trunk_schema
 from wazo_router_confd.schemas import did as schema
+from wazo_router_confd.schemas import ipbx as ipbx_schema
+from wazo_router_confd.schemas import tenant as tenant_schema
 from wazo_router_confd.services import tenant as tenant_service
 
 
 re_did_prefix_from_regex = re.compile('[^0-9]')
 
 
-def get_did(db: Session, principal: Principal, did_id: int) -> DID:
-    db_did = db.query(DID).filter(DID.id == did_id)
+RELATIONS: Relations = dict(
+    tenant=(DID.__table__.c.tenant_uuid, tenant_schema.Tenant),
+    ipbx=(DID.__table__.c.ipbx_id, ipbx_schema.IPBXRead),
+    carrier_trunk=(
+        DID.__table__.c.carrier_trunk_id,
+        carrier_trunk_schema.CarrierTrunkRead,
+    ),
+)
+
+
+async def get_did(
+    db: AsyncDatabase,
+    principal: Principal,
+    did_id: int,
+    fieldset: Optional[Fieldset] = None,
+) -> Optional[Any]:
+    projection = Projection(DID.__table__, schema.DID, fieldset, RELATIONS)
+    db_did = projection.select().where(DID.id == did_id)
     if principal is not None and principal.tenant_uuids:
-        db_did = db_did.filter(DID.tenant_uuid.in_(principal.tenant_uuids))
-    return db_did.first()
+        db_did = db_did.where(DID.tenant_uuid.in_(principal.tenant_uuids))
+    return projection.get_item(await db.fetch_one(db_did.limit(1)))
 
 
-def get_did_by_regex(db: Session, principal: Principal, regex: Optional[str]) -> DID:
-    db_did = db.query(DID).filter(DID.did_regex == regex)
+async def get_did_by_regex(
+    db: AsyncDatabase, principal: Principal, regex: Optional[str]
+) -> Optional[Any]:
+    db_did = select([DID.__table__]).where(DID.did_regex == regex)
     if principal is not None and principal.tenant_uuids:
-        db_did = db_did.filter(DID.tenant_uuid.in_(principal.tenant_uuids))
-    return db_did.first()
+        db_did = db_did.where(DID.tenant_uuid.in_(principal.tenant_uuids))
+    return await db.fetch_one(db_did.limit(1))
 
 
-def get_dids(
-    db: Session, principal: Principal, offset: int = 0, limit: int = 100
-) -> schema.DIDList:
-    items = db.query(DID)
+async def get_dids(
+    db: AsyncDatabase,
+    principal: Principal,
+    pagination: Optional[Pagination] = None,
+    fieldset: Optional[Fieldset] = None,
+) -> Union[schema.DIDList, dict]:
+    projection = Projection(DID.__table__, schema.DID, fieldset, RELATIONS)
+    items = projection.select()
     if principal is not None and principal.tenant_uuid:
-        items = items.filter(DID.tenant_uuid == principal.tenant_uuid)
-    items = items.offset(offset).limit(limit).all()
-    return schema.DIDList(items=items)
+        items = items.where(DID.tenant_uuid == principal.tenant_uuid)
+    page = await paginate(
+        db,
+        items,
+        DID.__table__.c.id,
+        pagination,
+        order_columns=('did_regex', 'did_prefix', 'ipbx_id', 'carrier_trunk_id'),
+    )
+    if fieldset:
+        return dict(page, items=projection.get_items(page['items']))
+    return schema.DIDList(**page)
 
 
 def get_did_prefix_from_regex(did_regex: Optional[str] = None) -> str:
@@ -49,47 +90,289 @@ def get_did_prefix_from_regex(did_regex: Optional[str] = None) -> str:
     return did_prefix
 
 
-def create_did(db: Session, principal: Principal, did: schema.DIDCreate) -> DID:
-    did.tenant_uuid = tenant_service.get_uuid(principal, db, did.tenant_uuid)
-    db_did = DID(
-        did_regex=did.did_regex,
-        did_prefix=get_did_prefix_from_regex(did.did_regex),
-        carrier_trunk_id=did.carrier_trunk_id,
-        tenant_uuid=did.tenant_uuid,
-        ipbx_id=did.ipbx_id,
+@transactional
+async def create_did(
+    db: AsyncDatabase, principal: Principal, did: schema.DIDCreate
+) -> Any:
+    did.tenant_uuid = await tenant_service.get_uuid(principal, db, did.tenant_uuid)
+    return await db.fetch_one(
+        DID.__table__.insert()
+        .values(
+            did_regex=did.did_regex,
+            did_prefix=get_did_prefix_from_regex(did.did_regex),
+            carrier_trunk_id=did.carrier_trunk_id,
+            tenant_uuid=did.tenant_uuid,
+            ipbx_id=did.ipbx_id,
+        )
+        .returning(*DID.__table__.c)
     )
-    db.add(db_did)
-    db.commit()
-    db.refresh(db_did)
-    return db_did
 
 
-def update_did(
-    db: Session, principal: Principal, did_id: int, did: schema.DIDUpdate
-) -> DID:
-    db_did = get_did(db, principal, did_id)
+@transactional
+async def update_did(
+    db: AsyncDatabase, principal: Principal, did_id: int, did: schema.DIDUpdate
+) -> Optional[Any]:
+    db_did = await get_did(db, principal, did_id)
     if db_did is not None:
-        db_did.did_regex = (
-            did.did_regex if did.did_regex is not None else db_did.did_regex
-        )
-        db_did.did_prefix = get_did_prefix_from_regex(db_did.did_regex)
-        db_did.ipbx_id = did.ipbx_id if did.ipbx_id is not None else db_did.ipbx_id
-        db_did.carrier_trunk_id = (
-            did.carrier_trunk_id
-            if did.carrier_trunk_id is not None
-            else db_did.carrier_trunk_id
+        did_regex = did.did_regex if did.did_regex is not None else db_did.did_regex
+        db_did = await db.fetch_one(
+            DID.__table__.update()
+            .where(DID.id == db_did.id)
+            .values(
+                did_regex=did_regex,
+                did_prefix=get_did_prefix_from_regex(did_regex),
+                ipbx_id=did.ipbx_id if did.ipbx_id is not None else db_did.ipbx_id,
+                carrier_trunk_id=(
+                    did.carrier_trunk_id
+                    if did.carrier_trunk_id is not None
+                    else db_did.carrier_trunk_id
+                ),
+                tenant_uuid=(
+                    did.tenant_uuid
+                    if did.tenant_uuid is not None
+                    else db_did.tenant_uuid
+                ),
+            )
+            .returning(*DID.__table__.c)
         )
-        db_did.tenant_uuid = (
-            did.tenant_uuid if did.tenant_uuid is not None else db_did.tenant_uuid
-        )
-        db.commit()
-        db.refresh(db_did)
     return db_did
 
 
-def delete_did(db: Session, principal: Principal, did_id: int) -> DID:
-    db_did = get_did(db, principal, did_id)
+@transactional
+async def delete_did(
+    db: AsyncDatabase, principal: Principal, did_id: int
+) -> Optional[Any]:
+    db_did = await get_did(db, principal, did_id)
     if db_did is not None:
-        db.delete(db_did)
-        db.commit()
+        await db.execute(DID.__table__.delete().where(DID.id == db_did.id))
     return db_did
+
+
+BULK_COLUMNS = ('tenant_uuid', 'ipbx_id', 'carrier_trunk_id', 'did_regex')
+BULK_MAX_ERRORS = 1000
+EXPORT_BATCH_SIZE = 5000
+
+# the usual DID regexes, valid without compiling them: the compilation is the
+# bulk of the validation of an import
+re_simple_did_regex = re.compile(
+    r'\^?(?:(?:[0-9.]|\\[d+]|\[[0-9]+\])(?:[?*+]|\{[0-9]{1,9},?\})?)*\$?'
+)
+
+
+def read_did_rows(body: bytes, ndjson: bool = False) -> Iterator[Tuple[int, Any]]:
+    """The line number and the fields of each DID of a CSV or NDJSON import."""
+    text = body.decode('utf-8-sig')
+    if not ndjson:
+        reader = csv.DictReader(io.StringIO(text))
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_num, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, loads(line)
+        except ValueError:
+            yield line_num, None
+
+
+def get_bulk_did_values(principal: Principal, row: Any) -> list:
+    """The values of a DID to import, ValueError tells why it is refused."""
+    if not isinstance(row, dict):
+        raise ValueError("Invalid row")
+    did_regex = row.get('did_regex')
+    if not isinstance(did_regex, str) or not did_regex:
+        raise ValueError("Missing did_regex")
+    if len(did_regex) > 256:
+        raise ValueError("did_regex is too long")
+    try:
+        if re_simple_did_regex.fullmatch(did_regex) is None:
+            re.compile(did_regex)
+    except re.error as e:
+        raise ValueError("Invalid did_regex: %s" % e)
+    did_prefix = get_did_prefix_from_regex(did_regex)
+    if len(did_prefix) > 128:
+        raise ValueError("did_prefix is too long")
+    try:
+        ipbx_id = int(row['ipbx_id'])
+        carrier_trunk_id = int(row['carrier_trunk_id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Invalid ipbx_id or carrier_trunk_id")
+    tenant_uuid = row.get('tenant_uuid') or None
+    try:
+        tenant_uuid = UUID(tenant_uuid) if tenant_uuid is not None else None
+    except (TypeError, ValueError):
+        raise ValueError("Invalid tenant_uuid")
+    tenant_uuid, error = tenant_service.get_bulk_uuid(principal, tenant_uuid)
+    if error is not None:
+        raise ValueError(error)
+    return [str(tenant_uuid), ipbx_id, carrier_trunk_id, did_regex, did_prefix]
+
+
+CREATE_IMPORT_TABLE = """
+CREATE TEMPORARY TABLE dids_import (
+    line integer NOT NULL,
+    tenant_uuid uuid NOT NULL,
+    ipbx_id integer NOT NULL,
+    carrier_trunk_id integer NOT NULL,
+    did_regex varchar(256) NOT NULL,
+    did_prefix varchar(128) NOT NULL
+) ON COMMIT DROP
+"""
+
+# the rows which can not be merged are removed from the import, one reason
+# reported for each
+REMOVE_INVALID_ROWS = """
+DELETE FROM dids_import USING (
+    SELECT DISTINCT ON (line) line, error FROM (
+        SELECT line, 'IPBX not found' AS error FROM dids_import i
+        WHERE NOT EXISTS (
+            SELECT 1 FROM ipbx
+            WHERE ipbx.tenant_uuid = i.tenant_uuid AND ipbx.id = i.ipbx_id
+        )
+        UNION ALL
+        SELECT line, 'Carrier trunk not found' FROM dids_import i
+        WHERE NOT EXISTS (
+            SELECT 1 FROM carrier_trunks WHERE carrier_trunks.id = i.carrier_trunk_id
+        )
+        UNION ALL
+        SELECT line, 'Duplicated did_regex in the import' FROM (
+            SELECT line, row_number() OVER (
+                PARTITION BY tenant_uuid, did_regex ORDER BY line
+            ) AS occurrence FROM dids_import
+        ) AS occurrences WHERE occurrence > 1
+    ) AS errors ORDER BY line
+) AS invalid
+WHERE dids_import.line = invalid.line
+RETURNING dids_import.line, dids_import.did_regex, invalid.error
+"""
+
+REMOVE_EXISTING_ROWS = """
+DELETE FROM dids_import USING dids
+WHERE dids.tenant_uuid = dids_import.tenant_uuid
+AND dids.did_regex = dids_import.did_regex
+RETURNING dids_import.line, dids_import.did_regex, 'Duplicated did_regex'
+"""
+
+MERGE_IMPORT_ROWS = """
+WITH merged AS (
+    INSERT INTO dids (tenant_uuid, ipbx_id, carrier_trunk_id, did_regex, did_prefix)
+    SELECT tenant_uuid, ipbx_id, carrier_trunk_id, did_regex, did_prefix
+    FROM dids_import ORDER BY line
+    ON CONFLICT (tenant_uuid, did_regex) DO %s
+    RETURNING xmax = 0 AS inserted
+)
+SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+FROM merged
+"""
+
+MERGE_UPDATE = """UPDATE SET
+    ipbx_id = EXCLUDED.ipbx_id,
+    carrier_trunk_id = EXCLUDED.carrier_trunk_id,
+    did_prefix = EXCLUDED.did_prefix
+"""
+
+
+def import_dids(
+    engine: Any,
+    principal: Principal,
+    rows: Iterator[Tuple[int, Any]],
+    update: bool = False,
+    dry_run: bool = False,
+) -> schema.DIDBulkResult:
+    """Load the DIDs with COPY into a staging table, then merge them.
+
+    The existing DIDs are updated or reported as conflicts, and every row
+    which can not be imported is reported with its line number.
+    """
+    errors: List[Tuple[int, Optional[str], str]] = []
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    tenants = set()
+    for line, row in rows:
+        try:
+            values = get_bulk_did_values(principal, row)
+        except ValueError as e:
+            did_regex = row.get('did_regex') if isinstance(row, dict) else None
+            errors.append(
+                (line, did_regex if isinstance(did_regex, str) else None, str(e))
+            )
+            continue
+        tenants.add(values[0])
+        writer.writerow([line] + values)
+    buffer.seek(0)
+
+    # COPY is not available on the asynchronous connections
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_IMPORT_TABLE)
+            cursor.copy_expert("COPY dids_import FROM STDIN WITH (FORMAT csv)", buffer)
+            cursor.execute("ANALYZE dids_import")
+            # the tenants are created on first use, like for a single DID
+            cursor.execute(
+                "INSERT INTO tenants (uuid, name) "
+                "SELECT tenant::uuid, tenant FROM unnest(%s::text[]) AS tenant "
+                "ON CONFLICT DO NOTHING",
+                (sorted(tenants),),
+            )
+            cursor.execute(REMOVE_INVALID_ROWS)
+            errors.extend(cursor.fetchall())
+            if not update:
+                cursor.execute(REMOVE_EXISTING_ROWS)
+                errors.extend(cursor.fetchall())
+            set_bulk_changes(cursor, True)
+            cursor.execute(MERGE_IMPORT_ROWS % (MERGE_UPDATE if update else 'NOTHING'))
+            created, updated = cursor.fetchone()
+            set_bulk_changes(cursor, False)
+            if created or updated:
+                notify_bulk_changes(cursor, 'dids', sorted(tenants))
+        if dry_run:
+            connection.rollback()
+        else:
+            connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    errors.sort()
+    return schema.DIDBulkResult(
+        created=created,
+        updated=updated,
+        error_count=len(errors),
+        errors=[
+            schema.DIDBulkError(line=line, did_regex=did_regex, message=message)
+            for line, did_regex, message in errors[:BULK_MAX_ERRORS]
+        ],
+    )
+
+
+async def export_dids(
+    db: AsyncDatabase, principal: Principal, ndjson: bool = False
+) -> AsyncIterator[str]:
+    """Stream the DIDs in the import format, by batches in id order."""
+    columns = [DID.__table__.c.id] + [DID.__table__.c[name] for name in BULK_COLUMNS]
+    query = select(columns).order_by(DID.id).limit(EXPORT_BATCH_SIZE)
+    if principal is not None and principal.tenant_uuid:
+        query = query.where(DID.tenant_uuid == principal.tenant_uuid)
+    if not ndjson:
+        yield ','.join(column.name for column in columns) + '\r\n'
+    last_id = None
+    while True:
+        rows = await db.fetch_all(
+            query.where(DID.id > last_id) if last_id is not None else query
+        )
+        if not rows:
+            break
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            values = [row[0], str(row[1])] + [row[name] for name in BULK_COLUMNS[1:]]
+            if ndjson:
+                buffer.write(dumps(dict(zip(['id'] + list(BULK_COLUMNS), values))))
+                buffer.write('\n')
+            else:
+                writer.writerow(values)
+        yield buffer.getvalue()
+        last_id = rows[-1][0]
@@ -1,70 +1,152 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from sqlalchemy.orm import Session
+from typing import Any, Dict, Iterable, Optional, Union
+
+from sqlalchemy import select
 
 from wazo_router_confd.auth import Principal
+from wazo_router_confd.conditional import ROW_VERSION, Conditional, get_row_version
+from wazo_router_confd.database import AsyncDatabase, transactional
+from wazo_router_confd.fieldsets import Fieldset, Projection, Relations
 from wazo_router_confd.models.domain import Domain
+from wazo_router_confd.pagination import Pagination, paginate
 from wazo_router_confd.schemas import domain as schema
+from wazo_router_confd.schemas import tenant as tenant_schema
 from wazo_router_confd.services import tenant as tenant_service
 
 
-def get_domain_by_id(db: Session, principal: Principal, domain_id: int) -> Domain:
-    db_domain = db.query(Domain).filter(Domain.id == domain_id)
+RELATIONS: Relations = dict(
+    tenant=(Domain.__table__.c.tenant_uuid, tenant_schema.Tenant)
+)
+
+
+async def get_domain_by_id(
+    db: AsyncDatabase,
+    principal: Principal,
+    domain_id: int,
+    fieldset: Optional[Fieldset] = None,
+    conditional: Optional[Conditional] = None,
+) -> Optional[Any]:
+    projection = Projection(Domain.__table__, schema.Domain, fieldset, RELATIONS)
+    db_domain = projection.select().where(Domain.id == domain_id)
     if principal is not None and principal.tenant_uuids:
-        db_domain = db_domain.filter(Domain.tenant_uuid.in_(principal.tenant_uuids))
-    return db_domain.first()
+        db_domain = db_domain.where(Domain.tenant_uuid.in_(principal.tenant_uuids))
+    row = await db.fetch_one(db_domain.limit(1))
+    if row is not None and conditional is not None:
+        conditional.set_etag(projection.get_etag(row))
+    return projection.get_item(row)
+
+
+async def get_domains_by_ids(db: AsyncDatabase, ids: Iterable[int]) -> Dict[int, Any]:
+    ids = set(ids)
+    if not ids:
+        return {}
+    rows = await db.fetch_all(select([Domain.__table__]).where(Domain.id.in_(ids)))
+    return {row.id: row for row in rows}
 
 
-def get_domain(db: Session, principal: Principal, domain: str) -> Domain:
-    db_domain = db.query(Domain).filter(Domain.domain == domain)
+async def get_domain(
+    db: AsyncDatabase, principal: Principal, domain: str
+) -> Optional[Any]:
+    db_domain = select([Domain.__table__]).where(Domain.domain == domain)
     if principal is not None and principal.tenant_uuids:
-        db_domain = db_domain.filter(Domain.tenant_uuid.in_(principal.tenant_uuids))
-    return db_domain.first()
+        db_domain = db_domain.where(Domain.tenant_uuid.in_(principal.tenant_uuids))
+    return await db.fetch_one(db_domain.limit(1))
 
 
-def get_domains(
-    db: Session, principal: Principal, offset: int = 0, limit: int = 100
-) -> schema.DomainList:
-    items = db.query(Domain)
+async def get_domains(
+    db: AsyncDatabase,
+    principal: Principal,
+    pagination: Optional[Pagination] = None,
+    fieldset: Optional[Fieldset] = None,
+    conditional: Optional[Conditional] = None,
+) -> Union[schema.DomainList, dict]:
+    projection = Projection(Domain.__table__, schema.Domain, fieldset, RELATIONS)
+    items = projection.select()
     if principal is not None and principal.tenant_uuid:
-        items = items.filter(Domain.tenant_uuid == principal.tenant_uuid)
-    items = items.offset(offset).limit(limit).all()
-    return schema.DomainList(items=items)
-
-
-def create_domain(
-    db: Session, principal: Principal, domain: schema.DomainCreate
-) -> Domain:
-    domain.tenant_uuid = tenant_service.get_uuid(principal, db, domain.tenant_uuid)
-    db_domain = Domain(domain=domain.domain, tenant_uuid=domain.tenant_uuid)
-    db.add(db_domain)
-    db.commit()
-    db.refresh(db_domain)
-    return db_domain
+        items = items.where(Domain.tenant_uuid == principal.tenant_uuid)
+    page = await paginate(
+        db, items, Domain.__table__.c.id, pagination, order_columns=('domain',)
+    )
+    if conditional is not None:
+        conditional.set_etag(projection.get_page_etag(page, Domain.__table__.c.id))
+        if conditional.not_modified:
+            # not serialized, the client has it
+            return page
+    if fieldset:
+        return dict(page, items=projection.get_items(page['items']))
+    return schema.DomainList(**page)
+
+
+@transactional
+async def create_domain(
+    db: AsyncDatabase, principal: Principal, domain: schema.DomainCreate
+) -> Any:
+    domain.tenant_uuid = await tenant_service.get_uuid(
+        principal, db, domain.tenant_uuid
+    )
+    return await db.fetch_one(
+        Domain.__table__.insert()
+        .values(domain=domain.domain, tenant_uuid=domain.tenant_uuid)
+        .returning(*Domain.__table__.c)
+    )
 
 
-def update_domain(
-    db: Session, principal: Principal, domain_id: int, domain: schema.DomainUpdate
-) -> Domain:
-    db_domain = get_domain_by_id(db, principal, domain_id)
+@transactional
+async def update_domain(
+    db: AsyncDatabase,
+    principal: Principal,
+    domain_id: int,
+    domain: schema.DomainUpdate,
+    conditional: Optional[Conditional] = None,
+) -> Optional[Any]:
+    db_domain = await get_domain_by_id(db, principal, domain_id)
+    conditional = conditional or Conditional()
     if db_domain is not None:
-        db_domain.domain = (
-            domain.domain if domain.domain is not None else db_domain.domain
+        db_domain = conditional.written(
+            await db.fetch_one(
+                conditional.guard(
+                    Domain.__table__.update().where(Domain.id == db_domain.id),
+                    Domain.__table__,
+                    db_domain,
+                )
+                .values(
+                    domain=domain.domain
+                    if domain.domain is not None
+                    else db_domain.domain,
+                    tenant_uuid=(
+                        domain.tenant_uuid
+                        if domain.tenant_uuid is not None
+                        else db_domain.tenant_uuid
+                    ),
+                )
+                .returning(
+                    *Domain.__table__.c,
+                    get_row_version(Domain.__table__).label(ROW_VERSION)
+                )
+            )
         )
-        db_domain.tenant_uuid = (
-            domain.tenant_uuid
-            if domain.tenant_uuid is not None
-            else db_domain.tenant_uuid
-        )
-        db.commit()
-        db.refresh(db_domain)
     return db_domain
 
 
-def delete_domain(db: Session, principal: Principal, domain_id: int) -> Domain:
-    db_domain = get_domain_by_id(db, principal, domain_id)
+@transactional
+async def delete_domain(
+    db: AsyncDatabase,
+    principal: Principal,
+    domain_id: int,
+    conditional: Optional[Conditional] = None,
+) -> Optional[Any]:
+    db_domain = await get_domain_by_id(db, principal, domain_id)
+    conditional = conditional or Conditional()
     if db_domain is not None:
-        db.delete(db_domain)
-        db.commit()
+        conditional.written(
+            await db.fetch_one(
+                conditional.guard(
+                    Domain.__table__.delete().where(Domain.id == db_domain.id),
+                    Domain.__table__,
+                    db_domain,
+                ).returning(Domain.id)
+            )
+        )
     return db_domain
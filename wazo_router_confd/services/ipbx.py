@@ -1,103 +1,386 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from sqlalchemy.orm import Session
+from typing import Any, Dict, List, Optional, Set, Union
+
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
 
 from wazo_router_confd.auth import Principal
+from wazo_router_confd.conditional import ROW_VERSION, Conditional, get_row_version
+from wazo_router_confd.database import AsyncDatabase, transactional
+from wazo_router_confd.fieldsets import Fieldset, Projection, Relations
 from wazo_router_confd.models.domain import Domain
 from wazo_router_confd.models.ipbx import IPBX
+from wazo_router_confd.pagination import Pagination, paginate
+from wazo_router_confd.schemas import domain as domain_schema
 from wazo_router_confd.schemas import ipbx as schema
+from wazo_router_confd.schemas import normalization as normalization_schema
+from wazo_router_confd.schemas import tenant as tenant_schema
+from wazo_router_confd.services import domain as domain_service
+from wazo_router_confd.services import normalization as normalization_service
 from wazo_router_confd.services import password as password_service
 from wazo_router_confd.services import tenant as tenant_service
 
 
-def get_ipbx(db: Session, principal: Principal, ipbx_id: int) -> IPBX:
-    db_ipbx = db.query(IPBX).filter(IPBX.id == ipbx_id)
+RELATIONS: Relations = dict(
+    tenant=(IPBX.__table__.c.tenant_uuid, tenant_schema.Tenant),
+    domain=(IPBX.__table__.c.domain_id, domain_schema.Domain),
+    normalization_profile=(
+        IPBX.__table__.c.normalization_profile_id,
+        normalization_schema.NormalizationProfile,
+    ),
+)
+
+
+async def get_ipbx(
+    db: AsyncDatabase,
+    principal: Principal,
+    ipbx_id: int,
+    fieldset: Optional[Fieldset] = None,
+    conditional: Optional[Conditional] = None,
+) -> Optional[Any]:
+    projection = Projection(IPBX.__table__, schema.IPBXRead, fieldset, RELATIONS)
+    db_ipbx = projection.select().where(IPBX.id == ipbx_id)
     if principal is not None and principal.tenant_uuids:
-        db_ipbx = db_ipbx.filter(IPBX.tenant_uuid.in_(principal.tenant_uuids))
-    return db_ipbx.first()
+        db_ipbx = db_ipbx.where(IPBX.tenant_uuid.in_(principal.tenant_uuids))
+    row = await db.fetch_one(db_ipbx.limit(1))
+    if row is not None and conditional is not None:
+        conditional.set_etag(projection.get_etag(row))
+    return projection.get_item(row)
 
 
-def get_ipbxs(
-    db: Session, principal: Principal, offset: int = 0, limit: int = 100
-) -> schema.IPBXList:
-    items = db.query(IPBX)
+async def get_ipbxs(
+    db: AsyncDatabase,
+    principal: Principal,
+    pagination: Optional[Pagination] = None,
+    fieldset: Optional[Fieldset] = None,
+    conditional: Optional[Conditional] = None,
+) -> Union[schema.IPBXList, dict]:
+    projection = Projection(IPBX.__table__, schema.IPBXRead, fieldset, RELATIONS)
+    items = projection.select()
     if principal is not None and principal.tenant_uuid:
-        items = items.filter(IPBX.tenant_uuid == principal.tenant_uuid)
-    items = items.offset(offset).limit(limit).all()
-    return schema.IPBXList(items=items)
-
-
-def create_ipbx(db: Session, principal: Principal, ipbx: schema.IPBXCreate) -> IPBX:
-    ipbx.tenant_uuid = tenant_service.get_uuid(principal, db, ipbx.tenant_uuid)
-    domain = db.query(Domain).filter(Domain.id == ipbx.domain_id).first()
-    db_ipbx = IPBX(
-        tenant_uuid=ipbx.tenant_uuid,
-        domain_id=ipbx.domain_id,
-        normalization_profile_id=ipbx.normalization_profile_id,
-        customer=ipbx.customer,
-        ip_fqdn=ipbx.ip_fqdn,
-        port=ipbx.port,
-        ip_address=ipbx.ip_address,
-        registered=ipbx.registered,
-        username=ipbx.username,
-        password=password_service.hash(ipbx.password),
-        password_ha1=password_service.hash_ha1(
-            ipbx.username, domain.domain, ipbx.password
-        ),
-        realm=ipbx.realm,
+        items = items.where(IPBX.tenant_uuid == principal.tenant_uuid)
+    page = await paginate(
+        db,
+        items,
+        IPBX.__table__.c.id,
+        pagination,
+        order_columns=('ip_fqdn', 'ip_address', 'customer', 'username', 'domain_id'),
     )
-    db.add(db_ipbx)
-    db.commit()
-    db.refresh(db_ipbx)
-    return db_ipbx
+    if conditional is not None:
+        conditional.set_etag(projection.get_page_etag(page, IPBX.__table__.c.id))
+        if conditional.not_modified:
+            # not serialized, the client has it
+            return page
+    if fieldset:
+        return dict(page, items=projection.get_items(page['items']))
+    return schema.IPBXList(**page)
 
 
-def update_ipbx(
-    db: Session, principal: Principal, ipbx_id: int, ipbx: schema.IPBXUpdate
-) -> IPBX:
-    db_ipbx = get_ipbx(db, principal, ipbx_id)
-    if db_ipbx is not None:
-        db_ipbx.tenant_uuid = (
-            ipbx.tenant_uuid if ipbx.tenant_uuid is not None else db_ipbx.tenant_uuid
+async def get_domain_name(db: AsyncDatabase, domain_id: int) -> str:
+    return await db.fetch_value(
+        select([Domain.__table__.c.domain]).where(Domain.id == domain_id)
+    )
+
+
+async def create_ipbx(
+    db: AsyncDatabase, principal: Principal, ipbx: schema.IPBXCreate
+) -> Any:
+    # key stretching is CPU bound, keep it off the event loop and out of the
+    # transaction
+    password = await run_in_threadpool(password_service.hash, ipbx.password)
+    async with db.transaction():
+        ipbx.tenant_uuid = await tenant_service.get_uuid(
+            principal, db, ipbx.tenant_uuid
         )
-        db_ipbx.domain_id = (
-            ipbx.domain_id if ipbx.domain_id is not None else db_ipbx.domain_id
+        domain = await get_domain_name(db, ipbx.domain_id)
+        return await db.fetch_one(
+            IPBX.__table__.insert()
+            .values(
+                tenant_uuid=ipbx.tenant_uuid,
+                domain_id=ipbx.domain_id,
+                normalization_profile_id=ipbx.normalization_profile_id,
+                customer=ipbx.customer,
+                ip_fqdn=ipbx.ip_fqdn,
+                port=ipbx.port,
+                ip_address=ipbx.ip_address,
+                registered=ipbx.registered,
+                username=ipbx.username,
+                password=password,
+                password_ha1=password_service.hash_ha1(
+                    ipbx.username, domain, ipbx.password
+                ),
+                realm=ipbx.realm,
+            )
+            .returning(*IPBX.__table__.c)
         )
-        db_ipbx.normalization_profile_id = (
+
+
+def get_ipbx_update_values(db_ipbx: IPBX, ipbx: schema.IPBXUpdate) -> dict:
+    return dict(
+        tenant_uuid=(
+            ipbx.tenant_uuid if ipbx.tenant_uuid is not None else db_ipbx.tenant_uuid
+        ),
+        domain_id=ipbx.domain_id if ipbx.domain_id is not None else db_ipbx.domain_id,
+        normalization_profile_id=(
             ipbx.normalization_profile_id
             if ipbx.normalization_profile_id is not None
             else db_ipbx.normalization_profile_id
-        )
-        db_ipbx.customer = (
-            ipbx.customer if ipbx.customer is not None else db_ipbx.customer
-        )
-        db_ipbx.ip_fqdn = ipbx.ip_fqdn if ipbx.ip_fqdn is not None else db_ipbx.ip_fqdn
-        db_ipbx.port = ipbx.port if ipbx.port is not None else db_ipbx.port
-        db_ipbx.ip_address = (
+        ),
+        customer=ipbx.customer if ipbx.customer is not None else db_ipbx.customer,
+        ip_fqdn=ipbx.ip_fqdn if ipbx.ip_fqdn is not None else db_ipbx.ip_fqdn,
+        port=ipbx.port if ipbx.port is not None else db_ipbx.port,
+        ip_address=(
             ipbx.ip_address if ipbx.ip_address is not None else db_ipbx.ip_address
-        )
-        db_ipbx.registered = (
+        ),
+        registered=(
             ipbx.registered if ipbx.registered is not None else db_ipbx.registered
-        )
-        db_ipbx.username = (
-            ipbx.username if ipbx.username is not None else db_ipbx.username
-        )
-        if ipbx.password is not None:
-            domain = db.query(Domain).filter(Domain.id == ipbx.domain_id).first()
-            db_ipbx.password = password_service.hash(ipbx.password)
-            db_ipbx.password_ha1 = password_service.hash_ha1(
-                ipbx.username, domain.domain, ipbx.password
+        ),
+        username=ipbx.username if ipbx.username is not None else db_ipbx.username,
+        realm=ipbx.realm if ipbx.realm is not None else db_ipbx.realm,
+    )
+
+
+async def update_ipbx(
+    db: AsyncDatabase,
+    principal: Principal,
+    ipbx_id: int,
+    ipbx: schema.IPBXUpdate,
+    conditional: Optional[Conditional] = None,
+) -> Optional[Any]:
+    password = None
+    if ipbx.password is not None:
+        password = await run_in_threadpool(password_service.hash, ipbx.password)
+    async with db.transaction():
+        db_ipbx = await get_ipbx(db, principal, ipbx_id)
+        conditional = conditional or Conditional()
+        if db_ipbx is not None:
+            values = get_ipbx_update_values(db_ipbx, ipbx)
+            if ipbx.password is not None:
+                domain = await get_domain_name(db, values['domain_id'])
+                values['password'] = password
+                values['password_ha1'] = password_service.hash_ha1(
+                    values['username'], domain, ipbx.password
+                )
+            db_ipbx = conditional.written(
+                await db.fetch_one(
+                    conditional.guard(
+                        IPBX.__table__.update().where(IPBX.id == db_ipbx.id),
+                        IPBX.__table__,
+                        db_ipbx,
+                    )
+                    .values(**values)
+                    .returning(
+                        *IPBX.__table__.c,
+                        get_row_version(IPBX.__table__).label(ROW_VERSION)
+                    )
+                )
             )
-        db_ipbx.realm = ipbx.realm if ipbx.realm is not None else db_ipbx.realm
-        db.commit()
-        db.refresh(db_ipbx)
-    return db_ipbx
+        return db_ipbx
 
 
-def delete_ipbx(db: Session, principal: Principal, ipbx_id: int) -> IPBX:
-    db_ipbx = get_ipbx(db, principal, ipbx_id)
+@transactional
+async def delete_ipbx(
+    db: AsyncDatabase,
+    principal: Principal,
+    ipbx_id: int,
+    conditional: Optional[Conditional] = None,
+) -> Optional[Any]:
+    db_ipbx = await get_ipbx(db, principal, ipbx_id)
+    conditional = conditional or Conditional()
     if db_ipbx is not None:
-        db.delete(db_ipbx)
-        db.commit()
+        conditional.written(
+            await db.fetch_one(
+                conditional.guard(
+                    IPBX.__table__.delete().where(IPBX.id == db_ipbx.id),
+                    IPBX.__table__,
+                    db_ipbx,
+                ).returning(IPBX.id)
+            )
+        )
     return db_ipbx
+
+
+BULK_BATCH_SIZE = 1000
+
+
+async def check_bulk_ipbxs(
+    db: AsyncDatabase, values: Dict[int, dict], errors: Dict[int, str]
+) -> Dict[int, Any]:
+    """Move the IPBXs which can not be saved from `values` to `errors`.
+
+    The references of the whole request are resolved with one query by
+    table, the domains are returned for the realm of the password_ha1.
+    """
+    domains = await domain_service.get_domains_by_ids(
+        db, [ipbx['domain_id'] for ipbx in values.values()]
+    )
+    normalization_profiles = await normalization_service.get_normalization_profiles_by_ids(
+        db,
+        [
+            ipbx['normalization_profile_id']
+            for ipbx in values.values()
+            if ipbx['normalization_profile_id'] is not None
+        ],
+    )
+    # the owner of each username: the id of an existing IPBX, or the index of
+    # an IPBX of the request
+    usernames = {ipbx['username'] for ipbx in values.values()} - {None}
+    owners: Dict[tuple, Any] = {}
+    if usernames:
+        for row in await db.fetch_all(
+            select([IPBX.id, IPBX.tenant_uuid, IPBX.domain_id, IPBX.username]).where(
+                IPBX.username.in_(usernames)
+            )
+        ):
+            owners[(row.tenant_uuid, row.domain_id, row.username)] = row.id
+    for index, ipbx in values.items():
+        domain = domains.get(ipbx['domain_id'])
+        normalization_profile = normalization_profiles.get(
+            ipbx['normalization_profile_id']
+        )
+        key = (ipbx['tenant_uuid'], ipbx['domain_id'], ipbx['username'])
+        if domain is None or domain.tenant_uuid != ipbx['tenant_uuid']:
+            errors[index] = "Domain not found"
+        elif ipbx['normalization_profile_id'] is not None and (
+            normalization_profile is None
+            or normalization_profile.tenant_uuid != ipbx['tenant_uuid']
+        ):
+            errors[index] = "Normalization profile not found"
+        elif ipbx['username'] is None:
+            continue
+        elif key in owners and owners[key] != ipbx.get('id'):
+            errors[index] = "Duplicated username"
+        else:
+            owners[key] = ('index', index)
+    for index in errors:
+        values.pop(index, None)
+    return domains
+
+
+async def hash_bulk_passwords(
+    hasher: password_service.PasswordHasher,
+    values: Dict[int, dict],
+    passwords: Dict[int, Optional[str]],
+    domains: Dict[int, Any],
+):
+    indexes = [index for index in values if passwords.get(index) is not None]
+    hashed = await hasher.hash_all([passwords[index] for index in indexes])
+    for index, password in zip(indexes, hashed):
+        ipbx = values[index]
+        ipbx['password'] = password
+        ipbx['password_ha1'] = password_service.hash_ha1(
+            ipbx['username'], domains[ipbx['domain_id']].domain, passwords[index]
+        )
+
+
+def get_bulk_result(rows: List[Any], errors: Dict[int, str]) -> schema.IPBXBulkResult:
+    return schema.IPBXBulkResult(
+        items=rows,
+        errors=[
+            schema.IPBXBulkError(index=index, message=message)
+            for index, message in sorted(errors.items())
+        ],
+    )
+
+
+async def create_ipbxs(
+    db: AsyncDatabase,
+    principal: Principal,
+    ipbxs: List[schema.IPBXCreate],
+    hasher: password_service.PasswordHasher,
+) -> schema.IPBXBulkResult:
+    """Create the IPBXs, reporting the ones which can not be created.
+
+    The passwords are hashed on the process pool of `hasher`, and the rows
+    inserted by batches in one transaction.
+    """
+    errors: Dict[int, str] = {}
+    values: Dict[int, dict] = {}
+    for index, ipbx in enumerate(ipbxs):
+        tenant_uuid, error = tenant_service.get_bulk_uuid(principal, ipbx.tenant_uuid)
+        if error is not None:
+            errors[index] = error
+            continue
+        values[index] = dict(
+            tenant_uuid=tenant_uuid,
+            domain_id=ipbx.domain_id,
+            normalization_profile_id=ipbx.normalization_profile_id,
+            customer=ipbx.customer,
+            ip_fqdn=ipbx.ip_fqdn,
+            port=ipbx.port,
+            ip_address=ipbx.ip_address,
+            registered=ipbx.registered,
+            username=ipbx.username,
+            password=None,
+            password_ha1=None,
+            realm=ipbx.realm,
+        )
+    domains = await check_bulk_ipbxs(db, values, errors)
+    await hash_bulk_passwords(
+        hasher,
+        values,
+        {index: ipbx.password for index, ipbx in enumerate(ipbxs)},
+        domains,
+    )
+    rows = list(values.values())
+    async with db.transaction():
+        await tenant_service.create_missing_tenants(
+            db, [ipbx['tenant_uuid'] for ipbx in rows]
+        )
+        rows = await db.fetch_all_batches(
+            [
+                IPBX.__table__.insert()
+                .values(rows[start : start + BULK_BATCH_SIZE])
+                .returning(*IPBX.__table__.c)
+                for start in range(0, len(rows), BULK_BATCH_SIZE)
+            ]
+        )
+    return get_bulk_result(rows, errors)
+
+
+async def update_ipbxs(
+    db: AsyncDatabase,
+    principal: Principal,
+    ipbxs: List[schema.IPBXBulkUpdate],
+    hasher: password_service.PasswordHasher,
+) -> schema.IPBXBulkResult:
+    """Update the IPBXs, reporting the ones which can not be updated."""
+    db_ipbxs: Dict[int, Any] = {}
+    if ipbxs:
+        query = select([IPBX.__table__]).where(IPBX.id.in_({ipbx.id for ipbx in ipbxs}))
+        if principal is not None and principal.tenant_uuids:
+            query = query.where(IPBX.tenant_uuid.in_(principal.tenant_uuids))
+        db_ipbxs = {row.id: row for row in await db.fetch_all(query)}
+    errors: Dict[int, str] = {}
+    values: Dict[int, dict] = {}
+    updated: Set[int] = set()
+    for index, ipbx in enumerate(ipbxs):
+        if ipbx.id not in db_ipbxs:
+            errors[index] = "IPBX not found"
+        elif ipbx.id in updated:
+            errors[index] = "Duplicated id"
+        else:
+            updated.add(ipbx.id)
+            values[index] = get_ipbx_update_values(db_ipbxs[ipbx.id], ipbx)
+            values[index]['id'] = ipbx.id
+    domains = await check_bulk_ipbxs(db, values, errors)
+    await hash_bulk_passwords(
+        hasher,
+        values,
+        {index: ipbx.password for index, ipbx in enumerate(ipbxs)},
+        domains,
+    )
+    return get_bulk_result(
+        await db.fetch_all_batches(
+            [
+                IPBX.__table__.update()
+                .where(IPBX.id == ipbx['id'])
+                .values({name: value for name, value in ipbx.items() if name != 'id'})
+                .returning(*IPBX.__table__.c)
+                for ipbx in values.values()
+            ]
+        ),
+        errors,
+    )
@@ -3,14 +3,14 @@
 
 import re
 
-import aiopg  # type: ignore
-
-from typing import Any, Callable, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
 
 from psycopg2.extras import DictCursor  # type: ignore
 
-from wazo_router_confd.models.normalization import NormalizationProfile
-from wazo_router_confd.redis import Redis
+from wazo_router_confd.database import AiopgConnectionPool, PreparedStatement
+from wazo_router_confd.redis import Redis, RedisBatch
+from wazo_router_confd.routing_table import RoutingTable
 from wazo_router_confd.schemas import kamailio as schema
 from wazo_router_confd.schemas import cdr as cdr_schema
 from wazo_router_confd.services import password as password_service
@@ -21,6 +21,172 @@ re_protocol_local_part_and_domain = re.compile(
 ).match
 
 
+IPBX_ROUTE_COLUMNS = (
+    "ipbx.id, ipbx.tenant_uuid, ipbx.normalization_profile_id, ipbx.ip_fqdn, "
+    "ipbx.port, ipbx.username, ipbx.password, ipbx.realm"
+)
+CARRIER_TRUNK_ROUTE_COLUMNS = (
+    "carrier_trunks.id, carrier_trunks.tenant_uuid, "
+    "carrier_trunks.normalization_profile_id, carrier_trunks.sip_proxy, "
+    "carrier_trunks.sip_proxy_port, carrier_trunks.auth_username, "
+    "carrier_trunks.auth_password, carrier_trunks.realm"
+)
+
+# the kamailio hot path runs a fixed set of queries, each one is parsed and
+# planned once per pooled connection; the optional filters are separate
+# variants so that every statement keeps a plan fitted to its own predicates
+ipbx_by_id = PreparedStatement(
+    "kamailio_ipbx_by_id",
+    "SELECT %s FROM ipbx WHERE ipbx.id = $1" % IPBX_ROUTE_COLUMNS,
+    ("integer",),
+)
+carrier_trunk_by_id = PreparedStatement(
+    "kamailio_carrier_trunk_by_id",
+    "SELECT %s FROM carrier_trunks WHERE carrier_trunks.id = $1"
+    % CARRIER_TRUNK_ROUTE_COLUMNS,
+    ("integer",),
+)
+ipbx_by_domain = PreparedStatement(
+    "kamailio_ipbx_by_domain",
+    "SELECT %s FROM ipbx JOIN domains ON (ipbx.domain_id = domains.id) "
+    "WHERE domains.domain = $1 ORDER BY ipbx.id LIMIT 1" % IPBX_ROUTE_COLUMNS,
+    ("varchar",),
+)
+ipbx_by_domain_and_tenant = PreparedStatement(
+    "kamailio_ipbx_by_domain_and_tenant",
+    "SELECT %s FROM ipbx JOIN domains ON (ipbx.domain_id = domains.id) "
+    "WHERE domains.domain = $1 AND ipbx.tenant_uuid = $2 "
+    "ORDER BY ipbx.id LIMIT 1" % IPBX_ROUTE_COLUMNS,
+    ("varchar", "uuid"),
+)
+ipbx_by_did_prefixes = PreparedStatement(
+    "kamailio_ipbx_by_did_prefixes",
+    "SELECT %s, dids.did_regex FROM ipbx JOIN dids ON (dids.ipbx_id = ipbx.id) "
+    "WHERE dids.did_prefix = ANY($1) ORDER BY ipbx.id" % IPBX_ROUTE_COLUMNS,
+    ("varchar[]",),
+)
+ipbx_by_did_prefixes_and_tenant = PreparedStatement(
+    "kamailio_ipbx_by_did_prefixes_and_tenant",
+    "SELECT %s, dids.did_regex FROM ipbx JOIN dids ON (dids.ipbx_id = ipbx.id) "
+    "WHERE dids.did_prefix = ANY($1) AND ipbx.tenant_uuid = $2 ORDER BY ipbx.id"
+    % IPBX_ROUTE_COLUMNS,
+    ("varchar[]", "uuid"),
+)
+# the trunks of the tenants owning an ipbx; the composite foreign key keeps
+# carrier_trunks.tenant_uuid equal to the tenant of the carrier
+carrier_trunk_by_ipbx_ip_fqdn = PreparedStatement(
+    "kamailio_carrier_trunk_by_ipbx_ip_fqdn",
+    "SELECT carrier_trunk.* "
+    "FROM (SELECT DISTINCT tenant_uuid FROM ipbx WHERE ipbx.ip_fqdn = $1) AS tenant, "
+    "LATERAL (SELECT %s FROM carrier_trunks "
+    "WHERE carrier_trunks.tenant_uuid = tenant.tenant_uuid "
+    "ORDER BY carrier_trunks.id LIMIT 1) AS carrier_trunk "
+    "ORDER BY carrier_trunk.id LIMIT 1" % CARRIER_TRUNK_ROUTE_COLUMNS,
+    ("varchar",),
+)
+carrier_trunk_by_ipbx_ip_fqdn_and_tenant = PreparedStatement(
+    "kamailio_carrier_trunk_by_ipbx_ip_fqdn_and_tenant",
+    "SELECT %s FROM carrier_trunks WHERE carrier_trunks.tenant_uuid = $2 AND "
+    "EXISTS (SELECT 1 FROM ipbx WHERE ipbx.ip_fqdn = $1 AND ipbx.tenant_uuid = $2) "
+    "ORDER BY carrier_trunks.id LIMIT 1" % CARRIER_TRUNK_ROUTE_COLUMNS,
+    ("varchar", "uuid"),
+)
+carrier_trunk_auth_by_ip = PreparedStatement(
+    "kamailio_carrier_trunk_auth_by_ip",
+    "SELECT carriers.tenant_uuid, carrier_trunks.id "
+    "FROM carrier_trunks JOIN carriers ON carrier_trunks.carrier_id = carriers.id "
+    "WHERE (carrier_trunks.ip_address IS NULL OR carrier_trunks.ip_address = $1) "
+    "ORDER BY carrier_trunks.id LIMIT 1",
+    ("varchar",),
+)
+tenant_by_uuid = PreparedStatement(
+    "kamailio_tenant_by_uuid", "SELECT uuid FROM tenants WHERE uuid = $1", ("uuid",)
+)
+insert_cdr = PreparedStatement(
+    "kamailio_insert_cdr",
+    "INSERT INTO cdrs (tenant_uuid, source_ip, source_port, from_uri, to_uri, "
+    "call_id, call_start, duration) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
+    (
+        "uuid",
+        "varchar",
+        "integer",
+        "varchar",
+        "varchar",
+        "varchar",
+        "timestamp",
+        "integer",
+    ),
+)
+registered_carrier_trunks = PreparedStatement(
+    "kamailio_registered_carrier_trunks",
+    "SELECT carrier_trunks.carrier_id, carrier_trunks.id, "
+    "carrier_trunks.auth_username, carrier_trunks.auth_password, "
+    "carrier_trunks.realm, carrier_trunks.from_domain, "
+    "carrier_trunks.registrar_proxy, carrier_trunks.expire_seconds "
+    "FROM carrier_trunks WHERE registered = true ORDER BY id",
+)
+
+
+def build_ipbx_auth_statements() -> Dict[Tuple[bool, bool, bool], PreparedStatement]:
+    statements = {}
+    for source_ip in (False, True):
+        for username in (False, True):
+            for domain in (False, True):
+                where = []
+                types: List[str] = []
+                name = ["kamailio_ipbx_auth"]
+                if source_ip:
+                    types.append("varchar")
+                    where.append(
+                        "(ip_address IS NULL OR ip_address = $%d)" % len(types)
+                    )
+                    name.append("ip")
+                if username:
+                    types.append("varchar")
+                    where.append(
+                        "(ipbx.username = $%d OR (ipbx.password_ha1 IS NULL AND ipbx.username IS NULL))"
+                        % len(types)
+                    )
+                    name.append("username")
+                if domain:
+                    types.append("varchar")
+                    where.append("(domains.domain = $%d)" % len(types))
+                    name.append("domain")
+                statements[(source_ip, username, domain)] = PreparedStatement(
+                    "_".join(name),
+                    "SELECT ipbx.id, ipbx.tenant_uuid, ipbx.username, ipbx.password, ipbx.password_ha1, domains.domain "
+                    "FROM ipbx JOIN domains ON (ipbx.domain_id = domains.id) "
+                    "WHERE %s ORDER BY ipbx.id" % " AND ".join(where or ["true"]),
+                    tuple(types),
+                )
+    return statements
+
+
+ipbx_auth_statements = build_ipbx_auth_statements()
+# the read-only statements, which can be prepared on the replicas too
+lookup_statements = [
+    ipbx_by_id,
+    carrier_trunk_by_id,
+    ipbx_by_domain,
+    ipbx_by_domain_and_tenant,
+    ipbx_by_did_prefixes,
+    ipbx_by_did_prefixes_and_tenant,
+    carrier_trunk_by_ipbx_ip_fqdn,
+    carrier_trunk_by_ipbx_ip_fqdn_and_tenant,
+    carrier_trunk_auth_by_ip,
+    tenant_by_uuid,
+    registered_carrier_trunks,
+    normalization_service.normalization_profile_by_id,
+    normalization_service.normalization_rules_by_profile_id,
+] + list(ipbx_auth_statements.values())
+
+
+def get_ipbx_auth_statement(
+    source_ip: bool, username: bool, domain: bool
+) -> PreparedStatement:
+    return ipbx_auth_statements[(source_ip, username, domain)]
+
+
 def split_uri_to_parts(uri: str) -> Tuple[str, str, str, str]:
     m = re_protocol_local_part_and_domain(uri)
     if m is None:
@@ -29,387 +195,468 @@ def split_uri_to_parts(uri: str) -> Tuple[str, str, str, str]:
     return (protocol or '', local_part, domain_name, port_number or '')
 
 
-async def get_cached_dict_from_redis(
-    redis: Redis, redis_key: str, callback: Callable
-) -> Optional[dict]:
-    value = await redis.get_value(redis_key)
-    if value is None:
-        value = await callback()
-        await redis.set_value(redis_key, value)
-    return value
+async def get_cached_dicts_from_redis(
+    batch: RedisBatch, callbacks: Dict[str, Callable]
+) -> Dict[str, Optional[dict]]:
+    keys = list(callbacks)
+    values = dict(zip(keys, await batch.get_values(keys)))
+    for key in keys:
+        if values[key] is None:
+            value = values[key] = await callbacks[key]()
+            # None is read back as a miss, it is not worth storing
+            if value is not None:
+                batch.set_value(key, value)
+    return values
+
 
+async def get_normalization_profiles_by_ids(
+    conn: Any, batch: RedisBatch, normalization_profile_ids: List[Optional[int]]
+) -> Dict[int, normalization_service.CompiledNormalizationProfile]:
+    def get_callback(normalization_profile_id: int) -> Callable:
+        async def callback() -> dict:
+            return await normalization_service.get_normalization_profile_dict(
+                conn, normalization_profile_id
+            )
 
-async def get_normalization_profile_by_id(
-    conn: Any, redis: Redis, normalization_profile_id: int
-) -> Optional[NormalizationProfile]:
-    redis_key = 'normalization_profiles:%s' % normalization_profile_id
+        return callback
 
-    async def callback() -> dict:
-        async with conn.cursor(cursor_factory=DictCursor) as cur:
-            await cur.execute(
-                "SELECT * from normalization_profiles WHERE id = %s;",
-                [normalization_profile_id],
+    profiles = await get_cached_dicts_from_redis(
+        batch,
+        {
+            'normalization_profiles:%s'
+            % normalization_profile_id: get_callback(normalization_profile_id)
+            for normalization_profile_id in normalization_profile_ids
+            if normalization_profile_id is not None
+        },
+    )
+    return {
+        profile['id']: normalization_service.compile_normalization_profile(profile)
+        for profile in profiles.values()
+        if profile is not None and profile.get('country_code')
+    }
+
+
+def normalize_local_number_to_e164(
+    number: str,
+    profile: Optional[normalization_service.CompiledNormalizationProfile] = None,
+) -> str:
+    if profile is None:
+        return normalization_service.re_clean_number('', number)
+    return profile.normalize_local_number_to_e164(number)
+
+
+def normalize_e164_to_local_number(
+    number: str,
+    profile: Optional[normalization_service.CompiledNormalizationProfile] = None,
+) -> str:
+    if profile is None:
+        return normalization_service.re_clean_number('', number)
+    return profile.normalize_e164_to_local_number(number)
+
+
+def get_routing_redis_key(request: schema.RoutingRequest) -> str:
+    return 'kamailio_routing:%s:%s_%s_%s_%s' % (
+        request.source_ip or '*',
+        request.source_port or 5060,
+        request.domain or '*',
+        request.username or '*',
+        request.to_uri or '*',
+    )
+
+
+def get_auth_redis_key(request: schema.AuthRequest) -> str:
+    return 'kamailio_auth:%s:%s_%s_%s' % (
+        request.source_ip or '*',
+        request.source_port or 5060,
+        request.domain or '*',
+        request.username or '*',
+    )
+
+
+class DatabaseRoutingLookups(object):
+    """Routing lookups run on a database connection, the profiles cached in Redis."""
+
+    def __init__(self, conn: Any, batch: RedisBatch):
+        self.conn = conn
+        self.batch = batch
+
+    async def fetchone(
+        self, statement: PreparedStatement, args: Sequence[Any]
+    ) -> Optional[Any]:
+        async with self.conn.cursor(cursor_factory=DictCursor) as cur:
+            await statement.execute(cur, args)
+            return await cur.fetchone()
+
+    async def get_ipbx(self, ipbx_id: int) -> Optional[Any]:
+        return await self.fetchone(ipbx_by_id, [ipbx_id])
+
+    async def get_carrier_trunk(self, carrier_trunk_id: int) -> Optional[Any]:
+        return await self.fetchone(carrier_trunk_by_id, [carrier_trunk_id])
+
+    async def get_ipbx_by_domain(
+        self, domain_name: str, tenant_uuid: Optional[UUID]
+    ) -> Optional[Any]:
+        if tenant_uuid is not None:
+            return await self.fetchone(
+                ipbx_by_domain_and_tenant, [domain_name, tenant_uuid]
             )
-            row = await cur.fetchone()
-            return (
-                dict(
-                    name=row['name'],
-                    country_code=row['country_code'],
-                    area_code=row['area_code'],
-                    intl_prefix=row['intl_prefix'],
-                    ld_prefix=row['ld_prefix'],
-                    always_intl_prefix_plus=row['always_intl_prefix_plus'],
-                    always_ld=row['always_ld'],
+        return await self.fetchone(ipbx_by_domain, [domain_name])
+
+    async def get_ipbx_by_did(
+        self, local_part: str, tenant_uuid: Optional[UUID]
+    ) -> Optional[Any]:
+        prefixes = [local_part[:i] for i in range(0, min(10, len(local_part)))]
+        async with self.conn.cursor(cursor_factory=DictCursor) as cur:
+            if tenant_uuid is not None:
+                await ipbx_by_did_prefixes_and_tenant.execute(
+                    cur, [prefixes, tenant_uuid]
                 )
-                if row is not None
-                else {}
+            else:
+                await ipbx_by_did_prefixes.execute(cur, [prefixes])
+            async for ipbx in cur:
+                if re.match(ipbx['did_regex'], local_part):
+                    return ipbx
+        return None
+
+    async def get_carrier_trunk_by_source(
+        self, source_ip: Optional[str], tenant_uuid: Optional[UUID]
+    ) -> Optional[Any]:
+        if tenant_uuid is not None:
+            return await self.fetchone(
+                carrier_trunk_by_ipbx_ip_fqdn_and_tenant, [source_ip, tenant_uuid]
             )
+        return await self.fetchone(carrier_trunk_by_ipbx_ip_fqdn, [source_ip])
 
-    profile = await get_cached_dict_from_redis(redis, redis_key, callback)
-    normalization_profile = (
-        NormalizationProfile(
-            name=profile['name'],
-            country_code=profile['country_code'],
-            area_code=profile['area_code'],
-            intl_prefix=profile['intl_prefix'],
-            ld_prefix=profile['ld_prefix'],
-            always_intl_prefix_plus=profile['always_intl_prefix_plus'],
-            always_ld=profile['always_ld'],
+    async def get_normalization_profiles(
+        self, normalization_profile_ids: List[Optional[int]]
+    ) -> Dict[int, normalization_service.CompiledNormalizationProfile]:
+        return await get_normalization_profiles_by_ids(
+            self.conn, self.batch, normalization_profile_ids
         )
-        if profile is not None and profile.get('country_code')
+
+
+class TableRoutingLookups(object):
+    """The same lookups, answered by the shared routing table."""
+
+    def __init__(self, table: RoutingTable):
+        self.table = table
+
+    async def get_ipbx(self, ipbx_id: int) -> Optional[dict]:
+        return self.table.get('ipbx:%d' % ipbx_id)
+
+    async def get_carrier_trunk(self, carrier_trunk_id: int) -> Optional[dict]:
+        return self.table.get('carrier_trunk:%d' % carrier_trunk_id)
+
+    async def get_ipbx_by_domain(
+        self, domain_name: str, tenant_uuid: Optional[UUID]
+    ) -> Optional[dict]:
+        for ipbx_id, ipbx_tenant_uuid in (
+            self.table.get('domain:%s' % domain_name) or []
+        ):
+            if tenant_uuid is None or ipbx_tenant_uuid == str(tenant_uuid):
+                return self.table.get('ipbx:%d' % ipbx_id)
+        return None
+
+    async def get_ipbx_by_did(
+        self, local_part: str, tenant_uuid: Optional[UUID]
+    ) -> Optional[dict]:
+        dids = sorted(
+            did
+            for i in range(0, min(10, len(local_part)))
+            for did in self.table.get('did:%s' % local_part[:i]) or []
+            if tenant_uuid is None or did[1] == str(tenant_uuid)
+        )
+        for ipbx_id, _, did_regex in dids:
+            if re.match(did_regex, local_part):
+                return self.table.get('ipbx:%d' % ipbx_id)
+        return None
+
+    async def get_carrier_trunk_by_source(
+        self, source_ip: Optional[str], tenant_uuid: Optional[UUID]
+    ) -> Optional[dict]:
+        for carrier_trunk_tenant_uuid, carrier_trunk_id in (
+            self.table.get('source:%s' % source_ip) or []
+        ):
+            if tenant_uuid is None or carrier_trunk_tenant_uuid == str(tenant_uuid):
+                return self.table.get('carrier_trunk:%d' % carrier_trunk_id)
+        return None
+
+    async def get_normalization_profiles(
+        self, normalization_profile_ids: List[Optional[int]]
+    ) -> Dict[int, normalization_service.CompiledNormalizationProfile]:
+        profiles = {}
+        for normalization_profile_id in normalization_profile_ids:
+            if normalization_profile_id is None:
+                continue
+            profile = self.table.get(
+                'normalization_profile:%d' % normalization_profile_id
+            )
+            if profile is not None and profile.get('country_code'):
+                # compiled once per published table
+                profile['revision'] = self.table.build_id
+                profiles[
+                    normalization_profile_id
+                ] = normalization_service.compile_normalization_profile(profile)
+        return profiles
+
+
+async def get_routing(
+    lookups: Any,
+    request: schema.RoutingRequest,
+    auth_response: Optional[schema.AuthResponse],
+) -> dict:
+    routes = []
+    # get the domain name from the to uri
+    (
+        from_protocol,
+        from_local_part,
+        from_domain_name,
+        from_port_number,
+    ) = split_uri_to_parts(request.from_uri)
+    protocol, local_part, domain_name, port_number = split_uri_to_parts(request.to_uri)
+    # normalize according ipbx/carrier trunk source
+    normalization_profile = None
+    source = None
+    if auth_response is not None and auth_response.ipbx_id:
+        source = await lookups.get_ipbx(auth_response.ipbx_id)
+    elif auth_response is not None and auth_response.carrier_trunk_id:
+        source = await lookups.get_carrier_trunk(auth_response.carrier_trunk_id)
+    if source is not None:
+        normalization_profile = (
+            await lookups.get_normalization_profiles(
+                [source['normalization_profile_id']]
+            )
+        ).get(source['normalization_profile_id'])
+    from_local_part = normalize_local_number_to_e164(
+        from_local_part, profile=normalization_profile
+    )
+    local_part = normalize_local_number_to_e164(
+        local_part, profile=normalization_profile
+    )
+    # filter by tenant, if the request is authenticated
+    tenant_uuid = (
+        auth_response.tenant_uuid
+        if auth_response is not None and auth_response.tenant_uuid
         else None
     )
-    return normalization_profile
+    # get the first ipbx linked to that domain, ordered by id
+    ipbx = await lookups.get_ipbx_by_domain(domain_name, tenant_uuid)
+    # otherwise the first ipbx linked to that DID, ordered by id
+    if ipbx is None:
+        ipbx = await lookups.get_ipbx_by_did(local_part, tenant_uuid)
+    # route by carrier trunk if the package is coming from a known IPBX
+    carrier_trunk = await lookups.get_carrier_trunk_by_source(
+        request.source_ip, tenant_uuid
+    )
+    # get the normalization profiles of both routes with a single round trip
+    normalization_profiles = await lookups.get_normalization_profiles(
+        [
+            ipbx['normalization_profile_id'] if ipbx is not None else None,
+            carrier_trunk['normalization_profile_id']
+            if carrier_trunk is not None
+            else None,
+        ]
+    )
+    # build a route for the ipbx
+    ipbx_auth = None
+    if ipbx is not None:
+        # normalize from uri
+        normalization_profile = normalization_profiles.get(
+            ipbx['normalization_profile_id']
+        )
+        normalized_local_part = normalize_e164_to_local_number(
+            from_local_part, profile=normalization_profile
+        )
+        normalized_from_uri = "%s%s@%s" % (
+            from_protocol,
+            normalized_local_part,
+            from_domain_name,
+        )
+        # normalize to uri
+        normalized_local_part = normalize_e164_to_local_number(
+            local_part, profile=normalization_profile
+        )
+        normalized_to_uri = "%s%s@%s" % (protocol, normalized_local_part, domain_name)
+        #
+        routes.append(
+            {
+                "dst_uri": "sip:%s:%s" % (ipbx['ip_fqdn'], ipbx['port']),
+                "path": "",
+                "socket": "",
+                "headers": {
+                    "from": {"display": request.from_name, "uri": normalized_from_uri},
+                    "to": {"display": request.to_name, "uri": normalized_to_uri},
+                    "extra": "P-Asserted-Identity: <sip:"
+                    + request.from_name
+                    + "@"
+                    + normalized_from_uri
+                    + ">\r\n",
+                },
+                "branch_flags": 8,
+                "fr_timer": 5000,
+                "fr_inv_timer": 30000,
+            }
+        )
+        # if ipbx requires it, set the auth parameters
+        if (
+            ipbx['username'] is not None
+            and ipbx['password'] is not None
+            and ipbx['realm'] is not None
+        ):
+            ipbx_auth = dict(
+                auth_username=ipbx['username'],
+                auth_password=ipbx['password'],
+                realm=ipbx['realm'],
+            )
+    # build a route for the carrier trunk
+    carrier_trunk_auth = None
+    if carrier_trunk is not None:
+        # normalize from uri
+        normalization_profile = normalization_profiles.get(
+            carrier_trunk['normalization_profile_id']
+        )
+        normalized_local_part = normalize_e164_to_local_number(
+            from_local_part, profile=normalization_profile
+        )
+        normalized_from_uri = "%s%s@%s%s" % (
+            from_protocol,
+            normalized_local_part,
+            from_domain_name,
+            from_port_number,
+        )
+        # normalize to uri
+        normalized_local_part = normalize_e164_to_local_number(
+            local_part, profile=normalization_profile
+        )
+        normalized_to_uri = "%s%s@%s%s" % (
+            protocol,
+            normalized_local_part,
+            domain_name,
+            port_number,
+        )
+        #
+        routes.append(
+            {
+                "dst_uri": "sip:%s:%s"
+                % (carrier_trunk['sip_proxy'], carrier_trunk['sip_proxy_port']),
+                "path": "",
+                "socket": "",
+                "headers": {
+                    "from": {"display": request.from_name, "uri": normalized_from_uri},
+                    "to": {"display": request.to_name, "uri": normalized_to_uri},
+                    "extra": "P-Asserted-Identity: <sip:"
+                    + request.from_name
+                    + "@"
+                    + normalized_from_uri
+                    + ">\r\n",
+                },
+                "branch_flags": 8,
+                "fr_timer": 5000,
+                "fr_inv_timer": 30000,
+            }
+        )
+        # if carrier trunk is registered, set the auth parameters
+        if (
+            carrier_trunk['auth_username'] is not None
+            and carrier_trunk['auth_password'] is not None
+            and carrier_trunk['realm'] is not None
+        ):
+            carrier_trunk_auth = dict(
+                auth_username=carrier_trunk['auth_username'],
+                auth_password=carrier_trunk['auth_password'],
+                realm=carrier_trunk['realm'],
+            )
+    # build the JSON document, compatible with the rtjson Kamailio module form
+    rtjson = (
+        {"success": True, "version": "1.0", "routing": "serial", "routes": routes}
+        if routes
+        else {"success": False}
+    )
+    # update with carrier trunk auth parameters, if set
+    if carrier_trunk_auth is not None:
+        rtjson.update(carrier_trunk_auth)
+    # update with ipbx auth parameters, if set
+    elif ipbx_auth is not None:
+        rtjson.update(ipbx_auth)
+    # return
+    return {"auth": dict(auth_response) if auth_response else None, "rtjson": rtjson}
 
 
 async def routing(
-    pool: aiopg.Pool, redis: Redis, request: schema.RoutingRequest
+    pool: AiopgConnectionPool,
+    redis: Redis,
+    request: schema.RoutingRequest,
+    table: Optional[RoutingTable] = None,
 ) -> schema.RoutingResponse:
-    redis_key = 'kamailio_routing:%s:%s_%s_%s_%s' % (
-        request.source_ip or '*',
-        request.source_port or 5060,
-        request.domain or '*',
-        request.username or '*',
-        request.to_uri or '*',
+    batch = RedisBatch(redis)
+    redis_key = get_routing_redis_key(request)
+    auth_request = (
+        schema.AuthRequest(
+            source_ip=request.source_ip,
+            source_port=request.source_port,
+            domain=request.domain,
+            username=request.username,
+        )
+        if request.auth
+        else None
+    )
+    # read the routing and the nested auth entries with a single round trip
+    await batch.get_values(
+        [redis_key, get_auth_redis_key(auth_request)]
+        if auth_request is not None
+        else [redis_key]
     )
 
     async def callback() -> dict:
         # perform authorization the request, if needed
         auth_response = (
-            await auth(
-                pool,
-                redis,
-                request=schema.AuthRequest(
-                    source_ip=request.source_ip,
-                    source_port=request.source_port,
-                    domain=request.domain,
-                    username=request.username,
-                ),
-            )
-            if request.auth
+            await get_auth_response(pool, batch, request=auth_request)
+            if auth_request is not None
             else None
         )
+        if table is not None:
+            return await get_routing(TableRoutingLookups(table), request, auth_response)
         async with pool.acquire() as conn:
-            # routing
-            routes = []
-            # get the domain name from the to uri
-            (
-                from_protocol,
-                from_local_part,
-                from_domain_name,
-                from_port_number,
-            ) = split_uri_to_parts(request.from_uri)
-            protocol, local_part, domain_name, port_number = split_uri_to_parts(
-                request.to_uri
-            )
-            # normalize according ipbx/carrier trunk source
-            normalization_profile = None
-            if auth_response is not None and auth_response.ipbx_id:
-                sql = "SELECT ipbx.* " "FROM ipbx " "WHERE ipbx.id = %s"
-                async with conn.cursor(cursor_factory=DictCursor) as cur:
-                    await cur.execute(sql, [auth_response.ipbx_id])
-                    ipbx = await cur.fetchone()
-                    if (
-                        ipbx is not None
-                        and ipbx['normalization_profile_id'] is not None
-                    ):
-                        normalization_profile = await get_normalization_profile_by_id(
-                            conn, redis, ipbx['normalization_profile_id']
-                        )
-            elif auth_response is not None and auth_response.carrier_trunk_id:
-                sql = (
-                    "SELECT carrier_trunks.* "
-                    "FROM carrier_trunks "
-                    "WHERE carrier_trunks.id = %s"
-                )
-                async with conn.cursor(cursor_factory=DictCursor) as cur:
-                    await cur.execute(sql, [auth_response.carrier_trunk_id])
-                    carrier_trunk = await cur.fetchone()
-                    if (
-                        carrier_trunk is not None
-                        and carrier_trunk['normalization_profile_id'] is not None
-                    ):
-                        normalization_profile = await get_normalization_profile_by_id(
-                            conn, redis, carrier_trunk['normalization_profile_id']
-                        )
-            from_local_part = await normalization_service.normalize_local_number_to_e164(
-                conn, from_local_part, profile=normalization_profile
-            )
-            local_part = await normalization_service.normalize_local_number_to_e164(
-                conn, local_part, profile=normalization_profile
-            )
-            # get all the ipbxs linked to that domain
-            where = ["domains.domain = %s"]
-            where_args: List[Any] = [domain_name]
-            # filter by tenant, if the request is authenticated
-            if auth_response is not None and auth_response.tenant_uuid:
-                where.append("ipbx.tenant_uuid = %s")
-                where_args.append(auth_response.tenant_uuid)
-            # get the list of ipbx, ordered by id
-            ipbxs = []
-            sql = (
-                "SELECT ipbx.* "
-                "FROM ipbx JOIN domains ON (ipbx.domain_id = domains.id) "
-                "WHERE %s ORDER BY ipbx.id LIMIT 1;" % " AND ".join(where)
-            )
-            async with conn.cursor(cursor_factory=DictCursor) as cur:
-                await cur.execute(sql, where_args)
-                ipbx = await cur.fetchone()
-                if ipbx is not None:
-                    ipbxs.append(ipbx)
-            # get all the ipbxs linked to that DID
-            prefixes = [local_part[:i] for i in range(0, min(10, len(local_part)))]
-            where = ["dids.did_prefix = ANY(%s)"]
-            where_args = [prefixes]
-            # filter by tenant, if the request is authenticated
-            if auth_response is not None and auth_response.tenant_uuid:
-                where.append("ipbx.tenant_uuid = %s")
-                where_args.append(auth_response.tenant_uuid)
-            # get the list of ipbx, ordered by id
-            sql = (
-                "SELECT ipbx.*, dids.did_regex "
-                "FROM ipbx JOIN dids ON (dids.ipbx_id = ipbx.id) "
-                "WHERE %s ORDER BY ipbx.id;" % " AND ".join(where)
-            )
-            async with conn.cursor(cursor_factory=DictCursor) as cur:
-                await cur.execute(sql, where_args)
-                async for ipbx in cur:
-                    if re.match(ipbx['did_regex'], local_part):
-                        ipbxs.append(ipbx)
-                        break
-            # build a route for each ipbx
-            ipbx_auth = None
-            for ipbx in ipbxs:
-                # normalize from uri
-                normalization_profile = None
-                if ipbx['normalization_profile_id'] is not None:
-                    normalization_profile = await get_normalization_profile_by_id(
-                        conn, redis, ipbx['normalization_profile_id']
-                    )
-                normalized_local_part = await normalization_service.normalize_e164_to_local_number(
-                    conn, from_local_part, profile=normalization_profile
-                )
-                normalized_from_uri = "%s%s@%s" % (
-                    from_protocol,
-                    normalized_local_part,
-                    from_domain_name,
-                )
-                # normalize to uri
-                normalized_local_part = await normalization_service.normalize_e164_to_local_number(
-                    conn, local_part, profile=normalization_profile
-                )
-                normalized_to_uri = "%s%s@%s" % (
-                    protocol,
-                    normalized_local_part,
-                    domain_name,
-                )
-                #
-                routes.append(
-                    {
-                        "dst_uri": "sip:%s:%s" % (ipbx['ip_fqdn'], ipbx['port']),
-                        "path": "",
-                        "socket": "",
-                        "headers": {
-                            "from": {
-                                "display": request.from_name,
-                                "uri": normalized_from_uri,
-                            },
-                            "to": {
-                                "display": request.to_name,
-                                "uri": normalized_to_uri,
-                            },
-                            "extra": "P-Asserted-Identity: <sip:"
-                            + request.from_name
-                            + "@"
-                            + normalized_from_uri
-                            + ">\r\n",
-                        },
-                        "branch_flags": 8,
-                        "fr_timer": 5000,
-                        "fr_inv_timer": 30000,
-                    }
-                )
-                # if ipbx requires it, set the auth parameters
-                if (
-                    ipbx['username'] is not None
-                    and ipbx['password'] is not None
-                    and ipbx['realm'] is not None
-                ):
-                    ipbx_auth = dict(
-                        auth_username=ipbx['username'],
-                        auth_password=ipbx['password'],
-                        realm=ipbx['realm'],
-                    )
-                # we stop at the first ipbx found
-                break
-            # route by carrier trunk if the package is coming from a known IPBX
-            where = ["ipbx.ip_fqdn = %s"]
-            where_args = [request.source_ip]
-            # filter by tenant, if the request is authenticated
-            if auth_response is not None and auth_response.tenant_uuid:
-                where.append("carriers.tenant_uuid = %s")
-                where_args.append(auth_response.tenant_uuid)
-            # get the list of carrier trunks, ordered by id
-            carrier_trunk_auth = None
-            sql = (
-                "SELECT carrier_trunks.* "
-                "FROM carrier_trunks JOIN carriers ON (carrier_trunks.carrier_id = carriers.id) "
-                "JOIN ipbx ON (ipbx.tenant_uuid = carriers.tenant_uuid) "
-                "WHERE %s ORDER BY carrier_trunks.id LIMIT 1;" % " AND ".join(where)
-            )
-            async with conn.cursor(cursor_factory=DictCursor) as cur:
-                await cur.execute(sql, where_args)
-                carrier_trunk = await cur.fetchone()
-                if carrier_trunk is not None:
-                    # normalize from uri
-                    normalization_profile = None
-                    if carrier_trunk['normalization_profile_id'] is not None:
-                        normalization_profile = await get_normalization_profile_by_id(
-                            conn, redis, carrier_trunk['normalization_profile_id']
-                        )
-                    normalized_local_part = await normalization_service.normalize_e164_to_local_number(
-                        conn, from_local_part, profile=normalization_profile
-                    )
-                    normalized_from_uri = "%s%s@%s%s" % (
-                        from_protocol,
-                        normalized_local_part,
-                        from_domain_name,
-                        from_port_number,
-                    )
-                    # normalize to uri
-                    normalized_local_part = await normalization_service.normalize_e164_to_local_number(
-                        conn, local_part, profile=normalization_profile
-                    )
-                    normalized_to_uri = "%s%s@%s%s" % (
-                        protocol,
-                        normalized_local_part,
-                        domain_name,
-                        port_number,
-                    )
-                    #
-                    routes.append(
-                        {
-                            "dst_uri": "sip:%s:%s"
-                            % (
-                                carrier_trunk['sip_proxy'],
-                                carrier_trunk['sip_proxy_port'],
-                            ),
-                            "path": "",
-                            "socket": "",
-                            "headers": {
-                                "from": {
-                                    "display": request.from_name,
-                                    "uri": normalized_from_uri,
-                                },
-                                "to": {
-                                    "display": request.to_name,
-                                    "uri": normalized_to_uri,
-                                },
-                                "extra": "P-Asserted-Identity: <sip:"
-                                + request.from_name
-                                + "@"
-                                + normalized_from_uri
-                                + ">\r\n",
-                            },
-                            "branch_flags": 8,
-                            "fr_timer": 5000,
-                            "fr_inv_timer": 30000,
-                        }
-                    )
-                    # if carrier trunk is registered, set the auth parameters
-                    if (
-                        carrier_trunk['auth_username'] is not None
-                        and carrier_trunk['auth_password'] is not None
-                        and carrier_trunk['realm'] is not None
-                    ):
-                        carrier_trunk_auth = dict(
-                            auth_username=carrier_trunk['auth_username'],
-                            auth_password=carrier_trunk['auth_password'],
-                            realm=carrier_trunk['realm'],
-                        )
-            # build the JSON document, compatible with the rtjson Kamailio module form
-            rtjson = (
-                {
-                    "success": True,
-                    "version": "1.0",
-                    "routing": "serial",
-                    "routes": routes,
-                }
-                if routes
-                else {"success": False}
+            return await get_routing(
+                DatabaseRoutingLookups(conn, batch), request, auth_response
             )
-            # update with carrier trunk auth parameters, if set
-            if carrier_trunk_auth is not None:
-                rtjson.update(carrier_trunk_auth)
-            # update with ipbx auth parameters, if set
-            elif ipbx_auth is not None:
-                rtjson.update(ipbx_auth)
-            # return
-            return {
-                "auth": dict(auth_response) if auth_response else None,
-                "rtjson": rtjson,
-            }
 
     # return the routing and auth responses
-    routing_response = (
-        await get_cached_dict_from_redis(redis, redis_key, callback) or {}
-    )
-    return schema.RoutingResponse(**routing_response)
+    values = await get_cached_dicts_from_redis(batch, {redis_key: callback})
+    # write all the computed entries with a single round trip
+    await batch.commit()
+    return schema.RoutingResponse(**(values[redis_key] or {}))
 
 
 async def auth(
-    pool: aiopg.Pool, redis: Redis, request: schema.AuthRequest
+    pool: AiopgConnectionPool, redis: Redis, request: schema.AuthRequest
 ) -> schema.AuthResponse:
-    redis_key = 'kamailio_auth:%s:%s_%s_%s' % (
-        request.source_ip or '*',
-        request.source_port or 5060,
-        request.domain or '*',
-        request.username or '*',
-    )
+    batch = RedisBatch(redis)
+    auth_response = await get_auth_response(pool, batch, request=request)
+    await batch.commit()
+    return auth_response
+
+
+async def get_auth_response(
+    pool: AiopgConnectionPool, batch: RedisBatch, request: schema.AuthRequest
+) -> schema.AuthResponse:
+    redis_key = get_auth_redis_key(request)
 
     async def callback() -> dict:
         if request.source_ip or request.username:
             async with pool.acquire() as conn:
-                where = ["1 = 1"]
-                where_args = []
-                if request.source_ip:
-                    where.append("(ip_address IS NULL OR ip_address = %s)")
-                    where_args.append(request.source_ip)
-                if request.username:
-                    where.append(
-                        "(ipbx.username = %s OR (ipbx.password_ha1 IS NULL AND ipbx.username IS NULL))"
-                    )
-                    where_args.append(request.username)
-                if request.domain:
-                    where.append("(domains.domain = %s)")
-                    where_args.append(request.domain)
-                sql = (
-                    "SELECT ipbx.id, ipbx.tenant_uuid, ipbx.username, ipbx.password, ipbx.password_ha1, domains.domain "
-                    "FROM ipbx JOIN domains ON (ipbx.domain_id = domains.id) "
-                    "WHERE %s ORDER BY ipbx.id;" % " AND ".join(where)
+                statement = get_ipbx_auth_statement(
+                    bool(request.source_ip),
+                    bool(request.username),
+                    bool(request.domain),
                 )
+                args = [
+                    arg
+                    for arg in (request.source_ip, request.username, request.domain)
+                    if arg
+                ]
                 async with conn.cursor(cursor_factory=DictCursor) as cur:
-                    await cur.execute(sql, where_args)
+                    await statement.execute(cur, args)
                     async for ipbx in cur:
                         if (
                             not request.password
@@ -428,14 +675,8 @@ async def auth(
                             )
                 #
                 if request.source_ip:
-                    sql = (
-                        "SELECT carriers.tenant_uuid, carrier_trunks.id "
-                        "FROM carrier_trunks JOIN carriers ON carrier_trunks.carrier_id = carriers.id "
-                        "WHERE (carrier_trunks.ip_address IS NULL OR carrier_trunks.ip_address = %s) "
-                        "ORDER BY carrier_trunks.id LIMIT 1;"
-                    )
                     async with conn.cursor(cursor_factory=DictCursor) as cur:
-                        await cur.execute(sql, [request.source_ip])
+                        await carrier_trunk_auth_by_ip.execute(cur, [request.source_ip])
                         carrier_trunk = await cur.fetchone()
                         if carrier_trunk is not None:
                             return dict(
@@ -445,18 +686,14 @@ async def auth(
                             )
         return dict(success=False)
 
-    auth_response = await get_cached_dict_from_redis(redis, redis_key, callback) or {
-        'success': False
-    }
-    return schema.AuthResponse(**auth_response)
+    values = await get_cached_dicts_from_redis(batch, {redis_key: callback})
+    return schema.AuthResponse(**(values[redis_key] or {'success': False}))
 
 
-async def cdr(pool: aiopg.Pool, request: schema.CDRRequest) -> dict:
+async def cdr(pool: AiopgConnectionPool, request: schema.CDRRequest) -> dict:
     async with pool.acquire() as conn:
         async with conn.cursor(cursor_factory=DictCursor) as cur:
-            await cur.execute(
-                "SELECT * FROM tenants WHERE uuid = %s;", [request.tenant_uuid]
-            )
+            await tenant_by_uuid.execute(cur, [request.tenant_uuid])
             tenant = await cur.fetchone()
             if tenant is None:
                 return {"success": False, "cdr": None}
@@ -470,9 +707,8 @@ async def cdr(pool: aiopg.Pool, request: schema.CDRRequest) -> dict:
                 call_start=request.call_start,
                 duration=request.duration,
             )
-            await cur.execute(
-                "INSERT INTO cdrs (tenant_uuid, source_ip, source_port, from_uri, to_uri, call_id, call_start, duration) "
-                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s);",
+            await insert_cdr.execute(
+                cur,
                 [
                     cdr.tenant_uuid,
                     cdr.source_ip,
@@ -487,7 +723,7 @@ async def cdr(pool: aiopg.Pool, request: schema.CDRRequest) -> dict:
             return {"success": True, "cdr": cdr}
 
 
-async def dbtext_uacreg(pool: aiopg.Pool) -> schema.DBText:
+async def dbtext_uacreg(pool: AiopgConnectionPool) -> schema.DBText:
     content = []
     content.append(
         " ".join(
@@ -512,9 +748,7 @@ async def dbtext_uacreg(pool: aiopg.Pool) -> schema.DBText:
     )
     async with pool.acquire() as conn:
         async with conn.cursor(cursor_factory=DictCursor) as cur:
-            await cur.execute(
-                "SELECT row_number() OVER () AS carrier_id, * FROM carrier_trunks WHERE registered = true ORDER BY id;"
-            )
+            await registered_carrier_trunks.execute(cur)
             async for carrier_trunk in cur:
                 content.append(
                     ":".join(
@@ -3,25 +3,158 @@
 
 import re
 
-from typing import Any, List, Optional
+from json import dumps, loads
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+    Union,
+)
+from uuid import uuid4
 
 from psycopg2.extras import DictCursor  # type: ignore
 
-from sqlalchemy.orm import Session
+from sqlalchemy import select
 
 
 from wazo_router_confd.auth import Principal
+from wazo_router_confd.database import AsyncDatabase, PreparedStatement, transactional
+from wazo_router_confd.fieldsets import Fieldset, Projection, Relations
 from wazo_router_confd.models.normalization import (
     NormalizationProfile,
     NormalizationRule,
 )
+from wazo_router_confd.pagination import Pagination, paginate
 from wazo_router_confd.schemas import normalization as schema
+from wazo_router_confd.schemas import tenant as tenant_schema
 from wazo_router_confd.services import tenant as tenant_service
 
 
 re_clean_number = re.compile('[^0-9a-zA-Z]').sub
 re_match_prefix_from_regex = re.compile('[^0-9a-zA-Z]')
 
+RULE_TYPE_LOCAL_TO_E164 = 1
+RULE_TYPE_E164_TO_LOCAL = 2
+MAX_MATCH_PREFIX_LENGTH = 10
+
+CompiledRule = Tuple[int, Pattern, str]
+
+
+class NormalizationRuleTrie(object):
+    rules: List[CompiledRule]
+    children: Dict[str, 'NormalizationRuleTrie']
+
+    def __init__(self):
+        self.rules = []
+        self.children = {}
+
+    def insert(self, match_prefix: str, rule: CompiledRule):
+        node = self
+        for char in match_prefix:
+            node = node.children.setdefault(char, NormalizationRuleTrie())
+        node.rules.append(rule)
+
+    def match(self, number: str) -> List[CompiledRule]:
+        # same candidates as "match_prefix = ANY(number[:i] for i < 10)"
+        depth = min(MAX_MATCH_PREFIX_LENGTH, len(number))
+        if depth == 0:
+            return []
+        rules = list(self.rules)
+        node = self
+        for char in number[: depth - 1]:
+            child = node.children.get(char)
+            if child is None:
+                break
+            node = child
+            rules.extend(node.rules)
+        rules.sort(key=lambda rule: rule[0])
+        return rules
+
+
+class CompiledNormalizationProfile(object):
+    id: Optional[int]
+    revision: Optional[str]
+    name: Optional[str]
+    country_code: Optional[str]
+    area_code: Optional[str]
+    intl_prefix: Optional[str]
+    ld_prefix: Optional[str]
+    always_intl_prefix_plus: bool
+    always_ld: bool
+    tries: Dict[int, NormalizationRuleTrie]
+
+    def __init__(self, profile: dict):
+        self.id = profile.get('id')
+        self.revision = profile.get('revision')
+        self.name = profile.get('name')
+        self.country_code = profile.get('country_code')
+        self.area_code = profile.get('area_code')
+        self.intl_prefix = profile.get('intl_prefix')
+        self.ld_prefix = profile.get('ld_prefix')
+        self.always_intl_prefix_plus = bool(profile.get('always_intl_prefix_plus'))
+        self.always_ld = bool(profile.get('always_ld'))
+        self.tries = {}
+        rules = sorted(
+            profile.get('rules') or [], key=lambda x: (x['priority'], x['id'])
+        )
+        for order, rule in enumerate(rules):
+            trie = self.tries.setdefault(rule['rule_type'], NormalizationRuleTrie())
+            trie.insert(
+                rule['match_prefix'],
+                (order, re.compile(rule['match_regex']), rule['replace_regex']),
+            )
+
+    def apply_rules(self, rule_type: int, number: str) -> str:
+        trie = self.tries.get(rule_type)
+        if trie is not None:
+            for _, match_regex, replace_regex in trie.match(number):
+                number = match_regex.sub(replace_regex, number)
+        return number
+
+    def normalize(self, rule_type: int, number: str) -> str:
+        number = self.apply_rules(rule_type, re_clean_number('', number))
+        if rule_type == RULE_TYPE_E164_TO_LOCAL and self.always_intl_prefix_plus:
+            number = "+%s" % number
+        return number
+
+    def normalize_many(
+        self, rule_type: int, numbers: Iterable[str]
+    ) -> Iterator[Tuple[str, str]]:
+        trie = self.tries.get(rule_type)
+        # numbers sharing the same leading digits share the same candidate rules
+        matches: Dict[str, List[CompiledRule]] = {}
+        for number in numbers:
+            normalized_number = re_clean_number('', number)
+            if trie is not None and normalized_number:
+                key = normalized_number[: MAX_MATCH_PREFIX_LENGTH - 1]
+                if len(normalized_number) < MAX_MATCH_PREFIX_LENGTH:
+                    key = normalized_number[:-1]
+                rules = matches.get(key)
+                if rules is None:
+                    rules = matches[key] = trie.match(normalized_number)
+                for _, match_regex, replace_regex in rules:
+                    normalized_number = match_regex.sub(
+                        replace_regex, normalized_number
+                    )
+            if rule_type == RULE_TYPE_E164_TO_LOCAL and self.always_intl_prefix_plus:
+                normalized_number = "+%s" % normalized_number
+            yield number, normalized_number
+
+    def normalize_local_number_to_e164(self, number: str) -> str:
+        return self.normalize(RULE_TYPE_LOCAL_TO_E164, number)
+
+    def normalize_e164_to_local_number(self, number: str) -> str:
+        return self.normalize(RULE_TYPE_E164_TO_LOCAL, number)
+
+
+compiled_normalization_profiles: Dict[int, CompiledNormalizationProfile] = {}
+
 
 def get_match_prefix_from_regex(match_regex: Optional[str] = None) -> str:
     did_prefix = (
@@ -32,286 +165,528 @@ def get_match_prefix_from_regex(match_regex: Optional[str] = None) -> str:
     return did_prefix
 
 
-def get_normalization_profile(
-    db: Session, principal: Principal, normalization_profile_id: int
-) -> NormalizationProfile:
-    db_normalization_profile = db.query(NormalizationProfile).filter(
+PROFILE_RELATIONS: Relations = dict(
+    tenant=(NormalizationProfile.__table__.c.tenant_uuid, tenant_schema.Tenant)
+)
+
+
+async def get_normalization_profile(
+    db: AsyncDatabase,
+    principal: Principal,
+    normalization_profile_id: int,
+    fieldset: Optional[Fieldset] = None,
+) -> Optional[Any]:
+    projection = Projection(
+        NormalizationProfile.__table__,
+        schema.NormalizationProfile,
+        fieldset,
+        PROFILE_RELATIONS,
+    )
+    db_normalization_profile = projection.select().where(
         NormalizationProfile.id == normalization_profile_id
     )
     if principal is not None and principal.tenant_uuids:
-        db_normalization_profile = db_normalization_profile.filter(
+        db_normalization_profile = db_normalization_profile.where(
             NormalizationProfile.tenant_uuid.in_(principal.tenant_uuids)
         )
-    return db_normalization_profile.first()
+    return projection.get_item(await db.fetch_one(db_normalization_profile.limit(1)))
 
 
-def get_normalization_profile_by_name(
-    db: Session, principal: Principal, name: Optional[str]
-) -> NormalizationProfile:
-    db_normalization_profile = db.query(NormalizationProfile).filter(
+async def get_normalization_profiles_by_ids(
+    db: AsyncDatabase, ids: Iterable[int]
+) -> Dict[int, Any]:
+    ids = set(ids)
+    if not ids:
+        return {}
+    rows = await db.fetch_all(
+        select([NormalizationProfile.__table__]).where(NormalizationProfile.id.in_(ids))
+    )
+    return {row.id: row for row in rows}
+
+
+async def get_normalization_profile_by_name(
+    db: AsyncDatabase, principal: Principal, name: Optional[str]
+) -> Optional[Any]:
+    db_normalization_profile = select([NormalizationProfile.__table__]).where(
         NormalizationProfile.name == name
     )
     if principal is not None and principal.tenant_uuids:
-        db_normalization_profile = db_normalization_profile.filter(
+        db_normalization_profile = db_normalization_profile.where(
             NormalizationProfile.tenant_uuid.in_(principal.tenant_uuids)
         )
-    return db_normalization_profile.first()
+    return await db.fetch_one(db_normalization_profile.limit(1))
 
 
-def get_normalization_profiles(
-    db: Session, principal: Principal, offset: int = 0, limit: int = 100
-) -> schema.NormalizationProfileList:
-    items = db.query(NormalizationProfile)
+async def get_normalization_profiles(
+    db: AsyncDatabase,
+    principal: Principal,
+    pagination: Optional[Pagination] = None,
+    fieldset: Optional[Fieldset] = None,
+) -> Union[schema.NormalizationProfileList, dict]:
+    projection = Projection(
+        NormalizationProfile.__table__,
+        schema.NormalizationProfile,
+        fieldset,
+        PROFILE_RELATIONS,
+    )
+    items = projection.select()
     if principal is not None and principal.tenant_uuid:
-        items = items.filter(NormalizationProfile.tenant_uuid == principal.tenant_uuid)
-    items = items.offset(offset).limit(limit).all()
-    return schema.NormalizationProfileList(items=items)
+        items = items.where(NormalizationProfile.tenant_uuid == principal.tenant_uuid)
+    page = await paginate(
+        db,
+        items,
+        NormalizationProfile.__table__.c.id,
+        pagination,
+        order_columns=('name',),
+    )
+    if fieldset:
+        return dict(page, items=projection.get_items(page['items']))
+    return schema.NormalizationProfileList(**page)
 
 
-def create_normalization_profile(
-    db: Session,
+@transactional
+async def create_normalization_profile(
+    db: AsyncDatabase,
     principal: Principal,
     normalization_profile: schema.NormalizationProfileCreate,
-) -> NormalizationProfile:
-    normalization_profile.tenant_uuid = tenant_service.get_uuid(
+) -> Any:
+    normalization_profile.tenant_uuid = await tenant_service.get_uuid(
         principal, db, normalization_profile.tenant_uuid
     )
-    db_normalization_profile = NormalizationProfile(
-        name=normalization_profile.name,
-        tenant_uuid=normalization_profile.tenant_uuid,
-        country_code=normalization_profile.country_code,
-        area_code=normalization_profile.area_code,
-        intl_prefix=normalization_profile.intl_prefix,
-        ld_prefix=normalization_profile.ld_prefix,
-        always_ld=normalization_profile.always_ld,
-        always_intl_prefix_plus=normalization_profile.always_intl_prefix_plus,
+    return await db.fetch_one(
+        NormalizationProfile.__table__.insert()
+        .values(
+            name=normalization_profile.name,
+            tenant_uuid=normalization_profile.tenant_uuid,
+            country_code=normalization_profile.country_code,
+            area_code=normalization_profile.area_code,
+            intl_prefix=normalization_profile.intl_prefix,
+            ld_prefix=normalization_profile.ld_prefix,
+            always_ld=normalization_profile.always_ld,
+            always_intl_prefix_plus=normalization_profile.always_intl_prefix_plus,
+        )
+        .returning(*NormalizationProfile.__table__.c)
     )
-    db.add(db_normalization_profile)
-    db.commit()
-    db.refresh(db_normalization_profile)
-    return db_normalization_profile
 
 
-def update_normalization_profile(
-    db: Session,
+@transactional
+async def update_normalization_profile(
+    db: AsyncDatabase,
     principal: Principal,
     normalization_profile_id: int,
     normalization_profile: schema.NormalizationProfileUpdate,
-) -> NormalizationProfile:
-    db_normalization_profile = get_normalization_profile(
+) -> Optional[Any]:
+    db_normalization_profile = await get_normalization_profile(
         db, principal, normalization_profile_id
     )
     if db_normalization_profile is not None:
-        db_normalization_profile.tenant_uuid = (
-            normalization_profile.tenant_uuid
-            if normalization_profile.tenant_uuid is not None
-            else db_normalization_profile.tenant_uuid
-        )
-        db_normalization_profile.country_code = (
-            normalization_profile.country_code
-            if normalization_profile.country_code is not None
-            else db_normalization_profile.country_code
-        )
-        db_normalization_profile.name = (
-            normalization_profile.name
-            if normalization_profile.name is not None
-            else db_normalization_profile.name
+        db_normalization_profile = await db.fetch_one(
+            NormalizationProfile.__table__.update()
+            .where(NormalizationProfile.id == db_normalization_profile.id)
+            .values(
+                tenant_uuid=(
+                    normalization_profile.tenant_uuid
+                    if normalization_profile.tenant_uuid is not None
+                    else db_normalization_profile.tenant_uuid
+                ),
+                country_code=(
+                    normalization_profile.country_code
+                    if normalization_profile.country_code is not None
+                    else db_normalization_profile.country_code
+                ),
+                name=(
+                    normalization_profile.name
+                    if normalization_profile.name is not None
+                    else db_normalization_profile.name
+                ),
+                area_code=(
+                    normalization_profile.area_code
+                    if normalization_profile.area_code is not None
+                    else db_normalization_profile.area_code
+                ),
+                intl_prefix=(
+                    normalization_profile.intl_prefix
+                    if normalization_profile.intl_prefix is not None
+                    else db_normalization_profile.intl_prefix
+                ),
+                ld_prefix=(
+                    normalization_profile.ld_prefix
+                    if normalization_profile.ld_prefix is not None
+                    else db_normalization_profile.ld_prefix
+                ),
+                always_ld=(
+                    normalization_profile.always_ld
+                    if normalization_profile.always_ld is not None
+                    else db_normalization_profile.always_ld
+                ),
+                always_intl_prefix_plus=(
+                    normalization_profile.always_intl_prefix_plus
+                    if normalization_profile.always_intl_prefix_plus is not None
+                    else db_normalization_profile.always_intl_prefix_plus
+                ),
+            )
+            .returning(*NormalizationProfile.__table__.c)
         )
-        db_normalization_profile.area_code = (
-            normalization_profile.area_code
-            if normalization_profile.area_code is not None
-            else db_normalization_profile.area_code
-        )
-        db_normalization_profile.intl_prefix = (
-            normalization_profile.intl_prefix
-            if normalization_profile.intl_prefix is not None
-            else db_normalization_profile.intl_prefix
-        )
-        db_normalization_profile.ld_prefix = (
-            normalization_profile.ld_prefix
-            if normalization_profile.ld_prefix is not None
-            else db_normalization_profile.ld_prefix
-        )
-        db_normalization_profile.always_ld = (
-            normalization_profile.always_ld
-            if normalization_profile.always_ld is not None
-            else db_normalization_profile.always_ld
-        )
-        db_normalization_profile.always_intl_prefix_plus = (
-            normalization_profile.always_intl_prefix_plus
-            if normalization_profile.always_intl_prefix_plus is not None
-            else db_normalization_profile.always_intl_prefix_plus
-        )
-        db.commit()
-        db.refresh(db_normalization_profile)
     return db_normalization_profile
 
 
-def delete_normalization_profile(
-    db: Session, principal: Principal, normalization_profile_id: int
-) -> NormalizationProfile:
-    db_normalization_profile = get_normalization_profile(
+@transactional
+async def delete_normalization_profile(
+    db: AsyncDatabase, principal: Principal, normalization_profile_id: int
+) -> Optional[Any]:
+    db_normalization_profile = await get_normalization_profile(
         db, principal, normalization_profile_id
     )
     if db_normalization_profile is not None:
-        db.delete(db_normalization_profile)
-        db.commit()
+        await db.execute(
+            NormalizationProfile.__table__.delete().where(
+                NormalizationProfile.id == db_normalization_profile.id
+            )
+        )
     return db_normalization_profile
 
 
-def get_normalization_rule(
-    db: Session, principal: Principal, normalization_rule_id: int
-) -> NormalizationRule:
-    db_normalization_rule = db.query(NormalizationRule).filter(
-        NormalizationRule.id == normalization_rule_id
+async def get_compiled_normalization_profile_by_id(
+    db: AsyncDatabase, principal: Principal, normalization_profile_id: int
+) -> Optional[CompiledNormalizationProfile]:
+    db_normalization_profile = await get_normalization_profile(
+        db, principal, normalization_profile_id
     )
-    if principal is not None and principal.tenant_uuids:
-        db_normalization_rule = db_normalization_rule.join(NormalizationProfile).filter(
-            NormalizationProfile.tenant_uuid.in_(principal.tenant_uuids)
+    if db_normalization_profile is None:
+        return None
+    db_normalization_rules = await db.fetch_all(
+        select([NormalizationRule.__table__])
+        .where(NormalizationRule.profile_id == db_normalization_profile.id)
+        .order_by(NormalizationRule.priority, NormalizationRule.id)
+    )
+    return CompiledNormalizationProfile(
+        dict(
+            id=db_normalization_profile.id,
+            name=db_normalization_profile.name,
+            country_code=db_normalization_profile.country_code,
+            area_code=db_normalization_profile.area_code,
+            intl_prefix=db_normalization_profile.intl_prefix,
+            ld_prefix=db_normalization_profile.ld_prefix,
+            always_intl_prefix_plus=db_normalization_profile.always_intl_prefix_plus,
+            always_ld=db_normalization_profile.always_ld,
+            rules=[
+                dict(
+                    id=rule.id,
+                    rule_type=rule.rule_type,
+                    priority=rule.priority,
+                    match_regex=rule.match_regex,
+                    match_prefix=rule.match_prefix,
+                    replace_regex=rule.replace_regex,
+                )
+                for rule in db_normalization_rules
+            ],
         )
-    return db_normalization_rule.first()
+    )
 
 
-def get_normalization_rule_by_match_regex(
-    db: Session, principal: Principal, match_regex: Optional[str]
-) -> NormalizationRule:
-    db_normalization_rule = db.query(NormalizationRule).filter(
-        NormalizationRule.match_regex == match_regex
+def normalize_numbers(
+    profile: CompiledNormalizationProfile,
+    direction: schema.NormalizationDirection,
+    numbers: Iterable[str],
+) -> Iterator[Tuple[str, str]]:
+    rule_type = (
+        RULE_TYPE_LOCAL_TO_E164
+        if direction == schema.NormalizationDirection.local_to_e164
+        else RULE_TYPE_E164_TO_LOCAL
     )
+    return profile.normalize_many(rule_type, numbers)
+
+
+async def normalize_ndjson_numbers(
+    profile: CompiledNormalizationProfile,
+    direction: schema.NormalizationDirection,
+    lines: AsyncIterator[bytes],
+) -> AsyncIterator[str]:
+    buffer = b''
+    async for chunk in lines:
+        buffer += chunk
+        if b'\n' not in buffer:
+            continue
+        chunk_lines = buffer.split(b'\n')
+        buffer = chunk_lines.pop()
+        for line in normalize_ndjson_lines(profile, direction, chunk_lines):
+            yield line
+    for line in normalize_ndjson_lines(profile, direction, [buffer]):
+        yield line
+
+
+def normalize_ndjson_lines(
+    profile: CompiledNormalizationProfile,
+    direction: schema.NormalizationDirection,
+    lines: List[bytes],
+) -> Iterator[str]:
+    entries: List[Tuple[Optional[str], bytes]] = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            number = loads(line)
+        except ValueError:
+            number = None
+        if isinstance(number, dict):
+            number = number.get('number')
+        entries.append((str(number) if isinstance(number, (str, int)) else None, line))
+    normalized_numbers = normalize_numbers(
+        profile, direction, (number for number, _ in entries if number is not None)
+    )
+    for number, line in entries:
+        if number is None:
+            item = dict(number=line.decode('utf-8', 'replace'), error="Invalid number")
+        else:
+            number, normalized = next(normalized_numbers)
+            item = dict(number=number, normalized=normalized)
+        yield dumps(item) + "\n"
+
+
+RULE_RELATIONS: Relations = dict(
+    profile=(NormalizationRule.__table__.c.profile_id, schema.NormalizationProfile)
+)
+
+
+def get_normalization_rules_query(principal: Principal, query: Any = None):
+    if query is None:
+        query = select([NormalizationRule.__table__])
     if principal is not None and principal.tenant_uuids:
-        db_normalization_rule = db_normalization_rule.join(NormalizationProfile).filter(
-            NormalizationProfile.tenant_uuid.in_(principal.tenant_uuids)
+        query = query.where(
+            NormalizationRule.profile_id.in_(
+                select([NormalizationProfile.id]).where(
+                    NormalizationProfile.tenant_uuid.in_(principal.tenant_uuids)
+                )
+            )
         )
-    return db_normalization_rule.first()
+    return query
 
 
-def get_normalization_rules(
-    db: Session, principal: Principal, offset: int = 0, limit: int = 100
-) -> schema.NormalizationRuleList:
-    items = db.query(NormalizationRule)
+async def get_normalization_rule(
+    db: AsyncDatabase,
+    principal: Principal,
+    normalization_rule_id: int,
+    fieldset: Optional[Fieldset] = None,
+) -> Optional[Any]:
+    projection = Projection(
+        NormalizationRule.__table__, schema.NormalizationRule, fieldset, RULE_RELATIONS
+    )
+    db_normalization_rule = get_normalization_rules_query(
+        principal, projection.select()
+    ).where(NormalizationRule.id == normalization_rule_id)
+    return projection.get_item(await db.fetch_one(db_normalization_rule.limit(1)))
+
+
+async def get_normalization_rule_by_match_regex(
+    db: AsyncDatabase, principal: Principal, match_regex: Optional[str]
+) -> Optional[Any]:
+    db_normalization_rule = get_normalization_rules_query(principal).where(
+        NormalizationRule.match_regex == match_regex
+    )
+    return await db.fetch_one(db_normalization_rule.limit(1))
+
+
+async def get_normalization_rules(
+    db: AsyncDatabase,
+    principal: Principal,
+    pagination: Optional[Pagination] = None,
+    fieldset: Optional[Fieldset] = None,
+) -> Union[schema.NormalizationRuleList, dict]:
+    projection = Projection(
+        NormalizationRule.__table__, schema.NormalizationRule, fieldset, RULE_RELATIONS
+    )
+    items = projection.select()
     if principal is not None and principal.tenant_uuid:
-        items = items.join(NormalizationProfile).filter(
-            NormalizationProfile.tenant_uuid == principal.tenant_uuid
+        items = items.where(
+            NormalizationRule.profile_id.in_(
+                select([NormalizationProfile.id]).where(
+                    NormalizationProfile.tenant_uuid == principal.tenant_uuid
+                )
+            )
         )
-    items = items.offset(offset).limit(limit).all()
-    return schema.NormalizationRuleList(items=items)
+    page = await paginate(
+        db,
+        items,
+        NormalizationRule.__table__.c.id,
+        pagination,
+        order_columns=('profile_id', 'priority', 'match_prefix'),
+    )
+    if fieldset:
+        return dict(page, items=projection.get_items(page['items']))
+    return schema.NormalizationRuleList(**page)
 
 
-def create_normalization_rule(
-    db: Session,
+@transactional
+async def create_normalization_rule(
+    db: AsyncDatabase,
     principal: Principal,
     normalization_rule: schema.NormalizationRuleCreate,
-) -> NormalizationRule:
-    profile = get_normalization_profile(db, principal, normalization_rule.profile_id)
+) -> Any:
+    profile = await get_normalization_profile(
+        db, principal, normalization_rule.profile_id
+    )
     if profile is None:
         return None
-    db_normalization_rule = NormalizationRule(
-        profile_id=normalization_rule.profile_id,
-        rule_type=normalization_rule.rule_type,
-        priority=normalization_rule.priority,
-        match_regex=normalization_rule.match_regex,
-        match_prefix=get_match_prefix_from_regex(normalization_rule.match_regex),
-        replace_regex=normalization_rule.replace_regex,
+    return await db.fetch_one(
+        NormalizationRule.__table__.insert()
+        .values(
+            profile_id=normalization_rule.profile_id,
+            rule_type=normalization_rule.rule_type,
+            priority=normalization_rule.priority,
+            match_regex=normalization_rule.match_regex,
+            match_prefix=get_match_prefix_from_regex(normalization_rule.match_regex),
+            replace_regex=normalization_rule.replace_regex,
+        )
+        .returning(*NormalizationRule.__table__.c)
     )
-    db.add(db_normalization_rule)
-    db.commit()
-    db.refresh(db_normalization_rule)
-    return db_normalization_rule
 
 
-def update_normalization_rule(
-    db: Session,
+@transactional
+async def update_normalization_rule(
+    db: AsyncDatabase,
     principal: Principal,
     normalization_rule_id: int,
     normalization_rule: schema.NormalizationRuleUpdate,
-) -> NormalizationRule:
-    db_normalization_rule = get_normalization_rule(db, principal, normalization_rule_id)
+) -> Optional[Any]:
+    db_normalization_rule = await get_normalization_rule(
+        db, principal, normalization_rule_id
+    )
     if db_normalization_rule is not None:
-        db_normalization_rule.profile_id = (
-            normalization_rule.profile_id
-            if normalization_rule.profile_id is not None
-            else db_normalization_rule.profile_id
-        )
-        db_normalization_rule.rule_type = (
-            normalization_rule.rule_type
-            if normalization_rule.rule_type is not None
-            else db_normalization_rule.rule_type
-        )
-        db_normalization_rule.priority = (
-            normalization_rule.priority
-            if normalization_rule.priority is not None
-            else db_normalization_rule.priority
-        )
-        db_normalization_rule.match_regex = (
+        match_regex = (
             normalization_rule.match_regex
             if normalization_rule.match_regex is not None
             else db_normalization_rule.match_regex
         )
-        db_normalization_rule.match_prefix = get_match_prefix_from_regex(
-            db_normalization_rule.match_regex
-        )
-        db_normalization_rule.replace_regex = (
-            normalization_rule.replace_regex
-            if normalization_rule.replace_regex is not None
-            else db_normalization_rule.replace_regex
+        db_normalization_rule = await db.fetch_one(
+            NormalizationRule.__table__.update()
+            .where(NormalizationRule.id == db_normalization_rule.id)
+            .values(
+                profile_id=(
+                    normalization_rule.profile_id
+                    if normalization_rule.profile_id is not None
+                    else db_normalization_rule.profile_id
+                ),
+                rule_type=(
+                    normalization_rule.rule_type
+                    if normalization_rule.rule_type is not None
+                    else db_normalization_rule.rule_type
+                ),
+                priority=(
+                    normalization_rule.priority
+                    if normalization_rule.priority is not None
+                    else db_normalization_rule.priority
+                ),
+                match_regex=match_regex,
+                match_prefix=get_match_prefix_from_regex(match_regex),
+                replace_regex=(
+                    normalization_rule.replace_regex
+                    if normalization_rule.replace_regex is not None
+                    else db_normalization_rule.replace_regex
+                ),
+            )
+            .returning(*NormalizationRule.__table__.c)
         )
-        db.commit()
-        db.refresh(db_normalization_rule)
     return db_normalization_rule
 
 
-def delete_normalization_rule(
-    db: Session, principal: Principal, normalization_rule_id: int
-) -> NormalizationRule:
-    db_normalization_rule = get_normalization_rule(db, principal, normalization_rule_id)
+@transactional
+async def delete_normalization_rule(
+    db: AsyncDatabase, principal: Principal, normalization_rule_id: int
+) -> Optional[Any]:
+    db_normalization_rule = await get_normalization_rule(
+        db, principal, normalization_rule_id
+    )
     if db_normalization_rule is not None:
-        db.delete(db_normalization_rule)
-        db.commit()
+        await db.execute(
+            NormalizationRule.__table__.delete().where(
+                NormalizationRule.id == db_normalization_rule.id
+            )
+        )
     return db_normalization_rule
 
 
+normalization_profile_by_id = PreparedStatement(
+    "normalization_profile_by_id",
+    "SELECT id, name, country_code, area_code, intl_prefix, ld_prefix, "
+    "always_intl_prefix_plus, always_ld FROM normalization_profiles WHERE id = $1",
+    ("integer",),
+)
+normalization_rules_by_profile_id = PreparedStatement(
+    "normalization_rules_by_profile_id",
+    "SELECT id, rule_type, priority, match_regex, match_prefix, replace_regex "
+    "FROM normalization_rules WHERE profile_id = $1 ORDER BY priority, id",
+    ("integer",),
+)
+
+
+async def get_normalization_profile_dict(
+    conn: Any, normalization_profile_id: int
+) -> dict:
+    async with conn.cursor(cursor_factory=DictCursor) as cur:
+        await normalization_profile_by_id.execute(cur, [normalization_profile_id])
+        row = await cur.fetchone()
+        if row is None:
+            return {}
+        await normalization_rules_by_profile_id.execute(cur, [normalization_profile_id])
+        rules = [dict(rule) async for rule in cur]
+        return dict(
+            id=row['id'],
+            revision=uuid4().hex,
+            name=row['name'],
+            country_code=row['country_code'],
+            area_code=row['area_code'],
+            intl_prefix=row['intl_prefix'],
+            ld_prefix=row['ld_prefix'],
+            always_intl_prefix_plus=row['always_intl_prefix_plus'],
+            always_ld=row['always_ld'],
+            rules=rules,
+        )
+
+
+def compile_normalization_profile(profile: dict) -> CompiledNormalizationProfile:
+    profile_id = profile.get('id')
+    compiled_profile = (
+        compiled_normalization_profiles.get(profile_id)
+        if profile_id is not None
+        else None
+    )
+    if (
+        compiled_profile is None
+        or compiled_profile.revision is None
+        or compiled_profile.revision != profile.get('revision')
+    ):
+        compiled_profile = CompiledNormalizationProfile(profile)
+        if profile_id is not None:
+            compiled_normalization_profiles[profile_id] = compiled_profile
+    return compiled_profile
+
+
+async def get_compiled_normalization_profile(
+    conn: Any, profile: Any
+) -> CompiledNormalizationProfile:
+    if isinstance(profile, CompiledNormalizationProfile):
+        return profile
+    return compile_normalization_profile(
+        await get_normalization_profile_dict(conn, profile.id)
+    )
+
+
 async def normalize_local_number_to_e164(
-    conn: Any, number: str, profile: Optional[NormalizationProfile] = None
+    conn: Any, number: str, profile: Optional[Any] = None
 ) -> str:
-    number = re_clean_number('', number)
-    if profile is not None:
-        prefixes = [number[:i] for i in range(0, min(10, len(number)))]
-        sql = (
-            "SELECT match_regex, replace_regex "
-            "FROM normalization_rules "
-            "WHERE profile_id = %s AND rule_type = 1 AND match_prefix = ANY(%s) "
-            "ORDER BY priority, id;"
-        )
-        rules = []
-        async with conn.cursor(cursor_factory=DictCursor) as cur:
-            await cur.execute(sql, [profile.id, prefixes])
-            async for rule in cur:
-                rules.append(rule)
-        number = normalize_apply_rules(number, rules)
-    return number
+    if profile is None:
+        return re_clean_number('', number)
+    compiled_profile = await get_compiled_normalization_profile(conn, profile)
+    return compiled_profile.normalize_local_number_to_e164(number)
 
 
 async def normalize_e164_to_local_number(
-    conn: Any, number: str, profile: Optional[NormalizationProfile] = None
+    conn: Any, number: str, profile: Optional[Any] = None
 ) -> str:
-    number = re_clean_number('', number)
-    if profile is not None:
-        prefixes = [number[:i] for i in range(0, min(10, len(number)))]
-        sql = (
-            "SELECT match_regex, replace_regex "
-            "FROM normalization_rules "
-            "WHERE profile_id = %s AND rule_type = 2 AND match_prefix = ANY(%s) "
-            "ORDER BY priority, id;"
-        )
-        rules = []
-        async with conn.cursor(cursor_factory=DictCursor) as cur:
-            await cur.execute(sql, [profile.id, prefixes])
-            async for rule in cur:
-                rules.append(rule)
-        number = normalize_apply_rules(number, rules)
-        if profile.always_intl_prefix_plus:
-            number = "+%s" % number
-    return number
+    if profile is None:
+        return re_clean_number('', number)
+    compiled_profile = await get_compiled_normalization_profile(conn, profile)
+    return compiled_profile.normalize_e164_to_local_number(number)
 
 
 def normalize_apply_rules(number: str, rules: List[dict]) -> str:
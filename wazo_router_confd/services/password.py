@@ -1,9 +1,16 @@
-from typing import Optional
-
+import asyncio
 import binascii
 import hashlib
+import multiprocessing
 import os
 
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
 
 def hash(password: Optional[str]) -> Optional[str]:
     if password is None:
@@ -14,6 +21,10 @@ def hash(password: Optional[str]) -> Optional[str]:
     return (salt + pwdhash).decode('ascii')
 
 
+def hash_all(passwords: List[Optional[str]]) -> List[Optional[str]]:
+    return [hash(password) for password in passwords]
+
+
 def hash_ha1(
     username: Optional[str], realm: Optional[str], password: Optional[str]
 ) -> Optional[str]:
@@ -31,3 +42,56 @@ def verify(stored_password: str, provided_password: str) -> bool:
     )
     pwdhash_str = binascii.hexlify(pwdhash).decode('ascii')
     return pwdhash_str == stored_password
+
+
+class PasswordHasher(object):
+    """Hash the passwords of the bulk requests on a pool of processes.
+
+    The key stretching holds the GIL, so the passwords of thousands of
+    resources are hashed in parallel by other processes. The pool is started
+    on first use, from a fork server as the service runs threads.
+    """
+
+    processes: int
+    executor: Optional[ProcessPoolExecutor]
+
+    def __init__(self, processes: Optional[int] = None):
+        self.processes = processes or os.cpu_count() or 1
+        self.executor = None
+
+    async def hash_all(self, passwords: List[Optional[str]]) -> List[Optional[str]]:
+        if len([password for password in passwords if password is not None]) <= 1:
+            return await run_in_threadpool(hash_all, passwords)
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context('forkserver')
+            )
+        # a few chunks by process, so that they end at about the same time
+        size = -(-len(passwords) // (self.processes * 4))
+        loop = asyncio.get_event_loop()
+        chunks = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    self.executor, hash_all, passwords[start : start + size]
+                )
+                for start in range(0, len(passwords), size)
+            ]
+        )
+        return [password for chunk in chunks for password in chunk]
+
+    async def stop(self):
+        if self.executor is not None:
+            executor, self.executor = self.executor, None
+            await run_in_threadpool(executor.shutdown)
+
+
+def get_password_hasher(request: Request) -> PasswordHasher:
+    return getattr(request.app, 'password_hasher')
+
+
+def setup_password_hasher(app: FastAPI, config: dict) -> FastAPI:
+    processes = config.get('password_hashing_processes')
+    hasher = PasswordHasher(int(processes) if processes else None)
+    setattr(app, 'password_hasher', hasher)
+    app.add_event_handler("shutdown", hasher.stop)
+    return app
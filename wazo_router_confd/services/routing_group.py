@@ -1,81 +1,124 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from sqlalchemy.orm import Session
+from typing import Any, Optional, Union
 
 from wazo_router_confd.auth import Principal
+from wazo_router_confd.database import AsyncDatabase, transactional
+from wazo_router_confd.fieldsets import Fieldset, Projection, Relations
 from wazo_router_confd.models.routing_group import RoutingGroup
+from wazo_router_confd.pagination import Pagination, paginate
 from wazo_router_confd.schemas import routing_group as schema
+from wazo_router_confd.schemas import routing_rule as routing_rule_schema
+from wazo_router_confd.schemas import tenant as tenant_schema
 from wazo_router_confd.services import tenant as tenant_service
 
 
-def get_routing_group(
-    db: Session, principal: Principal, routing_group_id: int
-) -> RoutingGroup:
-    db_routing_group = db.query(RoutingGroup).filter(
-        RoutingGroup.id == routing_group_id
+RELATIONS: Relations = dict(
+    tenant=(RoutingGroup.__table__.c.tenant_uuid, tenant_schema.Tenant),
+    routing_rule=(
+        RoutingGroup.__table__.c.routing_rule_id,
+        routing_rule_schema.RoutingRule,
+    ),
+)
+
+
+async def get_routing_group(
+    db: AsyncDatabase,
+    principal: Principal,
+    routing_group_id: int,
+    fieldset: Optional[Fieldset] = None,
+) -> Optional[Any]:
+    projection = Projection(
+        RoutingGroup.__table__, schema.RoutingGroup, fieldset, RELATIONS
     )
+    db_routing_group = projection.select().where(RoutingGroup.id == routing_group_id)
     if principal is not None and principal.tenant_uuids:
-        db_routing_group = db_routing_group.filter(
+        db_routing_group = db_routing_group.where(
             RoutingGroup.tenant_uuid.in_(principal.tenant_uuids)
         )
-    return db_routing_group.first()
+    return projection.get_item(await db.fetch_one(db_routing_group.limit(1)))
 
 
-def get_routing_groups(
-    db: Session, principal: Principal, offset: int = 0, limit: int = 100
-) -> schema.RoutingGroupList:
-    items = db.query(RoutingGroup)
+async def get_routing_groups(
+    db: AsyncDatabase,
+    principal: Principal,
+    pagination: Optional[Pagination] = None,
+    fieldset: Optional[Fieldset] = None,
+) -> Union[schema.RoutingGroupList, dict]:
+    projection = Projection(
+        RoutingGroup.__table__, schema.RoutingGroup, fieldset, RELATIONS
+    )
+    items = projection.select()
     if principal is not None and principal.tenant_uuid:
-        items = items.filter(RoutingGroup.tenant_uuid == principal.tenant_uuid)
-    items = items.offset(offset).limit(limit).all()
-    return schema.RoutingGroupList(items=items)
+        items = items.where(RoutingGroup.tenant_uuid == principal.tenant_uuid)
+    page = await paginate(
+        db,
+        items,
+        RoutingGroup.__table__.c.id,
+        pagination,
+        order_columns=('routing_rule_id',),
+    )
+    if fieldset:
+        return dict(page, items=projection.get_items(page['items']))
+    return schema.RoutingGroupList(**page)
 
 
-def create_routing_group(
-    db: Session, principal: Principal, routing_group: schema.RoutingGroupCreate
-) -> RoutingGroup:
-    routing_group.tenant_uuid = tenant_service.get_uuid(
+@transactional
+async def create_routing_group(
+    db: AsyncDatabase, principal: Principal, routing_group: schema.RoutingGroupCreate
+) -> Any:
+    routing_group.tenant_uuid = await tenant_service.get_uuid(
         principal, db, routing_group.tenant_uuid
     )
-    db_routing_group = RoutingGroup(
-        routing_rule_id=routing_group.routing_rule_id,
-        tenant_uuid=routing_group.tenant_uuid,
+    return await db.fetch_one(
+        RoutingGroup.__table__.insert()
+        .values(
+            routing_rule_id=routing_group.routing_rule_id,
+            tenant_uuid=routing_group.tenant_uuid,
+        )
+        .returning(*RoutingGroup.__table__.c)
     )
-    db.add(db_routing_group)
-    db.commit()
-    db.refresh(db_routing_group)
-    return db_routing_group
 
 
-def update_routing_group(
-    db: Session,
+@transactional
+async def update_routing_group(
+    db: AsyncDatabase,
     principal: Principal,
     routing_group_id: int,
     routing_group: schema.RoutingGroupUpdate,
-) -> RoutingGroup:
-    db_routing_group = get_routing_group(db, principal, routing_group_id)
+) -> Optional[Any]:
+    db_routing_group = await get_routing_group(db, principal, routing_group_id)
     if db_routing_group is not None:
-        db_routing_group.routing_rule_id = (
-            routing_group.routing_rule_id
-            if routing_group.routing_rule_id is not None
-            else db_routing_group.routing_rule_id
+        db_routing_group = await db.fetch_one(
+            RoutingGroup.__table__.update()
+            .where(RoutingGroup.id == db_routing_group.id)
+            .values(
+                routing_rule_id=(
+                    routing_group.routing_rule_id
+                    if routing_group.routing_rule_id is not None
+                    else db_routing_group.routing_rule_id
+                ),
+                tenant_uuid=(
+                    routing_group.tenant_uuid
+                    if routing_group.tenant_uuid is not None
+                    else db_routing_group.tenant_uuid
+                ),
+            )
+            .returning(*RoutingGroup.__table__.c)
         )
-        db_routing_group.tenant_uuid = (
-            routing_group.tenant_uuid
-            if routing_group.tenant_uuid is not None
-            else db_routing_group.tenant_uuid
-        )
-        db.commit()
-        db.refresh(db_routing_group)
     return db_routing_group
 
 
-def delete_routing_group(
-    db: Session, principal: Principal, routing_group_id: int
-) -> RoutingGroup:
-    db_routing_group = get_routing_group(db, principal, routing_group_id)
+@transactional
+async def delete_routing_group(
+    db: AsyncDatabase, principal: Principal, routing_group_id: int
+) -> Optional[Any]:
+    db_routing_group = await get_routing_group(db, principal, routing_group_id)
     if db_routing_group is not None:
-        db.delete(db_routing_group)
-        db.commit()
+        await db.execute(
+            RoutingGroup.__table__.delete().where(
+                RoutingGroup.id == db_routing_group.id
+            )
+        )
     return db_routing_group
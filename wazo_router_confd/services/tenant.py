@@ -3,77 +3,112 @@
 
 from json import dumps
 from pydantic import UUID4
-from typing import Optional
+from typing import Any, Iterable, Optional, Tuple, Union
 from uuid import uuid4, UUID
 
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
 
 from wazo_router_confd.auth import Principal
+from wazo_router_confd.database import AsyncDatabase, transactional
+from wazo_router_confd.fieldsets import Fieldset, Projection
 from wazo_router_confd.models.tenant import Tenant
+from wazo_router_confd.pagination import Pagination, paginate
 from wazo_router_confd.schemas import tenant as schema
 
 
-def get_tenant(db: Session, principal: Principal, tenant_uuid: UUID4) -> Tenant:
-    tenant = db.query(Tenant).filter(Tenant.uuid == tenant_uuid)
+async def get_tenant(
+    db: AsyncDatabase,
+    principal: Principal,
+    tenant_uuid: UUID4,
+    fieldset: Optional[Fieldset] = None,
+) -> Optional[Any]:
+    projection = Projection(Tenant.__table__, schema.Tenant, fieldset)
+    tenant = projection.select().where(Tenant.uuid == tenant_uuid)
     if principal is not None and principal.tenant_uuids:
-        tenant = tenant.filter(Tenant.uuid.in_(principal.tenant_uuids))
-    return tenant.first()
+        tenant = tenant.where(Tenant.uuid.in_(principal.tenant_uuids))
+    return projection.get_item(await db.fetch_one(tenant.limit(1)))
 
 
-def get_tenant_by_name(db: Session, principal: Principal, name: str) -> Tenant:
-    tenant = db.query(Tenant).filter(Tenant.name == name)
+async def get_tenant_by_name(
+    db: AsyncDatabase, principal: Principal, name: str
+) -> Optional[Any]:
+    tenant = select([Tenant.__table__]).where(Tenant.name == name)
     if principal is not None and principal.tenant_uuids:
-        tenant = tenant.filter(Tenant.uuid.in_(principal.tenant_uuids))
-    return tenant.first()
+        tenant = tenant.where(Tenant.uuid.in_(principal.tenant_uuids))
+    return await db.fetch_one(tenant.limit(1))
 
 
-def get_tenant_by_uuid(db: Session, uuid: str) -> Tenant:
-    return db.query(Tenant).filter(Tenant.uuid == uuid).first()
+async def get_tenant_by_uuid(db: AsyncDatabase, uuid: str) -> Optional[Any]:
+    return await db.fetch_one(
+        select([Tenant.__table__]).where(Tenant.uuid == uuid).limit(1)
+    )
 
 
-def get_tenants(
-    db: Session, principal: Principal, offset: int = 0, limit: int = 100
-) -> schema.TenantList:
-    items = db.query(Tenant)
+async def get_tenants(
+    db: AsyncDatabase,
+    principal: Principal,
+    pagination: Optional[Pagination] = None,
+    fieldset: Optional[Fieldset] = None,
+) -> Union[schema.TenantList, dict]:
+    projection = Projection(Tenant.__table__, schema.Tenant, fieldset)
+    items = projection.select()
     if principal is not None and principal.tenant_uuid:
-        items = items.filter(Tenant.uuid == principal.tenant_uuid)
-    items = items.offset(offset).limit(limit).all()
-    return schema.TenantList(items=items)
-
-
-def create_tenant(
-    db: Session, principal: Principal, tenant: schema.TenantCreate
-) -> Tenant:
-    tenant.uuid = get_uuid(principal, db, tenant.uuid, create=False)
-    db_tenant = Tenant(name=tenant.name, uuid=tenant.uuid or uuid4().hex)
-    db.add(db_tenant)
-    db.commit()
-    db.refresh(db_tenant)
-    return db_tenant
-
-
-def update_tenant(
-    db: Session, principal: Principal, tenant_uuid: UUID4, tenant: schema.TenantUpdate
-) -> Tenant:
-    db_tenant = get_tenant(db, principal, tenant_uuid)
+        items = items.where(Tenant.uuid == principal.tenant_uuid)
+    page = await paginate(
+        db, items, Tenant.__table__.c.uuid, pagination, order_columns=('name',)
+    )
+    if fieldset:
+        return dict(page, items=projection.get_items(page['items']))
+    return schema.TenantList(**page)
+
+
+@transactional
+async def create_tenant(
+    db: AsyncDatabase, principal: Principal, tenant: schema.TenantCreate
+) -> Any:
+    tenant.uuid = await get_uuid(principal, db, tenant.uuid, create=False)
+    return await db.fetch_one(
+        Tenant.__table__.insert()
+        .values(name=tenant.name, uuid=tenant.uuid or uuid4().hex)
+        .returning(*Tenant.__table__.c)
+    )
+
+
+@transactional
+async def update_tenant(
+    db: AsyncDatabase,
+    principal: Principal,
+    tenant_uuid: UUID4,
+    tenant: schema.TenantUpdate,
+) -> Optional[Any]:
+    db_tenant = await get_tenant(db, principal, tenant_uuid)
     if db_tenant is not None:
-        db_tenant.name = tenant.name
-        db.commit()
-        db.refresh(db_tenant)
+        db_tenant = await db.fetch_one(
+            Tenant.__table__.update()
+            .where(Tenant.uuid == db_tenant.uuid)
+            .values(name=tenant.name)
+            .returning(*Tenant.__table__.c)
+        )
     return db_tenant
 
 
-def delete_tenant(db: Session, principal: Principal, tenant_uuid: UUID4) -> Tenant:
-    db_tenant = get_tenant(db, principal, tenant_uuid)
+@transactional
+async def delete_tenant(
+    db: AsyncDatabase, principal: Principal, tenant_uuid: UUID4
+) -> Optional[Any]:
+    db_tenant = await get_tenant(db, principal, tenant_uuid)
     if db_tenant is not None:
-        db.delete(db_tenant)
-        db.commit()
+        await db.execute(Tenant.__table__.delete().where(Tenant.uuid == db_tenant.uuid))
     return db_tenant
 
 
-def get_uuid(
-    principal: Principal, db: Session, tenant_uuid: Optional[UUID], create: bool = True
+async def get_uuid(
+    principal: Principal,
+    db: AsyncDatabase,
+    tenant_uuid: Optional[UUID],
+    create: bool = True,
 ) -> UUID4:
     if principal is None:
         if tenant_uuid is None:
@@ -98,7 +133,32 @@ def get_uuid(
         )
     else:
         tenant_uuid = UUID4(principal.tenant_uuid)
-    if create and get_tenant_by_uuid(db, str(tenant_uuid)) is None:
+    if create and await get_tenant_by_uuid(db, str(tenant_uuid)) is None:
         tenant = schema.TenantCreate(name=str(tenant_uuid), uuid=tenant_uuid)
-        create_tenant(db, principal, tenant)
+        await create_tenant(db, principal, tenant)
     return tenant_uuid
+
+
+def get_bulk_uuid(
+    principal: Principal, tenant_uuid: Optional[UUID]
+) -> Tuple[Optional[UUID], Optional[str]]:
+    """The tenant of a resource of a bulk request, or why it is refused.
+
+    The same rules as `get_uuid`, reported instead of raised.
+    """
+    if principal is None:
+        if tenant_uuid is None:
+            return None, "Missing tenant_uuid"
+    elif tenant_uuid is not None and tenant_uuid != UUID(principal.tenant_uuid):
+        return None, "Token not valid for tenant_uuid %s" % tenant_uuid
+    else:
+        tenant_uuid = UUID(principal.tenant_uuid)
+    return tenant_uuid, None
+
+
+async def create_missing_tenants(db: AsyncDatabase, tenant_uuids: Iterable[UUID]):
+    values = [dict(uuid=uuid, name=str(uuid)) for uuid in sorted(set(tenant_uuids))]
+    if values:
+        await db.execute(
+            insert(Tenant.__table__).values(values).on_conflict_do_nothing()
+        )
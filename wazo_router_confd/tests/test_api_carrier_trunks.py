@@ -175,7 +175,9 @@ def test_get_carrier_trunks(app, client):
                 'expire_seconds': 3600,
                 'retry_seconds': 30,
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
@@ -305,3 +307,101 @@ def test_delete_carrier_trunk(app, client):
 def test_delete_carrier_trunk_not_found(app, client):
     response = client.delete("/1.0/carrier_trunks/1")
     assert response.status_code == 404
+
+
+def test_create_carrier_trunks(app, client):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.carrier import Carrier
+    from wazo_router_confd.models.carrier_trunk import CarrierTrunk
+    from wazo_router_confd.models.tenant import Tenant
+    from wazo_router_confd.services import password
+
+    tenant = Tenant(name="tenant", uuid="3ab844af-8039-45d9-a3aa-bae6f298228f")
+    other_tenant = Tenant(name="other", uuid="ffffffff-8039-45d9-a3aa-bae6f298228f")
+    carrier = Carrier(name="carrier", tenant=tenant)
+    other_carrier = Carrier(name="other", tenant=other_tenant)
+    carrier_trunk = CarrierTrunk(
+        name='existing', carrier=carrier, sip_proxy='proxy.somedomain.com'
+    )
+    session = SessionLocal(bind=app.engine)
+    session.add_all([tenant, other_tenant, carrier, other_carrier, carrier_trunk])
+    session.commit()
+    #
+    response = client.post(
+        "/1.0/carrier_trunks/bulk",
+        json=[
+            {
+                "name": name,
+                "tenant_uuid": str(tenant.uuid),
+                "carrier_id": carrier_id,
+                "sip_proxy": "proxy.somedomain.com",
+                "auth_username": "user",
+                "auth_password": "pass",
+            }
+            for name, carrier_id in [
+                ("carrier_trunk1", carrier.id),
+                ("carrier_trunk2", other_carrier.id),
+                ("existing", carrier.id),
+                ("carrier_trunk1", carrier.id),
+                ("carrier_trunk3", carrier.id),
+            ]
+        ],
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert [item['name'] for item in result['items']] == [
+        "carrier_trunk1",
+        "carrier_trunk3",
+    ]
+    assert result['errors'] == [
+        {"index": 1, "message": "Carrier not found"},
+        {"index": 2, "message": "Duplicated name"},
+        {"index": 3, "message": "Duplicated name"},
+    ]
+    db_carrier_trunk = (
+        session.query(CarrierTrunk).filter(CarrierTrunk.name == 'carrier_trunk3').one()
+    )
+    assert password.verify(db_carrier_trunk.auth_password, "pass")
+
+
+def test_update_carrier_trunks(app, client):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.carrier import Carrier
+    from wazo_router_confd.models.carrier_trunk import CarrierTrunk
+    from wazo_router_confd.models.tenant import Tenant
+    from wazo_router_confd.services import password
+
+    tenant = Tenant(name="tenant", uuid="3ab844af-8039-45d9-a3aa-bae6f298228f")
+    carrier = Carrier(name="carrier", tenant=tenant)
+    carrier_trunks = [
+        CarrierTrunk(name='carrier_trunk%d' % i, carrier=carrier, sip_proxy='proxy.com')
+        for i in range(2)
+    ]
+    session = SessionLocal(bind=app.engine)
+    session.add_all([tenant, carrier] + carrier_trunks)
+    session.commit()
+    #
+    response = client.put(
+        "/1.0/carrier_trunks/bulk",
+        json=[
+            {
+                "id": carrier_trunks[0].id,
+                "name": "carrier_trunk0",
+                "sip_proxy": "newproxy.com",
+                "auth_password": "newpass",
+            },
+            {
+                "id": carrier_trunks[1].id,
+                "name": "carrier_trunk0",
+                "sip_proxy": "proxy.com",
+            },
+        ],
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert [(item['id'], item['sip_proxy']) for item in result['items']] == [
+        (carrier_trunks[0].id, "newproxy.com")
+    ]
+    assert result['errors'] == [{"index": 1, "message": "Duplicated name"}]
+    session.expire_all()
+    assert password.verify(carrier_trunks[0].auth_password, "newpass")
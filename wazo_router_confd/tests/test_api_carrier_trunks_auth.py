@@ -175,7 +175,9 @@ def test_get_carrier_trunks(app_auth, client_auth_with_token):
                 'expire_seconds': 3600,
                 'retry_seconds': 30,
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
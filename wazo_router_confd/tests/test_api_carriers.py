@@ -82,7 +82,9 @@ def test_get_carriers(app, client):
     assert response.json() == {
         "items": [
             {'id': carrier.id, 'name': 'carrier1', 'tenant_uuid': str(tenant.uuid)}
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
@@ -82,7 +82,9 @@ def test_get_carriers(app_auth, client_auth_with_token):
     assert response.json() == {
         "items": [
             {'id': carrier.id, 'name': 'carrier1', 'tenant_uuid': str(tenant.uuid)}
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
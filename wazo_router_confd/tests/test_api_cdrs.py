@@ -117,7 +117,9 @@ def test_get_cdrs(app, client):
                 "call_start": "2019-09-01T00:00:00",
                 "tenant_uuid": str(tenant.uuid),
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
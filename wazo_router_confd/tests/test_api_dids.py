@@ -1,6 +1,8 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import json
+
 from unittest import mock
 
 
@@ -191,7 +193,9 @@ def test_get_dids(app, client):
                 "ipbx_id": ipbx.id,
                 "carrier_trunk_id": carrier_trunk.id,
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
@@ -338,3 +342,176 @@ def test_delete_did(app, client):
 def test_delete_did_not_found(app, client):
     response = client.delete("/1.0/dids/1")
     assert response.status_code == 404
+
+
+def test_import_dids(app, client):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.carrier import Carrier
+    from wazo_router_confd.models.carrier_trunk import CarrierTrunk
+    from wazo_router_confd.models.did import DID
+    from wazo_router_confd.models.domain import Domain
+    from wazo_router_confd.models.tenant import Tenant
+    from wazo_router_confd.models.ipbx import IPBX
+
+    session = SessionLocal(bind=app.engine)
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    domain = Domain(domain='testdomain.com', tenant=tenant)
+    ipbx = IPBX(
+        tenant=tenant,
+        domain=domain,
+        customer=1,
+        ip_fqdn='mypbx.com',
+        registered=True,
+        username='user',
+        password='password',
+    )
+    carrier = Carrier(name='carrier', tenant=tenant)
+    carrier_trunk = CarrierTrunk(
+        name='carrier_trunk1', carrier=carrier, sip_proxy='proxy.somedomain.com'
+    )
+    session.add_all([tenant, domain, ipbx, carrier, carrier_trunk])
+    session.commit()
+    #
+    rows = [
+        "tenant_uuid,ipbx_id,carrier_trunk_id,did_regex",
+        "%s,%s,%s,^39123\\d+$" % (tenant.uuid, ipbx.id, carrier_trunk.id),
+        "%s,%s,%s,^39456(" % (tenant.uuid, ipbx.id, carrier_trunk.id),
+        "%s,%s,%s,^39789\\d+$" % (tenant.uuid, ipbx.id + 1, carrier_trunk.id),
+        "%s,%s,%s,^39123\\d+$" % (tenant.uuid, ipbx.id, carrier_trunk.id),
+        "%s,%s,%s,^39000\\d+$" % (tenant.uuid, ipbx.id, carrier_trunk.id),
+    ]
+    response = client.post(
+        "/1.0/dids/bulk",
+        data='\r\n'.join(rows),
+        headers={'Content-Type': 'text/csv'},
+        params={'dry_run': True},
+    )
+    assert response.status_code == 200
+    assert response.json()['created'] == 2
+    assert session.query(DID).count() == 0
+    #
+    response = client.post(
+        "/1.0/dids/bulk", data='\r\n'.join(rows), headers={'Content-Type': 'text/csv'}
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert result['created'] == 2
+    assert result['updated'] == 0
+    assert result['error_count'] == 3
+    assert [(error['line'], error['message']) for error in result['errors']] == [
+        (3, "Invalid did_regex: missing ), unterminated subpattern at position 6"),
+        (4, "IPBX not found"),
+        (5, "Duplicated did_regex in the import"),
+    ]
+    dids = session.query(DID).order_by(DID.did_regex).all()
+    assert [(did.did_regex, did.did_prefix) for did in dids] == [
+        (r"^39000\d+$", "39000"),
+        (r"^39123\d+$", "39123"),
+    ]
+    #
+    carrier_trunk2 = CarrierTrunk(
+        name='carrier_trunk2', carrier=carrier, sip_proxy='proxy2.somedomain.com'
+    )
+    session.add(carrier_trunk2)
+    session.commit()
+    ndjson = '\n'.join(
+        '{"ipbx_id": %s, "carrier_trunk_id": %s, "did_regex": "%s", '
+        '"tenant_uuid": "%s"}' % (ipbx.id, carrier_trunk2.id, regex, tenant.uuid)
+        for regex in (r"^39123\\d+$", r"^39555\\d+$")
+    )
+    response = client.post(
+        "/1.0/dids/bulk", data=ndjson, headers={'Content-Type': 'application/x-ndjson'}
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert (result['created'], result['updated']) == (1, 0)
+    assert result['errors'] == [
+        {"line": 1, "did_regex": r"^39123\d+$", "message": "Duplicated did_regex"}
+    ]
+    #
+    response = client.post(
+        "/1.0/dids/bulk",
+        data=ndjson,
+        headers={'Content-Type': 'application/x-ndjson'},
+        params={'on_conflict': 'update'},
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert (result['created'], result['updated'], result['errors']) == (0, 2, [])
+    session.expire_all()
+    assert (
+        session.query(DID).filter(DID.carrier_trunk_id == carrier_trunk2.id).count()
+        == 2
+    )
+
+
+def test_import_dids_invalid(app, client):
+    response = client.post("/1.0/dids/bulk", params={'on_conflict': 'replace'})
+    assert response.status_code == 400
+    response = client.post(
+        "/1.0/dids/bulk", data=b'\xff\xfe', headers={'Content-Type': 'text/csv'}
+    )
+    assert response.status_code == 400
+
+
+def test_export_dids(app, client):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.carrier import Carrier
+    from wazo_router_confd.models.carrier_trunk import CarrierTrunk
+    from wazo_router_confd.models.did import DID
+    from wazo_router_confd.models.domain import Domain
+    from wazo_router_confd.models.tenant import Tenant
+    from wazo_router_confd.models.ipbx import IPBX
+
+    session = SessionLocal(bind=app.engine)
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    domain = Domain(domain='testdomain.com', tenant=tenant)
+    ipbx = IPBX(
+        tenant=tenant,
+        domain=domain,
+        customer=1,
+        ip_fqdn='mypbx.com',
+        registered=True,
+        username='user',
+        password='password',
+    )
+    carrier = Carrier(name='carrier', tenant=tenant)
+    carrier_trunk = CarrierTrunk(
+        name='carrier_trunk1', carrier=carrier, sip_proxy='proxy.somedomain.com'
+    )
+    dids = [
+        DID(
+            did_regex=r'^3912%d\d+$' % i,
+            tenant=tenant,
+            ipbx=ipbx,
+            carrier_trunk=carrier_trunk,
+        )
+        for i in range(3)
+    ]
+    session.add_all([tenant, domain, ipbx, carrier, carrier_trunk] + dids)
+    session.commit()
+    #
+    with mock.patch('wazo_router_confd.services.did.EXPORT_BATCH_SIZE', 2):
+        response = client.get("/1.0/dids/bulk")
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/csv')
+    assert response.text.splitlines() == [
+        "id,tenant_uuid,ipbx_id,carrier_trunk_id,did_regex"
+    ] + [
+        "%s,%s,%s,%s,%s"
+        % (did.id, tenant.uuid, ipbx.id, carrier_trunk.id, did.did_regex)
+        for did in dids
+    ]
+    #
+    response = client.get("/1.0/dids/bulk", params={'format': 'ndjson'})
+    assert response.status_code == 200
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {
+            "id": did.id,
+            "tenant_uuid": str(tenant.uuid),
+            "ipbx_id": ipbx.id,
+            "carrier_trunk_id": carrier_trunk.id,
+            "did_regex": did.did_regex,
+        }
+        for did in dids
+    ]
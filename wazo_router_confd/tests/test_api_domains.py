@@ -88,7 +88,9 @@ def test_get_domains(app, client):
                 'domain': 'testdomain.com',
                 'tenant_uuid': str(tenant.uuid),
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
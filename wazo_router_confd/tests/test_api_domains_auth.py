@@ -88,7 +88,9 @@ def test_get_domains(app_auth, client_auth_with_token):
                 'domain': 'testdomain.com',
                 'tenant_uuid': str(tenant.uuid),
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
@@ -114,7 +114,9 @@ def test_get_ipbxs(app, client):
                 "username": "user",
                 "realm": "realm",
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
@@ -272,3 +274,119 @@ def test_delete_ipbx(app, client):
 def test_delete_ipbx_not_found(app, client):
     response = client.delete("/1.0/ipbxs/1")
     assert response.status_code == 404
+
+
+def test_create_ipbxs(app, client):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.domain import Domain
+    from wazo_router_confd.models.ipbx import IPBX
+    from wazo_router_confd.models.tenant import Tenant
+    from wazo_router_confd.services import password
+
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    other_tenant = Tenant(name='other', uuid='ffffffff-b481-41bb-a41a-75d1cc25ff34')
+    domain = Domain(domain='testdomain.com', tenant=tenant)
+    other_domain = Domain(domain='otherdomain.com', tenant=other_tenant)
+    ipbx = IPBX(
+        tenant=tenant,
+        domain=domain,
+        ip_fqdn='mypbx.com',
+        username='existing',
+        password='password',
+    )
+    session = SessionLocal(bind=app.engine)
+    session.add_all([tenant, other_tenant, domain, other_domain, ipbx])
+    session.commit()
+    #
+    ipbxs = [
+        {
+            "tenant_uuid": str(tenant.uuid),
+            "domain_id": domain_id,
+            "ip_fqdn": "mypbx%d.com" % i,
+            "username": username,
+            "password": "password%d" % i,
+        }
+        for i, (domain_id, username) in enumerate(
+            [
+                (domain.id, "user1"),
+                (other_domain.id, "user2"),
+                (domain.id, "existing"),
+                (domain.id, "user1"),
+                (domain.id, "user3"),
+            ]
+        )
+    ]
+    response = client.post("/1.0/ipbxs/bulk", json=ipbxs)
+    assert response.status_code == 200
+    result = response.json()
+    assert [item['username'] for item in result['items']] == ["user1", "user3"]
+    assert result['errors'] == [
+        {"index": 1, "message": "Domain not found"},
+        {"index": 2, "message": "Duplicated username"},
+        {"index": 3, "message": "Duplicated username"},
+    ]
+    db_ipbx = session.query(IPBX).filter(IPBX.username == 'user3').one()
+    assert password.verify(db_ipbx.password, "password4")
+    assert db_ipbx.password_ha1 == password.hash_ha1(
+        "user3", "testdomain.com", "password4"
+    )
+
+
+def test_update_ipbxs(app, client):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.domain import Domain
+    from wazo_router_confd.models.ipbx import IPBX
+    from wazo_router_confd.models.tenant import Tenant
+    from wazo_router_confd.services import password
+
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    domain = Domain(domain='testdomain.com', tenant=tenant)
+    ipbxs = [
+        IPBX(
+            tenant=tenant,
+            domain=domain,
+            ip_fqdn='mypbx%d.com' % i,
+            username='user%d' % i,
+            password='password',
+        )
+        for i in range(3)
+    ]
+    session = SessionLocal(bind=app.engine)
+    session.add_all([tenant, domain] + ipbxs)
+    session.commit()
+    #
+    response = client.put(
+        "/1.0/ipbxs/bulk",
+        json=[
+            {
+                "id": ipbxs[0].id,
+                "domain_id": domain.id,
+                "ip_fqdn": "newpbx.com",
+                "password": "newpassword",
+            },
+            {
+                "id": ipbxs[1].id,
+                "domain_id": domain.id,
+                "ip_fqdn": "mypbx1.com",
+                "username": "user2",
+            },
+            {"id": ipbxs[2].id, "domain_id": domain.id, "ip_fqdn": "mypbx2.com"},
+            {"id": ipbxs[2].id + 1, "domain_id": domain.id, "ip_fqdn": "mypbx.com"},
+        ],
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert [(item['id'], item['ip_fqdn']) for item in result['items']] == [
+        (ipbxs[0].id, "newpbx.com"),
+        (ipbxs[2].id, "mypbx2.com"),
+    ]
+    assert result['errors'] == [
+        {"index": 1, "message": "Duplicated username"},
+        {"index": 3, "message": "IPBX not found"},
+    ]
+    session.expire_all()
+    assert password.verify(ipbxs[0].password, "newpassword")
+    assert ipbxs[0].password_ha1 == password.hash_ha1(
+        "user0", "testdomain.com", "newpassword"
+    )
+    assert ipbxs[1].username == "user1"
@@ -114,7 +114,9 @@ def test_get_ipbxs(app_auth, client_auth_with_token):
                 "username": "user",
                 "realm": "realm",
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
@@ -165,3 +165,91 @@ def test_kamailio_routing_did_with_no_matching_ipbx(app, client):
     )
     assert response.status_code == 200
     assert response.json() == {"auth": None, "rtjson": {"success": False}}
+
+
+def test_kamailio_routing_did_with_normalization_rules(app, client):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.carrier import Carrier
+    from wazo_router_confd.models.carrier_trunk import CarrierTrunk
+    from wazo_router_confd.models.domain import Domain
+    from wazo_router_confd.models.tenant import Tenant
+    from wazo_router_confd.models.ipbx import IPBX
+    from wazo_router_confd.models.did import DID
+    from wazo_router_confd.models.normalization import NormalizationProfile
+    from wazo_router_confd.models.normalization import NormalizationRule
+
+    session = SessionLocal(bind=app.engine)
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    domain = Domain(domain='testdomain.com', tenant=tenant)
+    normalization_profile = NormalizationProfile(
+        tenant=tenant,
+        name='Profile',
+        country_code='39',
+        area_code='040',
+        intl_prefix='00',
+        ld_prefix='',
+        always_intl_prefix_plus=False,
+        always_ld=False,
+    )
+    normalization_rule = NormalizationRule(
+        profile=normalization_profile,
+        rule_type=2,
+        priority=0,
+        match_regex=r'^39(.+)',
+        match_prefix='39',
+        replace_regex=r'0\1',
+    )
+    ipbx = IPBX(
+        tenant=tenant,
+        domain=domain,
+        normalization_profile=normalization_profile,
+        customer=1,
+        ip_fqdn='mypbx.com',
+        registered=True,
+        username='user',
+        password='password',
+    )
+    carrier = Carrier(name='carrier', tenant=tenant)
+    carrier_trunk = CarrierTrunk(
+        name='carrier_trunk1', carrier=carrier, sip_proxy='proxy.somedomain.com'
+    )
+    did = DID(
+        did_regex=r'^39[0-9]+$',
+        did_prefix='39',
+        tenant=tenant,
+        ipbx=ipbx,
+        carrier_trunk=carrier_trunk,
+    )
+    session.add_all(
+        [
+            tenant,
+            domain,
+            normalization_profile,
+            normalization_rule,
+            ipbx,
+            carrier,
+            carrier_trunk,
+            did,
+        ]
+    )
+    session.commit()
+    #
+    response = client.post(
+        "/1.0/kamailio/routing",
+        json={
+            "event": "sip-routing",
+            "source_ip": "10.0.0.1",
+            "source_port": 5060,
+            "call_id": "call-id",
+            "from_name": "From name",
+            "from_uri": "sip:100@sourcedomain.com",
+            "to_uri": "sip:39123456789@dummy.com",
+            "to_name": "to name",
+        },
+    )
+    assert response.status_code == 200
+    routes = response.json()['rtjson']['routes']
+    assert len(routes) == 1
+    assert routes[0]['dst_uri'] == "sip:mypbx.com:5060"
+    assert routes[0]['headers']['from']['uri'] == "sip:100@sourcedomain.com"
+    assert routes[0]['headers']['to']['uri'] == "sip:0123456789@dummy.com"
@@ -1,6 +1,8 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import json
+
 from unittest import mock
 
 
@@ -115,7 +117,9 @@ def test_get_normalization_profiles(app, client):
                 "always_ld": False,
                 "always_intl_prefix_plus": False,
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
@@ -190,3 +194,92 @@ def test_delete_normalization_profile(app, client):
 def test_delete_normalization_profile_not_found(app, client):
     response = client.delete("/1.0/normalization-profiles/1")
     assert response.status_code == 404
+
+
+def test_normalize_numbers(app, client):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.normalization import NormalizationProfile
+    from wazo_router_confd.models.normalization import NormalizationRule
+    from wazo_router_confd.models.tenant import Tenant
+
+    session = SessionLocal(bind=app.engine)
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    normalization_profile = NormalizationProfile(
+        name='profile 1', tenant=tenant, always_intl_prefix_plus=True
+    )
+    normalization_rules = [
+        NormalizationRule(
+            profile=normalization_profile,
+            rule_type=1,
+            match_regex=r'^0(.+)',
+            match_prefix='0',
+            replace_regex=r'39\1',
+        ),
+        NormalizationRule(
+            profile=normalization_profile,
+            rule_type=2,
+            match_regex=r'^39(.+)',
+            match_prefix='39',
+            replace_regex=r'0\1',
+        ),
+    ]
+    session.add_all([tenant, normalization_profile] + normalization_rules)
+    session.commit()
+    #
+    response = client.post(
+        "/1.0/normalization-profiles/%s/normalize" % normalization_profile.id,
+        json={"direction": "local_to_e164", "numbers": ["011 625234", "44123"]},
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "items": [
+            {"number": "011 625234", "normalized": "3911625234"},
+            {"number": "44123", "normalized": "44123"},
+        ]
+    }
+    #
+    response = client.post(
+        "/1.0/normalization-profiles/%s/normalize" % normalization_profile.id,
+        params={"direction": "e164_to_local"},
+        data='"3911625234"\n{"number": "44123"}\n[]\n',
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert response.headers['content-type'] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {"number": "3911625234", "normalized": "+011625234"},
+        {"number": "44123", "normalized": "+44123"},
+        {"number": "[]", "error": "Invalid number"},
+    ]
+
+
+def test_normalize_numbers_invalid_request(app, client):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.normalization import NormalizationProfile
+    from wazo_router_confd.models.tenant import Tenant
+
+    session = SessionLocal(bind=app.engine)
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    normalization_profile = NormalizationProfile(name='profile 1', tenant=tenant)
+    session.add_all([tenant, normalization_profile])
+    session.commit()
+    #
+    response = client.post(
+        "/1.0/normalization-profiles/%s/normalize" % normalization_profile.id,
+        json={"direction": "sideways", "numbers": ["011 625234"]},
+    )
+    assert response.status_code == 422
+    response = client.post(
+        "/1.0/normalization-profiles/%s/normalize" % normalization_profile.id,
+        data='"3911625234"\n',
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 400
+
+
+def test_normalize_numbers_not_found(app, client):
+    response = client.post(
+        "/1.0/normalization-profiles/1/normalize",
+        json={"direction": "local_to_e164", "numbers": ["011 625234"]},
+    )
+    assert response.status_code == 404
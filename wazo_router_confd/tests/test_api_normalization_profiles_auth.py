@@ -117,7 +117,9 @@ def test_get_normalization_profiles(app_auth, client_auth_with_token):
                 "always_ld": False,
                 "always_intl_prefix_plus": False,
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
@@ -130,7 +130,9 @@ def test_get_normalization_rules(app, client):
                 "match_regex": "^11",
                 "replace_regex": '',
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
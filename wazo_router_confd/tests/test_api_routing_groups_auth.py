@@ -104,7 +104,9 @@ def test_get_routing_groups(app_auth, client_auth_with_token):
                 "routing_rule_id": routing_rule.id,
                 "tenant_uuid": str(tenant.uuid),
             }
-        ]
+        ],
+        "total": None,
+        "next": None,
     }
 
 
@@ -5,3 +5,79 @@
 def test_api_status(client):
     response = client.get("/status")
     assert response.status_code == 204
+
+
+def test_api_status_pools(client):
+    response = client.get("/1.0/ipbxs")
+    assert response.status_code == 200
+    response = client.get("/status/pools")
+    assert response.status_code == 200
+    pools = response.json()
+    assert pools['aiopg']['min_size'] == 1
+    assert pools['aiopg']['max_size'] == 10
+    assert pools['aiopg']['acquired'] >= 1
+    assert pools['aiopg']['in_use'] + pools['aiopg']['idle'] == pools['aiopg']['size']
+    assert pools['sqlalchemy']['size'] == 1
+
+
+def test_pool_settings():
+    from wazo_router_confd.database import get_pool_settings
+
+    settings = get_pool_settings(
+        dict(
+            database_pool_min_size='2',
+            database_pool_max_size='20',
+            database_pool_acquire_timeout='1.5',
+            database_statement_timeout='5000',
+        )
+    )
+    assert settings == dict(
+        min_size=2,
+        max_size=20,
+        acquire_timeout=1.5,
+        max_lifetime=-1,
+        statement_timeout=5000,
+    )
+
+
+def test_api_status_after_warmup(database_uri):
+    from starlette.testclient import TestClient
+
+    from wazo_router_confd.app import get_app
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.normalization import NormalizationProfile
+    from wazo_router_confd.models.tenant import Tenant
+    from wazo_router_confd.services import kamailio as kamailio_service
+    from wazo_router_confd.services.normalization import compiled_normalization_profiles
+
+    app = get_app(
+        dict(
+            database_uri=database_uri,
+            redis_uri='redis://localhost',
+            redis_flush_on_connect=True,
+            database_upgrade=True,
+            preload_kamailio_caches=True,
+        )
+    )
+    session = SessionLocal(bind=app.engine)
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    normalization_profile = NormalizationProfile(
+        tenant=tenant, name='Profile', country_code='39', area_code='040'
+    )
+    session.add_all([tenant, normalization_profile])
+    session.commit()
+    compiled_normalization_profiles.pop(normalization_profile.id, None)
+
+    with TestClient(app) as client:
+        assert app.warmup.ready is False
+        assert client.get("/status").status_code == 503
+        for _ in range(100):
+            if client.get("/status").status_code == 204:
+                break
+        assert app.warmup.ready is True
+        assert normalization_profile.id in compiled_normalization_profiles
+        pool = app.async_db.connection_pool.pool
+        assert len(kamailio_service.ipbx_by_domain.connections) >= pool.minsize
+    session.query(Tenant).delete()
+    session.commit()
+    session.close()
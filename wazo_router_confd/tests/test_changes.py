@@ -0,0 +1,317 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import threading
+import time
+
+from typing import Dict
+from unittest import mock
+
+from starlette.testclient import TestClient
+
+
+TRIGGERS_QUERY = (
+    "SELECT tgrelid::regclass::text, tgname FROM pg_trigger "
+    "WHERE tgname LIKE 'notify_configuration_%%' ORDER BY 1, 2"
+)
+
+
+def test_change_triggers_migration():
+    from wazo_router_confd import conftest, database
+    from wazo_router_confd.models.changes import CHANGE_TABLES
+
+    # created by the migrations and along with the tables alike
+    triggers = []
+    for force_migration in (True, False):
+        config = dict(database_uri=conftest.create_temporary_database())
+        app = database.setup_database(mock.Mock(), config)
+        try:
+            database.upgrade_database(app, config, force_migration=force_migration)
+            with app.engine.connect() as conn:
+                triggers.append(conn.execute(TRIGGERS_QUERY).fetchall())
+        finally:
+            app.engine.dispose()
+    assert triggers[0] == triggers[1]
+    assert len(triggers[0]) == 2 * len(CHANGE_TABLES)
+
+
+def test_change_listener(event_loop):
+    import aioredis  # type: ignore
+
+    from wazo_router_confd import conftest
+    from wazo_router_confd.app import get_app
+    from wazo_router_confd.models.changes import notify_bulk_changes, set_bulk_changes
+
+    # the revisions are numbered from the creation of the database
+    app = get_app(
+        dict(
+            database_uri=conftest.create_temporary_database(),
+            redis_uri='redis://localhost',
+            redis_flush_on_connect=True,
+            database_upgrade=True,
+            database_change_listener=True,
+        )
+    )
+    received = []
+    app.change_listener.add_handler(received.append)
+    invalidated = []
+    app.invalidation_bus.add_handler(invalidated.append)
+
+    async def execute_redis(*args):
+        redis = await aioredis.create_redis('redis://localhost')
+        try:
+            return await redis.execute(*args)
+        finally:
+            redis.close()
+            await redis.wait_closed()
+
+    def wait_for_changes():
+        for _ in range(100):
+            if received:
+                return received.pop(0)
+            # the test client runs the event loop during the requests only
+            client.get("/status")
+            time.sleep(0.02)
+        raise AssertionError("no change received")
+
+    with TestClient(app) as client:
+        for _ in range(100):
+            if app.change_listener.connected:
+                break
+            client.get("/status")
+            time.sleep(0.02)
+        event_loop.run_until_complete(execute_redis('set', 'cached', 'value'))
+
+        # changes made outside of the API
+        with app.engine.begin() as conn:
+            conn.execute(
+                "INSERT INTO tenants (uuid, name) "
+                "VALUES ('5a6c0c40-b481-41bb-a41a-75d1cc25ff34', 'fabio')"
+            )
+            domain_id = conn.execute(
+                "INSERT INTO domains (domain, tenant_uuid) VALUES "
+                "('testdomain.com', '5a6c0c40-b481-41bb-a41a-75d1cc25ff34') "
+                "RETURNING id"
+            ).scalar()
+        changes = wait_for_changes()
+        assert changes == [
+            {
+                'revision': 1,
+                'table': 'tenants',
+                'op': 'insert',
+                'id': '5a6c0c40-b481-41bb-a41a-75d1cc25ff34',
+                'tenant': '5a6c0c40-b481-41bb-a41a-75d1cc25ff34',
+            },
+            {
+                'revision': 2,
+                'table': 'domains',
+                'op': 'insert',
+                'id': domain_id,
+                'tenant': '5a6c0c40-b481-41bb-a41a-75d1cc25ff34',
+            },
+        ]
+        assert ['domains', 'tenants'] in invalidated
+        assert not event_loop.run_until_complete(execute_redis('exists', 'cached'))
+
+        with app.engine.begin() as conn:
+            conn.execute("DELETE FROM domains")
+            conn.execute("TRUNCATE normalization_rules")
+        assert wait_for_changes() == [
+            {
+                'revision': 3,
+                'table': 'domains',
+                'op': 'delete',
+                'id': domain_id,
+                'tenant': '5a6c0c40-b481-41bb-a41a-75d1cc25ff34',
+            },
+            {
+                'revision': 4,
+                'table': 'normalization_rules',
+                'op': 'truncate',
+                'id': None,
+                'tenant': None,
+            },
+        ]
+
+        # the rows of a bulk load are notified once per tenant
+        connection = app.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                set_bulk_changes(cursor, True)
+                cursor.execute(
+                    "INSERT INTO domains (domain, tenant_uuid) SELECT "
+                    "'domain' || i || '.com', '5a6c0c40-b481-41bb-a41a-75d1cc25ff34' "
+                    "FROM generate_series(1, 100) AS i"
+                )
+                set_bulk_changes(cursor, False)
+                notify_bulk_changes(
+                    cursor, 'domains', ['5a6c0c40-b481-41bb-a41a-75d1cc25ff34']
+                )
+            connection.commit()
+        finally:
+            connection.close()
+        assert wait_for_changes() == [
+            {
+                'revision': 5,
+                'table': 'domains',
+                'op': 'bulk',
+                'id': None,
+                'tenant': '5a6c0c40-b481-41bb-a41a-75d1cc25ff34',
+            }
+        ]
+
+
+def parse_events(text: str) -> list:
+    events = []
+    for block in text.split('\n\n'):
+        fields: Dict[str, str] = {}
+        for line in block.splitlines():
+            name, separator, value = line.partition(': ')
+            if separator:
+                fields[name] = value
+        if 'event' in fields:
+            events.append(
+                (fields['event'], fields.get('id'), json.loads(fields['data']))
+            )
+    return events
+
+
+def test_kamailio_changes_stream():
+    from wazo_router_confd import conftest
+    from wazo_router_confd.app import get_app
+
+    app = get_app(
+        dict(
+            database_uri=conftest.create_temporary_database(),
+            redis_uri='redis://localhost',
+            redis_flush_on_connect=True,
+            database_upgrade=True,
+            database_change_listener=True,
+        )
+    )
+    tenants = [
+        '5a6c0c40-b481-41bb-a41a-75d1cc25ff34',
+        'ffffffff-b481-41bb-a41a-75d1cc25ff34',
+    ]
+
+    def add_tenants():
+        with app.engine.begin() as conn:
+            for i, tenant in enumerate(tenants):
+                conn.execute(
+                    "INSERT INTO domains (domain, tenant_uuid) "
+                    "VALUES ('domain%d.com', '%s')" % (i, tenant)
+                )
+
+    with app.engine.begin() as conn:
+        for tenant in tenants:
+            conn.execute(
+                "INSERT INTO tenants (uuid, name) VALUES ('%s', '%s')"
+                % (tenant, tenant)
+            )
+
+    with TestClient(app) as client:
+        for _ in range(100):
+            if app.change_listener.connected:
+                break
+            client.get("/status")
+            time.sleep(0.02)
+
+        # the changes made while the stream is open
+        timer = threading.Timer(0.2, add_tenants)
+        timer.start()
+        response = client.get(
+            "/1.0/kamailio/changes/stream",
+            params={'tenant_uuid': tenants[0], 'timeout': 1},
+        )
+        timer.join()
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/event-stream')
+        events = parse_events(response.text)
+        assert len(events) == 1
+        event, event_id, change = events[0]
+        assert event == 'change'
+        assert change['table'] == 'domains'
+        assert change['tenant'] == tenants[0]
+        assert event_id == str(change['revision'])
+
+        # resumed from the last received revision
+        response = client.get(
+            "/1.0/kamailio/changes/stream",
+            params={'timeout': 0.1},
+            headers={'Last-Event-ID': str(change['revision'])},
+        )
+        events = parse_events(response.text)
+        assert [(e[0], e[2]['tenant']) for e in events] == [('change', tenants[1])]
+        assert int(events[0][1]) > change['revision']
+
+        # the changes before the listener connected are unknown
+        response = client.get(
+            "/1.0/kamailio/changes/stream", params={'since': 0, 'timeout': 0.1}
+        )
+        assert parse_events(response.text)[0] == (
+            'reset',
+            None,
+            {'revision': app.change_listener.revision},
+        )
+
+
+def test_change_feed_replay():
+    from wazo_router_confd.changes import ChangeFeed, ChangeListener
+
+    listener = ChangeListener('dbname=wazo')
+    feed = ChangeFeed(listener, size=3)
+    assert feed.replay(0) is None
+    listener.since = 10
+    # the changes are in the commit order of their transactions, whatever their
+    # revisions
+    feed.publish([dict(revision=12), dict(revision=11)])
+    assert feed.replay(10) == [dict(revision=12), dict(revision=11)]
+    assert feed.replay(12) == [dict(revision=11)]
+    assert feed.replay(11) == []
+    assert feed.replay(9) is None
+    feed.publish([dict(revision=14), dict(revision=13)])
+    assert feed.replay(10) is None
+    assert feed.replay(12) == [dict(revision=11), dict(revision=14), dict(revision=13)]
+    assert feed.replay(14) == [dict(revision=13)]
+    # reconnected
+    listener.since = 15
+    feed.publish(None)
+    assert feed.replay(12) is None
+    assert feed.replay(15) == []
+
+
+def test_stream_tenants():
+    import pytest  # type: ignore
+
+    from fastapi import HTTPException
+
+    from wazo_router_confd.auth import Principal
+    from wazo_router_confd.changes import get_stream_tenants
+
+    tenant_a = '5a6c0c40-b481-41bb-a41a-75d1cc25ff34'
+    tenant_b = 'ffffffff-b481-41bb-a41a-75d1cc25ff34'
+    principal = Principal(
+        auth_id='auth_id',
+        uuid='uuid',
+        tenant_uuid=tenant_a,
+        tenant_uuids=[tenant_a],
+        token='token',
+    )
+    unscoped = Principal(
+        auth_id='auth_id',
+        uuid='uuid',
+        tenant_uuid=tenant_a,
+        tenant_uuids=[],
+        token='token',
+    )
+
+    assert get_stream_tenants(None) is None
+    assert get_stream_tenants(unscoped) is None
+    assert get_stream_tenants(unscoped, tenant_b) == {tenant_b}
+    assert get_stream_tenants(principal) == {tenant_a}
+    assert get_stream_tenants(principal, tenant_a) == {tenant_a}
+    # the token does not give access to the changes of another tenant
+    with pytest.raises(HTTPException) as excinfo:
+        get_stream_tenants(principal, tenant_b)
+    assert excinfo.value.status_code == 403
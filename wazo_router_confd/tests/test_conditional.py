@@ -0,0 +1,131 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+
+def add_ipbx(app):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.domain import Domain
+    from wazo_router_confd.models.ipbx import IPBX
+    from wazo_router_confd.models.tenant import Tenant
+
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    domain = Domain(domain='testdomain.com', tenant=tenant)
+    ipbx = IPBX(tenant=tenant, domain=domain, ip_fqdn='mypbx.com', username='user')
+    session = SessionLocal(bind=app.engine)
+    session.add_all([tenant, domain, ipbx])
+    session.commit()
+    return domain.id, ipbx.id
+
+
+def test_if_none_match(app, client):
+    domain_id, ipbx_id = add_ipbx(app)
+    #
+    response = client.get("/1.0/ipbxs/%s" % ipbx_id)
+    assert response.status_code == 200
+    etag = response.headers['etag']
+    assert not etag.startswith('W/')
+    response = client.get("/1.0/ipbxs/%s" % ipbx_id, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['etag'] == etag
+    assert response.content == b''
+    #
+    response = client.get("/1.0/ipbxs")
+    assert response.status_code == 200
+    page_etag = response.headers['etag']
+    assert page_etag.startswith('W/')
+    response = client.get("/1.0/ipbxs", headers={'If-None-Match': page_etag})
+    assert response.status_code == 304
+    #
+    # the representations with an expanded relation change with the relation
+    response = client.get("/1.0/ipbxs/%s" % ipbx_id, params={'expand': 'domain'})
+    expanded_etag = response.headers['etag']
+    assert expanded_etag.startswith('W/')
+    response = client.put(
+        "/1.0/domains/%s" % domain_id, json={'domain': 'otherdomain.com'}
+    )
+    assert response.status_code == 200
+    response = client.get(
+        "/1.0/ipbxs/%s" % ipbx_id,
+        params={'expand': 'domain'},
+        headers={'If-None-Match': expanded_etag},
+    )
+    assert response.status_code == 200
+    assert response.json()['domain']['domain'] == 'otherdomain.com'
+    #
+    response = client.put(
+        "/1.0/ipbxs/%s" % ipbx_id,
+        json={'domain_id': domain_id, 'ip_fqdn': 'newpbx.com'},
+    )
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
+    response = client.get("/1.0/ipbxs/%s" % ipbx_id, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json()['ip_fqdn'] == 'newpbx.com'
+    response = client.get("/1.0/ipbxs", headers={'If-None-Match': page_etag})
+    assert response.status_code == 200
+    assert response.headers['etag'] != page_etag
+
+
+def test_if_match(app, client):
+    domain_id, ipbx_id = add_ipbx(app)
+    #
+    etag = client.get("/1.0/ipbxs/%s" % ipbx_id).headers['etag']
+    response = client.put(
+        "/1.0/ipbxs/%s" % ipbx_id,
+        json={'domain_id': domain_id, 'ip_fqdn': 'newpbx.com'},
+        headers={'If-Match': etag},
+    )
+    assert response.status_code == 200
+    new_etag = response.headers['etag']
+    assert new_etag != etag
+    #
+    # a concurrent update
+    response = client.put(
+        "/1.0/ipbxs/%s" % ipbx_id,
+        json={'domain_id': domain_id, 'ip_fqdn': 'otherpbx.com'},
+        headers={'If-Match': etag},
+    )
+    assert response.status_code == 412
+    response = client.delete("/1.0/ipbxs/%s" % ipbx_id, headers={'If-Match': etag})
+    assert response.status_code == 412
+    assert client.get("/1.0/ipbxs/%s" % ipbx_id).json()['ip_fqdn'] == 'newpbx.com'
+    #
+    # the partial representations can not be written
+    weak_etag = client.get(
+        "/1.0/ipbxs/%s" % ipbx_id, params={'fields': 'ip_fqdn'}
+    ).headers['etag']
+    assert weak_etag == 'W/' + new_etag
+    response = client.delete("/1.0/ipbxs/%s" % ipbx_id, headers={'If-Match': weak_etag})
+    assert response.status_code == 412
+    #
+    response = client.delete(
+        "/1.0/ipbxs/%s" % ipbx_id, headers={'If-Match': '"0", %s' % new_etag}
+    )
+    assert response.status_code == 200
+    assert client.get("/1.0/ipbxs/%s" % ipbx_id).status_code == 404
+
+
+def test_guarded_statement(app, client):
+    from wazo_router_confd.conditional import (
+        ROW_VERSION,
+        Conditional,
+        format_etag,
+        get_row_version,
+    )
+    from wazo_router_confd.models.domain import Domain
+
+    domain_id, _ = add_ipbx(app)
+    table = Domain.__table__
+    with app.engine.connect() as conn:
+        row = conn.execute(
+            table.select()
+            .with_only_columns([table.c.id, get_row_version(table).label(ROW_VERSION)])
+            .where(table.c.id == domain_id)
+        ).first()
+        conditional = Conditional(if_match=[format_etag(row[ROW_VERSION])])
+        statement = conditional.guard(
+            table.update().where(table.c.id == domain_id), table, row
+        ).values(domain='guarded.com')
+        # changed by another transaction since it was read
+        conn.execute(table.update().values(domain='changed.com'))
+        assert conn.execute(statement).rowcount == 0
@@ -0,0 +1,157 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import threading
+import time
+
+from base64 import b64encode
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import pytest  # type: ignore
+
+from starlette.testclient import TestClient
+
+
+class ConsulAgentHandler(BaseHTTPRequestHandler):
+    """The KV store and the service registration of a Consul agent."""
+
+    server: 'ConsulAgent'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Consul-Index', str(self.server.index))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        key = url.path[len('/v1/kv/') :]
+        with self.server.changed:
+            if 'index' in query:
+                self.server.changed.wait_for(
+                    lambda: self.server.index > int(query['index'][0]),
+                    timeout=int(query['wait'][0].rstrip('s')),
+                )
+            entries = [
+                dict(Key=k, Value=b64encode(v.encode('utf-8')).decode('ascii'))
+                for k, v in sorted(self.server.kv.items())
+                if (k.startswith(key) if 'recurse' in query else k == key)
+            ]
+        self.reply(entries or None, 200 if entries else 404)
+
+    def do_PUT(self):
+        path = urlparse(self.path).path
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if path == '/v1/agent/service/register':
+            service = json.loads(body)
+            self.server.services[service['ID']] = service
+        elif path.startswith('/v1/agent/service/deregister/'):
+            self.server.services.pop(path.rsplit('/', 1)[1], None)
+        else:
+            self.server.set(path[len('/v1/kv/') :], body.decode('utf-8'))
+        self.reply(True)
+
+
+class ConsulAgent(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ConsulAgentHandler)
+        self.kv = {}
+        self.services = {}
+        self.index = 1
+        self.changed = threading.Condition()
+
+    @property
+    def uri(self) -> str:
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def set(self, key: str, value: str):
+        with self.changed:
+            self.kv[key] = value
+            self.index += 1
+            self.changed.notify_all()
+
+
+@pytest.fixture(scope="function")
+def consul_agent():
+    agent = ConsulAgent()
+    thread = threading.Thread(target=agent.serve_forever, daemon=True)
+    thread.start()
+    yield agent
+    agent.shutdown()
+    agent.server_close()
+
+
+def test_consul_service(consul_agent):
+    from wazo_router_confd.consul import ConsulService, run_sync
+
+    consul = ConsulService(consul_agent.uri)
+    assert run_sync(consul.get('wazo-router-confd.redis_timeout')) is None
+    assert run_sync(consul.put('wazo-router-confd.redis_timeout', '0.5')) is True
+    assert run_sync(consul.get('wazo-router-confd.redis_timeout')) == b'0.5'
+    index, values = run_sync(consul.get_prefix('wazo-router-confd.'))
+    assert index == 2
+    assert values == {'wazo-router-confd.redis_timeout': b'0.5'}
+
+    run_sync(consul.register('service-1', 'wazo-router-confd', port=5000))
+    assert consul_agent.services['service-1']['Port'] == 5000
+    run_sync(consul.deregister('service-1'))
+    assert consul_agent.services == {}
+
+
+def test_consul_settings_watch(consul_agent, database_uri):
+    from wazo_router_confd.app import get_app
+
+    consul_agent.set('wazo-router-confd.redis_timeout', '0.5')
+    consul_agent.set('wazo-router-confd.unknown_setting', 'ignored')
+    config = dict(
+        consul_uri=consul_agent.uri,
+        consul_watch_wait=1,
+        database_uri=database_uri,
+        redis_uri='redis://localhost',
+        redis_local_cache_size=10,
+        advertise_host='127.0.0.1',
+        advertise_port=5000,
+    )
+    app = get_app(config)
+    # loaded before the application is built
+    assert app.redis.breaker.timeout == 0.5
+    assert 'unknown_setting' not in config
+
+    def wait_for(condition):
+        for _ in range(100):
+            if condition():
+                return True
+            # the test client runs the event loop during the requests only
+            client.get("/status")
+            time.sleep(0.05)
+        return False
+
+    with TestClient(app) as client:
+        assert len(consul_agent.services) == 1
+        pool = app.async_db.connection_pool.pool
+        consul_agent.set('wazo-router-confd.redis_local_cache_size', '5')
+        consul_agent.set('wazo-router-confd.database_pool_max_size', '4')
+        assert wait_for(lambda: app.redis.local_cache.max_size == 5)
+        assert app.async_db.connection_pool.max_size == 4
+        assert app.async_db.connection_pool.pool is not pool
+        assert app.async_db.connection_pool.pool.maxsize == 4
+        assert app.async_db.engine._pool is app.async_db.connection_pool.pool
+        assert client.get("/status/pools").status_code == 200
+
+        # applied at the next restart
+        consul_agent.set('wazo-router-confd.database_statement_timeout', '1000')
+        assert wait_for(lambda: config.get('database_statement_timeout') == '1000')
+        assert app.async_db.connection_pool.statement_timeout == 0
+    assert consul_agent.services == {}
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from unittest import mock
+import os
 import pprint
 
 from alembic import migration  # type: ignore
@@ -27,3 +28,43 @@ def test_database_migration():
     finally:
         database.SessionLocal.close_all()
         app.engine.dispose()
+
+
+def test_get_migration_heads():
+    from alembic.config import Config  # type: ignore
+    from alembic.script import ScriptDirectory  # type: ignore
+
+    script_location = os.path.join(
+        os.path.dirname(database.__file__), 'migrations', 'alembic'
+    )
+    config = Config()
+    config.set_main_option('script_location', script_location)
+    assert database.get_migration_heads(
+        os.path.join(script_location, 'versions')
+    ) == set(ScriptDirectory.from_config(config).get_heads())
+
+
+def test_database_upgrade_up_to_date():
+    database_uri = conftest.create_temporary_database()
+    config = dict(database_uri=database_uri)
+    app = mock.Mock()
+    app = database.setup_database(app, config)
+
+    try:
+        database.upgrade_database(app, config)
+        # Alembic is not run once the database is at the head revision
+        with mock.patch('alembic.command.upgrade') as upgrade:
+            database.upgrade_database(app, config)
+        upgrade.assert_not_called()
+        with app.engine.connect() as conn:
+            assert database.get_database_heads(conn) == database.get_migration_heads(
+                os.path.join(
+                    os.path.dirname(database.__file__),
+                    'migrations',
+                    'alembic',
+                    'versions',
+                )
+            )
+    finally:
+        database.SessionLocal.close_all()
+        app.engine.dispose()
@@ -0,0 +1,41 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+
+import pytest  # type: ignore
+
+
+def test_pool_acquire_timeout(database_uri, event_loop):
+    from wazo_router_confd.database import AiopgConnectionPool, from_database_uri_to_dsn
+
+    async def test():
+        pool = AiopgConnectionPool(
+            from_database_uri_to_dsn(database_uri),
+            min_size=1,
+            max_size=1,
+            acquire_timeout=0.2,
+        )
+        await pool.connect()
+        try:
+            # the aiopg pool is left untouched
+            conn = await pool.pool.acquire()
+            await pool.pool.release(conn)
+            async with pool.acquire() as conn:
+                # the acquire timeout does not bound the queries
+                async with conn.cursor() as cur:
+                    await cur.execute("SELECT pg_sleep(0.4)")
+                # no connection is released meanwhile
+                with pytest.raises(asyncio.TimeoutError):
+                    async with pool.acquire():
+                        pass
+            return pool.get_status()
+        finally:
+            await pool.clear()
+            pool.pool.close()
+            await pool.pool.wait_closed()
+
+    status = event_loop.run_until_complete(test())
+    assert status['acquired'] == 1
+    assert status['timeouts'] == 1
+    assert status['waiters'] == 0
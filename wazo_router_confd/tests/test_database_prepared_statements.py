@@ -0,0 +1,52 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import aiopg  # type: ignore
+
+from psycopg2.extras import DictCursor  # type: ignore
+
+from wazo_router_confd.database import from_database_uri_to_dsn
+
+
+def test_prepared_statement(app, database_uri, event_loop):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.tenant import Tenant
+    from wazo_router_confd.services.kamailio import tenant_by_uuid
+
+    session = SessionLocal(bind=app.engine)
+    session.add(Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34'))
+    session.commit()
+
+    async def test():
+        pool = await aiopg.create_pool(
+            dsn=from_database_uri_to_dsn(database_uri), minsize=1, maxsize=1
+        )
+        tenants = []
+        async with pool.acquire() as conn:
+            async with conn.cursor(cursor_factory=DictCursor) as cur:
+                for uuid in (
+                    '5a6c0c40-b481-41bb-a41a-75d1cc25ff34',
+                    'ffffffff-ffff-4c1c-ad1c-ffffffffffff',
+                ):
+                    await tenant_by_uuid.execute(cur, [uuid])
+                    tenants.append(await cur.fetchone())
+                await cur.execute(
+                    "SELECT count(*) FROM pg_prepared_statements WHERE name = %s",
+                    [tenant_by_uuid.name],
+                )
+                prepared = (await cur.fetchone())[0]
+                # the session lost its statements: they are prepared again
+                await cur.execute("DEALLOCATE ALL")
+                await tenant_by_uuid.execute(
+                    cur, ['5a6c0c40-b481-41bb-a41a-75d1cc25ff34']
+                )
+                tenants.append(await cur.fetchone())
+        pool.close()
+        await pool.wait_closed()
+        return tenants, prepared
+
+    tenants, prepared = event_loop.run_until_complete(test())
+    assert prepared == 1
+    assert str(tenants[0]['uuid']) == '5a6c0c40-b481-41bb-a41a-75d1cc25ff34'
+    assert tenants[1] is None
+    assert str(tenants[2]['uuid']) == '5a6c0c40-b481-41bb-a41a-75d1cc25ff34'
@@ -0,0 +1,136 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import aiopg  # type: ignore
+
+from wazo_router_confd.database import from_database_uri_to_dsn
+
+
+SEED_SQL = (
+    "INSERT INTO tenants (uuid, name) "
+    "SELECT md5(i::text)::uuid, 'tenant' || i FROM generate_series(1, 200) i",
+    "INSERT INTO domains (id, tenant_uuid, domain) "
+    "SELECT i, md5((i % 200 + 1)::text)::uuid, 'domain' || i || '.com' "
+    "FROM generate_series(1, 2000) i",
+    "INSERT INTO normalization_profiles (id, tenant_uuid, name, country_code, "
+    "always_intl_prefix_plus, always_ld) "
+    "SELECT i, md5((i % 200 + 1)::text)::uuid, 'profile' || i, '39', false, false "
+    "FROM generate_series(0, 199) i",
+    "INSERT INTO normalization_rules (profile_id, rule_type, priority, match_regex, "
+    "match_prefix, replace_regex) "
+    "SELECT i % 200, 1, i, '^' || i, i::text, '' FROM generate_series(1, 2000) i",
+    "INSERT INTO ipbx (id, tenant_uuid, domain_id, normalization_profile_id, "
+    "ip_fqdn, ip_address, port, registered, username, password_ha1) "
+    "SELECT i, md5((i % 200 + 1)::text)::uuid, i, i % 200, 'pbx' || i, "
+    "'10.0.' || i, 5060, false, 'user' || i, md5(i::text) "
+    "FROM generate_series(1, 2000) i",
+    "INSERT INTO carriers (id, tenant_uuid, name) "
+    "SELECT i, md5((i % 200 + 1)::text)::uuid, 'carrier' || i "
+    "FROM generate_series(0, 199) i",
+    "INSERT INTO carrier_trunks (id, tenant_uuid, carrier_id, name, sip_proxy, "
+    "sip_proxy_port, ip_address, registered, expire_seconds, retry_seconds) "
+    "SELECT i, md5((i % 200 + 1)::text)::uuid, i % 200, 'trunk' || i, "
+    "'proxy' || i, 5060, '172.0.' || i, i % 100 = 0, 3600, 30 "
+    "FROM generate_series(1, 2000) i",
+    "INSERT INTO dids (tenant_uuid, ipbx_id, carrier_trunk_id, did_regex, did_prefix) "
+    "SELECT md5((i % 200 + 1)::text)::uuid, i, i, '^' || (100000 + i), "
+    "(100000 + i)::text FROM generate_series(1, 2000) i",
+    "ANALYZE",
+)
+
+
+def get_plan_problems(plan: dict) -> list:
+    # a sequential scan, or an index walked from end to end without any
+    # index condition (unless the index is partial), do not scale
+    problems = []
+    node_type = plan['Node Type']
+    if node_type == 'Seq Scan':
+        problems.append('Seq Scan on %s' % plan['Relation Name'])
+    elif (
+        node_type in ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+        and 'Index Cond' not in plan
+        and plan['Index Name'] not in PARTIAL_INDEXES
+    ):
+        problems.append('%s using %s' % (node_type, plan['Index Name']))
+    for subplan in plan.get('Plans', []):
+        problems.extend(get_plan_problems(subplan))
+    return problems
+
+
+PARTIAL_INDEXES = ('ix_carrier_trunks_registered',)
+
+
+def test_kamailio_queries_use_indexes(app, database_uri, event_loop):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.services import kamailio
+    from wazo_router_confd.services import normalization
+
+    session = SessionLocal(bind=app.engine)
+    for sql in SEED_SQL:
+        session.execute(sql)
+    session.commit()
+    tenant_uuid = session.execute("SELECT md5('3')::uuid").scalar()
+
+    statements = [
+        (kamailio.ipbx_by_id, [1]),
+        (kamailio.carrier_trunk_by_id, [1]),
+        (kamailio.ipbx_by_domain, ['domain42.com']),
+        (kamailio.ipbx_by_domain_and_tenant, ['domain42.com', tenant_uuid]),
+        (kamailio.ipbx_by_did_prefixes, [['', '1', '10', '100', '1000', '10004']]),
+        (kamailio.ipbx_by_did_prefixes_and_tenant, [['', '1', '10'], tenant_uuid]),
+        (kamailio.carrier_trunk_by_ipbx_ip_fqdn, ['pbx42']),
+        (kamailio.carrier_trunk_by_ipbx_ip_fqdn_and_tenant, ['pbx42', tenant_uuid]),
+        (kamailio.carrier_trunk_auth_by_ip, ['172.0.42']),
+        (kamailio.tenant_by_uuid, [tenant_uuid]),
+        (kamailio.registered_carrier_trunks, []),
+        (normalization.normalization_profile_by_id, [1]),
+        (normalization.normalization_rules_by_profile_id, [1]),
+    ]
+    for (source_ip, username, domain_name), statement in sorted(
+        kamailio.ipbx_auth_statements.items()
+    ):
+        # the auth lookup only runs with a source ip or a username
+        if source_ip or username:
+            args = [
+                arg
+                for arg, enabled in (
+                    ('10.0.42', source_ip),
+                    ('user42', username),
+                    ('domain42.com', domain_name),
+                )
+                if enabled
+            ]
+            statements.append((statement, args))
+
+    async def test():
+        pool = await aiopg.create_pool(dsn=from_database_uri_to_dsn(database_uri))
+        plans = {}
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                # make the planner pick an index whenever one can be used
+                await cur.execute("SET enable_seqscan = off")
+                for statement, args in statements:
+                    await statement.prepare(cur)
+                    await cur.execute(
+                        "EXPLAIN (FORMAT JSON) " + statement.get_execute_sql(args), args
+                    )
+                    plans[statement.name] = (await cur.fetchone())[0][0]['Plan']
+                    await cur.execute("DEALLOCATE %s" % statement.name)
+        pool.close()
+        await pool.wait_closed()
+        return plans
+
+    try:
+        plans = event_loop.run_until_complete(test())
+    finally:
+        # the seeded tenants are not valid for the API, drop them
+        session.execute("DELETE FROM tenants")
+        session.commit()
+        session.close()
+    assert len(plans) == len(statements)
+    problems = {
+        name: get_plan_problems(plan)
+        for name, plan in plans.items()
+        if get_plan_problems(plan)
+    }
+    assert problems == {}
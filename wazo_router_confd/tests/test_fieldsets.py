@@ -0,0 +1,131 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+
+def add_ipbxs(app):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.carrier import Carrier
+    from wazo_router_confd.models.carrier_trunk import CarrierTrunk
+    from wazo_router_confd.models.domain import Domain
+    from wazo_router_confd.models.ipbx import IPBX
+    from wazo_router_confd.models.normalization import NormalizationProfile
+    from wazo_router_confd.models.tenant import Tenant
+
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    domain = Domain(domain='testdomain.com', tenant=tenant)
+    profile = NormalizationProfile(name='profile', tenant=tenant, country_code='39')
+    ipbx_1 = IPBX(
+        tenant=tenant,
+        domain=domain,
+        normalization_profile=profile,
+        ip_fqdn='mypbx.com',
+        username='user1',
+        password='password',
+    )
+    ipbx_2 = IPBX(tenant=tenant, domain=domain, ip_fqdn='otherpbx.com')
+    carrier = Carrier(name='carrier', tenant=tenant)
+    carrier_trunk = CarrierTrunk(
+        name='carrier_trunk', tenant=tenant, carrier=carrier, sip_proxy='proxy.com'
+    )
+    session = SessionLocal(bind=app.engine)
+    session.add_all([tenant, domain, profile, ipbx_1, ipbx_2, carrier, carrier_trunk])
+    session.commit()
+    return dict(
+        domain_id=domain.id,
+        profile_id=profile.id,
+        ipbx_ids=[ipbx_1.id, ipbx_2.id],
+        carrier_id=carrier.id,
+        carrier_trunk_id=carrier_trunk.id,
+    )
+
+
+def test_sparse_fieldset(app, client):
+    ids = add_ipbxs(app)
+    #
+    response = client.get("/1.0/ipbxs", params={'fields': 'id,ip_fqdn'})
+    assert response.status_code == 200
+    assert response.json() == {
+        'items': [
+            {'id': ids['ipbx_ids'][0], 'ip_fqdn': 'mypbx.com'},
+            {'id': ids['ipbx_ids'][1], 'ip_fqdn': 'otherpbx.com'},
+        ],
+        'total': None,
+        'next': None,
+    }
+    #
+    response = client.get(
+        "/1.0/ipbxs/%s" % ids['ipbx_ids'][0], params={'fields': 'username'}
+    )
+    assert response.status_code == 200
+    assert response.json() == {'username': 'user1'}
+    #
+    # the cursor is kept when the sort column is not among the fields
+    response = client.get(
+        "/1.0/ipbxs", params={'fields': 'id', 'order': 'ip_fqdn', 'limit': 1}
+    )
+    assert response.json()['items'] == [{'id': ids['ipbx_ids'][0]}]
+    response = client.get(response.json()['next'])
+    assert response.json()['items'] == [{'id': ids['ipbx_ids'][1]}]
+
+
+def test_expand_relations(app, client):
+    ids = add_ipbxs(app)
+    #
+    response = client.get(
+        "/1.0/ipbxs", params={'fields': 'id', 'expand': 'domain,normalization_profile'}
+    )
+    assert response.status_code == 200
+    items = response.json()['items']
+    assert items[0]['domain'] == {
+        'id': ids['domain_id'],
+        'domain': 'testdomain.com',
+        'tenant_uuid': '5a6c0c40-b481-41bb-a41a-75d1cc25ff34',
+    }
+    assert items[0]['normalization_profile']['id'] == ids['profile_id']
+    assert items[0]['normalization_profile']['country_code'] == '39'
+    assert items[1]['normalization_profile'] is None
+    #
+    response = client.get(
+        "/1.0/ipbxs/%s" % ids['ipbx_ids'][0],
+        params={'fields': 'ip_fqdn,domain.domain,tenant.name'},
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        'ip_fqdn': 'mypbx.com',
+        'domain': {'domain': 'testdomain.com'},
+        'tenant': {'name': 'fabio'},
+    }
+    #
+    response = client.get(
+        "/1.0/carrier_trunks/%s" % ids['carrier_trunk_id'],
+        params={'fields': 'name', 'expand': 'carrier'},
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        'name': 'carrier_trunk',
+        'carrier': {
+            'id': ids['carrier_id'],
+            'name': 'carrier',
+            'tenant_uuid': '5a6c0c40-b481-41bb-a41a-75d1cc25ff34',
+        },
+    }
+    #
+    response = client.get("/1.0/ipbxs", params={'expand': 'domain'})
+    item = response.json()['items'][0]
+    assert item['domain']['domain'] == 'testdomain.com'
+    assert 'password' not in item
+    assert item['ip_fqdn'] == 'mypbx.com'
+
+
+def test_invalid_fieldset(app, client):
+    add_ipbxs(app)
+    #
+    for params in [
+        {'fields': 'password'},
+        {'fields': 'unknown'},
+        {'expand': 'carrier'},
+        {'fields': 'domain.unknown'},
+        {'fields': 'domain.tenant.name'},
+    ]:
+        response = client.get("/1.0/ipbxs", params=params)
+        assert response.status_code == 400, params
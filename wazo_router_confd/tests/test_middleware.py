@@ -0,0 +1,153 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from fastapi import Depends, FastAPI
+from starlette.requests import Request
+from starlette.testclient import TestClient
+
+from wazo_router_confd.auth import Principal, get_principal
+
+
+class FakeAuthClient(object):
+    async def get_token_data(self, token, tenant_uuid):
+        if token != 'valid':
+            return None
+        return Principal(
+            auth_id='auth_id',
+            uuid='uuid',
+            tenant_uuid=tenant_uuid,
+            tenant_uuids=[tenant_uuid],
+            token=token,
+        )
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.flushes = 0
+
+    async def flushdb(self):
+        self.flushes += 1
+
+
+class FakeInvalidationBus(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.published = []
+
+    async def publish(self, tables):
+        self.published.append((tables, self.redis.flushes))
+
+
+def get_test_app(auth_client=None, redis=None, invalidation_bus=None):
+    from wazo_router_confd.middleware import RequestMiddleware
+    from wazo_router_confd.redis import deferred_tables
+
+    app = FastAPI()
+
+    @app.get("/1.0/items")
+    def get_items(request: Request, principal: Principal = Depends(get_principal)):
+        return {
+            'value': request.state.value,
+            'tenant_uuid': principal.tenant_uuid if principal else None,
+        }
+
+    @app.post("/1.0/items")
+    def create_item():
+        # as the commit of a change
+        tables = deferred_tables.get()
+        if tables is not None:
+            tables.add('items')
+        return {}
+
+    @app.post("/1.0/kamailio/routing")
+    def kamailio_routing():
+        return {}
+
+    app.add_middleware(
+        RequestMiddleware,
+        request_state={'value': 42},
+        auth_client=auth_client,
+        redis=redis,
+        invalidation_bus=invalidation_bus,
+    )
+    return app
+
+
+def test_request_middleware_state():
+    client = TestClient(get_test_app())
+    response = client.get("/1.0/items")
+    assert response.status_code == 200
+    assert response.json() == {'value': 42, 'tenant_uuid': None}
+
+
+def test_request_middleware_auth():
+    client = TestClient(get_test_app(auth_client=FakeAuthClient()))
+    response = client.get("/1.0/items")
+    assert response.status_code == 401
+    response = client.get("/1.0/items", headers={'X-Auth-Token': 'invalid'})
+    assert response.status_code == 401
+    response = client.get(
+        "/1.0/items",
+        headers={
+            'X-Auth-Token': 'valid',
+            'Wazo-Tenant': 'ffffffff-ffff-4c1c-ad1c-ffffffffffff',
+        },
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        'value': 42,
+        'tenant_uuid': 'ffffffff-ffff-4c1c-ad1c-ffffffffffff',
+    }
+
+
+def test_request_middleware_flush():
+    redis = FakeRedis()
+    client = TestClient(get_test_app(redis=redis))
+    assert client.get("/1.0/items").status_code == 200
+    assert client.post("/1.0/kamailio/routing").status_code == 200
+    assert redis.flushes == 0
+    assert client.post("/1.0/items").status_code == 200
+    assert redis.flushes == 1
+    assert client.post("/1.0/unknown").status_code == 404
+    assert redis.flushes == 1
+
+
+def test_request_middleware_publish_after_flush():
+    from wazo_router_confd.redis import deferred_tables
+
+    redis = FakeRedis()
+    bus = FakeInvalidationBus(redis)
+    client = TestClient(get_test_app(redis=redis, invalidation_bus=bus))
+    assert client.post("/1.0/items").status_code == 200
+    # the other instances are told about the change once Redis is flushed
+    assert bus.published == [(['items'], 1)]
+    assert deferred_tables.get() is None
+
+
+def test_api_publish_after_flush(app):
+    redis = getattr(app, 'redis')
+    bus = getattr(app, 'invalidation_bus')
+    events = []
+
+    async def flushdb(flushdb=redis.flushdb):
+        await flushdb()
+        events.append('flushed')
+
+    async def publish(tables, publish=bus.publish):
+        events.append(tables)
+        await publish(tables)
+
+    setattr(redis, 'flushdb', flushdb)
+    setattr(bus, 'publish', publish)
+    with TestClient(app) as client:
+        response = client.post(
+            "/1.0/tenants",
+            json={'name': 'fabio', 'uuid': '5a6c0c40-b481-41bb-a41a-75d1cc25ff34'},
+        )
+        assert response.status_code == 200
+        tenant_uuid = response.json()['uuid']
+        response = client.put("/1.0/tenants/%s" % tenant_uuid, json={'name': 'alex'})
+        assert response.status_code == 200
+        client.delete("/1.0/tenants/%s" % tenant_uuid)
+    # the other instances are told about each change once Redis is flushed
+    assert events[:4] == ['flushed', ['tenants'], 'flushed', ['tenants']]
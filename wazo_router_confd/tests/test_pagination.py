@@ -0,0 +1,91 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+
+def add_ipbxs(app, usernames):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.domain import Domain
+    from wazo_router_confd.models.ipbx import IPBX
+    from wazo_router_confd.models.tenant import Tenant
+
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    domain = Domain(domain='testdomain.com', tenant=tenant)
+    ipbxs = [
+        IPBX(tenant=tenant, domain=domain, ip_fqdn='mypbx.com', username=username)
+        for username in usernames
+    ]
+    session = SessionLocal(bind=app.engine)
+    session.add_all([tenant, domain] + ipbxs)
+    session.commit()
+    return [ipbx.id for ipbx in ipbxs]
+
+
+def walk(client, url, params):
+    pages = []
+    response = client.get(url, params=params)
+    while True:
+        assert response.status_code == 200
+        pages.append(response.json())
+        if pages[-1]['next'] is None:
+            return pages
+        response = client.get(pages[-1]['next'])
+
+
+def test_paginate_by_key(app, client):
+    ids = add_ipbxs(app, ['user%d' % i for i in range(5)])
+    #
+    pages = walk(client, "/1.0/ipbxs", {'limit': 2, 'total': 'exact'})
+    assert [[item['id'] for item in page['items']] for page in pages] == [
+        ids[0:2],
+        ids[2:4],
+        ids[4:5],
+    ]
+    assert [page['total'] for page in pages] == [5, 5, 5]
+    assert 'cursor=' in pages[0]['next']
+    assert 'limit=2' in pages[0]['next']
+    #
+    pages = walk(client, "/1.0/ipbxs", {'limit': 3, 'direction': 'desc'})
+    assert [item['id'] for page in pages for item in page['items']] == ids[::-1]
+    #
+    response = client.get("/1.0/ipbxs", params={'offset': 3, 'limit': 10})
+    assert [item['id'] for item in response.json()['items']] == ids[3:]
+    assert response.json()['next'] is None
+
+
+def test_paginate_by_nullable_column(app, client):
+    ids = add_ipbxs(app, ['b', None, 'a', 'c', None])
+    #
+    for direction, expected in [
+        ('asc', [ids[2], ids[0], ids[3], ids[1], ids[4]]),
+        ('desc', [ids[4], ids[1], ids[3], ids[0], ids[2]]),
+    ]:
+        for limit in (1, 2, 3):
+            pages = walk(
+                client,
+                "/1.0/ipbxs",
+                {'order': 'username', 'direction': direction, 'limit': limit},
+            )
+            assert [item['id'] for page in pages for item in page['items']] == (
+                expected
+            )
+
+
+def test_paginate_estimated_total(app, client):
+    add_ipbxs(app, ['user%d' % i for i in range(3)])
+    #
+    response = client.get("/1.0/ipbxs", params={'total': 'estimated'})
+    assert response.status_code == 200
+    assert isinstance(response.json()['total'], int)
+
+
+def test_paginate_invalid(app, client):
+    for params in [
+        {'order': 'password'},
+        {'direction': 'up'},
+        {'total': 'all'},
+        {'limit': -1},
+        {'cursor': 'invalid'},
+        {'cursor': 'WzFd', 'order': 'username'},
+    ]:
+        response = client.get("/1.0/ipbxs", params=params)
+        assert response.status_code == 400, params
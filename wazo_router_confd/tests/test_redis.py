@@ -0,0 +1,239 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from wazo_router_confd.redis import Redis, RedisBatch
+
+
+def test_redis_get_and_set_values(event_loop):
+    async def test():
+        redis = Redis('redis://localhost', flush_on_connect=True)
+        await redis.connect()
+        try:
+            await redis.set_values({'key1': {'a': 1}, 'key2': {'b': 2}})
+            return await redis.get_values(['key1', 'missing', 'key2'])
+        finally:
+            redis.disconnect()
+
+    ret = event_loop.run_until_complete(test())
+    assert [{'a': 1}, None, {'b': 2}] == ret
+
+
+def test_redis_batch(event_loop):
+    async def test():
+        redis = Redis('redis://localhost', flush_on_connect=True)
+        await redis.connect()
+        try:
+            await redis.set_value('key1', {'a': 1})
+            batch = RedisBatch(redis)
+            first = await batch.get_values(['key1', 'key2'])
+            batch.set_value('key2', {'b': 2})
+            # reads are served by the batch, writes are sent on commit
+            second = await batch.get_values(['key1', 'key2'])
+            before_commit = await redis.get_value('key2')
+            await batch.commit()
+            after_commit = await redis.get_value('key2')
+            return first, second, before_commit, after_commit
+        finally:
+            redis.disconnect()
+
+    first, second, before_commit, after_commit = event_loop.run_until_complete(test())
+    assert [{'a': 1}, None] == first
+    assert [{'a': 1}, {'b': 2}] == second
+    assert before_commit is None
+    assert {'b': 2} == after_commit
+
+
+def test_redis_codecs():
+    from uuid import UUID
+
+    from wazo_router_confd.redis import get_codec
+
+    value = dict(
+        success=True,
+        tenant_uuid=UUID('5a6c0c40-b481-41bb-a41a-75d1cc25ff34'),
+        ipbx_id=1,
+        domain=None,
+    )
+    for name in ('json', 'msgpack'):
+        codec = get_codec(name)
+        assert codec.decode(codec.encode(value)) == dict(
+            value, tenant_uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34'
+        )
+
+
+def test_redis_codecs_do_not_share_entries(event_loop):
+    from wazo_router_confd.redis import get_codec
+
+    async def test():
+        json_redis = Redis('redis://localhost', flush_on_connect=True)
+        msgpack_redis = Redis('redis://localhost', codec=get_codec('msgpack'))
+        await json_redis.connect()
+        await msgpack_redis.connect()
+        try:
+            await json_redis.set_value('key', {'codec': 'json'})
+            await msgpack_redis.set_value('key', {'codec': 'msgpack'})
+            return (
+                await json_redis.get_value('key'),
+                await msgpack_redis.get_values(['key']),
+            )
+        finally:
+            json_redis.disconnect()
+            msgpack_redis.disconnect()
+
+    json_value, msgpack_values = event_loop.run_until_complete(test())
+    assert {'codec': 'json'} == json_value
+    assert [{'codec': 'msgpack'}] == msgpack_values
+
+
+def test_redis_local_cache(event_loop):
+    async def test():
+        redis = Redis('redis://localhost', flush_on_connect=True, local_cache_size=1)
+        await redis.connect()
+        try:
+            await redis.set_values({'key1': {'a': 1}, 'key2': {'b': 2}})
+            # the local cache keeps the most recently used value only
+            local_values = dict(redis.local_cache.values)
+            await redis.pool.set(redis.get_key('key2'), redis.codec.encode({'b': 3}))
+            return local_values, await redis.get_values(['key1', 'key2'])
+        finally:
+            redis.disconnect()
+
+    local_values, values = event_loop.run_until_complete(test())
+    assert {'key2': {'b': 2}} == local_values
+    assert [{'a': 1}, {'b': 2}] == values
+
+
+def test_redis_flushdb_once(event_loop):
+    async def test():
+        redis = Redis('redis://localhost', flush_on_connect=True)
+        other = Redis('redis://localhost')
+        await redis.connect()
+        await other.connect()
+        try:
+            await redis.set_value('key1', {'a': 1})
+            await redis.flushdb_once('1')
+            await redis.set_value('key2', {'b': 2})
+            # already flushed for this name by another process
+            await other.flushdb_once('1')
+            kept = await other.get_value('key2')
+            await other.flushdb_once('2')
+            return kept, await redis.get_values(['key1', 'key2'])
+        finally:
+            redis.disconnect()
+            other.disconnect()
+
+    kept, values = event_loop.run_until_complete(test())
+    assert {'b': 2} == kept
+    assert [None, None] == values
+
+
+def test_invalidation_bus(event_loop):
+    import asyncio
+
+    from wazo_router_confd.redis import InvalidationBus
+
+    async def test():
+        redis1 = Redis('redis://localhost', flush_on_connect=True)
+        redis2 = Redis('redis://localhost', local_cache_size=10)
+        await redis1.connect()
+        await redis2.connect()
+        bus1 = InvalidationBus(redis1, poll_interval=60)
+        bus2 = InvalidationBus(redis2, poll_interval=60)
+        received = []
+        bus2.add_handler(received.append)
+        await bus1.start()
+        await bus2.start()
+        try:
+            await asyncio.sleep(0.1)
+            await bus1.publish(['ipbx'])
+            # a missed message is detected by the gap in the sequence
+            await redis1.pool.incr('wazo-router-confd:invalidation-sequence')
+            await bus1.publish(['domains'])
+            for _ in range(50):
+                if len(received) >= 2:
+                    break
+                await asyncio.sleep(0.1)
+            return received
+        finally:
+            await bus1.stop()
+            await bus2.stop()
+            redis1.disconnect()
+            redis2.disconnect()
+
+    received = event_loop.run_until_complete(test())
+    assert [['ipbx'], None] == received
+
+
+def test_circuit_breaker(event_loop):
+    import asyncio
+
+    from wazo_router_confd.redis import CircuitBreaker, CircuitBreakerOpen
+
+    async def fail():
+        raise ConnectionError()
+
+    async def hang():
+        await asyncio.sleep(1)
+
+    async def succeed():
+        return 'ok'
+
+    async def call(breaker, factory):
+        try:
+            return await breaker.call(factory)
+        except CircuitBreakerOpen:
+            return 'open'
+        except (ConnectionError, asyncio.TimeoutError):
+            return 'failed'
+
+    async def test():
+        breaker = CircuitBreaker(
+            timeout=0.01, failure_threshold=0.5, window_size=4, reset_timeout=0.05
+        )
+        results = [
+            await call(breaker, factory) for factory in (succeed, fail, hang, fail)
+        ]
+        # the breaker is open, calls are not attempted
+        results.append(await call(breaker, succeed))
+        await asyncio.sleep(0.06)
+        # half-open, a failed probe opens the breaker again
+        results.append(await call(breaker, fail))
+        results.append(await call(breaker, succeed))
+        await asyncio.sleep(0.06)
+        results.append(await call(breaker, succeed))
+        results.append(breaker.state)
+        return results
+
+    results = event_loop.run_until_complete(test())
+    assert [
+        'ok',
+        'failed',
+        'failed',
+        'failed',
+        'open',
+        'failed',
+        'open',
+        'ok',
+        'closed',
+    ] == results
+
+
+def test_redis_unavailable(event_loop):
+    async def test():
+        # nothing listens on this port
+        redis = Redis('redis://localhost:1', local_cache_size=10)
+        await redis.connect()
+        try:
+            await redis.set_values({'key1': {'a': 1}})
+            await redis.set_value('key2', {'b': 2})
+            values = await redis.get_values(['key1', 'key2', 'key3'])
+            await redis.flushdb()
+            return values, await redis.get_value('key1'), redis.breaker.state
+        finally:
+            redis.disconnect()
+
+    values, value, state = event_loop.run_until_complete(test())
+    # values are served by the local cache while REDIS is unavailable
+    assert [{'a': 1}, {'b': 2}, None] == values
+    assert value is None
+    assert 'open' == state
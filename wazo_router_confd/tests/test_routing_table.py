@@ -0,0 +1,164 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import time
+
+import pytest  # type: ignore
+
+from starlette.testclient import TestClient
+
+
+def test_routing_table_lookups(tmp_path):
+    from wazo_router_confd.routing_table import RoutingTable, write_routing_table
+
+    path = str(tmp_path / 'routing.table')
+    entries = {'ipbx:%d' % i: {'id': i} for i in range(100)}
+    entries['domain:testdomain.com'] = [[1, '5a6c0c40-b481-41bb-a41a-75d1cc25ff34']]
+    write_routing_table(path, entries, 42)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+    table = RoutingTable(path)
+    assert table.revision == 42
+    assert table.count == 101
+    assert table.get('ipbx:0') == {'id': 0}
+    assert table.get('ipbx:99') == {'id': 99}
+    assert table.get('domain:testdomain.com') == [
+        [1, '5a6c0c40-b481-41bb-a41a-75d1cc25ff34']
+    ]
+    assert table.get('ipbx:100') is None
+    assert table.get('') is None
+    assert table.get('zzz') is None
+
+    # the file is replaced, the mapping of the previous one stays readable
+    write_routing_table(path, {'ipbx:1': {'id': 1, 'port': 5080}}, 43)
+    assert table.get('ipbx:99') == {'id': 99}
+    assert RoutingTable(path).get('ipbx:1') == {'id': 1, 'port': 5080}
+    assert [name for name in os.listdir(str(tmp_path))] == ['routing.table']
+
+
+def test_routing_table_manager(tmp_path):
+    from wazo_router_confd.redis import InvalidationBus, Redis
+    from wazo_router_confd.routing_table import RoutingTableManager, get_revision
+    from wazo_router_confd.routing_table import write_routing_table
+
+    path = str(tmp_path / 'routing.table')
+    manager = RoutingTableManager(
+        path, None, InvalidationBus(Redis('redis://localhost')), check_interval=0.1
+    )
+    manager.remap()
+    assert manager.current() is None
+    write_routing_table(path, {}, get_revision())
+    manager.remap()
+    table = manager.current()
+    assert table is not None
+    manager.invalidate(['cdrs'])
+    assert manager.current() is table
+    # the table is not used until a new one is published
+    manager.invalidate(['dids'])
+    assert manager.current() is None
+    write_routing_table(path, {}, get_revision(time.time() + 1))
+    manager.remap()
+    assert manager.current() is not None
+    assert manager.current() is not table
+
+
+@pytest.fixture(scope="function")
+def routing_table_app(database_uri, tmp_path):
+    from wazo_router_confd.app import get_app
+
+    config = dict(
+        database_uri=database_uri,
+        redis_uri='redis://localhost',
+        redis_flush_on_connect=True,
+        database_upgrade=True,
+        routing_table_path=str(tmp_path / 'routing.table'),
+        routing_table_check_interval=0.05,
+    )
+    return get_app(config)
+
+
+def test_kamailio_routing_from_routing_table(routing_table_app):
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.carrier import Carrier
+    from wazo_router_confd.models.carrier_trunk import CarrierTrunk
+    from wazo_router_confd.models.domain import Domain
+    from wazo_router_confd.models.ipbx import IPBX
+    from wazo_router_confd.models.did import DID
+    from wazo_router_confd.models.tenant import Tenant
+
+    app = routing_table_app
+    session = SessionLocal(bind=app.engine)
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    domain = Domain(domain='testdomain.com', tenant=tenant)
+    ipbx = IPBX(
+        tenant=tenant,
+        domain=domain,
+        customer=1,
+        ip_fqdn='mypbx.com',
+        registered=True,
+        username='user',
+        password='password',
+    )
+    carrier = Carrier(name='carrier', tenant=tenant)
+    carrier_trunk = CarrierTrunk(
+        name='carrier_trunk1', carrier=carrier, sip_proxy='proxy.somedomain.com'
+    )
+    did = DID(
+        did_regex=r'^39[0-9]+$',
+        did_prefix='39',
+        tenant=tenant,
+        ipbx=ipbx,
+        carrier_trunk=carrier_trunk,
+    )
+    session.add_all([tenant, domain, ipbx, carrier, carrier_trunk, did])
+    session.commit()
+
+    def route(to_uri):
+        response = client.post(
+            "/1.0/kamailio/routing",
+            json={
+                "event": "sip-routing",
+                "source_ip": "10.0.0.1",
+                "source_port": 5060,
+                "call_id": "call-id",
+                "from_name": "From name",
+                "from_uri": "sip:100@sourcedomain.com",
+                "from_tag": "from_tag",
+                "to_uri": to_uri,
+                "to_name": "to name",
+                "to_tag": "to_tag",
+            },
+        )
+        assert response.status_code == 200
+        return response.json()['rtjson']
+
+    manager = app.routing_table_manager
+    with TestClient(app) as client:
+        # built at startup
+        table = manager.current()
+        assert table is not None
+        assert table.get('did:39')[0][0] == ipbx.id
+        routes = route("sip:39123456789@dummy.com")['routes']
+        assert routes[0]['dst_uri'] == 'sip:mypbx.com:5060'
+        assert route("sip:40123456789@dummy.com") == {'success': False}
+
+        response = client.put(
+            "/1.0/ipbxs/%d" % ipbx.id,
+            json={'domain_id': domain.id, 'ip_fqdn': 'mypbx.com', 'port': 5070},
+        )
+        assert response.status_code == 200
+        # the lookups go to the database until the table is republished
+        assert manager.current() is None
+        routes = route("sip:39123456789@dummy.com")['routes']
+        assert routes[0]['dst_uri'] == 'sip:mypbx.com:5070'
+        for _ in range(100):
+            if manager.current() is not None:
+                break
+            # the test client runs the event loop during the requests only
+            client.get("/status")
+            time.sleep(0.05)
+        assert manager.current() is not table
+        assert manager.current().get('ipbx:%d' % ipbx.id)['port'] == 5070
+        routes = route("sip:100@testdomain.com")['routes']
+        assert routes[0]['dst_uri'] == 'sip:mypbx.com:5070'
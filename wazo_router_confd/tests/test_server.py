@@ -0,0 +1,83 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import requests
+
+
+def test_get_worker_config():
+    from wazo_router_confd.server import get_worker_config
+
+    config = dict(database_pool_min_size=2, database_pool_max_size='40')
+    assert get_worker_config(config, 4) == dict(
+        database_pool_min_size=1, database_pool_max_size=10
+    )
+    assert get_worker_config({}, 2) == dict(
+        database_pool_min_size=1, database_pool_max_size=5
+    )
+
+
+def get_worker_pids(url: str, count: int = 50) -> set:
+    pids = set()
+    for _ in range(count):
+        pids.add(requests.get(url, timeout=5).json()['pid'])
+    return pids
+
+
+def wait_for(url: str):
+    for _ in range(100):
+        try:
+            return requests.get(url, timeout=1)
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise AssertionError("%s is not reachable" % url)
+
+
+def test_supervisor():
+    import uvicorn  # type: ignore
+
+    from fastapi import FastAPI
+
+    from wazo_router_confd.server import Supervisor
+
+    app = FastAPI()
+
+    @app.get("/pid")
+    def get_pid():
+        return {'pid': os.getpid()}
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.set_inheritable(True)
+    port = sock.getsockname()[1]
+    url = 'http://127.0.0.1:%d/pid' % port
+
+    supervisor = Supervisor(
+        uvicorn.Config(app, host='127.0.0.1', port=port, loop='asyncio'), 2
+    )
+    parent = multiprocessing.get_context('fork').Process(
+        target=supervisor.run, args=(sock,)
+    )
+    parent.start()
+    try:
+        wait_for(url)
+        pids = get_worker_pids(url)
+        assert 1 <= len(pids) <= 2
+        assert parent.pid not in pids
+        # a reload replaces every worker, without failing a request
+        os.kill(parent.pid, signal.SIGHUP)
+        for _ in range(200):
+            new_pids = get_worker_pids(url, 10)
+            if not new_pids & pids:
+                break
+        assert not new_pids & pids
+    finally:
+        os.kill(parent.pid, signal.SIGTERM)
+        parent.join(10)
+        sock.close()
+    assert parent.exitcode == 0
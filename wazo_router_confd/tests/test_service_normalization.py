@@ -94,3 +94,58 @@ def test_normalize_e164_to_local_number(app, database_uri, event_loop):
 
     ret = event_loop.run_until_complete(test())
     assert '+36011625234' == ret
+
+
+def test_compiled_normalization_profile():
+    from wazo_router_confd.services.normalization import CompiledNormalizationProfile
+
+    profile = CompiledNormalizationProfile(
+        dict(
+            id=1,
+            revision='1',
+            name='profile 1',
+            country_code='39',
+            always_intl_prefix_plus=True,
+            rules=[
+                dict(
+                    id=1,
+                    rule_type=1,
+                    priority=1,
+                    match_regex=r'^0(.+)',
+                    match_prefix='0',
+                    replace_regex=r'39\1',
+                ),
+                dict(
+                    id=2,
+                    rule_type=1,
+                    priority=0,
+                    match_regex=r'^00(.+)',
+                    match_prefix='00',
+                    replace_regex=r'\1',
+                ),
+                dict(
+                    id=3,
+                    rule_type=2,
+                    priority=0,
+                    match_regex=r'^39(.+)',
+                    match_prefix='39',
+                    replace_regex=r'0\1',
+                ),
+            ],
+        )
+    )
+    # rules are applied in priority order, whatever their prefix length
+    assert '3911625234' == profile.normalize_local_number_to_e164('011 625234')
+    assert '3311625234' == profile.normalize_local_number_to_e164('003311625234')
+    assert '+0011625234' == profile.normalize_e164_to_local_number('39011625234')
+    assert '+44123' == profile.normalize_e164_to_local_number('44123')
+
+
+def test_compiled_normalization_profile_is_reused_until_changed():
+    from wazo_router_confd.services.normalization import compile_normalization_profile
+
+    profile = dict(id=1, revision='1', name='profile 1', rules=[])
+    compiled_profile = compile_normalization_profile(profile)
+    assert compiled_profile is compile_normalization_profile(dict(profile))
+    profile['revision'] = '2'
+    assert compiled_profile is not compile_normalization_profile(profile)
@@ -20,3 +20,21 @@ def test_hash_ha1():
     #
     result = password.hash_ha1("username", "realm", "password")
     assert result is not None
+
+
+def test_password_hasher():
+    from wazo_router_confd.consul import run_sync
+    from wazo_router_confd.services import password
+
+    hasher = password.PasswordHasher(processes=2)
+    passwords = ["password%d" % i for i in range(5)] + [None]
+    try:
+        hashed = run_sync(hasher.hash_all(passwords))
+        assert hasher.executor is not None
+    finally:
+        run_sync(hasher.stop())
+    assert hashed[-1] is None
+    assert all(
+        password.verify(stored, provided)
+        for stored, provided in zip(hashed[:-1], passwords[:-1])
+    )
@@ -8,14 +8,22 @@ from uuid import uuid4
 from fastapi.exceptions import HTTPException
 
 from wazo_router_confd.auth import Principal
-from wazo_router_confd.database import SessionLocal
-from wazo_router_confd.services.tenant import get_uuid
+from wazo_router_confd.services.tenant import get_tenant_by_uuid, get_uuid
 
 
-def test_get_uuid_with_principal(app):
+@pytest.fixture(scope="function")
+def db(app, event_loop):
+    async_db = app.async_db
+    event_loop.run_until_complete(async_db.connection_pool.connect())
+    event_loop.run_until_complete(async_db.connect())
+    yield async_db
+    async_db.connection_pool.pool.close()
+    event_loop.run_until_complete(async_db.connection_pool.pool.wait_closed())
+
+
+def test_get_uuid_with_principal(db, event_loop):
     uuid = uuid4()
 
-    session = SessionLocal(bind=app.engine)
     principal = Principal(
         auth_id="auth_id",
         uuid="uuid",
@@ -23,25 +31,21 @@ def test_get_uuid_with_principal(app):
         tenant_uuids=[str(uuid)],
         token="token",
     )
-    res = get_uuid(principal, session, None)
+    res = event_loop.run_until_complete(get_uuid(principal, db, None))
     assert res == uuid
 
 
-def test_get_uuid_with_principal_none(app):
+def test_get_uuid_with_principal_none(db, event_loop):
     uuid = uuid4()
 
-    session = SessionLocal(bind=app.engine)
     principal = None
-    res = get_uuid(principal, session, uuid)
+    res = event_loop.run_until_complete(get_uuid(principal, db, uuid))
     assert res == uuid
 
 
-def test_get_uuid_mismatch_with_principal(app):
+def test_get_uuid_mismatch_with_principal(db, event_loop):
     uuid = uuid4()
 
-    session = SessionLocal(bind=app.engine)
-    session = SessionLocal(bind=app.engine)
-
     uuid_principal = str(uuid4())
     principal = Principal(
         auth_id="auth_id",
@@ -51,13 +55,47 @@ def test_get_uuid_mismatch_with_principal(app):
         token="token",
     )
     with pytest.raises(HTTPException):
-        get_uuid(principal, session, uuid)
+        event_loop.run_until_complete(get_uuid(principal, db, uuid))
 
 
-def test_get_uuid_with_principal_none_and_empty_field(app):
+def test_get_uuid_with_principal_none_and_empty_field(db, event_loop):
     uuid = None
 
-    session = SessionLocal(bind=app.engine)
     principal = None
     with pytest.raises(HTTPException):
-        get_uuid(principal, session, uuid)
+        event_loop.run_until_complete(get_uuid(principal, db, uuid))
+
+
+def test_get_uuid_in_transaction(db, event_loop):
+    uuid = uuid4()
+    tables = []
+    db.add_listener(tables.append)
+
+    async def test():
+        async with db.transaction():
+            await get_uuid(None, db, uuid)
+            # the statements of the transaction share its connection
+            assert await get_tenant_by_uuid(db, str(uuid)) is not None
+            assert tables == []
+        assert tables == ['tenants']
+
+    event_loop.run_until_complete(test())
+    tenant = event_loop.run_until_complete(get_tenant_by_uuid(db, str(uuid)))
+    assert tenant is not None
+
+
+def test_get_uuid_in_transaction_rollback(db, event_loop):
+    uuid = uuid4()
+    tables = []
+    db.add_listener(tables.append)
+
+    async def test():
+        async with db.transaction():
+            await get_uuid(None, db, uuid)
+            raise RuntimeError("rollback")
+
+    with pytest.raises(RuntimeError):
+        event_loop.run_until_complete(test())
+    assert tables == []
+    tenant = event_loop.run_until_complete(get_tenant_by_uuid(db, str(uuid)))
+    assert tenant is None
@@ -0,0 +1,169 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import time
+
+from starlette.testclient import TestClient
+
+from wazo_router_confd.schemas.kamailio import AuthRequest, RoutingRequest
+
+
+def get_routing_request(to_uri: str, call_id: str) -> RoutingRequest:
+    return RoutingRequest(
+        source_ip='10.0.0.1',
+        call_id=call_id,
+        from_name='From name',
+        from_uri='sip:100@sourcedomain.com',
+        to_uri=to_uri,
+    )
+
+
+def test_traffic_recorder(tmp_path):
+    from wazo_router_confd.warmup import TrafficRecorder
+
+    path = str(tmp_path / 'traffic.json')
+    recorder = TrafficRecorder(path, size=2)
+    recorder.record(get_routing_request('sip:39123@dummy.com', 'call-1'))
+    recorder.record(get_routing_request('sip:39123@dummy.com', 'call-2'))
+    recorder.record(get_routing_request('sip:39456@dummy.com', 'call-3'))
+    recorder.record(AuthRequest(source_ip='10.0.0.2'))
+    recorder.record(AuthRequest(source_ip='10.0.0.3', username='user', password='x'))
+    assert len(recorder.requests) == 3
+    recorder.save()
+    assert recorder.requests == {}
+
+    requests = recorder.load()
+    assert len(requests) == 2
+    assert requests[0].to_uri == 'sip:39123@dummy.com'
+    assert requests[0].call_id is None
+
+    # the recorded counts decay, the recent traffic comes first
+    for _ in range(3):
+        recorder.record(AuthRequest(source_ip='10.0.0.2'))
+    recorder.save()
+    requests = recorder.load()
+    assert requests[0] == AuthRequest(source_ip='10.0.0.2')
+    assert requests[1].to_uri == 'sip:39123@dummy.com'
+
+
+def test_warmup_kamailio_caches(database_uri, tmp_path, event_loop):
+    import aioredis  # type: ignore
+
+    from wazo_router_confd.app import get_app
+    from wazo_router_confd.database import SessionLocal
+    from wazo_router_confd.models.carrier import Carrier
+    from wazo_router_confd.models.carrier_trunk import CarrierTrunk
+    from wazo_router_confd.models.domain import Domain
+    from wazo_router_confd.models.ipbx import IPBX
+    from wazo_router_confd.models.tenant import Tenant
+    from wazo_router_confd.services.kamailio import (
+        get_auth_redis_key,
+        get_routing_redis_key,
+    )
+    from wazo_router_confd.warmup import TrafficRecorder
+
+    recorder = TrafficRecorder(str(tmp_path / 'traffic.json'))
+    routing_request = get_routing_request('sip:100@testdomain.com', 'call-1')
+    recorder.record(routing_request)
+    recorder.save()
+
+    app = get_app(
+        dict(
+            database_uri=database_uri,
+            redis_uri='redis://localhost',
+            redis_flush_on_connect=True,
+            database_upgrade=True,
+            warmup_kamailio_caches=True,
+            warmup_concurrency=2,
+            warmup_traffic_path=recorder.path,
+        )
+    )
+    session = SessionLocal(bind=app.engine)
+    tenant = Tenant(name='fabio', uuid='5a6c0c40-b481-41bb-a41a-75d1cc25ff34')
+    domain = Domain(domain='testdomain.com', tenant=tenant)
+    ipbx = IPBX(
+        tenant=tenant,
+        domain=domain,
+        customer=1,
+        ip_fqdn='mypbx.com',
+        ip_address='10.0.0.2',
+        registered=True,
+    )
+    carrier = Carrier(name='carrier', tenant=tenant)
+    carrier_trunk = CarrierTrunk(
+        name='carrier_trunk1',
+        carrier=carrier,
+        sip_proxy='proxy.somedomain.com',
+        ip_address='10.0.0.3',
+    )
+    session.add_all([tenant, domain, ipbx, carrier, carrier_trunk])
+    session.commit()
+
+    try:
+        with TestClient(app) as client:
+            # the service does not wait for the warmup of the entries
+            assert client.get("/status").status_code == 204
+            for _ in range(100):
+                status = client.get("/status/warmup").json()
+                if status['state'] == 'done':
+                    break
+                time.sleep(0.01)
+            assert status['ready'] is True
+            assert status['total'] == 3
+            assert status['done'] == 3
+            assert status['failed'] == 0
+
+            async def get_cached_keys(keys):
+                redis = await aioredis.create_redis('redis://localhost')
+                try:
+                    return [key for key in keys if await redis.exists(key)]
+                finally:
+                    redis.close()
+                    await redis.wait_closed()
+
+            codec_version = app.redis.codec.version
+            keys = [
+                '%s:%s' % (codec_version, key)
+                for key in (
+                    get_routing_redis_key(routing_request),
+                    get_auth_redis_key(AuthRequest(source_ip='10.0.0.3')),
+                    get_auth_redis_key(
+                        AuthRequest(source_ip='10.0.0.2', domain='testdomain.com')
+                    ),
+                )
+            ]
+            assert event_loop.run_until_complete(get_cached_keys(keys)) == keys
+
+            response = client.post("/1.0/kamailio/auth", json={'source_ip': '10.0.0.3'})
+            assert response.json()['carrier_trunk_id'] == carrier_trunk.id
+        # the traffic of the run has been saved
+        assert len(recorder.load()) == 2
+    finally:
+        session.query(Tenant).delete()
+        session.commit()
+        session.close()
+
+
+def test_warmup_preload_failed(event_loop):
+    from fastapi import FastAPI
+
+    from wazo_router_confd.warmup import Warmup
+
+    warmup = Warmup(FastAPI(), preload_retry_interval=0.01)
+    statuses = []
+
+    async def preload():
+        statuses.append(warmup.get_status())
+        if len(statuses) < 3:
+            raise Exception("The database is not available")
+
+    setattr(warmup, 'preload', preload)
+    event_loop.run_until_complete(warmup.run())
+    # not reported ready until a preload succeeds
+    assert statuses[0]['ready'] is False
+    assert statuses[0]['error'] is None
+    assert statuses[1]['ready'] is False
+    assert statuses[1]['error'] == "The database is not available"
+    assert len(statuses) == 3
+    assert warmup.ready is True
+    assert warmup.get_status()['error'] is None
@@ -0,0 +1,387 @@
+# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import fcntl
+import logging
+import os
+
+from contextlib import AsyncExitStack
+from json import dump, load
+from time import monotonic
+from typing import Dict, List, Optional, Tuple, Union
+from uuid import uuid4
+
+from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from wazo_router_confd.database import AiopgConnectionPool, AsyncDatabase
+from wazo_router_confd.redis import RedisBatch
+from wazo_router_confd.schemas import kamailio as kamailio_schema
+from wazo_router_confd.services import kamailio as kamailio_service
+
+
+logger = logging.getLogger(__name__)
+
+KamailioRequest = Union[kamailio_schema.AuthRequest, kamailio_schema.RoutingRequest]
+
+
+async def prepare_lookup_statements(pool: AiopgConnectionPool):
+    # hold the connections opened at startup, so that each one is prepared
+    async with AsyncExitStack() as stack:
+        connections = [
+            await stack.enter_async_context(pool.acquire())
+            for _ in range(pool.min_size)
+        ]
+        for conn in connections:
+            async with conn.cursor() as cur:
+                for statement in kamailio_service.lookup_statements:
+                    if cur.raw.connection not in statement.connections:
+                        await statement.prepare(cur)
+
+
+async def preload_normalization_profiles(async_db: AsyncDatabase, batch: RedisBatch):
+    async with async_db.connection_pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT id FROM normalization_profiles ORDER BY id")
+            normalization_profile_ids = [row[0] async for row in cur]
+        # compiled in the process and cached in Redis
+        await kamailio_service.get_normalization_profiles_by_ids(
+            conn, batch, normalization_profile_ids
+        )
+
+
+async def get_configured_auth_requests(
+    async_db: AsyncDatabase,
+) -> List[kamailio_schema.AuthRequest]:
+    """The authentications by source address of the carrier trunks and ipbxs."""
+    async with async_db.connection_pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT DISTINCT ip_address FROM carrier_trunks "
+                "WHERE ip_address IS NOT NULL ORDER BY ip_address"
+            )
+            requests = [
+                kamailio_schema.AuthRequest(source_ip=ip_address)
+                async for ip_address, in cur
+            ]
+            await cur.execute(
+                "SELECT DISTINCT ipbx.ip_address, domains.domain "
+                "FROM ipbx JOIN domains ON (ipbx.domain_id = domains.id) "
+                "WHERE ipbx.ip_address IS NOT NULL ORDER BY domains.domain"
+            )
+            requests.extend(
+                [
+                    kamailio_schema.AuthRequest(source_ip=ip_address, domain=domain)
+                    async for ip_address, domain in cur
+                ]
+            )
+    return requests
+
+
+def get_request_key(request: KamailioRequest) -> str:
+    if isinstance(request, kamailio_schema.AuthRequest):
+        return kamailio_service.get_auth_redis_key(request)
+    return kamailio_service.get_routing_redis_key(request)
+
+
+class TrafficRecorder(object):
+    """Count the kamailio requests by cache entry.
+
+    The workers periodically merge their counts into a file, older counts
+    halved at each merge, and the most frequent requests are warmed up at the
+    next startup.
+    """
+
+    path: str
+    size: int
+    save_interval: float
+    requests: Dict[str, list]
+    task: Optional[asyncio.Future]
+
+    def __init__(self, path: str, size: int = 1000, save_interval: float = 60.0):
+        self.path = path
+        self.size = size
+        self.save_interval = save_interval
+        self.requests = {}
+        self.task = None
+
+    def record(self, request: KamailioRequest):
+        if getattr(request, 'password', None):
+            # the cache entry of an authentication does not depend on the
+            # password, it must not be computed without it
+            return
+        key = get_request_key(request)
+        entry = self.requests.get(key)
+        if entry is not None:
+            entry[0] += 1
+            return
+        if len(self.requests) >= self.size * 4:
+            self.requests = dict(self.get_top(self.requests))
+        kind = 'auth' if isinstance(request, kamailio_schema.AuthRequest) else 'routing'
+        # the fields identifying a call are not part of the cache entry
+        value = request.dict(exclude={'call_id', 'from_tag', 'to_tag'})
+        self.requests[key] = [1, kind, value]
+
+    def get_top(self, requests: Dict[str, list]) -> List[Tuple[str, list]]:
+        return sorted(requests.items(), key=lambda item: -item[1][0])[: self.size]
+
+    def read(self) -> Dict[str, list]:
+        try:
+            with open(self.path) as f:
+                return dict(load(f))
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.warning("Recorded traffic %s can not be read: %s", self.path, e)
+            return {}
+
+    def load(self) -> List[KamailioRequest]:
+        return [
+            kamailio_schema.AuthRequest(**value)
+            if kind == 'auth'
+            else kamailio_schema.RoutingRequest(**value)
+            for _, (_, kind, value) in self.get_top(self.read())
+        ]
+
+    def save(self):
+        requests, self.requests = self.requests, {}
+        if not requests:
+            return
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            merged = self.read()
+            for entry in merged.values():
+                entry[0] /= 2
+            for key, (count, kind, value) in requests.items():
+                entry = merged.setdefault(key, [0, kind, value])
+                entry[0] += count
+            tmp_path = '%s.%s.tmp' % (self.path, uuid4().hex)
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                dump(self.get_top(merged), f)
+            os.replace(tmp_path, self.path)
+
+    async def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await run_in_threadpool(self.save)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            try:
+                await run_in_threadpool(self.save)
+            except Exception as e:
+                logger.warning("Recorded traffic %s can not be saved: %s", self.path, e)
+
+
+class Warmup(object):
+    """Load the kamailio caches in the background after startup.
+
+    With the preload, the service is not reported ready on /status before the
+    statements are prepared and the normalization profiles loaded, so that
+    the clients and Consul wait for a loaded instance; a failed preload is
+    retried, and its error reported on /status/warmup. The auth and routing
+    entries are then computed with a bounded concurrency, the progress is
+    reported on /status/warmup.
+    """
+
+    app: FastAPI
+    preload_caches: bool
+    warmup_entries: bool
+    concurrency: int
+    recorder: Optional[TrafficRecorder]
+    preload_retry_interval: float
+    ready: bool
+    state: str
+    error: Optional[str]
+    total: int
+    done: int
+    failed: int
+    started_at: Optional[float]
+    duration: Optional[float]
+    task: Optional[asyncio.Future]
+
+    def __init__(
+        self,
+        app: FastAPI,
+        preload_caches: bool = True,
+        warmup_entries: bool = False,
+        concurrency: int = 4,
+        recorder: Optional[TrafficRecorder] = None,
+        preload_retry_interval: float = 5.0,
+    ):
+        self.app = app
+        self.preload_caches = preload_caches
+        self.warmup_entries = warmup_entries
+        self.concurrency = concurrency
+        self.recorder = recorder
+        self.preload_retry_interval = preload_retry_interval
+        self.ready = not preload_caches
+        self.state = 'pending'
+        self.error = None
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.started_at = None
+        self.duration = None
+        self.task = None
+
+    def get_databases(self) -> List[AsyncDatabase]:
+        replica_set = getattr(self.app, 'replica_set', None)
+        if replica_set is None:
+            return [getattr(self.app, 'async_db')]
+        return [replica_set.primary] + list(replica_set.replicas)
+
+    def get_status(self) -> dict:
+        return dict(
+            ready=self.ready,
+            state=self.state,
+            error=self.error,
+            total=self.total,
+            done=self.done,
+            failed=self.failed,
+            duration=(
+                self.duration
+                if self.duration is not None or self.started_at is None
+                else monotonic() - self.started_at
+            ),
+        )
+
+    async def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        self.started_at = monotonic()
+        if self.preload_caches:
+            self.state = 'preloading'
+            while not self.ready:
+                try:
+                    await self.preload()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # still not ready, until a preload succeeds
+                    logger.warning("Kamailio caches preload failed: %s", e)
+                    self.error = str(e) or repr(e)
+                    await asyncio.sleep(self.preload_retry_interval)
+                    continue
+                self.ready = True
+                self.error = None
+            logger.info("Kamailio caches preloaded")
+        if self.warmup_entries:
+            self.state = 'warming'
+            try:
+                await self.warmup()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Kamailio caches warmup failed: %s", e)
+            logger.info(
+                "Kamailio caches warmed up, %d entries, %d failed",
+                self.done,
+                self.failed,
+            )
+        self.state = 'done'
+        self.duration = monotonic() - self.started_at
+
+    async def preload(self):
+        for database in self.get_databases():
+            await prepare_lookup_statements(database.connection_pool)
+        batch = RedisBatch(getattr(self.app, 'redis'))
+        await preload_normalization_profiles(getattr(self.app, 'async_db'), batch)
+        await batch.commit()
+
+    async def get_requests(self) -> List[KamailioRequest]:
+        requests: List[KamailioRequest] = []
+        if self.recorder is not None:
+            requests.extend(await run_in_threadpool(self.recorder.load))
+        requests.extend(
+            await get_configured_auth_requests(getattr(self.app, 'async_db'))
+        )
+        # one request per cache entry, the recorded traffic first
+        return list(
+            {
+                get_request_key(request): request for request in reversed(requests)
+            }.values()
+        )[::-1]
+
+    async def compute(self, request: KamailioRequest):
+        pool = getattr(self.app, 'replica_set').choose().connection_pool
+        redis = getattr(self.app, 'redis')
+        if isinstance(request, kamailio_schema.AuthRequest):
+            await kamailio_service.auth(pool, redis, request=request)
+            return
+        manager = getattr(self.app, 'routing_table_manager', None)
+        await kamailio_service.routing(
+            pool,
+            redis,
+            request=request,
+            table=manager.current() if manager is not None else None,
+        )
+
+    async def warmup(self):
+        requests = await self.get_requests()
+        self.total = len(requests)
+        queue: asyncio.Queue = asyncio.Queue()
+        for request in requests:
+            queue.put_nowait(request)
+
+        async def worker():
+            while not queue.empty():
+                request = queue.get_nowait()
+                try:
+                    await self.compute(request)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.debug("Kamailio cache warmup of %s failed: %s", request, e)
+                    self.failed += 1
+                self.done += 1
+
+        await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+
+
+def get_traffic_recorder(request: Request) -> Optional[TrafficRecorder]:
+    return getattr(request.state, 'traffic_recorder', None)
+
+
+def setup_warmup(app: FastAPI, config: dict) -> FastAPI:
+    recorder = None
+    if config.get('warmup_traffic_path'):
+        recorder = TrafficRecorder(
+            config['warmup_traffic_path'],
+            size=int(config.get('warmup_traffic_size') or 1000),
+            save_interval=float(config.get('warmup_traffic_save_interval') or 60.0),
+        )
+        setattr(app, 'traffic_recorder', recorder)
+        app.add_event_handler("startup", recorder.start)
+        app.add_event_handler("shutdown", recorder.stop)
+    preload_caches = bool(config.get('preload_kamailio_caches'))
+    warmup_entries = bool(config.get('warmup_kamailio_caches'))
+    if not preload_caches and not warmup_entries:
+        return app
+    warmup = Warmup(
+        app,
+        preload_caches=preload_caches,
+        warmup_entries=warmup_entries,
+        concurrency=int(config.get('warmup_concurrency') or 4),
+        recorder=recorder,
+    )
+    setattr(app, 'warmup', warmup)
+    app.add_event_handler("startup", warmup.start)
+    app.add_event_handler("shutdown", warmup.stop)
+    return app